@@ -0,0 +1,182 @@
+import json
+import hashlib
+import threading
+import logging
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+from app.config import REQUEST_COALESCING
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    """Collapse whitespace so trivially different spellings of a request share a key"""
+    return " ".join(str(text).split())
+
+
+def coalescing_key(*parts: Any) -> str:
+    """Stable hash of the inputs that determine a result (input, criteria, model, sampling params)"""
+    encoded = json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+
+class _Flight:
+    """One in-flight computation and everything it has produced so far"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.items: List[Any] = []
+        self.done = False
+        self.error = None
+        self.waiters = 0
+
+
+class RequestCoalescer:
+    """
+    Single-flight execution of identical concurrent requests.
+
+    The first request for a key starts the computation; requests for the same key that
+    arrive while it is running wait for it and receive the same result (or exception)
+    instead of starting their own. Nothing is cached: once a computation has finished,
+    the next request for its key runs again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights: Dict[Tuple[str, str], _Flight] = {}
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    def _count(self, namespace: str, stat: str):
+        # Caller holds self.lock
+        counts = self.stats.setdefault(namespace, {"executed": 0, "coalesced": 0, "errors": 0})
+        counts[stat] += 1
+
+    def _join(self, namespace: str, key: str) -> Tuple[_Flight, bool]:
+        """Get the flight for a key, creating it if there is none; returns (flight, is_leader)"""
+        with self.lock:
+            flight = self.flights.get((namespace, key))
+            if flight is not None:
+                self._count(namespace, "coalesced")
+                with flight.condition:
+                    flight.waiters += 1
+                return flight, False
+            flight = _Flight()
+            self.flights[(namespace, key)] = flight
+            self._count(namespace, "executed")
+            return flight, True
+
+    def _finish(self, namespace: str, key: str, flight: _Flight, error: BaseException = None):
+        with self.lock:
+            self.flights.pop((namespace, key), None)
+            if error is not None:
+                self._count(namespace, "errors")
+        with flight.condition:
+            flight.error = error
+            flight.done = True
+            flight.condition.notify_all()
+        if flight.waiters:
+            logger.info(f"Coalesced {flight.waiters} identical {namespace} request(s) into one")
+
+    def run(self, namespace: str, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        Run fn once for all concurrent callers with the same key.
+
+        Args:
+            namespace: Kind of request (used for metrics)
+            key: Hash of everything that determines the result (see coalescing_key)
+            fn: Computes the result
+
+        Returns:
+            Tuple of (result, shared) where shared is True if the result was computed
+            for another caller. Shared results are the same object, so do not mutate them.
+            Use a namespace of its own for stream(): a flight started by stream() holds
+            every streamed item, and run() would return the last one.
+        """
+        if not REQUEST_COALESCING:
+            return fn(), False
+
+        flight, is_leader = self._join(namespace, key)
+        if is_leader:
+            try:
+                result = fn()
+            except BaseException as e:
+                self._finish(namespace, key, flight, e)
+                raise
+            flight.items.append(result)
+            self._finish(namespace, key, flight)
+            return result, False
+
+        with flight.condition:
+            while not flight.done:
+                flight.condition.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.items[-1], True
+
+    def stream(self, namespace: str, key: str, factory: Callable[[], Iterator[Any]]) -> Tuple[Iterator[Any], bool]:
+        """
+        Share one streamed computation between all concurrent callers with the same key.
+
+        The stream is produced by a background thread, so every caller, including the one
+        that started it, receives all items from the beginning and may stop reading at any
+        time without affecting the others.
+
+        Returns:
+            Tuple of (iterator, shared) where shared is True if the stream was started for
+            another caller
+        """
+        if not REQUEST_COALESCING:
+            return factory(), False
+
+        flight, is_leader = self._join(namespace, key)
+        if is_leader:
+            def produce():
+                try:
+                    for item in factory():
+                        with flight.condition:
+                            flight.items.append(item)
+                            flight.condition.notify_all()
+                except BaseException as e:
+                    logger.error(f"Error in coalesced {namespace} stream: {e}")
+                    self._finish(namespace, key, flight, e)
+                    return
+                self._finish(namespace, key, flight)
+
+            threading.Thread(target=produce, name=f"coalesced-{namespace}", daemon=True).start()
+        return self._follow(flight), not is_leader
+
+    @staticmethod
+    def _follow(flight: _Flight) -> Iterator[Any]:
+        """Yield a flight's items as they are produced, then raise its error if it failed"""
+        index = 0
+        while True:
+            with flight.condition:
+                while index >= len(flight.items) and not flight.done:
+                    flight.condition.wait()
+                items = flight.items[index:]
+                done = flight.done
+            for item in items:
+                yield item
+            index += len(items)
+            if done and index >= len(flight.items):
+                if flight.error is not None:
+                    raise flight.error
+                return
+
+    def get_state(self) -> Dict[str, Any]:
+        """Get executed vs coalesced request counts per kind of request"""
+        with self.lock:
+            state = {}
+            for namespace, counts in self.stats.items():
+                total = counts["executed"] + counts["coalesced"]
+                state[namespace] = {
+                    **counts,
+                    "hit_rate": round(counts["coalesced"] / total, 3) if total else 0.0,
+                    "in_flight": sum(1 for ns, _ in self.flights if ns == namespace)
+                }
+            return {"enabled": REQUEST_COALESCING, "requests": state}
+
+
+# Create singleton instance
+request_coalescer = RequestCoalescer()
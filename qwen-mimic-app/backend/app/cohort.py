@@ -0,0 +1,153 @@
+import os
+import json
+import sqlite3
+import logging
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Upper bound on rows listed per section of an admission summary
+CONTEXT_MAX_ROWS = 25
+
+# Line that introduces the patient information of an assessment prompt
+PATIENT_INFORMATION_HEADER = "Patient information:"
+
+
+def select_cohort(db_path: str, where: Optional[str] = None, sql: Optional[str] = None,
+                  limit: Optional[int] = None) -> List[Tuple[int, int]]:
+    """
+    Select the admissions of a cohort from the MIMIC SQLite database.
+
+    Args:
+        db_path: Path to the MIMIC-IV SQLite database
+        where: SQL condition on the admissions table, e.g. "admission_type = 'URGENT'"
+        sql: Full query returning hadm_id and subject_id columns (instead of where)
+        limit: Maximum number of admissions
+
+    Returns:
+        (hadm_id, subject_id) pairs ordered by hadm_id
+    """
+    if sql is None:
+        sql = "SELECT hadm_id, subject_id FROM admissions"
+        if where:
+            sql += f" WHERE {where}"
+    query = f"SELECT DISTINCT hadm_id, subject_id FROM ({sql.strip().rstrip(';')}) ORDER BY hadm_id"
+    if limit:
+        query += f" LIMIT {int(limit)}"
+
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        return [(int(hadm_id), int(subject_id)) for hadm_id, subject_id in conn.execute(query)]
+    finally:
+        conn.close()
+
+
+def _section(conn: sqlite3.Connection, title: str, query: str, params: tuple) -> Optional[str]:
+    """One section of an admission summary, or None if the table is missing or empty"""
+    try:
+        rows = conn.execute(query, params).fetchmany(CONTEXT_MAX_ROWS)
+    except sqlite3.OperationalError as e:
+        logger.debug(f"Skipping {title}: {e}")
+        return None
+    if not rows:
+        return None
+    return f"{title}: " + "; ".join(", ".join(str(v) for v in row if v not in (None, "")) for row in rows)
+
+
+def admission_context(conn: sqlite3.Connection, hadm_id: int) -> str:
+    """Summary of an admission from the MIMIC tables, used as the patient information in the prompt"""
+    sections = [
+        _section(conn, "Admission",
+                 "SELECT admission_type, admission_location, discharge_location, admittime, dischtime, "
+                 "CASE WHEN hospital_expire_flag = 1 THEN 'died in hospital' END "
+                 "FROM admissions WHERE hadm_id = ?", (hadm_id,)),
+        _section(conn, "Patient",
+                 "SELECT p.gender, 'age ' || p.anchor_age FROM patients p "
+                 "JOIN admissions a ON a.subject_id = p.subject_id WHERE a.hadm_id = ?", (hadm_id,)),
+        _section(conn, "Diagnoses (ICD)",
+                 "SELECT icd_code FROM diagnoses_icd WHERE hadm_id = ? ORDER BY seq_num", (hadm_id,)),
+        _section(conn, "Procedures (ICD)",
+                 "SELECT icd_code FROM procedures_icd WHERE hadm_id = ? ORDER BY seq_num", (hadm_id,)),
+        _section(conn, "Prescriptions",
+                 "SELECT DISTINCT drug FROM prescriptions WHERE hadm_id = ? ORDER BY starttime", (hadm_id,)),
+    ]
+    return "\n".join(s for s in sections if s)
+
+
+def build_prompt(criteria_name: str, hadm_id: int, context: str) -> str:
+    """Assessment prompt for one admission, in the format the reasoner extracts the id from"""
+    prompt = f"Evaluate {criteria_name} for admission={hadm_id}."
+    if context:
+        prompt += f"\n{PATIENT_INFORMATION_HEADER}\n{context}"
+    return prompt
+
+
+class CohortCheckpoint:
+    """
+    Append-only JSONL record of finished assessments, so an interrupted run can resume.
+
+    Every result is flushed and fsynced as soon as it arrives; a line cut off by a
+    kill is ignored on resume. If the output path ends in .parquet, results are
+    checkpointed to a .jsonl file next to it and exported to Parquet.
+    """
+
+    def __init__(self, output_path: str):
+        self.output_path = output_path
+        self.parquet = output_path.endswith(".parquet")
+        self.path = output_path[:-len(".parquet")] + ".jsonl" if self.parquet else output_path
+        self._file = None
+
+    def load(self) -> List[Dict[str, Any]]:
+        """Records written so far"""
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        with open(self.path, encoding="utf-8") as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    logger.warning(f"Ignoring incomplete checkpoint line {line_number} in {self.path}")
+        return records
+
+    def completed(self, criteria_name: str, retry_errors: bool = False) -> Set[int]:
+        """hadm_ids already assessed under a criteria set (failed ones too, unless retry_errors)"""
+        return {
+            record["hadm_id"] for record in self.load()
+            if record.get("criteria") == criteria_name and not (retry_errors and record.get("error"))
+        }
+
+    def append(self, record: Dict[str, Any]):
+        """Write one result durably"""
+        if self._file is None:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+            # A kill mid-write leaves a partial last line; start on a fresh one
+            if self._file.tell() > 0:
+                with open(self.path, "rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        self._file.write("\n")
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def export_parquet(self) -> Optional[str]:
+        """Write all records to the Parquet output (requires pandas and pyarrow)"""
+        if not self.parquet:
+            return None
+        import pandas as pd
+        records = self.load()
+        # Later records for the same admission (retries) replace earlier ones
+        latest = {(r.get("hadm_id"), r.get("criteria")): r for r in records}
+        pd.DataFrame(list(latest.values())).to_parquet(self.output_path, index=False)
+        return self.output_path
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
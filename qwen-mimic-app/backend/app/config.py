@@ -8,3 +8,151 @@ load_dotenv()
 # DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 MIMIC_DB_PATH = os.getenv("MIMIC_DB_PATH")
 LLM_MODEL_NAME = os.getenv("LLM_MODEL_NAME", "MedAgentReasoner-3B-Chat")
+
+# Directory of the SQLite files the backend writes (response cache, criteria and score stores),
+# kept out of the source tree; each path below can also be set on its own
+DATA_DIR = os.getenv("DATA_DIR", "data")
+
+# Model registry: total RAM budget for loaded models (0 = unlimited)
+# and idle time after which an unused model is unloaded (0 = never)
+MODEL_MEMORY_BUDGET_GB = float(os.getenv("MODEL_MEMORY_BUDGET_GB", "0"))
+MODEL_IDLE_TTL_SECONDS = float(os.getenv("MODEL_IDLE_TTL_SECONDS", "0"))
+
+# Model types loaded by the background warm-up after startup (comma-separated, empty = none)
+WARMUP_MODELS = [m.strip() for m in os.getenv("WARMUP_MODELS", "reasoning,sql").split(",") if m.strip()]
+
+# Weight precision for each model type on CPU: fp32, bf16 or int8 (dynamic quantization)
+CPU_PRECISION = {
+    "reasoning": os.getenv("REASONING_CPU_PRECISION", "fp32").lower(),
+    "sql": os.getenv("SQL_CPU_PRECISION", "fp32").lower(),
+}
+
+# Optional draft model per model type for assisted (speculative) decoding on the
+# transformers backend; must share the main model's tokenizer (e.g. Qwen/Qwen2.5-0.5B-Instruct)
+DRAFT_MODEL = {
+    "reasoning": os.getenv("REASONING_DRAFT_MODEL", ""),
+    "sql": os.getenv("SQL_DRAFT_MODEL", ""),
+}
+# Number of tokens the draft model proposes per verification step
+DRAFT_LOOKAHEAD = int(os.getenv("DRAFT_LOOKAHEAD", "5"))
+
+# Adaptive max_tokens per task from observed output lengths (percentile * headroom,
+# capped at the task default) once enough outputs have been seen
+ADAPTIVE_TOKEN_BUDGET = os.getenv("ADAPTIVE_TOKEN_BUDGET", "true").lower() == "true"
+TOKEN_BUDGET_PERCENTILE = float(os.getenv("TOKEN_BUDGET_PERCENTILE", "95"))
+TOKEN_BUDGET_HEADROOM = float(os.getenv("TOKEN_BUDGET_HEADROOM", "1.25"))
+TOKEN_BUDGET_MIN_SAMPLES = int(os.getenv("TOKEN_BUDGET_MIN_SAMPLES", "20"))
+
+# Server-side conversation sessions: expire after SESSION_TTL_SECONDS, offload the
+# KV cache to disk after SESSION_OFFLOAD_SECONDS idle, and keep at most
+# SESSION_CACHE_BUDGET_GB of KV caches in memory (0 = unlimited)
+SESSION_TTL_SECONDS = float(os.getenv("SESSION_TTL_SECONDS", "3600"))
+SESSION_OFFLOAD_SECONDS = float(os.getenv("SESSION_OFFLOAD_SECONDS", "300"))
+SESSION_CACHE_BUDGET_GB = float(os.getenv("SESSION_CACHE_BUDGET_GB", "4"))
+SESSION_CACHE_DIR = os.getenv("SESSION_CACHE_DIR", "")
+
+# Token budget for reasoning prompts; older turns are compacted to fit (0 = no limit)
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "6000"))
+# Most recent user/assistant turns that are always kept verbatim
+HISTORY_KEEP_RECENT_TURNS = int(os.getenv("HISTORY_KEEP_RECENT_TURNS", "2"))
+
+# Quantized GGUF weights per model type for the llama.cpp CPU backend: a path to a .gguf
+# file or 'repo_id:filename' on the Hugging Face Hub (empty = not available for that model)
+GGUF_MODEL = {
+    "reasoning": os.getenv("REASONING_GGUF_MODEL", ""),
+    "sql": os.getenv("SQL_GGUF_MODEL", ""),
+}
+# llama.cpp context window, CPU threads (0 = llama.cpp default) and GPU-offloaded layers
+LLAMA_CPP_CONTEXT = int(os.getenv("LLAMA_CPP_CONTEXT", "10000"))
+LLAMA_CPP_THREADS = int(os.getenv("LLAMA_CPP_THREADS", "0"))
+LLAMA_CPP_GPU_LAYERS = int(os.getenv("LLAMA_CPP_GPU_LAYERS", "0"))
+
+# Fast loading from pre-staged local checkpoints: model directories are looked up as
+# MODEL_STAGING_DIR/<org>--<name> (or the model name itself as a path), and their
+# safetensors shards are memory-mapped by FAST_LOAD_WORKERS threads (0 = one per shard)
+FAST_MODEL_LOADING = os.getenv("FAST_MODEL_LOADING", "true").lower() == "true"
+MODEL_STAGING_DIR = os.getenv("MODEL_STAGING_DIR", "")
+FAST_LOAD_WORKERS = int(os.getenv("FAST_LOAD_WORKERS", "0"))
+
+# Compiled decoding on the transformers backend: static pre-allocated KV cache plus a
+# torch.compile'd decode step, compiled at load time for each cache length in the bucket list.
+# Replaces session KV cache reuse and assisted decoding for generations that fit a bucket.
+COMPILED_DECODE = os.getenv("COMPILED_DECODE", "false").lower() == "true"
+COMPILED_CACHE_BUCKETS = [int(b) for b in os.getenv("COMPILED_CACHE_BUCKETS", "2048,4096,8192").split(",") if b.strip()]
+
+# CPU thread layout: profile written by autotune_cpu.py, number of uvicorn workers sharing
+# the host (defaults to uvicorn's WEB_CONCURRENCY), and an optional fixed worker index
+# (-1 = workers claim core slices automatically)
+CPU_TUNING_PROFILE = os.getenv("CPU_TUNING_PROFILE", "cpu_profile.json")
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", os.getenv("WEB_CONCURRENCY", "1")))
+CPU_WORKER_INDEX = int(os.getenv("CPU_WORKER_INDEX", "-1"))
+
+# Memory governor: limit for this process (0 = cgroup limit or physical RAM), fractions of it
+# at which generations are shortened and caches released (soft) or requests refused (hard),
+# how often RSS is checked, how far below the soft limit RSS must fall before the background
+# check releases caches again, the largest query result kept in memory, and the KV cache size
+# per token assumed for models that do not report one (Qwen2.5-3B in fp32)
+MEMORY_LIMIT_GB = float(os.getenv("MEMORY_LIMIT_GB", "0"))
+MEMORY_SOFT_LIMIT = float(os.getenv("MEMORY_SOFT_LIMIT", "0.8"))
+MEMORY_HARD_LIMIT = float(os.getenv("MEMORY_HARD_LIMIT", "0.92"))
+MEMORY_RESUME_MARGIN = float(os.getenv("MEMORY_RESUME_MARGIN", "0.05"))
+MEMORY_CHECK_SECONDS = float(os.getenv("MEMORY_CHECK_SECONDS", "5"))
+MEMORY_MAX_RESULT_MB = float(os.getenv("MEMORY_MAX_RESULT_MB", "256"))
+KV_BYTES_PER_TOKEN = int(os.getenv("KV_BYTES_PER_TOKEN", "73728"))
+
+# Single-flight coalescing: identical concurrent /query and /diagnose requests (same normalized
+# input, criteria, model and sampling params) share one in-flight generation or SQL execution
+REQUEST_COALESCING = os.getenv("REQUEST_COALESCING", "true").lower() == "true"
+
+# Deterministic reasoning: greedy decoding by default (requests can also opt in per call), with
+# greedy responses kept in a persistent SQLite cache of at most RESPONSE_CACHE_MAX_ENTRIES
+# (least recently used evicted first; empty path or 0 = no cache)
+DETERMINISTIC_REASONING = os.getenv("DETERMINISTIC_REASONING", "false").lower() == "true"
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", os.path.join(DATA_DIR, "response_cache.sqlite"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "5000"))
+
+# /diagnose/batch: prompts generated together per micro-batch (halved under memory pressure)
+# and the largest number of prompts accepted in one request
+DIAGNOSE_BATCH_SIZE = int(os.getenv("DIAGNOSE_BATCH_SIZE", "8"))
+DIAGNOSE_BATCH_MAX_PROMPTS = int(os.getenv("DIAGNOSE_BATCH_MAX_PROMPTS", "500"))
+
+# Custom criteria and the active criteria key are kept in SQLite so they survive restarts and are
+# shared by all workers; each process checks for changes at most every CRITERIA_SYNC_SECONDS
+# (empty path = kept in memory for this process only)
+CRITERIA_STORE_PATH = os.getenv("CRITERIA_STORE_PATH", os.path.join(DATA_DIR, "criteria.sqlite"))
+CRITERIA_SYNC_SECONDS = float(os.getenv("CRITERIA_SYNC_SECONDS", "1.0"))
+
+# Score new assessments with the criteria's compiled rules over the MIMIC measurements first; cases
+# the rules decide (whatever the unrecorded measurements) are answered without the model
+RULE_PRECHECK = os.getenv("RULE_PRECHECK", "false").lower() == "true"
+
+# Rules only count as met together when they are met within one charttime window of this many
+# hours (24 = per calendar day); 0 evaluates them over the whole admission
+RULE_WINDOW_HOURS = float(os.getenv("RULE_WINDOW_HOURS", "24"))
+
+# Incremental re-scoring: measurement ranges, rule scores and the changes feed are kept in
+# SQLite at SCORE_STORE_PATH (empty = in memory); with RESCORE_INTERVAL_SECONDS > 0 new
+# chartevents/labevents rows in the MIMIC database are picked up on that interval
+SCORE_STORE_PATH = os.getenv("SCORE_STORE_PATH", os.path.join(DATA_DIR, "criteria_scores.sqlite"))
+RESCORE_INTERVAL_SECONDS = float(os.getenv("RESCORE_INTERVAL_SECONDS", "0"))
+
+# Per-admission lab/chart timelines: built from the MIMIC SQLite database, or from a Parquet event
+# table when TIMELINE_PARQUET_PATH is set, and cached for up to TIMELINE_CACHE_SIZE admissions per kind
+TIMELINE_PARQUET_PATH = os.getenv("TIMELINE_PARQUET_PATH", "")
+TIMELINE_CACHE_SIZE = int(os.getenv("TIMELINE_CACHE_SIZE", "2000"))
+
+# Token budget of the patient information put into a prompt (admission summary plus the
+# measurements the criteria needs); longer histories are thinned to fit (0 = no limit)
+PATIENT_CONTEXT_MAX_TOKENS = int(os.getenv("PATIENT_CONTEXT_MAX_TOKENS", "1024"))
+
+# Patient context prefetch: once a prompt names a patient, their admissions are encoded as
+# compact patient information (see PATIENT_CONTEXT_MAX_TOKENS) in the background
+# (PATIENT_PREFETCH_WORKERS threads) and kept for PATIENT_CACHE_TTL_SECONDS in an LRU of
+# PATIENT_CACHE_SIZE records; a record that is ready when a turn starts is added to its prompt.
+# Deterministic reasoning steps wait up to PATIENT_PREFETCH_WAIT_SECONDS for it so that a
+# repeated assessment sees the same prompt
+PATIENT_PREFETCH = os.getenv("PATIENT_PREFETCH", "true").lower() == "true"
+PATIENT_PREFETCH_WORKERS = int(os.getenv("PATIENT_PREFETCH_WORKERS", "8"))
+PATIENT_CACHE_SIZE = int(os.getenv("PATIENT_CACHE_SIZE", "256"))
+PATIENT_CACHE_TTL_SECONDS = float(os.getenv("PATIENT_CACHE_TTL_SECONDS", "600"))
+PATIENT_PREFETCH_WAIT_SECONDS = float(os.getenv("PATIENT_PREFETCH_WAIT_SECONDS", "10"))
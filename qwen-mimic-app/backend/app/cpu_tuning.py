@@ -0,0 +1,184 @@
+import os
+import sys
+import json
+import logging
+import tempfile
+from typing import Any, Dict, List, Optional
+
+from app.config import CPU_TUNING_PROFILE, CPU_WORKERS, CPU_WORKER_INDEX
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Lock files used by uvicorn workers to claim a distinct core slice
+SLOT_LOCK_PREFIX = os.path.join(tempfile.gettempdir(), "medinsight_cpu_slot")
+
+# Thread pool sizes read by OpenMP (torch, llama.cpp) and the BLAS libraries behind numpy
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+# Settings applied to this process, reported by GET /cpu-profile
+_applied: Dict[str, Any] = {}
+# Open lock file holding this worker's slot for the lifetime of the process
+_slot_file = None
+
+
+def available_cores() -> List[int]:
+    """CPU cores this process may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def load_profile(path: str = CPU_TUNING_PROFILE) -> Optional[Dict[str, Any]]:
+    """Read a tuning profile written by autotune_cpu.py, or None if there is none"""
+    if not path or not os.path.isfile(path):
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable CPU tuning profile {path}: {e}")
+        return None
+
+
+def choose_layout(profile: Optional[Dict[str, Any]], workers: int, num_cores: int) -> Dict[str, Any]:
+    """
+    Pick the thread layout for a number of workers.
+
+    Uses the profile entry for this worker count if the profile was tuned on a host
+    with the same number of cores; otherwise splits the cores evenly between workers.
+    """
+    if profile is not None:
+        if profile.get("cpu_count") != num_cores:
+            logger.warning(f"CPU tuning profile was made for {profile.get('cpu_count')} cores, "
+                           f"this host has {num_cores}; using the default layout")
+        else:
+            layout = profile.get("layouts", {}).get(str(workers))
+            if layout is not None:
+                return dict(layout, source="profile")
+            logger.warning(f"CPU tuning profile has no layout for {workers} workers; using the default layout")
+
+    return {
+        "workers": workers,
+        "threads_per_worker": max(1, num_cores // workers),
+        "interop_threads": 1,
+        "pin": workers > 1,
+        "source": "default"
+    }
+
+
+def worker_cores(cores: List[int], threads_per_worker: int, index: int) -> List[int]:
+    """The slice of cores worker number index is pinned to"""
+    start = (index * threads_per_worker) % len(cores)
+    return [cores[(start + i) % len(cores)] for i in range(min(threads_per_worker, len(cores)))]
+
+
+def claim_worker_slot(workers: int) -> int:
+    """
+    Claim a worker index between 0 and workers - 1.
+
+    CPU_WORKER_INDEX is used if set. Otherwise each uvicorn worker takes the first free
+    slot by holding an exclusive lock on its slot file; a restarted worker reclaims the
+    slot its predecessor released on exit.
+    """
+    global _slot_file
+    if CPU_WORKER_INDEX >= 0:
+        return CPU_WORKER_INDEX % workers
+    try:
+        import fcntl
+    except ImportError:
+        return 0
+
+    for index in range(workers):
+        slot_file = open(f"{SLOT_LOCK_PREFIX}_{index}.lock", "w")
+        try:
+            fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            slot_file.close()
+            continue
+        _slot_file = slot_file
+        return index
+
+    logger.warning(f"All {workers} CPU worker slots are taken; sharing slot 0")
+    return 0
+
+
+def pin_process(cores: List[int]) -> bool:
+    """Restrict every thread of this process to the given cores (Linux only)"""
+    if not hasattr(os, "sched_setaffinity"):
+        return False
+    # sched_setaffinity only affects one thread, so apply it to all existing threads;
+    # threads started later inherit the affinity of their creator
+    try:
+        thread_ids = [int(tid) for tid in os.listdir("/proc/self/task")]
+    except OSError:
+        thread_ids = [0]
+    for tid in thread_ids:
+        try:
+            os.sched_setaffinity(tid, cores)
+        except OSError:
+            pass
+    return True
+
+
+def apply_cpu_profile() -> Dict[str, Any]:
+    """
+    Apply the CPU tuning profile to this worker process.
+
+    Pins the process to its core slice and sets the OpenMP/BLAS thread counts. Call it
+    before numpy, pandas or torch are imported, since their thread pools read these
+    variables only once; configure_torch_threads() applies them to torch once it is.
+
+    Returns:
+        The applied settings
+    """
+    cores = available_cores()
+    workers = max(1, CPU_WORKERS)
+    layout = choose_layout(load_profile(), workers, len(cores))
+    index = claim_worker_slot(workers) if workers > 1 else 0
+
+    threads = int(layout["threads_per_worker"])
+    pinned_cores = worker_cores(cores, threads, index) if layout.get("pin") else cores
+    pinned = layout.get("pin", False) and pin_process(pinned_cores)
+
+    # Read by torch, numpy and llama.cpp when their thread pools are created
+    for variable in THREAD_ENV_VARS:
+        os.environ[variable] = str(threads)
+    if "numpy" in sys.modules:
+        logger.warning("numpy was imported before the CPU profile was applied; its thread pool keeps its size")
+
+    _applied.clear()
+    _applied.update({
+        "workers": workers,
+        "worker_index": index,
+        "threads": threads,
+        "interop_threads": int(layout.get("interop_threads", 1)),
+        "cores": pinned_cores if pinned else None,
+        "source": layout["source"],
+        "torch_configured": False
+    })
+    logger.info(f"CPU layout ({layout['source']}): worker {index + 1}/{workers}, {threads} threads"
+                f"{f', pinned to cores {pinned_cores}' if pinned else ''}")
+
+    if "torch" in sys.modules:
+        configure_torch_threads()
+    return dict(_applied)
+
+
+def configure_torch_threads():
+    """Apply the thread counts from apply_cpu_profile() to torch (no-op if it was not applied)"""
+    if not _applied or _applied.get("torch_configured"):
+        return
+    import torch
+    torch.set_num_threads(_applied["threads"])
+    try:
+        torch.set_interop_threads(_applied["interop_threads"])
+    except RuntimeError:
+        # Can only be set before any inter-op parallel work has started
+        logger.warning("Could not set torch interop threads, parallel work has already started")
+    _applied["torch_configured"] = True
+
+
+def get_cpu_settings() -> Dict[str, Any]:
+    """Settings applied to this worker, for monitoring"""
+    return dict(_applied)
@@ -1,5 +1,14 @@
+import os
+import json
+import time
+import sqlite3
+import threading
 import logging
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional
+
+from app.response_cache import response_cache, criteria_hash
+from app.rules import compile_rules
+from app.config import CRITERIA_STORE_PATH, CRITERIA_SYNC_SECONDS
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -15,7 +24,9 @@ DEFAULT_CRITERIA = {
             "- Systolic Blood Pressure (SBP) ≤ 100 mmHg",
             "- Altered mentation (GCS verbal response is not \"Oriented\")"
         ],
-        "threshold": "≥2 => qSOFA"
+        "threshold": "≥2 => qSOFA",
+        # One rule per criterion for scoring without the model (see app/rules.py)
+        "rules": ["resp_rate >= 22", "sbp <= 100", "gcs_verbal < 5"]
     },
     "SIRS": {
         "name": "SIRS",
@@ -26,7 +37,13 @@ DEFAULT_CRITERIA = {
             "- Respiratory rate >20/min or PaCO2 <32 mmHg",
             "- White blood cell count >12,000/mm³ or <4,000/mm³ or >10% immature bands"
         ],
-        "threshold": "≥2 => SIRS"
+        "threshold": "≥2 => SIRS",
+        "rules": [
+            "temperature > 38 or temperature < 36",
+            "heart_rate > 90",
+            "resp_rate > 20 or paco2 < 32",
+            "wbc > 12 or wbc < 4 or bands > 10"
+        ]
     },
     "Sepsis-3": {
         "name": "Sepsis-3",
@@ -40,79 +57,333 @@ DEFAULT_CRITERIA = {
     }
 }
 
-# Active criteria - default to qSOFA
-ACTIVE_CRITERIA_KEY = "qSOFA"
 
-# Custom user-defined criteria
-CUSTOM_CRITERIA = {}
+# Criteria used when none has been selected or the selected one was deleted
+DEFAULT_CRITERIA_KEY = "qSOFA"
+
+# Instructions shared by every criteria set, after the opening question line
+REASONING_INSTRUCTIONS = (
+    "You must conduct reasoning inside <think> and </think> first every time you get new information.\n"
+    "After reasoning, if you find you lack some knowledge, you can call a search engine by <search> query </search>, and it will return the top searched results between <information> and </information>.\n"
+    "You can search as many times as you want. If you find no further external knowledge needed, you can directly provide the answer inside <answer> and </answer> without detailed illustrations. Example: <answer> Assessment complete, patient shows signs of respiratory distress </answer>\n\n"
+)
+
+def build_system_prompt(criteria: Dict[str, Any]) -> str:
+    """System prompt for an assessment against a criteria set"""
+    system_prompt = (
+        f"Answer the {criteria['name']} assessment question based on the criteria provided below.\n"
+        + REASONING_INSTRUCTIONS
+        + f"{criteria['name']} criteria to consider:\n"
+    )
+    
+    # Add each criterion from the configuration
+    for criterion in criteria['criteria']:
+        system_prompt += f"{criterion}\n"
+    
+    # Add threshold if provided (not empty)
+    if 'threshold' in criteria and criteria['threshold'].strip():
+        system_prompt += f"\nThreshold rule: {criteria['threshold']}\n"
+        system_prompt += "Apply this threshold rule in your assessment.\n"
+    else:
+        # If no threshold provided, add guidance to use medical knowledge
+        system_prompt += "\nUse your medical knowledge to reason about these specific criteria and determine their clinical significance.\n"
+    return system_prompt
+
+
+class CompiledCriteria:
+    """One version of a criteria definition, with its system prompt and content hash built once"""
+
+    def __init__(self, key: str, version: int, definition: Dict[str, Any]):
+        self.key = key
+        self.version = version
+        self.definition = definition
+        self.system_prompt = build_system_prompt(definition)
+        self.content_hash = criteria_hash(definition)
+        # Vectorized predicates for scoring without the model, if the definition has rules
+        self.rule_set = compile_rules(definition)
+        # System message token ids per model key
+        self._token_ids: Dict[Any, List[int]] = {}
+
+    def token_ids(self, handler: Any) -> Optional[List[int]]:
+        """
+        Token ids of the formatted system message for a model, tokenized on first use.
+        Returns None if the handler cannot tokenize messages.
+        """
+        model_key = getattr(handler, "key", None)
+        ids = self._token_ids.get(model_key)
+        if ids is None:
+            encode = getattr(handler, "encode_message", None)
+            if encode is None:
+                return None
+            ids = encode("system", self.system_prompt)
+            self._token_ids[model_key] = ids
+        return ids
+
+
+class CriteriaStore:
+    """
+    Singleton store of criteria definitions.
+
+    The built-in definitions in DEFAULT_CRITERIA are version 0. Custom definitions and
+    the active criteria key are kept in SQLite, so they survive restarts and are shared
+    by every worker process. Each change to a custom definition adds a new version; a
+    deletion is recorded as a version without a definition, so version numbers are
+    never reused. The current versions are compiled and kept in memory, and reloaded
+    when another process has committed a change (PRAGMA data_version, checked at most
+    every CRITERIA_SYNC_SECONDS), so a lookup on the request path is a dictionary access.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = super(CriteriaStore, cls).__new__(cls)
+                cls._instance._initialize()
+            return cls._instance
+
+    def _initialize(self):
+        """Initialize the store state; the database is opened on first use."""
+        self.path = CRITERIA_STORE_PATH
+        self.sync_seconds = CRITERIA_SYNC_SECONDS
+        self.state_lock = threading.RLock()
+        self._conn = None
+        self._data_version = None
+        self._checked = None
+        self._compiled: Dict[str, CompiledCriteria] = {
+            key: CompiledCriteria(key, 0, definition) for key, definition in DEFAULT_CRITERIA.items()
+        }
+        self._active_key = DEFAULT_CRITERIA_KEY
+        self.reloads = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        # Caller holds self.state_lock
+        if self._conn is None:
+            if self.path:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self._conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            else:
+                self._conn = sqlite3.connect(":memory:", isolation_level=None, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS criteria_versions ("
+                "key TEXT NOT NULL, version INTEGER NOT NULL, definition TEXT, created REAL NOT NULL, "
+                "PRIMARY KEY (key, version))"
+            )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)")
+        return self._conn
+
+    def _load(self):
+        """Recompile the current version of every definition (caller holds self.state_lock)"""
+        conn = self._connection()
+        rows = conn.execute(
+            "SELECT key, version, definition FROM criteria_versions v "
+            "WHERE version = (SELECT MAX(version) FROM criteria_versions WHERE key = v.key)"
+        ).fetchall()
+        active = conn.execute("SELECT value FROM settings WHERE name = 'active_criteria'").fetchone()
+        self._data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+
+        compiled = {key: self._compiled.get(key) or CompiledCriteria(key, 0, definition)
+                    for key, definition in DEFAULT_CRITERIA.items()}
+        for key, version, definition in rows:
+            if definition is None or key in DEFAULT_CRITERIA:
+                continue
+            current = self._compiled.get(key)
+            # Unchanged versions keep their compiled prompt and token ids
+            if current is not None and current.version == version:
+                compiled[key] = current
+            else:
+                compiled[key] = CompiledCriteria(key, version, json.loads(definition))
+        # Swapped in one assignment so lock-free readers see either the old or the new set
+        self._compiled = compiled
+        self._active_key = active[0] if active else DEFAULT_CRITERIA_KEY
+        self.reloads += 1
+
+    def _sync(self):
+        """Pick up changes committed by other processes, at most every sync_seconds"""
+        now = time.monotonic()
+        if self._checked is not None and now - self._checked < self.sync_seconds:
+            return
+        with self.state_lock:
+            if self._checked is not None and now - self._checked < self.sync_seconds:
+                return
+            try:
+                if self._checked is None:
+                    self._load()
+                elif self._connection().execute("PRAGMA data_version").fetchone()[0] != self._data_version:
+                    self._load()
+                    logger.info("Reloaded criteria changed by another process")
+            except (sqlite3.Error, ValueError) as e:
+                logger.error(f"Error reading criteria store: {e}")
+            self._checked = now
+
+    def get(self, key: str) -> Optional[CompiledCriteria]:
+        """Current compiled version of a criteria definition, or None if there is no such key"""
+        self._sync()
+        return self._compiled.get(key)
+
+    def active_key(self) -> str:
+        """Key of the active criteria, falling back to the default if it no longer exists"""
+        self._sync()
+        key = self._active_key
+        return key if key in self._compiled else DEFAULT_CRITERIA_KEY
+
+    def list(self) -> List[CompiledCriteria]:
+        """Current version of every definition, built-in ones first"""
+        self._sync()
+        return list(self._compiled.values())
+
+    def set_active(self, key: str) -> bool:
+        """Make a criteria definition the active one in every worker"""
+        with self.state_lock:
+            self._sync()
+            if key not in self._compiled:
+                return False
+            conn = self._connection()
+            conn.execute("INSERT OR REPLACE INTO settings VALUES ('active_criteria', ?)", (key,))
+            self._load()
+        return True
+
+    def put(self, key: str, definition: Dict[str, Any]) -> Optional[CompiledCriteria]:
+        """Store a new version of a custom definition; returns None for a built-in key"""
+        if key in DEFAULT_CRITERIA:
+            return None
+        with self.state_lock:
+            self._sync()
+            previous = self._compiled.get(key)
+            self._append_version(key, json.dumps(definition, ensure_ascii=False))
+            self._load()
+            compiled = self._compiled[key]
+        # Responses cached for the replaced definition are no longer valid
+        if previous is not None:
+            response_cache.invalidate_criteria(previous.content_hash)
+        return compiled
+
+    def delete(self, key: str) -> bool:
+        """Delete a custom definition, resetting the active criteria if it was active"""
+        if key in DEFAULT_CRITERIA:
+            return False
+        with self.state_lock:
+            self._sync()
+            previous = self._compiled.get(key)
+            if previous is None:
+                return False
+            self._append_version(key, None)
+            if self._active_key == key:
+                self._connection().execute("DELETE FROM settings WHERE name = 'active_criteria'")
+                logger.info(f"Active criteria reset to default: {DEFAULT_CRITERIA_KEY}")
+            self._load()
+        response_cache.invalidate_criteria(previous.content_hash)
+        return True
+
+    def _append_version(self, key: str, definition: Optional[str]):
+        # Caller holds self.state_lock; BEGIN IMMEDIATE keeps version numbers unique across processes
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute(
+                "SELECT COALESCE(MAX(version), 0) + 1 FROM criteria_versions WHERE key = ?", (key,)
+            ).fetchone()[0]
+            conn.execute("INSERT INTO criteria_versions VALUES (?, ?, ?, ?)", (key, version, definition, time.time()))
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+
+    def versions(self, key: str) -> List[Dict[str, Any]]:
+        """Every stored version of a custom definition, oldest first; deletions have no definition"""
+        with self.state_lock:
+            rows = self._connection().execute(
+                "SELECT version, definition, created FROM criteria_versions WHERE key = ? ORDER BY version", (key,)
+            ).fetchall()
+        return [
+            {"version": version, "definition": json.loads(definition) if definition else None, "created": created}
+            for version, definition, created in rows
+        ]
+
+    def get_state(self) -> Dict[str, Any]:
+        """Get a summary of the store for monitoring"""
+        self._sync()
+        return {
+            "path": self.path or None,
+            "definitions": len(self._compiled),
+            "custom": sum(1 for key in self._compiled if key not in DEFAULT_CRITERIA),
+            "active": self.active_key(),
+            "reloads": self.reloads,
+            "sync_seconds": self.sync_seconds
+        }
+
+
+# Create singleton instance
+criteria_store = CriteriaStore()
 
 def get_criteria_list() -> List[Dict]:
     """Get a list of all available criteria including default and custom ones"""
-    all_criteria = {}
-    all_criteria.update(DEFAULT_CRITERIA)
-    all_criteria.update(CUSTOM_CRITERIA)
     return [
-        {"key": key, "name": data["name"], "description": data["description"]} 
-        for key, data in all_criteria.items()
+        {"key": c.key, "name": c.definition["name"], "description": c.definition["description"], "version": c.version}
+        for c in criteria_store.list()
     ]
 
 def get_active_criteria() -> Dict:
     """Get the currently active criteria configuration"""
-    # First check custom criteria
-    if ACTIVE_CRITERIA_KEY in CUSTOM_CRITERIA:
-        return CUSTOM_CRITERIA[ACTIVE_CRITERIA_KEY]
-    # Then check default criteria
-    if ACTIVE_CRITERIA_KEY in DEFAULT_CRITERIA:
-        return DEFAULT_CRITERIA[ACTIVE_CRITERIA_KEY]
-    # Fallback to qSOFA if key not found
-    return DEFAULT_CRITERIA["qSOFA"]
+    return criteria_store.get(criteria_store.active_key()).definition
+
+def get_active_criteria_key() -> str:
+    """Get the key of the currently active criteria configuration"""
+    return criteria_store.active_key()
+
+def get_criteria(criteria_key: str) -> Optional[Dict]:
+    """Get a criteria configuration by key, or None if there is no such key"""
+    compiled = criteria_store.get(criteria_key)
+    return compiled.definition if compiled is not None else None
+
+def get_compiled_criteria(criteria_key: str) -> Optional[CompiledCriteria]:
+    """Get the current compiled version of a criteria configuration, or None if there is no such key"""
+    return criteria_store.get(criteria_key)
+
+def get_criteria_versions(criteria_key: str) -> List[Dict[str, Any]]:
+    """Get the stored versions of a custom criteria configuration"""
+    return criteria_store.versions(criteria_key)
 
 def set_active_criteria(criteria_key: str) -> bool:
     """Set the active criteria by key"""
-    global ACTIVE_CRITERIA_KEY
-    
-    # Check if key exists in any criteria set
-    if criteria_key in DEFAULT_CRITERIA or criteria_key in CUSTOM_CRITERIA:
-        ACTIVE_CRITERIA_KEY = criteria_key
+    if criteria_store.set_active(criteria_key):
         logger.info(f"Active criteria set to: {criteria_key}")
         return True
     
     logger.error(f"Criteria key not found: {criteria_key}")
     return False
 
-def add_custom_criteria(key: str, name: str, description: str, criteria: List[str], threshold: str) -> bool:
-    """Add a new custom criteria configuration"""
-    global CUSTOM_CRITERIA
-    
-    if key in DEFAULT_CRITERIA:
-        logger.warning(f"Cannot override default criteria key: {key}")
-        return False
-    
+def add_custom_criteria(key: str, name: str, description: str, criteria: List[str], threshold: str,
+                        rules: Optional[List[str]] = None) -> bool:
+    """
+    Add a new custom criteria configuration, or a new version of an existing one.
+    Raises RuleError if rules are given and cannot be compiled.
+    """
     # Store threshold exactly as provided by the user
     # The reasoner will use it if it's not empty
-    CUSTOM_CRITERIA[key] = {
+    definition = {
         "name": name,
         "description": description,
         "criteria": criteria,
         "threshold": threshold or ""  # Store empty string if None
     }
+    if rules:
+        definition["rules"] = rules
+        compile_rules(definition)
+    compiled = criteria_store.put(key, definition)
+    if compiled is None:
+        logger.warning(f"Cannot override default criteria key: {key}")
+        return False
     
-    logger.info(f"Added custom criteria: {key} with threshold: '{threshold or ''}'")
+    logger.info(f"Added custom criteria: {key} version {compiled.version} with threshold: '{threshold or ''}'")
     return True
 
 def delete_custom_criteria(key: str) -> bool:
     """Delete a custom criteria configuration"""
-    global CUSTOM_CRITERIA, ACTIVE_CRITERIA_KEY
-    
-    if key not in CUSTOM_CRITERIA:
+    if not criteria_store.delete(key):
         logger.warning(f"Custom criteria not found: {key}")
         return False
     
-    # If active criteria is being deleted, reset to default
-    if ACTIVE_CRITERIA_KEY == key:
-        ACTIVE_CRITERIA_KEY = "qSOFA"
-        logger.info(f"Active criteria reset to default: {ACTIVE_CRITERIA_KEY}")
-    
-    del CUSTOM_CRITERIA[key]
     logger.info(f"Deleted custom criteria: {key}")
-    return True 
+    return True
@@ -1,5 +1,6 @@
 import asyncio
 import json
+from functools import partial
 from fastapi import APIRouter, HTTPException
 from fastapi.responses import StreamingResponse
 from app.reasoner import LocalReasonerModel
@@ -7,7 +8,14 @@ import logging
 from pydantic import BaseModel, validator
 from typing import Optional, Dict, Any, List, Union
 import re
+import threading
+import time
+from app.config import DIAGNOSE_BATCH_SIZE, DIAGNOSE_BATCH_MAX_PROMPTS
 from app.model_progress import progress_monitor
+from app.sessions import session_store
+from app.criteria import get_criteria
+from app.response_cache import response_cache
+from app.memory_governor import MemoryPressureError
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -16,10 +24,32 @@ logger = logging.getLogger(__name__)
 # Define data models
 class DiagnoseRequest(BaseModel):
     query: str
+    # Greedy decoding and the persistent response cache (default DETERMINISTIC_REASONING)
+    deterministic: Optional[bool] = None
+    # Criteria set for this conversation instead of the globally active one
+    criteria: Optional[str] = None
+
+class MultiCriteriaRequest(BaseModel):
+    query: str
+    # Criteria keys to assess the patient against, e.g. ["qSOFA", "SIRS", "Sepsis-3"]
+    criteria: List[str]
+    deterministic: Optional[bool] = None
+
+class BatchDiagnoseRequest(BaseModel):
+    # One initial prompt per patient, e.g. "Evaluate qSOFA for patient 12345"
+    prompts: List[str]
+    batch_size: Optional[int] = None
+    deterministic: Optional[bool] = None
+    criteria: Optional[str] = None
 
 class ProvideInfoRequest(BaseModel):
     user_response: str
-    conversation_history: Union[str, List[Dict[str, Any]]]
+    # Either a session id returned by /diagnose, or the full conversation history
+    session_id: Optional[str] = None
+    conversation_history: Optional[Union[str, List[Dict[str, Any]]]] = None
+    deterministic: Optional[bool] = None
+    # Criteria set of a conversation sent as history (sessions remember their own)
+    criteria: Optional[str] = None
     
     @validator('conversation_history')
     def validate_conversation_history(cls, v):
@@ -34,8 +64,32 @@ class ProvideInfoRequest(BaseModel):
 
 router = APIRouter()
 
-# Initialize the model once
-local_reasoner = LocalReasonerModel()
+# Shared reasoner instance, created on first use so importing this module stays cheap
+_local_reasoner = None
+_local_reasoner_lock = threading.Lock()
+
+def get_local_reasoner() -> LocalReasonerModel:
+    """Get the shared reasoner, creating it on first use"""
+    global _local_reasoner
+    # The warm-up thread and the first requests may get here at the same time
+    if _local_reasoner is None:
+        with _local_reasoner_lock:
+            if _local_reasoner is None:
+                _local_reasoner = LocalReasonerModel()
+    return _local_reasoner
+
+async def iterate_in_thread(iterator):
+    """
+    Iterate a blocking iterator from async code, fetching each item in a worker thread
+    so model generation does not block the event loop.
+    """
+    loop = asyncio.get_event_loop()
+    sentinel = object()
+    while True:
+        item = await loop.run_in_executor(None, next, iterator, sentinel)
+        if item is sentinel:
+            break
+        yield item
 
 async def generate_response(response_content):
     """
@@ -63,8 +117,12 @@ async def generate_response(response_content):
                 yield f"data: {json.dumps({'type': 'full', 'content': response_content.get('full_response', '')})}\n\n"
                 await asyncio.sleep(0.1)
                 
+            # Session-based conversations only send the messages added by this turn
+            if "conversation_delta" in response_content:
+                yield f"data: {json.dumps({'type': 'conversation_delta', 'content': response_content['conversation_delta'], 'session_id': response_content.get('session_id')})}\n\n"
+                await asyncio.sleep(0.1)
             # Always send conversation history for state tracking - this part is crucial
-            if "conversation_history" in response_content:
+            elif "conversation_history" in response_content:
                 # Log for debugging
                 history_count = len(response_content.get('conversation_history', []))
                 logger.info(f"Sending conversation history with {history_count} messages in stream")
@@ -139,9 +197,14 @@ async def diagnose_test():
 
 @router.post("/diagnose")
 @router.get("/diagnose")
-async def diagnose(request: DiagnoseRequest = None, query: str = None):
+async def diagnose(request: DiagnoseRequest = None, query: str = None, deterministic: Optional[bool] = None,
+                   criteria: Optional[str] = None):
     # Support both POST body and GET query parameter
     user_query = query or (request.query if request else None)
+    if deterministic is None and request is not None:
+        deterministic = request.deterministic
+    if criteria is None and request is not None:
+        criteria = request.criteria
     
     if not user_query:
         raise HTTPException(status_code=400, detail="No query provided")
@@ -161,9 +224,20 @@ async def diagnose(request: DiagnoseRequest = None, query: str = None):
                 async for progress_chunk in stream_loading_progress():
                     yield progress_chunk
             
+            session = None
+            response = None
             try:
-                # Start the reasoning process using process_reasoning with no history
-                response = local_reasoner.process_reasoning(user_query)
+                # Start a server-side session so follow-up turns only send the new input
+                session = session_store.create()
+                yield f"data: {json.dumps({'type': 'session', 'content': session.session_id})}\n\n"
+                
+                # Start the reasoning process with no history, streaming sections as they are generated
+                async for kind, payload in iterate_in_thread(get_local_reasoner().stream_reasoning(
+                        user_query, session=session, deterministic=deterministic, criteria_key=criteria)):
+                    if kind == "section":
+                        yield f"data: {json.dumps({'type': 'section', 'event': payload.type, 'section': payload.section, 'content': payload.text})}\n\n"
+                    else:
+                        response = payload
                 logger.info("Generated initial reasoning response")
                 
                 # Send the model's response
@@ -172,6 +246,11 @@ async def diagnose(request: DiagnoseRequest = None, query: str = None):
             except Exception as e:
                 logger.error(f"Error generating response: {str(e)}")
                 yield f"data: {json.dumps({'type': 'error', 'content': str(e)})}\n\n"
+            finally:
+                # A session whose first turn failed or was abandoned cannot be continued; drop it
+                # rather than leave it holding memory until it expires
+                if session is not None and response is None:
+                    session_store.delete(session.session_id)
         
         # Return the streaming response
         return StreamingResponse(
@@ -186,6 +265,81 @@ async def diagnose(request: DiagnoseRequest = None, query: str = None):
         logger.error(f"Error in /diagnose endpoint: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
 
+@router.post("/diagnose/batch")
+async def diagnose_batch(request: BatchDiagnoseRequest):
+    """
+    Assess many patients at once with batched generation.
+    Streams NDJSON: one 'result' or 'error' line per prompt as its micro-batch finishes,
+    a 'batch' line with the throughput of each micro-batch, and a final 'summary' line.
+    """
+    if not request.prompts:
+        raise HTTPException(status_code=400, detail="No prompts provided")
+    if len(request.prompts) > DIAGNOSE_BATCH_MAX_PROMPTS:
+        raise HTTPException(status_code=400, detail=f"At most {DIAGNOSE_BATCH_MAX_PROMPTS} prompts per request")
+    batch_size = max(1, request.batch_size or DIAGNOSE_BATCH_SIZE)
+    logger.info(f"Processing batch of {len(request.prompts)} prompts in micro-batches of {batch_size}")
+    
+    async def response_stream():
+        start = time.perf_counter()
+        completed = 0
+        failed = 0
+        generated_tokens = 0
+        try:
+            batches = get_local_reasoner().process_batch(
+                request.prompts, batch_size, request.deterministic, criteria_key=request.criteria)
+            async for kind, payload in iterate_in_thread(batches):
+                if kind == "batch":
+                    generated_tokens += payload["generated_tokens"]
+                    yield json.dumps({"type": "batch", **payload}) + "\n"
+                elif "error" in payload:
+                    failed += 1
+                    yield json.dumps({"type": "error", "index": payload["index"],
+                                      "prompt": request.prompts[payload["index"]], "error": payload["error"]}) + "\n"
+                else:
+                    completed += 1
+                    yield json.dumps({"type": "result", "index": payload["index"],
+                                      "prompt": request.prompts[payload["index"]], "result": payload["result"]}) + "\n"
+        except Exception as e:
+            logger.error(f"Error in /diagnose/batch: {str(e)}")
+            yield json.dumps({"type": "error", "error": str(e)}) + "\n"
+        
+        seconds = time.perf_counter() - start
+        yield json.dumps({
+            "type": "summary",
+            "prompts": len(request.prompts),
+            "completed": completed,
+            "errors": failed,
+            "seconds": round(seconds, 3),
+            "prompts_per_second": round(completed / seconds, 3) if seconds > 0 else 0.0,
+            "tokens_per_second": round(generated_tokens / seconds, 2) if seconds > 0 else 0.0
+        }) + "\n"
+    
+    return StreamingResponse(response_stream(), media_type="application/x-ndjson")
+
+@router.post("/diagnose/multi")
+async def diagnose_multi(request: MultiCriteriaRequest):
+    """
+    Assess one patient against several criteria sets in one batched generation.
+    Returns one result per criteria set; each can be continued with /provide_info
+    by sending its conversation_history and criteria_key.
+    """
+    if not request.criteria:
+        raise HTTPException(status_code=400, detail="No criteria provided")
+    unknown = [key for key in request.criteria if get_criteria(key) is None]
+    if unknown:
+        raise HTTPException(status_code=404, detail=f"Criteria not found: {', '.join(unknown)}")
+    try:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            None, get_local_reasoner().process_multi_criteria, request.query, request.criteria, request.deterministic
+        )
+    except ValueError as e:
+        logger.error(f"Validation error in /diagnose/multi: {str(e)}")
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error in /diagnose/multi endpoint: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
+
 @router.post("/provide_info")
 async def provide_info_post(request: ProvideInfoRequest):
     """
@@ -195,7 +349,20 @@ async def provide_info_post(request: ProvideInfoRequest):
     try:
         # Extract data from request
         user_input = request.user_response
-        conversation_history = request.conversation_history
+        loop = asyncio.get_event_loop()
+        
+        if request.session_id:
+            # Server-side session: history and KV cache are already held here
+            session = session_store.get(request.session_id)
+            if session is None:
+                raise HTTPException(status_code=404, detail=f"Session '{request.session_id}' not found or expired")
+            logger.info(f"Continuing session {session.session_id} ({len(session.history)} messages) with: {user_input}")
+            # Generation blocks, so it runs in a worker thread rather than on the event loop
+            return await loop.run_in_executor(None, partial(
+                get_local_reasoner().process_reasoning,
+                user_input, session=session, deterministic=request.deterministic, criteria_key=request.criteria))
+        
+        conversation_history = request.conversation_history or []
         
         # Log what we received for debugging
         logger.info(f"Received user_response: {user_input}")
@@ -228,13 +395,23 @@ async def provide_info_post(request: ProvideInfoRequest):
         logger.info(f"Processing user response via POST: {user_input}")
         logger.info(f"Proceeding with {len(valid_items)} valid messages in conversation history")
         
-        # Continue the reasoning using process_reasoning with conversation history
-        response = local_reasoner.process_reasoning(user_input, conversation_history)
+        # Continue the reasoning using process_reasoning with conversation history, in a worker thread
+        response = await loop.run_in_executor(None, partial(
+            get_local_reasoner().process_reasoning,
+            user_input, conversation_history, deterministic=request.deterministic, criteria_key=request.criteria))
         logger.info("Generated continuation response for POST request")
         
         # Return the full response directly as JSON
         return response
         
+    except HTTPException:
+        raise
+    except ValueError as e:
+        logger.error(f"Validation error in /provide_info: {str(e)}")
+        raise HTTPException(status_code=400, detail=str(e))
+    except MemoryPressureError as e:
+        logger.warning(f"/provide_info refused under memory pressure: {str(e)}")
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         logger.error(f"Error in /provide_info POST endpoint: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
@@ -256,3 +433,25 @@ async def provide_info_get(user_response: str = None):
         detail="The GET endpoint for provide_info cannot properly handle conversation history. "
                "Please use the POST endpoint with conversation_history in the request body."
     )
+
+@router.get("/sessions")
+async def get_sessions():
+    """Get the state of the conversation session store"""
+    return session_store.get_state()
+
+@router.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    """End a conversation session and free its cache"""
+    if not session_store.delete(session_id):
+        raise HTTPException(status_code=404, detail=f"Session '{session_id}' not found")
+    return {"success": True}
+
+@router.get("/response-cache")
+async def get_response_cache():
+    """Get the state of the deterministic response cache"""
+    return response_cache.get_state()
+
+@router.delete("/response-cache")
+async def clear_response_cache():
+    """Remove all cached deterministic responses"""
+    return {"success": True, "removed": response_cache.clear()}
@@ -0,0 +1,171 @@
+import os
+import json
+import mmap
+import time
+import struct
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+import torch
+
+from app.config import MODEL_STAGING_DIR, FAST_LOAD_WORKERS
+from app.model_progress import progress_monitor
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# safetensors dtype names -> torch dtypes
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def find_local_checkpoint(model_name: str) -> Optional[str]:
+    """
+    Find a pre-staged local copy of a model.
+
+    Args:
+        model_name: Hugging Face model id or a local directory
+
+    Returns:
+        The model directory if it holds a config and safetensors weights, else None
+    """
+    candidates = [model_name]
+    if MODEL_STAGING_DIR:
+        # Staged copies use the Hub cache naming, e.g. tossowski--MedAgentReasoner-3B-Chat
+        candidates.append(os.path.join(MODEL_STAGING_DIR, model_name.replace("/", "--")))
+        candidates.append(os.path.join(MODEL_STAGING_DIR, model_name))
+    for path in candidates:
+        if os.path.isfile(os.path.join(path, "config.json")) and list_shards(path):
+            return path
+    return None
+
+
+def list_shards(model_dir: str) -> List[str]:
+    """Safetensors shard files of a checkpoint directory, in index order if there is an index"""
+    index_path = os.path.join(model_dir, "model.safetensors.index.json")
+    if os.path.isfile(index_path):
+        with open(index_path) as f:
+            weight_map = json.load(f)["weight_map"]
+        return [os.path.join(model_dir, name) for name in sorted(set(weight_map.values()))]
+    if not os.path.isdir(model_dir):
+        return []
+    return sorted(
+        os.path.join(model_dir, name) for name in os.listdir(model_dir) if name.endswith(".safetensors")
+    )
+
+
+def mmap_safetensors(path: str, torch_dtype: Optional[torch.dtype] = None) -> Dict[str, torch.Tensor]:
+    """
+    Open a safetensors file as tensors backed by a memory map.
+
+    Pages are read from disk when a tensor is first touched, not when the file is
+    opened. Floating point tensors are converted to torch_dtype if given, which
+    materializes them in memory.
+    """
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+        # Copy-on-write mapping: writable tensors without touching the file
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    if hasattr(mapped, "madvise") and hasattr(mmap, "MADV_WILLNEED"):
+        # Let the kernel start reading ahead while the tensors are set up
+        mapped.madvise(mmap.MADV_WILLNEED)
+
+    data_start = 8 + header_size
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        shape = info["shape"]
+        begin, end = info["data_offsets"]
+        if end == begin:
+            tensor = torch.empty(shape, dtype=dtype)
+        else:
+            tensor = torch.frombuffer(mapped, dtype=dtype, count=(end - begin) // dtype.itemsize,
+                                      offset=data_start + begin).reshape(shape)
+        if torch_dtype is not None and tensor.is_floating_point() and tensor.dtype != torch_dtype:
+            tensor = tensor.to(torch_dtype)
+        tensors[name] = tensor
+    return tensors
+
+
+def load_state_dict_parallel(model_dir: str, torch_dtype: Optional[torch.dtype] = None,
+                             max_workers: int = FAST_LOAD_WORKERS) -> Dict[str, torch.Tensor]:
+    """
+    Load all safetensors shards of a checkpoint in parallel threads.
+
+    Args:
+        model_dir: Directory with the safetensors shards
+        torch_dtype: Optional dtype for floating point weights
+        max_workers: Loader threads (0 = one per shard, up to the CPU count)
+
+    Returns:
+        The merged state dict
+    """
+    shards = list_shards(model_dir)
+    if not shards:
+        raise FileNotFoundError(f"No safetensors shards found in {model_dir}")
+    workers = max_workers or min(len(shards), os.cpu_count() or 1)
+
+    def load_shard(path: str):
+        start = time.perf_counter()
+        tensors = mmap_safetensors(path, torch_dtype)
+        return path, tensors, time.perf_counter() - start
+
+    for path in shards:
+        progress_monitor.update_progress(os.path.basename(path), 0)
+
+    state_dict: Dict[str, torch.Tensor] = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="shard-loader") as executor:
+        futures = [executor.submit(load_shard, path) for path in shards]
+        for future in as_completed(futures):
+            path, tensors, seconds = future.result()
+            state_dict.update(tensors)
+            progress_monitor.update_progress(os.path.basename(path), 100, load_seconds=seconds)
+            logger.info(f"Loaded {os.path.basename(path)} ({len(tensors)} tensors) in {seconds:.2f}s")
+    return state_dict
+
+
+def load_model_fast(model_dir: str, torch_dtype: torch.dtype = torch.float32,
+                    max_workers: int = FAST_LOAD_WORKERS):
+    """
+    Build a causal LM from a local checkpoint without the from_pretrained load path.
+
+    The model skeleton is created with empty (meta) parameters and the memory-mapped
+    weights are assigned to it directly, so no weight is initialized or copied twice.
+
+    Raises:
+        RuntimeError: If the checkpoint does not cover every parameter of the model
+    """
+    from accelerate import init_empty_weights
+    from transformers import AutoConfig, AutoModelForCausalLM
+
+    start = time.perf_counter()
+    config = AutoConfig.from_pretrained(model_dir)
+    with init_empty_weights(include_buffers=False):
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=torch_dtype)
+
+    state_dict = load_state_dict_parallel(model_dir, torch_dtype, max_workers)
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    # Tied weights (e.g. lm_head sharing the embeddings) are not stored twice in the checkpoint
+    model.tie_weights()
+
+    missing = [name for name, param in model.named_parameters() if param.device.type == "meta"]
+    if missing:
+        raise RuntimeError(f"Checkpoint in {model_dir} is missing {len(missing)} parameters, e.g. {missing[:3]}")
+
+    logger.info(f"Fast-loaded {model_dir} in {time.perf_counter() - start:.2f}s")
+    return model
@@ -0,0 +1,133 @@
+import re
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple
+
+from app.config import HISTORY_TOKEN_BUDGET, HISTORY_KEEP_RECENT_TURNS
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Approximate ChatML overhead per message (<|im_start|>role\n ... <|im_end|>\n)
+MESSAGE_OVERHEAD_TOKENS = 5
+
+THINK_PATTERN = re.compile(r"<think>.*?(</think>|$)", re.DOTALL)
+
+# Stands in for an assistant message that was only reasoning, so turns keep alternating
+REASONING_OMITTED = "[reasoning omitted]"
+
+
+def strip_thinking(content: str) -> str:
+    """Remove <think> blocks from an assistant message, keeping searches and answers"""
+    return THINK_PATTERN.sub("", content).strip()
+
+
+def strip_assistant_thinking(messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """Strip the reasoning of every assistant message, keeping a placeholder for reasoning-only ones"""
+    return [
+        {"role": m["role"], "content": strip_thinking(m["content"]) or REASONING_OMITTED} if m["role"] == "assistant" else m
+        for m in messages
+    ]
+
+
+class HistoryManager:
+    """
+    Keeps reasoning prompts within a token budget.
+
+    The system prompt, the original patient question and the most recent turns are
+    always kept verbatim. Older assistant messages lose their <think> blocks first;
+    if the prompt is still over budget, the oldest turns are dropped and replaced by
+    a short note. Token counts come from the model tokenizer and are cached per message;
+    one manager is shared by concurrent requests, so the cache is guarded by a lock.
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int],
+                 token_budget: int = HISTORY_TOKEN_BUDGET,
+                 keep_recent_turns: int = HISTORY_KEEP_RECENT_TURNS,
+                 cache_size: int = 4096):
+        self.count_tokens = count_tokens
+        self.token_budget = token_budget
+        self.keep_recent_turns = keep_recent_turns
+        self.cache_size = cache_size
+        self._token_counts: "OrderedDict[str, int]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def message_tokens(self, message: Dict[str, str]) -> int:
+        """Token count of one message including the chat template overhead"""
+        content = message.get("content", "")
+        key = hashlib.sha1(content.encode("utf-8")).hexdigest()
+        with self._cache_lock:
+            count = self._token_counts.get(key)
+            if count is not None:
+                self._token_counts.move_to_end(key)
+                return count + MESSAGE_OVERHEAD_TOKENS
+        # Tokenize outside the lock; two threads counting the same message get the same answer
+        count = self.count_tokens(content)
+        with self._cache_lock:
+            self._token_counts[key] = count
+            self._token_counts.move_to_end(key)
+            while len(self._token_counts) > self.cache_size:
+                self._token_counts.popitem(last=False)
+        return count + MESSAGE_OVERHEAD_TOKENS
+
+    def total_tokens(self, messages: List[Dict[str, str]]) -> int:
+        return sum(self.message_tokens(m) for m in messages)
+
+    def compact(self, messages: List[Dict[str, str]]) -> Tuple[List[Dict[str, str]], Dict[str, int]]:
+        """
+        Fit a message list into the token budget.
+
+        Args:
+            messages: System prompt, then the conversation, ending with the new user message
+
+        Returns:
+            The compacted messages and stats with prompt tokens before/after and tokens saved
+        """
+        tokens_before = self.total_tokens(messages)
+        stats = {"prompt_tokens_before": tokens_before, "prompt_tokens_after": tokens_before, "prompt_tokens_saved": 0}
+        if self.token_budget <= 0 or tokens_before <= self.token_budget:
+            return messages, stats
+
+        # Split into the pinned head (system prompt + original question), the middle, and the recent tail
+        head_end = 0
+        if head_end < len(messages) and messages[head_end]["role"] == "system":
+            head_end += 1
+        if head_end < len(messages) and messages[head_end]["role"] == "user":
+            head_end += 1
+        # Each turn is a user/assistant pair, plus the new user message at the end
+        tail_start = max(head_end, len(messages) - (2 * self.keep_recent_turns + 1))
+        head, middle, tail = messages[:head_end], messages[head_end:tail_start], messages[tail_start:]
+
+        # 1. Drop the reasoning of older assistant turns
+        middle = strip_assistant_thinking(middle)
+
+        # 2. Drop the oldest turns until the prompt fits; a turn runs up to the next message
+        # with the role of its first one, so the remaining messages still alternate
+        dropped = 0
+        while middle and self.total_tokens(head + middle + tail) > self.token_budget:
+            turn_end = 1
+            while turn_end < len(middle) and middle[turn_end]["role"] != middle[0]["role"]:
+                turn_end += 1
+            middle = middle[turn_end:]
+            dropped += turn_end
+        if dropped:
+            note = {"role": "system", "content": f"[{dropped} earlier messages omitted to fit the context window]"}
+            middle = [note] + middle
+
+        # 3. As a last resort, drop the reasoning of recent turns too (never the newest message)
+        compacted = head + middle + tail
+        if self.total_tokens(compacted) > self.token_budget:
+            tail = strip_assistant_thinking(tail)
+            compacted = head + middle + tail
+
+        tokens_after = self.total_tokens(compacted)
+        if tokens_after > self.token_budget:
+            logger.warning(f"Prompt still has {tokens_after} tokens after compaction (budget {self.token_budget})")
+
+        stats["prompt_tokens_after"] = tokens_after
+        stats["prompt_tokens_saved"] = tokens_before - tokens_after
+        logger.info(f"Compacted history from {tokens_before} to {tokens_after} tokens "
+                    f"({dropped} messages dropped)")
+        return compacted, stats
@@ -1,18 +1,45 @@
+import time
+_import_start = time.perf_counter()
+
+# Pin this worker to its cores and set the OpenMP/BLAS thread counts before numpy,
+# pandas or torch are imported below: their thread pools read them only once, at import
+from app.cpu_tuning import apply_cpu_profile, get_cpu_settings
+apply_cpu_profile()
+
+import asyncio
+import sqlite3
 import logging
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from app.query import get_qwen_generated_code, execute_sql_query
 from app.model_detector import HardwareDetector
+from app.model_registry import model_registry
+from app.memory_governor import memory_governor, MemoryPressureError
+from app.coalescing import request_coalescer
+from app.warmup import run_warmup, startup_monitor
+from app.token_budget import token_budget
 from app.diagnose import router as diagnose_router
+from app.scores import router as scores_router
+from app.rescoring import rescoring_pipeline
 from pydantic import BaseModel
-from typing import List, Dict, Optional
+from typing import Any, List, Dict, Optional
 from app.criteria import (
     get_criteria_list, 
     get_active_criteria, 
     set_active_criteria, 
     add_custom_criteria, 
-    delete_custom_criteria
+    delete_custom_criteria,
+    get_criteria_versions,
+    get_compiled_criteria,
+    get_active_criteria_key
 )
+from app.rules import load_measurements, score_records, score_rows
+from app.cohort import select_cohort
+from app.timelines import timeline_cache
+from app.patient_context import encode_patient_context
+from app.prefetch import patient_prefetcher
+from app.config import MIMIC_DB_PATH
 
 # Set up logging
 logging.basicConfig(
@@ -40,56 +67,49 @@ class CustomCriteriaCreate(BaseModel):
     description: str
     criteria: List[str]
     threshold: str
+    # Optional rule per criterion for scoring without the model, e.g. "resp_rate >= 22"
+    rules: Optional[List[str]] = None
 
 class CriteriaSelection(BaseModel):
     key: str
 
+class CriteriaScoreRequest(BaseModel):
+    # Measurements per patient, e.g. [{"hadm_id": 1, "resp_rate": 24, "sbp": 95, "gcs_verbal": 5}]
+    patients: Optional[List[Dict[str, Any]]] = None
+    # Otherwise admissions are loaded from the MIMIC database: given ids, or a condition on admissions
+    hadm_ids: Optional[List[int]] = None
+    where: Optional[str] = None
+    limit: Optional[int] = None
+
+class TimelinesRequest(BaseModel):
+    hadm_ids: List[int]
+    # 'lab' and/or 'chart'
+    kinds: List[str] = ["lab"]
+
+# Time spent importing the application modules (reported at startup)
+IMPORT_SECONDS = time.perf_counter() - _import_start
+
+# Keep a reference to the background warm-up so it is not garbage collected
+_warmup_task = None
+
 # Startup event
 @app.on_event("startup")
 async def startup_event():
-    """Run at app startup - detect hardware and log info"""
+    """Run at app startup - start serving immediately and warm up models in the background"""
+    global _warmup_task
     logger.info("🚀 Starting MedInsight backend server")
+    logger.info(f"Application modules imported in {IMPORT_SECONDS:.3f}s")
+    logger.info(f"CPU settings: {get_cpu_settings()}")
     
-    # Detect system capabilities
-    system_info = HardwareDetector.detect_system()
-    
-    # Log detailed system information
-    logger.info("=" * 50)
-    logger.info("SYSTEM INFORMATION")
-    logger.info("=" * 50)
-    logger.info(f"OS: {system_info['os']}")
-    logger.info(f"Architecture: {system_info['architecture']}")
-    logger.info(f"Python version: {system_info['python_version']}")
-    
-    if system_info.get('torch_available', False):
-        logger.info(f"PyTorch version: {system_info.get('torch_version', 'Unknown')}")
-        if system_info.get('cuda_available', False):
-            logger.info(f"CUDA available: Yes (version {system_info.get('cuda_version', 'Unknown')})")
-            logger.info(f"GPU: {system_info.get('gpu_name', 'Unknown')}")
-        elif system_info.get('mps_available', False):
-            logger.info("Apple MPS available: Yes (M1/M2 Mac acceleration)")
-        else:
-            logger.info("GPU acceleration: Not available, using CPU")
-    else:
-        logger.info("PyTorch: Not available")
-    
-    logger.info(f"Recommended backend: {system_info.get('recommended_backend', 'unknown')}")
-    logger.info("=" * 50)
-    
-    # Test if VLLM is available
-    can_use_vllm, vllm_reason = HardwareDetector.can_use_vllm()
-    logger.info(f"VLLM available: {'Yes' if can_use_vllm else 'No'}")
-    if not can_use_vllm:
-        logger.info(f"VLLM status: {vllm_reason}")
-    
-    # Test if transformers is available
-    can_use_transformers, transformers_reason = HardwareDetector.can_use_transformers()
-    logger.info(f"Transformers available: {'Yes' if can_use_transformers else 'No'}")
-    if not can_use_transformers:
-        logger.info(f"Transformers status: {transformers_reason}")
+    # Hardware probing, torch/transformers imports and model loading all happen
+    # in a worker thread so the API can answer /health right away
+    loop = asyncio.get_event_loop()
+    _warmup_task = loop.run_in_executor(None, run_warmup)
     
-    logger.info("=" * 50)
-    logger.info("Server started successfully")
+    # Keep rule-based scores current as measurements are added (RESCORE_INTERVAL_SECONDS > 0)
+    if MIMIC_DB_PATH:
+        rescoring_pipeline.start(MIMIC_DB_PATH)
+    logger.info("Server started successfully, warm-up running in background")
 
 @app.get("/")
 def read_root():
@@ -103,6 +123,7 @@ def get_system_info():
     # Add additional backend information
     can_use_vllm, vllm_reason = HardwareDetector.can_use_vllm()
     can_use_transformers, transformers_reason = HardwareDetector.can_use_transformers()
+    can_use_llama_cpp, llama_cpp_reason = HardwareDetector.can_use_llama_cpp()
     
     return {
         "os": system_info["os"],
@@ -116,8 +137,10 @@ def get_system_info():
         "recommended_backend": system_info.get("recommended_backend", "cpu"),
         "vllm_available": can_use_vllm,
         "transformers_available": can_use_transformers,
+        "llama_cpp_available": can_use_llama_cpp,
         "vllm_status": vllm_reason,
-        "transformers_status": transformers_reason
+        "transformers_status": transformers_reason,
+        "llama_cpp_status": llama_cpp_reason
     }
 
 # Criteria endpoints
@@ -164,11 +187,17 @@ def create_custom_criteria(criteria: CustomCriteriaCreate):
             criteria.name,
             criteria.description,
             criteria.criteria,
-            criteria.threshold
+            criteria.threshold,
+            criteria.rules
         ):
             return {"success": True, "message": f"Custom criteria '{criteria.name}' created"}
         else:
             raise HTTPException(status_code=400, detail=f"Could not create criteria '{criteria.key}'. Key may already be in use.")
+    except HTTPException:
+        raise
+    except ValueError as e:
+        # Rules that cannot be compiled
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error creating custom criteria: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -185,6 +214,136 @@ def remove_custom_criteria(key: str):
         logger.error(f"Error deleting custom criteria: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/criteria/custom/{key}/versions")
+def list_criteria_versions(key: str):
+    """Get every stored version of a custom criteria configuration"""
+    versions = get_criteria_versions(key)
+    if not versions:
+        raise HTTPException(status_code=404, detail=f"Custom criteria '{key}' not found")
+    return {"key": key, "versions": versions}
+
+@app.post("/criteria/{key}/score")
+def score_criteria(key: str, request: CriteriaScoreRequest):
+    """
+    Score patients against a criteria set's rules without the model.
+    Measurements are either given in the request or loaded from the MIMIC database for
+    a whole cohort, which is scored in one vectorized pass.
+    """
+    compiled = get_compiled_criteria(key)
+    if compiled is None:
+        raise HTTPException(status_code=404, detail=f"Criteria with key '{key}' not found")
+    if compiled.rule_set is None:
+        raise HTTPException(status_code=400, detail=f"Criteria '{key}' has no rules to score with")
+    
+    start = time.perf_counter()
+    try:
+        if request.patients is not None:
+            scores = score_records(compiled.rule_set, request.patients)
+        else:
+            if not MIMIC_DB_PATH:
+                raise HTTPException(status_code=400, detail="MIMIC_DB_PATH is not set; send measurements in 'patients'")
+            hadm_ids = request.hadm_ids
+            if hadm_ids is None:
+                hadm_ids = [hadm_id for hadm_id, _ in select_cohort(MIMIC_DB_PATH, where=request.where, limit=request.limit)]
+            conn = sqlite3.connect(f"file:{MIMIC_DB_PATH}?mode=ro", uri=True)
+            try:
+                scores = compiled.rule_set.score_admissions(load_measurements(conn, hadm_ids))
+            finally:
+                conn.close()
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error scoring criteria {key}: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    seconds = time.perf_counter() - start
+    logger.info(f"Scored {len(scores)} patients against {key} rules in {seconds:.3f}s")
+    return {
+        "criteria_key": key,
+        "version": compiled.version,
+        "rules": [rule.text for rule in compiled.rule_set.rules],
+        "min_met": compiled.rule_set.min_met,
+        "count": len(scores),
+        "summary": {decision: int(count) for decision, count in scores["decision"].value_counts().items()},
+        "seconds": round(seconds, 4),
+        "results": score_rows(compiled.rule_set, scores)
+    }
+
+@app.get("/timelines/{hadm_id}")
+def get_timeline(hadm_id: int, kind: str = "lab"):
+    """Get the {charttime: {label: value}} lab or chart timeline of one admission"""
+    try:
+        return {"hadm_id": hadm_id, "kind": kind, "timeline": timeline_cache.get([hadm_id], kind)[hadm_id]}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error building timeline for {hadm_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/timelines")
+def get_timelines(request: TimelinesRequest):
+    """Get the timelines of many admissions; uncached ones are loaded and built in one pass per kind"""
+    try:
+        timelines = {kind: timeline_cache.get(request.hadm_ids, kind) for kind in dict.fromkeys(request.kinds)}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error building timelines: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    return {
+        "timelines": [
+            {"hadm_id": hadm_id, **{kind: timelines[kind][hadm_id] for kind in timelines}}
+            for hadm_id in dict.fromkeys(request.hadm_ids)
+        ]
+    }
+
+@app.get("/timelines")
+def get_timeline_cache():
+    """Get timeline cache statistics (entries, hit rate, build time)"""
+    return timeline_cache.get_state()
+
+@app.get("/patient-context/{hadm_id}")
+def get_patient_context(hadm_id: int, criteria: Optional[str] = None, max_tokens: Optional[int] = None):
+    """Get the compact patient information put into prompts for an admission and criteria (default: active)"""
+    if not MIMIC_DB_PATH:
+        raise HTTPException(status_code=400, detail="MIMIC_DB_PATH is not set")
+    key = criteria or get_active_criteria_key()
+    compiled = get_compiled_criteria(key)
+    if compiled is None:
+        raise HTTPException(status_code=404, detail=f"Criteria with key '{key}' not found")
+    conn = sqlite3.connect(f"file:{MIMIC_DB_PATH}?mode=ro", uri=True)
+    try:
+        kwargs = {"max_tokens": max_tokens} if max_tokens is not None else {}
+        context = encode_patient_context(conn, hadm_id, compiled.rule_set, **kwargs)
+    except Exception as e:
+        logger.error(f"Error encoding patient context for {hadm_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        conn.close()
+    return {"hadm_id": hadm_id, "criteria_key": key, **context}
+
+@app.get("/patients")
+def get_patient_prefetch():
+    """Get patient record prefetch statistics (cache entries, hit rate, load time)"""
+    return patient_prefetcher.get_state()
+
+@app.get("/patients/{patient_id}")
+def get_patient_record(patient_id: int, criteria: Optional[str] = None):
+    """Get a patient's prefetched record for a criteria set (default: active), loading it if needed"""
+    if not patient_prefetcher.enabled:
+        raise HTTPException(status_code=400, detail="Patient prefetch is disabled or MIMIC_DB_PATH is not set")
+    key = criteria or get_active_criteria_key()
+    compiled = get_compiled_criteria(key)
+    if compiled is None:
+        raise HTTPException(status_code=404, detail=f"Criteria with key '{key}' not found")
+    patient_prefetcher.prefetch(patient_id, compiled.rule_set)
+    record = patient_prefetcher.get(patient_id, compiled.rule_set, wait=30)
+    if record is None:
+        raise HTTPException(status_code=503, detail=f"The record of patient {patient_id} could not be loaded")
+    if not record["text"]:
+        raise HTTPException(status_code=404, detail=f"Patient {patient_id} not found")
+    return {"criteria_key": key, **record}
+
 @app.post("/query")
 def process_query(user_query: dict):
     try:
@@ -198,6 +357,9 @@ def process_query(user_query: dict):
     except ValueError as e:
         logger.error(f"Value error in query: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
+    except MemoryPressureError as e:
+        logger.warning(f"Query refused under memory pressure: {str(e)}")
+        raise HTTPException(status_code=503, detail=str(e))
     except RuntimeError as e:
         logger.error(f"Runtime error in query: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -205,8 +367,66 @@ def process_query(user_query: dict):
         logger.error(f"Unexpected error in query: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
 
+@app.get("/models")
+def get_models():
+    """Get the state of the model registry (loaded models, memory use, evictions)"""
+    return model_registry.get_state()
+
+@app.post("/models/evict-idle")
+def evict_idle_models():
+    """Unload models that have been idle for longer than the configured TTL"""
+    evicted = model_registry.evict_idle()
+    return {"evicted": [{"model": k[0], "backend": k[1], "dtype": k[2], "draft_model": k[3] or None} for k in evicted]}
+
+@app.get("/token-budget")
+def get_token_budget():
+    """Get observed output lengths and wasted tokens avoided per generation task"""
+    return token_budget.get_state()
+
+@app.get("/cpu-profile")
+def get_cpu_profile():
+    """Get the CPU thread and core layout applied to this worker"""
+    return get_cpu_settings()
+
+@app.get("/memory")
+def get_memory():
+    """Get the memory governor state (RSS, limits, pressure, capped and refused requests)"""
+    return memory_governor.get_state()
+
+@app.get("/coalescing")
+def get_coalescing():
+    """Get how many identical concurrent requests shared an in-flight generation or query"""
+    return request_coalescer.get_state()
+
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
 
+@app.get("/ready")
+async def readiness_check():
+    """
+    Readiness probe - returns 503 while the background warm-up is running and
+    500 with the error if it failed (POST /ready/retry runs it again)
+    """
+    status = startup_monitor.get_status()
+    status["import_seconds"] = round(IMPORT_SECONDS, 3)
+    if status["state"] == "failed":
+        return JSONResponse(status_code=500, content=status)
+    if not status["ready"]:
+        return JSONResponse(status_code=503, content=status)
+    return status
+
+@app.post("/ready/retry")
+async def retry_warmup():
+    """Run the warm-up again after it failed"""
+    global _warmup_task
+    with startup_monitor.lock:
+        if startup_monitor.get_state() != "failed":
+            raise HTTPException(status_code=409, detail="Warm-up has not failed")
+        # Back to warming up right away so a second retry is refused
+        startup_monitor.error = None
+    _warmup_task = asyncio.get_event_loop().run_in_executor(None, run_warmup)
+    return {"state": "warming_up"}
+
 app.include_router(diagnose_router)
+app.include_router(scores_router)
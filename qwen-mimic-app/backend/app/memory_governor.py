@@ -0,0 +1,306 @@
+import gc
+import os
+import sys
+import time
+import threading
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.config import (
+    MEMORY_LIMIT_GB,
+    MEMORY_SOFT_LIMIT,
+    MEMORY_HARD_LIMIT,
+    MEMORY_CHECK_SECONDS,
+    MEMORY_RESUME_MARGIN,
+    MEMORY_MAX_RESULT_MB,
+    KV_BYTES_PER_TOKEN
+)
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Generations are refused rather than capped below this many new tokens
+MIN_GENERATION_TOKENS = 32
+
+# Evictors at or above this priority are expensive to rebuild (e.g. unloading a model) and
+# only run above the hard limit or when a generation would not fit otherwise
+EXPENSIVE_EVICTOR_PRIORITY = 10
+
+
+class MemoryPressureError(RuntimeError):
+    """A request was refused because it would not fit in the available memory"""
+
+
+def current_rss_bytes() -> int:
+    """Resident set size of this process in bytes"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        # ru_maxrss is in KB on Linux and bytes on macOS; peak is the best we can do here
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+
+
+def detect_memory_limit() -> int:
+    """Memory available to this process: the cgroup limit if there is one, else physical RAM"""
+    for path in ["/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"]:
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+            # Unlimited cgroups report 'max' or a huge number
+            if value != "max" and int(value) < 1 << 60:
+                return int(value)
+        except (OSError, ValueError):
+            continue
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+def kv_bytes_per_token(config: Any, dtype_bytes: int) -> int:
+    """Size of the key/value cache for one token of a transformers model config"""
+    layers = getattr(config, "num_hidden_layers", 0)
+    heads = getattr(config, "num_attention_heads", 0)
+    kv_heads = getattr(config, "num_key_value_heads", None) or heads
+    head_dim = getattr(config, "head_dim", None) or (config.hidden_size // heads if heads else 0)
+    return 2 * layers * kv_heads * head_dim * dtype_bytes
+
+
+class MemoryGovernor:
+    """
+    Singleton that keeps the process below its memory limit.
+
+    Tracks RSS against a soft and a hard threshold and estimates what each request
+    will add (KV cache from token counts, query result size). Under pressure it
+    degrades instead of letting the process be OOM-killed: it asks registered caches
+    to release memory, halves batch sizes and max_tokens, and refuses requests that
+    cannot fit even then.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = super(MemoryGovernor, cls).__new__(cls)
+                cls._instance._initialize()
+            return cls._instance
+
+    def _initialize(self):
+        """Initialize the governor state."""
+        self.state_lock = threading.Lock()
+        self.limit_bytes = int(MEMORY_LIMIT_GB * 1024 ** 3) if MEMORY_LIMIT_GB > 0 else detect_memory_limit()
+        self.soft_fraction = MEMORY_SOFT_LIMIT
+        self.hard_fraction = MEMORY_HARD_LIMIT
+        self.resume_margin = MEMORY_RESUME_MARGIN
+        self.max_result_bytes = int(MEMORY_MAX_RESULT_MB * 1024 ** 2)
+        self.evictors: List[Tuple[int, str, Callable[[], int]]] = []
+        self.rss_reader: Callable[[], int] = current_rss_bytes
+        self.stats = {"capped": 0, "refused": 0, "batches_shrunk": 0, "relief_runs": 0, "bytes_released": 0}
+        self.last_relief = None
+        # Set once the background check has relieved soft pressure, cleared when RSS falls
+        # below the resume threshold; keeps it from releasing caches on every check
+        self._soft_relieved = False
+        self._monitor = None
+
+    @property
+    def soft_limit_bytes(self) -> int:
+        return int(self.limit_bytes * self.soft_fraction)
+
+    @property
+    def hard_limit_bytes(self) -> int:
+        return int(self.limit_bytes * self.hard_fraction)
+
+    @property
+    def resume_limit_bytes(self) -> int:
+        return int(self.limit_bytes * max(0.0, self.soft_fraction - self.resume_margin))
+
+    def register_evictor(self, name: str, evictor: Callable[[], int], priority: int = 0):
+        """
+        Register a cache that can release memory under pressure.
+        The evictor frees what it can and returns an estimate of the bytes released.
+        Evictors run in priority order (cheapest to rebuild first) until pressure is gone.
+        """
+        with self.state_lock:
+            self.evictors = sorted(
+                [entry for entry in self.evictors if entry[1] != name] + [(priority, name, evictor)],
+                key=lambda entry: entry[0]
+            )
+        self._ensure_monitor()
+
+    def pressure(self) -> str:
+        """'ok', 'soft' (above the soft limit) or 'hard' (above the hard limit)"""
+        if not self.limit_bytes:
+            return "ok"
+        rss = self.rss_reader()
+        if rss >= self.hard_limit_bytes:
+            return "hard"
+        if rss >= self.soft_limit_bytes:
+            return "soft"
+        return "ok"
+
+    def available_bytes(self) -> int:
+        """Memory left below the hard limit"""
+        if not self.limit_bytes:
+            return sys.maxsize
+        return self.hard_limit_bytes - self.rss_reader()
+
+    def relieve(self, reason: str, needed_bytes: int = 0, max_priority: Optional[int] = None) -> int:
+        """
+        Ask registered caches to release memory until pressure is gone and needed_bytes fit.
+        With max_priority, evictors above that priority are left alone.
+        """
+        released = 0
+        for priority, name, evictor in list(self.evictors):
+            if max_priority is not None and priority > max_priority:
+                break
+            if self.pressure() == "ok" and self.available_bytes() >= needed_bytes:
+                break
+            try:
+                freed = evictor() or 0
+                released += freed
+                if freed:
+                    logger.info(f"Memory relief: {name} released ~{freed / 1024 ** 2:.0f} MB")
+            except Exception as e:
+                logger.error(f"Error releasing memory from {name}: {e}")
+        gc.collect()
+        with self.state_lock:
+            self.stats["relief_runs"] += 1
+            self.stats["bytes_released"] += released
+            self.last_relief = {"time": time.time(), "reason": reason, "bytes_released": released}
+        logger.warning(f"Memory relief ({reason}): released ~{released / 1024 ** 2:.0f} MB, "
+                       f"RSS now {self.rss_reader() / 1024 ** 3:.2f} GB")
+        return released
+
+    def _count(self, stat: str):
+        with self.state_lock:
+            self.stats[stat] += 1
+
+    def admit_generation(self, prompt_tokens: int, max_tokens: int,
+                         bytes_per_token: Optional[int] = None) -> int:
+        """
+        Check a generation against the available memory.
+
+        Args:
+            prompt_tokens: Tokens in the prompt
+            max_tokens: Requested maximum of new tokens
+            bytes_per_token: KV cache bytes per token of the model (default KV_BYTES_PER_TOKEN)
+
+        Returns:
+            The max_tokens to use, capped if memory is tight
+
+        Raises:
+            MemoryPressureError: If not even MIN_GENERATION_TOKENS fit after releasing caches
+        """
+        if not self.limit_bytes:
+            return max_tokens
+        bytes_per_token = bytes_per_token or KV_BYTES_PER_TOKEN
+        needed = (prompt_tokens + max_tokens) * bytes_per_token
+        if needed > self.available_bytes() or self.pressure() == "hard":
+            self.relieve(f"generation of up to {prompt_tokens + max_tokens} tokens", needed_bytes=needed)
+        elif self.pressure() == "soft":
+            # The generation fits, so only release what is cheap to rebuild
+            self.relieve(f"generation of up to {prompt_tokens + max_tokens} tokens",
+                         max_priority=EXPENSIVE_EVICTOR_PRIORITY - 1)
+
+        allowed = max_tokens
+        if self.pressure() == "soft":
+            # Above the soft limit every generation gets a shorter budget
+            allowed = max(MIN_GENERATION_TOKENS, max_tokens // 2)
+        fitting = self.available_bytes() // bytes_per_token - prompt_tokens
+        allowed = min(allowed, fitting)
+
+        if allowed < min(max_tokens, MIN_GENERATION_TOKENS):
+            self._count("refused")
+            raise MemoryPressureError(
+                f"Not enough memory for a {prompt_tokens}-token prompt: "
+                f"{max(0, self.available_bytes()) / 1024 ** 2:.0f} MB available below the hard limit"
+            )
+        if allowed < max_tokens:
+            self._count("capped")
+            logger.warning(f"Memory pressure: capped max_tokens from {max_tokens} to {allowed}")
+        return allowed
+
+    def batch_size(self, requested: int) -> int:
+        """Batch size to use for a batched workload: halved above the soft limit, 1 above the hard limit"""
+        state = self.pressure()
+        if state == "ok" or requested <= 1:
+            return requested
+        self._count("batches_shrunk")
+        return 1 if state == "hard" else max(1, requested // 2)
+
+    def result_budget_bytes(self) -> int:
+        """Largest result set a query may materialize right now"""
+        budget = self.max_result_bytes or sys.maxsize
+        if self.limit_bytes:
+            budget = min(budget, max(0, self.available_bytes()) // 2)
+        return budget
+
+    def refuse_result(self, rows: int, result_bytes: int):
+        """Refuse a query result that outgrew the result budget"""
+        self._count("refused")
+        raise MemoryPressureError(
+            f"Query result too large: {rows} rows (~{result_bytes / 1024 ** 2:.0f} MB) exceed the "
+            f"{self.result_budget_bytes() / 1024 ** 2:.0f} MB result budget; narrow the query or add a LIMIT"
+        )
+
+    def check_pressure(self) -> int:
+        """
+        One background check: above the hard limit every cache is released; above the soft
+        limit only cheap ones, and not again until RSS has fallen below the resume threshold.
+        Returns the bytes released.
+        """
+        state = self.pressure()
+        if state == "hard":
+            return self.relieve("RSS above the hard limit")
+        if state == "soft":
+            if self._soft_relieved:
+                return 0
+            self._soft_relieved = True
+            return self.relieve("RSS above the soft limit", max_priority=EXPENSIVE_EVICTOR_PRIORITY - 1)
+        if self._soft_relieved and self.rss_reader() < self.resume_limit_bytes:
+            self._soft_relieved = False
+        return 0
+
+    def _ensure_monitor(self):
+        """Start the background thread that releases memory before the hard limit is hit"""
+        if not self.limit_bytes or MEMORY_CHECK_SECONDS <= 0:
+            return
+        if self._monitor is not None and self._monitor.is_alive():
+            return
+
+        def monitor():
+            while True:
+                time.sleep(MEMORY_CHECK_SECONDS)
+                try:
+                    self.check_pressure()
+                except Exception as e:
+                    logger.error(f"Error checking memory pressure: {e}")
+
+        self._monitor = threading.Thread(target=monitor, name="memory-governor", daemon=True)
+        self._monitor.start()
+
+    def get_state(self) -> Dict[str, Any]:
+        """Get a summary of memory use and degradation for monitoring"""
+        rss = self.rss_reader()
+        result_budget = self.result_budget_bytes()
+        with self.state_lock:
+            return {
+                "rss_gb": round(rss / 1024 ** 3, 3),
+                "limit_gb": round(self.limit_bytes / 1024 ** 3, 3) if self.limit_bytes else None,
+                "soft_limit_gb": round(self.soft_limit_bytes / 1024 ** 3, 3) if self.limit_bytes else None,
+                "hard_limit_gb": round(self.hard_limit_bytes / 1024 ** 3, 3) if self.limit_bytes else None,
+                "resume_limit_gb": round(self.resume_limit_bytes / 1024 ** 3, 3) if self.limit_bytes else None,
+                "pressure": self.pressure(),
+                "result_budget_mb": round(result_budget / 1024 ** 2, 1) if result_budget != sys.maxsize else None,
+                "evictors": [name for _, name, _ in self.evictors],
+                "last_relief": self.last_relief,
+                **self.stats
+            }
+
+
+# Create singleton instance
+memory_governor = MemoryGovernor()
@@ -3,6 +3,7 @@ import sys
 import platform
 import logging
 import subprocess
+from functools import lru_cache
 from typing import Dict, Any, Tuple
 
 # Set up logging
@@ -14,7 +15,16 @@ class HardwareDetector:
     
     @staticmethod
     def detect_system() -> Dict[str, Any]:
-        """Detect system information and hardware capabilities"""
+        """
+        Detect system information and hardware capabilities.
+        The probe runs once per process; callers get a copy of the cached result.
+        """
+        return dict(HardwareDetector._probe_system())
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _probe_system() -> Dict[str, Any]:
+        """Probe the hardware (imports torch on first call)"""
         system_info = {
             "os": platform.system(),
             "architecture": platform.machine(),
@@ -67,6 +77,7 @@ class HardwareDetector:
         return system_info
 
     @staticmethod
+    @lru_cache(maxsize=None)
     def can_use_vllm() -> Tuple[bool, str]:
         """Check if vllm can be used on this system"""
         try:
@@ -84,6 +95,7 @@ class HardwareDetector:
             return False, f"Error checking VLLM: {str(e)}"
             
     @staticmethod
+    @lru_cache(maxsize=None)
     def can_use_transformers() -> Tuple[bool, str]:
         """Check if transformers can be used on this system"""
         try:
@@ -96,13 +108,26 @@ class HardwareDetector:
         except Exception as e:
             return False, f"Error checking Transformers: {str(e)}"
 
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def can_use_llama_cpp() -> Tuple[bool, str]:
+        """Check if llama.cpp (llama-cpp-python) can be used on this system"""
+        try:
+            import llama_cpp
+            
+            return True, f"llama.cpp is available (llama-cpp-python {llama_cpp.__version__})"
+        except ImportError:
+            return False, "llama-cpp-python is not installed (pip install -r requirements-llama-cpp.txt)"
+        except Exception as e:
+            return False, f"Error checking llama.cpp: {str(e)}"
+
 def get_optimal_backend() -> str:
     """Determine the optimal backend based on hardware detection"""
     system_info = HardwareDetector.detect_system()
     
     # Check for environment variable override
     force_backend = os.environ.get("FORCE_BACKEND", "").lower()
-    if force_backend in ["vllm", "transformers", "cpu"]:
+    if force_backend in ["vllm", "transformers", "llama_cpp", "cpu"]:
         logger.info(f"Backend forced to {force_backend} via environment variable")
         return force_backend
         
@@ -1,8 +1,23 @@
+import os
 import logging
 import importlib
 from typing import Any, Dict, List, Optional, Union
 
+from app.config import (
+    CPU_PRECISION,
+    DRAFT_MODEL,
+    DRAFT_LOOKAHEAD,
+    FAST_MODEL_LOADING,
+    COMPILED_DECODE,
+    COMPILED_CACHE_BUCKETS,
+    GGUF_MODEL,
+    LLAMA_CPP_CONTEXT,
+    LLAMA_CPP_THREADS,
+    LLAMA_CPP_GPU_LAYERS
+)
 from app.model_detector import get_optimal_backend, HardwareDetector
+from app.model_registry import model_registry, ModelHandle
+from app.cpu_tuning import get_cpu_settings
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -12,55 +27,179 @@ class ModelFactory:
     """Factory class to create the appropriate model handler based on hardware detection"""
     
     @staticmethod
-    def create_model(model_name: str, model_type: str = "reasoning") -> Any:
+    def resolve_backend(model_type: Optional[str] = None) -> str:
         """
-        Create a model handler for the specified model
+        Determine which backend will actually be used on this system
+        
+        Args:
+            model_type: Type of model ('reasoning' or 'sql'); llama.cpp is only used
+                for model types with GGUF weights configured
+        
+        Returns:
+            Backend name ('vllm', 'llama_cpp' or 'transformers')
+        
+        Raises:
+            RuntimeError: If no suitable backend is available
+        """
+        backend = get_optimal_backend()
+        has_gguf = bool(GGUF_MODEL.get(model_type))
+        
+        if backend in ["llama_cpp", "cpu"]:
+            # CPU-only systems prefer quantized GGUF weights when they are configured
+            can_use_llama_cpp, reason = HardwareDetector.can_use_llama_cpp()
+            if can_use_llama_cpp and has_gguf:
+                return "llama_cpp"
+            if backend == "llama_cpp":
+                if not has_gguf:
+                    reason = f"no GGUF weights configured for the {model_type} model"
+                logger.warning(f"Cannot use llama.cpp: {reason}")
+                logger.info("Falling back to transformers backend")
+                backend = "transformers"
+        
+        if backend == "vllm":
+            # Check if vllm can be used
+            can_use_vllm, reason = HardwareDetector.can_use_vllm()
+            if can_use_vllm:
+                return "vllm"
+            logger.warning(f"Cannot use VLLM: {reason}")
+            logger.info("Falling back to transformers backend")
+            backend = "transformers"
+        
+        if backend in ["transformers", "cpu"]:
+            # Check if transformers can be used
+            can_use_transformers, reason = HardwareDetector.can_use_transformers()
+            if not can_use_transformers:
+                logger.error(f"Cannot use Transformers: {reason}")
+                raise RuntimeError(f"No suitable backend available: {reason}")
+            return "transformers"
+        
+        # If we reach here with no backend, raise an error
+        raise RuntimeError("No suitable model backend available")
+    
+    @staticmethod
+    def load_handler(model_name: str, backend: str, dtype: str = "auto", draft_model_name: Optional[str] = None) -> Any:
+        """
+        Load a model handler immediately, bypassing the registry
         
         Args:
             model_name: Name/path of the model to load
-            model_type: Type of model ('reasoning' or 'sql')
+            backend: Backend returned by resolve_backend()
+            dtype: Weight precision for the model ('auto' lets the handler decide;
+                ignored by llama.cpp, where the GGUF file sets the quantization)
+            draft_model_name: Optional draft model for assisted decoding (transformers only)
             
         Returns:
             Model handler instance
         
         Raises:
-            RuntimeError: If no suitable backend is available or model loading fails
+            RuntimeError: If model loading fails
         """
-        # Determine the optimal backend
-        backend = get_optimal_backend()
-        logger.info(f"Creating {model_type} model with backend: {backend}")
-        
         try:
             if backend == "vllm":
-                # Check if vllm can be used
-                can_use_vllm, reason = HardwareDetector.can_use_vllm()
-                if not can_use_vllm:
-                    logger.warning(f"Cannot use VLLM: {reason}")
-                    logger.info("Falling back to transformers backend")
-                    backend = "transformers"
-                else:
-                    # Try to import and create VLLM handler
-                    from app.model_vllm import VLLMModelHandler
-                    handler = VLLMModelHandler(model_name)
-                    logger.info(f"Successfully created VLLMModelHandler for {model_name}")
-                    return handler
+                from app.model_vllm import VLLMModelHandler
+                handler = VLLMModelHandler(model_name)
+                logger.info(f"Successfully created VLLMModelHandler for {model_name}")
+                return handler
+            
+            if backend == "llama_cpp":
+                from app.model_llama_cpp import LlamaCppModelHandler
+                handler = LlamaCppModelHandler(
+                    model_name,
+                    n_ctx=LLAMA_CPP_CONTEXT,
+                    n_threads=LLAMA_CPP_THREADS or get_cpu_settings().get("threads", 0),
+                    n_gpu_layers=LLAMA_CPP_GPU_LAYERS
+                )
+                logger.info(f"Successfully created LlamaCppModelHandler for {model_name}")
+                return handler
             
             if backend == "transformers":
-                # Check if transformers can be used
-                can_use_transformers, reason = HardwareDetector.can_use_transformers()
-                if not can_use_transformers:
-                    logger.error(f"Cannot use Transformers: {reason}")
-                    raise RuntimeError(f"No suitable backend available: {reason}")
-                else:
-                    # Try to import and create Transformers handler
-                    from app.model_transformers import TransformersModelHandler
-                    handler = TransformersModelHandler(model_name)
-                    logger.info(f"Successfully created TransformersModelHandler for {model_name}")
-                    return handler
+                from app.model_transformers import TransformersModelHandler
+                handler_kwargs = {}
+                if dtype != "auto":
+                    handler_kwargs["precision"] = dtype
+                if draft_model_name:
+                    handler_kwargs["draft_model_name"] = draft_model_name
+                    handler_kwargs["num_assistant_tokens"] = DRAFT_LOOKAHEAD
+                if COMPILED_DECODE:
+                    handler_kwargs["compile_decode"] = True
+                    handler_kwargs["cache_buckets"] = COMPILED_CACHE_BUCKETS
+                handler = TransformersModelHandler(model_name, **handler_kwargs)
+                logger.info(f"Successfully created TransformersModelHandler for {model_name}")
+                return handler
             
-            # If we reach here with no backend, raise an error
-            raise RuntimeError("No suitable model backend available")
+            raise RuntimeError(f"Unknown model backend: {backend}")
                 
         except Exception as e:
             logger.error(f"Error creating model handler: {str(e)}")
             raise RuntimeError(f"Failed to create model handler: {str(e)}")
+    
+    @staticmethod
+    def load_tokenizer(model_name: str, backend: str) -> Any:
+        """
+        Load only the tokenizer of a model, so prompts can be measured while the weights
+        are not loaded
+        
+        Args:
+            model_name: Name/path of the model
+            backend: Backend returned by resolve_backend()
+            
+        Returns:
+            Object with count_tokens() and encode_message(), tokenizing like the handler
+        """
+        if backend == "llama_cpp":
+            from app.model_llama_cpp import LlamaCppTokenizer
+            return LlamaCppTokenizer(model_name)
+        
+        from transformers import AutoTokenizer
+        from app.tokenization import MessageTokenCache
+        source = model_name
+        if FAST_MODEL_LOADING and backend == "transformers":
+            from app.fast_loader import find_local_checkpoint
+            local_dir = find_local_checkpoint(model_name)
+            if local_dir is not None and os.path.isfile(os.path.join(local_dir, "tokenizer_config.json")):
+                source = local_dir
+        return MessageTokenCache(AutoTokenizer.from_pretrained(source))
+    
+    @staticmethod
+    def create_model(model_name: str, model_type: str = "reasoning", dtype: Optional[str] = None) -> ModelHandle:
+        """
+        Create a model handler for the specified model
+        
+        The handler is shared through the process-wide model registry: requests for the
+        same (model, backend, dtype, draft model) return handles to the same instance, which is only
+        loaded on first use and may be unloaded again when memory is needed.
+        
+        Args:
+            model_name: Name/path of the model to load
+            model_type: Type of model ('reasoning' or 'sql')
+            dtype: Weight precision for the model. Defaults to the CPU precision
+                configured for the model type (REASONING_CPU_PRECISION / SQL_CPU_PRECISION)
+                on the transformers backend, 'gguf' on llama.cpp and 'auto' elsewhere
+            
+        Returns:
+            Lazy handle exposing the model handler interface; it counts tokens with a
+            tokenizer loaded on its own while the model is not loaded
+        
+        Raises:
+            RuntimeError: If no suitable backend is available
+        """
+        # Determine the optimal backend
+        backend = ModelFactory.resolve_backend(model_type)
+        logger.info(f"Creating {model_type} model with backend: {backend}")
+        
+        if backend == "llama_cpp":
+            # llama.cpp loads the quantized GGUF export of the model instead
+            model_name = GGUF_MODEL[model_type]
+            dtype = "gguf"
+        elif dtype is None:
+            dtype = CPU_PRECISION.get(model_type, "fp32") if backend == "transformers" else "auto"
+        
+        draft_model_name = DRAFT_MODEL.get(model_type) or None
+        
+        # Assisted decoding loads the draft model into the same handler, so it is part of the key
+        key = (model_name, backend, dtype, draft_model_name or "")
+        return model_registry.register(
+            key,
+            lambda: ModelFactory.load_handler(model_name, backend, dtype, draft_model_name),
+            tokenizer_loader=lambda: ModelFactory.load_tokenizer(model_name, backend)
+        )
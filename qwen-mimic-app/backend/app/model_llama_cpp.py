@@ -0,0 +1,256 @@
+import os
+import queue
+import logging
+import threading
+from typing import Callable, List, Dict, Any, Iterator, Optional
+from llama_cpp import Llama
+from app.model_progress import progress_monitor
+from app.section_parser import parse_sections
+from app.tokenization import format_messages, format_message
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Generation ends once a reasoning step is complete, as with the other backends
+STOP_TAGS = ["</search>", "</answer>"]
+# End of the assistant turn in ChatML
+END_OF_TURN = "<|im_end|>"
+
+
+class LlamaCppTokenizer:
+    """
+    Tokenizer of a GGUF model, loaded with its vocabulary only
+    """
+
+    def __init__(self, model_path: str):
+        """
+        Args:
+            model_path: Path to a .gguf file, or 'repo_id:filename' on the Hugging Face Hub
+        """
+        if os.path.exists(model_path):
+            self.llm = Llama(model_path=model_path, vocab_only=True, verbose=False)
+        elif ":" in model_path:
+            repo_id, filename = model_path.split(":", 1)
+            self.llm = Llama.from_pretrained(repo_id=repo_id, filename=filename, vocab_only=True, verbose=False)
+        else:
+            raise FileNotFoundError(f"GGUF model not found at {model_path}")
+
+    def _tokenize(self, text: str, special: bool) -> List[int]:
+        return self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=special)
+
+    def count_tokens(self, text: str) -> int:
+        """Number of tokens the model's tokenizer produces for a piece of text"""
+        return len(self._tokenize(text, special=False))
+
+    def encode_message(self, role: str, content: str) -> List[int]:
+        """Token ids of one formatted chat message, as they appear in a prompt"""
+        return self._tokenize(format_message(role, content), special=True)
+
+
+class LlamaCppModelHandler:
+    """
+    llama.cpp implementation of model handling - quantized GGUF weights on CPU
+    """
+
+    def __init__(self, model_path: str, n_ctx: int = 10000, n_threads: int = 0, n_gpu_layers: int = 0):
+        """
+        Initialize the llama.cpp model handler
+
+        Args:
+            model_path: Path to a .gguf file, or 'repo_id:filename' to download from the Hugging Face Hub
+            n_ctx: Context window in tokens
+            n_threads: CPU threads used for generation (0 = llama.cpp default)
+            n_gpu_layers: Layers offloaded to a GPU if llama.cpp was built with GPU support
+        """
+        logger.info(f"Initializing llama.cpp model handler for {model_path}")
+
+        # Reset the progress monitor before loading
+        progress_monitor.reset()
+
+        llama_kwargs = {
+            "n_ctx": n_ctx,
+            "n_gpu_layers": n_gpu_layers,
+            "verbose": False
+        }
+        if n_threads > 0:
+            llama_kwargs["n_threads"] = n_threads
+
+        try:
+            if os.path.exists(model_path):
+                self.llm = Llama(model_path=model_path, **llama_kwargs)
+                self.memory_bytes = os.path.getsize(model_path)
+            elif ":" in model_path:
+                repo_id, filename = model_path.split(":", 1)
+                self.llm = Llama.from_pretrained(repo_id=repo_id, filename=filename, **llama_kwargs)
+                self.memory_bytes = os.path.getsize(self.llm.model_path)
+            else:
+                raise FileNotFoundError(f"GGUF model not found at {model_path}")
+
+            # llama.cpp is not thread-safe; generations on one model are serialized
+            self.lock = threading.Lock()
+
+            progress_monitor.mark_loading_complete()
+            logger.info(f"Successfully loaded GGUF model ({self.memory_bytes / 1024 ** 3:.2f} GB)")
+        except Exception as e:
+            logger.error(f"Error loading model: {str(e)}")
+            raise RuntimeError(f"Failed to load model: {e}")
+
+    def _tokenize(self, text: str, special: bool) -> List[int]:
+        return self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=special)
+
+    def generate(self, messages: List[Dict[str, str]], **kwargs) -> Dict[str, Any]:
+        """
+        Generate a response from the model
+
+        Args:
+            messages: List of message dictionaries with 'role' and 'content'
+            **kwargs: Additional parameters for generation
+                temperature: Float temperature for generation
+                max_tokens: Maximum number of tokens to generate
+                stop: Stop strings ending generation (default: </search> and </answer>)
+
+        Returns:
+            Dictionary with generated text and metadata
+        """
+        return self._decode(messages, **kwargs)
+
+    def generate_batch(self, conversations: List[List[Dict[str, str]]], **kwargs) -> List[Dict[str, Any]]:
+        """
+        Generate responses for several conversations.
+
+        llama-cpp-python decodes one sequence at a time, so the conversations are generated
+        one after another; the model stays loaded and its threads warm between them.
+        """
+        return [self.generate(messages, **kwargs) for messages in conversations]
+
+    def _decode(self, messages: List[Dict[str, str]], on_delta: Optional[Callable[[str], None]] = None,
+                cancelled: Optional[threading.Event] = None, **kwargs) -> Dict[str, Any]:
+        """
+        Run one generation while holding the model lock.
+
+        Text is passed to on_delta as it is decoded; nothing is yielded while the lock is
+        held, so a slow or abandoned stream consumer cannot keep other requests waiting.
+        Setting cancelled ends decoding early.
+        """
+        temperature = kwargs.get('temperature', 0.5)
+        max_tokens = kwargs.get('max_tokens', 1000)
+        stop_strings = kwargs.get('stop', STOP_TAGS) or []
+
+        prompt = format_messages(messages)
+
+        with self.lock:
+            prompt_tokens = len(self._tokenize(prompt, special=True))
+            # Stop strings are matched here rather than by llama.cpp so the closing tag
+            # stays in the output, as it does with the transformers backend
+            stream = self.llm.create_completion(
+                prompt,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                top_p=0.95,
+                stop=[END_OF_TURN],
+                stream=True
+            )
+
+            text = ""
+            num_tokens = 0
+            stopped_on = None
+            try:
+                for chunk in stream:
+                    if cancelled is not None and cancelled.is_set():
+                        break
+                    delta = chunk["choices"][0]["text"]
+                    num_tokens += 1
+                    if not delta:
+                        continue
+                    # Only the tail can contain a stop string completed by this chunk
+                    window_start = max(0, len(text) - max((len(s) for s in stop_strings), default=0))
+                    previous_length = len(text)
+                    text += delta
+                    tail = text[window_start:]
+                    stopped_on = next((s for s in stop_strings if s in tail), None)
+                    if stopped_on:
+                        # Drop anything generated after the stop string in the same chunk
+                        text = text[:window_start + tail.index(stopped_on) + len(stopped_on)]
+                        if on_delta is not None and len(text) > previous_length:
+                            on_delta(text[previous_length:])
+                        break
+                    if on_delta is not None:
+                        on_delta(delta)
+            except Exception as e:
+                logger.error(f"Error during generation: {str(e)}")
+                raise RuntimeError(f"Failed to generate response: {e}")
+            finally:
+                # Closing the generator ends decoding inside llama.cpp
+                stream.close()
+
+        result = {
+            "text": text.strip(),
+            "backend": "llama_cpp",
+            "num_tokens": num_tokens,
+            "prompt_tokens": prompt_tokens,
+            "stopped_on": stopped_on,
+            "tokens_saved": max(0, max_tokens - num_tokens) if stopped_on else 0
+        }
+        if stopped_on:
+            logger.info(f"Stopped on {stopped_on} after {num_tokens} tokens, saved up to {result['tokens_saved']}")
+        return result
+
+    def stream_generate(self, messages: List[Dict[str, str]], **kwargs) -> Iterator[Dict[str, Any]]:
+        """
+        Generate a response in streaming form
+
+        Decoding runs on a background thread that holds the model lock; this generator
+        only relays its output, and stops it if the consumer goes away.
+
+        Yields {"delta": text} for each generated token, then the result dictionary
+        with the same keys as generate().
+        """
+        chunks: "queue.Queue" = queue.Queue()
+        cancelled = threading.Event()
+        outcome = {}
+
+        def run():
+            try:
+                outcome["result"] = self._decode(messages, on_delta=chunks.put, cancelled=cancelled, **kwargs)
+            except Exception as e:
+                outcome["error"] = e
+            finally:
+                chunks.put(None)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            while True:
+                delta = chunks.get()
+                if delta is None:
+                    break
+                yield {"delta": delta}
+        finally:
+            # An abandoned stream ends decoding so the lock is released promptly
+            cancelled.set()
+        thread.join()
+
+        if "error" in outcome:
+            raise outcome["error"]
+        yield outcome["result"]
+
+    def count_tokens(self, text: str) -> int:
+        """Number of tokens the model's tokenizer produces for a piece of text"""
+        return len(self._tokenize(text, special=False))
+
+    def encode_message(self, role: str, content: str) -> List[int]:
+        """Token ids of one formatted chat message, as they appear in a prompt"""
+        return self._tokenize(format_message(role, content), special=True)
+
+    def extract_sections(self, text: str) -> Dict[str, Optional[str]]:
+        """
+        Extract sections from the generated text
+
+        Args:
+            text: The generated text to extract sections from
+
+        Returns:
+            Dictionary with extracted sections
+        """
+        return parse_sections(text)
@@ -29,8 +29,8 @@ class ModelLoadingMonitor:
         self.last_update = time.time()
         self.subscribers = []
         
-    def update_progress(self, file_name: str, progress: int, total: int = 100):
-        """Update the progress for a specific file."""
+    def update_progress(self, file_name: str, progress: int, total: int = 100, load_seconds: Optional[float] = None):
+        """Update the progress for a specific file, optionally with the time it took to load."""
         self.is_loading = True
         self.last_update = time.time()
         
@@ -40,6 +40,8 @@ class ModelLoadingMonitor:
             'total': total,
             'percentage': progress / total * 100
         }
+        if load_seconds is not None:
+            self.current_progress[file_name]['load_seconds'] = round(load_seconds, 3)
         
         # Notify subscribers
         for callback in self.subscribers:
@@ -0,0 +1,468 @@
+import gc
+import os
+import re
+import sys
+import time
+import threading
+import logging
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from app.config import MODEL_MEMORY_BUDGET_GB, MODEL_IDLE_TTL_SECONDS
+from app.memory_governor import memory_governor, EXPENSIVE_EVICTOR_PRIORITY
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Registry key: (model_name, backend, dtype, draft_model_name or "")
+ModelKey = Tuple[str, str, str, str]
+
+# Bytes per weight by dtype, for sizing a model before its first load ('gguf' is ~4.5-bit quantization)
+DTYPE_BYTES = {"fp32": 4, "auto": 4, "fp16": 2, "bf16": 2, "int8": 1, "gguf": 0.6}
+
+# Parameter count in a model name, e.g. 'Qwen2.5-3B-Instruct' or 'MedAgentReasoner-3B-Chat'
+PARAMETER_COUNT_PATTERN = re.compile(r"(\d+(?:\.\d+)?)[Bb](?![A-Za-z])")
+
+
+def estimate_handler_bytes(handler: Any) -> int:
+    """
+    Estimate the resident size of a loaded model handler in bytes.
+    Uses the size reported by the handler, or the parameter and buffer sizes
+    of the underlying torch model when available.
+    """
+    if getattr(handler, "memory_bytes", None):
+        return int(handler.memory_bytes)
+    model = getattr(handler, "model", None)
+    if model is None or not hasattr(model, "parameters"):
+        return 0
+    try:
+        total = sum(p.numel() * p.element_size() for p in model.parameters())
+        total += sum(b.numel() * b.element_size() for b in model.buffers())
+        return int(total)
+    except Exception as e:
+        logger.debug(f"Could not estimate model size: {e}")
+        return 0
+
+
+def estimate_model_bytes(key: ModelKey) -> int:
+    """
+    Estimate the size of a model before it is loaded, from the file size of a local
+    model file or the parameter count in the model name, plus the draft model if any.
+    Returns 0 if the size cannot be guessed.
+    """
+    dtype = key[2]
+    total = 0
+    for name in (key[0], key[3]):
+        if not name:
+            continue
+        if os.path.isfile(name):
+            total += os.path.getsize(name)
+            continue
+        match = PARAMETER_COUNT_PATTERN.search(name.split("/")[-1])
+        if match:
+            total += int(float(match.group(1)) * 1e9 * DTYPE_BYTES.get(dtype, 4))
+    return total
+
+
+class _RegistryEntry:
+    """Bookkeeping for a single model in the registry."""
+
+    def __init__(self, key: ModelKey, loader: Callable[[], Any], tokenizer_loader: Optional[Callable[[], Any]] = None):
+        self.key = key
+        self.loader = loader
+        self.handler = None
+        # Tokenizer without the weights, kept across unloads (see ModelRegistry.tokenizer)
+        self.tokenizer_loader = tokenizer_loader
+        self.tokenizer = None
+        self.tokenizer_lock = threading.Lock()
+        # Reported by the handler on its last load; kept so sizing a request never loads the model
+        self.kv_bytes_per_token = None
+        self.size_bytes = 0
+        self.in_use = 0
+        # Requests about to use the model (see ModelRegistry.reserved)
+        self.reserved = 0
+        self.load_count = 0
+        self.last_used = 0.0
+        self.load_seconds = 0.0
+        self.load_lock = threading.Lock()
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.handler is not None
+
+    @property
+    def is_busy(self) -> bool:
+        """In use, or reserved by a request that is about to use it; never unloaded"""
+        return self.in_use > 0 or self.reserved > 0
+
+
+class ModelRegistry:
+    """
+    Singleton registry of model handlers shared across the process.
+    Handlers are deduplicated by (model, backend, dtype, draft model), loaded on first use,
+    and unloaded least-recently-used first when the memory budget is exceeded
+    or when a model has been idle for longer than the TTL.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = super(ModelRegistry, cls).__new__(cls)
+                cls._instance._initialize()
+            return cls._instance
+
+    def _initialize(self):
+        """Initialize the registry state."""
+        self.entries: Dict[ModelKey, _RegistryEntry] = {}
+        self.state_lock = threading.RLock()
+        self.budget_bytes = int(MODEL_MEMORY_BUDGET_GB * 1024 ** 3) if MODEL_MEMORY_BUDGET_GB > 0 else 0
+        self.idle_ttl = MODEL_IDLE_TTL_SECONDS
+        self.evictions = 0
+        self._reaper = None
+
+    def register(self, key: ModelKey, loader: Callable[[], Any],
+                 tokenizer_loader: Optional[Callable[[], Any]] = None) -> "ModelHandle":
+        """
+        Register a model without loading it and return a lazy handle.
+        Registering the same key twice returns a handle to the same entry.
+
+        Args:
+            key: Registry key of the model
+            loader: Loads the model handler
+            tokenizer_loader: Loads only the tokenizer, returning an object with count_tokens()
+                and encode_message(); without one, counting tokens loads the model
+        """
+        with self.state_lock:
+            if key not in self.entries:
+                self.entries[key] = _RegistryEntry(key, loader, tokenizer_loader)
+                logger.info(f"Registered model {key[0]} (backend={key[1]}, dtype={key[2]})")
+        return ModelHandle(self, key)
+
+    def acquire(self, key: ModelKey) -> Any:
+        """
+        Return the loaded handler for a key, loading it if necessary, and mark it in use.
+
+        Raises:
+            KeyError: If the key is not registered
+            RuntimeError: If loading the model fails
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            raise KeyError(f"Model {key} is not registered")
+
+        with entry.load_lock:
+            with self.state_lock:
+                if entry.is_loaded:
+                    entry.in_use += 1
+                    entry.last_used = time.time()
+                    return entry.handler
+            # The load marks the model in use before releasing state_lock, so it cannot be
+            # evicted before the caller gets it
+            return self._load(entry)
+
+    def loaded_handler(self, key: ModelKey) -> Any:
+        """The handler for a key if it is loaded, or None; never loads it"""
+        entry = self.entries.get(key)
+        return entry.handler if entry is not None else None
+
+    def tokenizer(self, key: ModelKey) -> Any:
+        """
+        Something that tokenizes like the model for a key, without loading its weights:
+        the loaded handler, or the tokenizer loaded on its own and kept across unloads.
+        Returns None if the model is not loaded and has no tokenizer loader.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        handler = entry.handler
+        if handler is not None:
+            return handler
+        if entry.tokenizer_loader is None:
+            return None
+        with entry.tokenizer_lock:
+            if entry.tokenizer is None:
+                logger.info(f"Loading tokenizer for {key[0]}")
+                entry.tokenizer = entry.tokenizer_loader()
+            return entry.tokenizer
+
+    @contextmanager
+    def reserved(self, key: ModelKey):
+        """
+        Keep a model from being unloaded, without loading it, while a request prepares and
+        runs a generation. Memory relief during the request's admission check then frees
+        other caches instead of the model the request is about to use.
+        Keys that are not registered are ignored.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            yield
+            return
+        with self.state_lock:
+            entry.reserved += 1
+        try:
+            yield
+        finally:
+            with self.state_lock:
+                entry.reserved -= 1
+
+    def release(self, key: ModelKey):
+        """Mark one use of a model as finished."""
+        with self.state_lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.in_use > 0:
+                entry.in_use -= 1
+                entry.last_used = time.time()
+
+    def _load(self, entry: _RegistryEntry) -> Any:
+        """Load a model and mark it in use, making room under the memory budget first."""
+        # Free space ahead of time: the size of the last load, or an estimate on the first one
+        incoming_bytes = entry.size_bytes or estimate_model_bytes(entry.key)
+        if incoming_bytes:
+            self._enforce_budget(incoming_bytes=incoming_bytes, exclude=entry.key)
+
+        logger.info(f"Loading model {entry.key[0]} (backend={entry.key[1]}, dtype={entry.key[2]})")
+        start_time = time.time()
+        handler = entry.loader()
+        entry.load_seconds = time.time() - start_time
+        if handler is None:
+            raise RuntimeError(f"Loading model {entry.key[0]} returned no handler")
+
+        with self.state_lock:
+            entry.handler = handler
+            entry.size_bytes = estimate_handler_bytes(handler) or incoming_bytes
+            entry.kv_bytes_per_token = getattr(handler, "kv_bytes_per_token", None)
+            entry.load_count += 1
+            entry.in_use += 1
+            entry.last_used = time.time()
+
+        logger.info(f"Loaded {entry.key[0]} in {entry.load_seconds:.1f}s ({entry.size_bytes / 1024 ** 3:.2f} GB)")
+        self._enforce_budget(exclude=entry.key)
+        self._ensure_reaper()
+        return handler
+
+    def loaded_bytes(self) -> int:
+        """Total estimated size of all loaded models."""
+        with self.state_lock:
+            return sum(e.size_bytes for e in self.entries.values() if e.is_loaded)
+
+    def _enforce_budget(self, incoming_bytes: int = 0, exclude: Optional[ModelKey] = None):
+        """Unload least-recently-used idle models until the budget is respected."""
+        if not self.budget_bytes:
+            return
+        with self.state_lock:
+            candidates = sorted(
+                (e for e in self.entries.values() if e.is_loaded and e.key != exclude),
+                key=lambda e: e.last_used
+            )
+            for entry in candidates:
+                if self.loaded_bytes() + incoming_bytes <= self.budget_bytes:
+                    break
+                if entry.is_busy:
+                    continue
+                self._unload(entry, reason="memory budget exceeded")
+
+            if self.loaded_bytes() + incoming_bytes > self.budget_bytes:
+                logger.warning(
+                    f"Model memory {(self.loaded_bytes() + incoming_bytes) / 1024 ** 3:.2f} GB exceeds "
+                    f"budget of {self.budget_bytes / 1024 ** 3:.2f} GB and nothing else can be evicted"
+                )
+
+    def evict_idle(self) -> List[ModelKey]:
+        """Unload models that have not been used for longer than the idle TTL."""
+        evicted = []
+        if self.idle_ttl <= 0:
+            return evicted
+        now = time.time()
+        with self.state_lock:
+            for entry in self.entries.values():
+                if entry.is_loaded and not entry.is_busy and now - entry.last_used > self.idle_ttl:
+                    self._unload(entry, reason=f"idle for {now - entry.last_used:.0f}s")
+                    evicted.append(entry.key)
+        return evicted
+
+    def evict(self, key: ModelKey) -> bool:
+        """Unload a specific model if it is loaded and not in use."""
+        with self.state_lock:
+            entry = self.entries.get(key)
+            if entry is None or not entry.is_loaded or entry.is_busy:
+                return False
+            self._unload(entry, reason="explicit eviction")
+            return True
+
+    def release_memory(self) -> int:
+        """Unload the least recently used model that is not in use or reserved; returns its estimated size"""
+        with self.state_lock:
+            candidates = sorted(
+                (e for e in self.entries.values() if e.is_loaded and not e.is_busy),
+                key=lambda e: e.last_used
+            )
+            if not candidates:
+                return 0
+            entry = candidates[0]
+            self._unload(entry, reason="memory pressure")
+            return entry.size_bytes
+
+    def _unload(self, entry: _RegistryEntry, reason: str):
+        """Drop the handler reference and release the memory it held."""
+        logger.info(f"Unloading model {entry.key[0]} (backend={entry.key[1]}, dtype={entry.key[2]}): {reason}")
+        entry.handler = None
+        self.evictions += 1
+        gc.collect()
+        # Only touch torch if it is already imported
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _ensure_reaper(self):
+        """Start the background thread that evicts idle models."""
+        if self.idle_ttl <= 0 or (self._reaper is not None and self._reaper.is_alive()):
+            return
+        interval = max(1.0, min(60.0, self.idle_ttl / 4))
+
+        def reap():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.evict_idle()
+                except Exception as e:
+                    logger.error(f"Error evicting idle models: {e}")
+
+        self._reaper = threading.Thread(target=reap, name="model-registry-reaper", daemon=True)
+        self._reaper.start()
+
+    def get_state(self) -> Dict[str, Any]:
+        """Get a summary of the registry for monitoring."""
+        now = time.time()
+        with self.state_lock:
+            models = [
+                {
+                    "model": e.key[0],
+                    "backend": e.key[1],
+                    "dtype": e.key[2],
+                    "draft_model": e.key[3] or None,
+                    "loaded": e.is_loaded,
+                    "in_use": e.in_use,
+                    "reserved": e.reserved,
+                    "size_gb": round(e.size_bytes / 1024 ** 3, 3),
+                    "load_count": e.load_count,
+                    "load_seconds": round(e.load_seconds, 2),
+                    "idle_seconds": round(now - e.last_used, 1) if e.last_used else None
+                }
+                for e in self.entries.values()
+            ]
+            return {
+                "models": models,
+                "loaded_gb": round(self.loaded_bytes() / 1024 ** 3, 3),
+                "budget_gb": round(self.budget_bytes / 1024 ** 3, 3) if self.budget_bytes else None,
+                "idle_ttl_seconds": self.idle_ttl if self.idle_ttl > 0 else None,
+                "evictions": self.evictions
+            }
+
+
+class ModelHandle:
+    """
+    Lazy proxy to a registry-managed model handler.
+    The handler is loaded on first use and may be unloaded between calls,
+    so callers should keep the handle rather than the handler itself.
+    Only generation loads the model: sizing a request and counting tokens do not.
+    """
+
+    def __init__(self, registry: ModelRegistry, key: ModelKey):
+        self._registry = registry
+        self.key = key
+
+    @property
+    def model_name(self) -> str:
+        return self.key[0]
+
+    @property
+    def backend(self) -> str:
+        return self.key[1]
+
+    @property
+    def kv_bytes_per_token(self) -> Optional[int]:
+        """KV cache bytes per token reported on the model's last load, None before the first one"""
+        return self._registry.entries[self.key].kv_bytes_per_token
+
+    def count_tokens(self, text: str) -> int:
+        """Number of tokens the model's tokenizer produces for a piece of text"""
+        tokenizer = self._registry.tokenizer(self.key)
+        if tokenizer is not None:
+            return tokenizer.count_tokens(text)
+        handler = self._registry.acquire(self.key)
+        try:
+            return handler.count_tokens(text)
+        finally:
+            self._registry.release(self.key)
+
+    def encode_message(self, role: str, content: str) -> List[int]:
+        """Token ids of one formatted chat message, as they appear in a prompt"""
+        tokenizer = self._registry.tokenizer(self.key)
+        if tokenizer is not None:
+            return tokenizer.encode_message(role, content)
+        handler = self._registry.acquire(self.key)
+        try:
+            return handler.encode_message(role, content)
+        finally:
+            self._registry.release(self.key)
+
+    def load_kv_cache(self, path: str) -> Any:
+        """Restore a saved KV cache with the underlying handler, loading it if needed."""
+        handler = self._registry.acquire(self.key)
+        try:
+            return handler.load_kv_cache(path)
+        finally:
+            self._registry.release(self.key)
+
+    def generate(self, messages: List[Dict[str, str]], **kwargs) -> Dict[str, Any]:
+        """Generate with the underlying handler, loading it if needed."""
+        handler = self._registry.acquire(self.key)
+        try:
+            return handler.generate(messages, **kwargs)
+        finally:
+            self._registry.release(self.key)
+
+    def generate_batch(self, conversations: List[List[Dict[str, str]]], **kwargs) -> List[Dict[str, Any]]:
+        """Generate responses for several conversations in one batch, loading the handler if needed."""
+        handler = self._registry.acquire(self.key)
+        try:
+            return handler.generate_batch(conversations, **kwargs)
+        finally:
+            self._registry.release(self.key)
+
+    def stream_generate(self, messages: List[Dict[str, str]], **kwargs) -> Iterator[Dict[str, Any]]:
+        """Stream a generation from the underlying handler, keeping it in use until the stream ends."""
+        handler = self._registry.acquire(self.key)
+        try:
+            yield from handler.stream_generate(messages, **kwargs)
+        finally:
+            self._registry.release(self.key)
+
+    def extract_sections(self, text: str) -> Dict[str, Optional[str]]:
+        """Extract sections with the underlying handler, loading it if needed."""
+        handler = self._registry.acquire(self.key)
+        try:
+            return handler.extract_sections(text)
+        finally:
+            self._registry.release(self.key)
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("__"):
+            raise AttributeError(name)
+        # Forward anything else to the handler only if it is loaded, so probes such as
+        # getattr(handle, name, None) never load the model
+        handler = self._registry.loaded_handler(self.key)
+        if handler is None:
+            raise AttributeError(f"{name} is not available until {self.key[0]} is loaded")
+        return getattr(handler, name)
+
+    def __repr__(self) -> str:
+        return f"ModelHandle(model={self.key[0]!r}, backend={self.key[1]!r}, dtype={self.key[2]!r})"
+
+
+# Create singleton instance
+model_registry = ModelRegistry()
+# Reloading a model is slow, so idle models are only unloaded above the hard limit or to fit a generation
+memory_governor.register_evictor("idle_models", model_registry.release_memory, priority=EXPENSIVE_EVICTOR_PRIORITY)
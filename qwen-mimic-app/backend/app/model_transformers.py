@@ -1,11 +1,27 @@
-import re
+import os
 import torch
 import logging
 import sys
-import io
-from typing import List, Dict, Any, Optional
-from transformers import AutoModelForCausalLM, AutoTokenizer
+import time
+import threading
+from contextlib import nullcontext
+from typing import List, Dict, Any, Iterator, Optional
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    DynamicCache,
+    StaticCache,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextIteratorStreamer
+)
+from app.config import FAST_MODEL_LOADING
+from app.cpu_tuning import configure_torch_threads
+from app.memory_governor import kv_bytes_per_token
+from app.fast_loader import find_local_checkpoint, load_model_fast
 from app.model_progress import progress_monitor, monitor_stderr_for_progress
+from app.section_parser import parse_sections
+from app.tokenization import MessageTokenCache, format_messages
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -33,20 +49,133 @@ class StderrCapturer:
     def flush(self):
         self.orig_stderr.flush()
 
+# Closing tags that end a reasoning step - same as the vLLM stop_token_ids (</search>, </answer>)
+STOP_TAGS = ["</search>", "</answer>"]
+
+class StopOnTags(StoppingCriteria):
+    """
+    Stop generation once a sequence has produced one of the stop strings.
+    Only the last few generated tokens are decoded on each step, so the
+    check costs the same regardless of how long the output is.
+    """
+    
+    def __init__(self, tokenizer, stop_strings: List[str], prompt_length: int):
+        self.tokenizer = tokenizer
+        self.stop_strings = stop_strings
+        self.prompt_length = prompt_length
+        # Enough tokens to cover the longest stop string even if it is split character by character
+        self.window = max(len(s) for s in stop_strings) + 2
+        self.triggered = None
+    
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        done = []
+        for row in input_ids:
+            start = max(self.prompt_length, row.shape[0] - self.window)
+            tail = self.tokenizer.decode(row[start:], skip_special_tokens=False)
+            hit = next((s for s in self.stop_strings if s in tail), None)
+            if hit and self.triggered is None:
+                self.triggered = hit
+            done.append(hit is not None)
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+class KVCache:
+    """
+    Key/value cache left by a previous generation, with the token ids it covers.
+    Passing it to the next generate() call for the same conversation skips
+    re-processing the shared prefix of the prompt.
+    """
+    
+    def __init__(self, token_ids: torch.Tensor, past_key_values):
+        self.token_ids = token_ids.detach().to("cpu")
+        if not isinstance(past_key_values, DynamicCache):
+            past_key_values = DynamicCache.from_legacy_cache(past_key_values)
+        self.past_key_values = past_key_values
+    
+    @property
+    def length(self) -> int:
+        """Number of tokens held in the cache"""
+        return self.past_key_values.get_seq_length()
+    
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the cached keys and values"""
+        return sum(
+            t.numel() * t.element_size()
+            for layer in self.past_key_values.to_legacy_cache()
+            for t in layer
+        )
+    
+    def save(self, path: str):
+        """Write the cache to disk (moved to CPU first)"""
+        layers = [tuple(t.to("cpu") for t in layer) for layer in self.past_key_values.to_legacy_cache()]
+        torch.save({"token_ids": self.token_ids, "layers": layers}, path)
+    
+    @classmethod
+    def load(cls, path: str, device: torch.device) -> "KVCache":
+        """Read a cache written by save() back onto a device"""
+        data = torch.load(path, map_location=device)
+        layers = tuple(tuple(t for t in layer) for layer in data["layers"])
+        return cls(data["token_ids"], DynamicCache.from_legacy_cache(layers))
+
+# Weight precision modes supported on CPU
+CPU_PRECISIONS = ["fp32", "bf16", "int8"]
+
+# Static cache lengths for compiled decoding; each one is compiled once at startup
+DEFAULT_CACHE_BUCKETS = [2048, 4096, 8192]
+
+# Batched prompts sharing at least this many leading tokens prefill them once for the whole batch
+MIN_SHARED_PREFIX_TOKENS = 32
+
+def common_prefix_length(sequences: List[List[int]]) -> int:
+    """Number of leading tokens all sequences have in common"""
+    length = 0
+    for tokens in zip(*sequences):
+        if any(token != tokens[0] for token in tokens):
+            break
+        length += 1
+    return length
+
+def model_memory_bytes(model) -> int:
+    """
+    Size of a model's weights in bytes, counted from its state dict so that
+    packed int8 weights of dynamically quantized Linear layers are included
+    """
+    def tensor_bytes(value) -> int:
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(tensor_bytes(v) for v in value)
+        return 0
+    
+    return sum(tensor_bytes(v) for v in model.state_dict().values())
+
 class TransformersModelHandler:
     """
     Transformers-based implementation of model handling - optimized for M1 Macs
     """
     
-    def __init__(self, model_name: str):
+    def __init__(self, model_name: str, precision: str = "fp32",
+                 draft_model_name: Optional[str] = None, num_assistant_tokens: int = 5,
+                 compile_decode: bool = False, cache_buckets: Optional[List[int]] = None):
         """
         Initialize the Transformers model handler
         
         Args:
             model_name: Name of the model to load
+            precision: Weight precision used on CPU - 'fp32', 'bf16' (bfloat16 weights)
+                or 'int8' (dynamic int8 quantization of Linear layers).
+                GPU and MPS devices always use float16.
+            draft_model_name: Optional small model sharing the tokenizer, used for
+                assisted (speculative) decoding
+            num_assistant_tokens: Number of tokens the draft model proposes per verification step
+            compile_decode: Decode with a static KV cache and a torch.compile'd decode step
+            cache_buckets: Static cache lengths compiled for compile_decode (one graph each)
         """
         logger.info(f"Initializing Transformers model handler for {model_name}")
         
+        if precision not in CPU_PRECISIONS:
+            raise ValueError(f"Unknown precision '{precision}', expected one of {CPU_PRECISIONS}")
+        
         # Reset the progress monitor before loading
         progress_monitor.reset()
         
@@ -60,47 +189,97 @@ class TransformersModelHandler:
             self.device = torch.device("cuda")
             device_map = "auto"  # Use auto device mapping for better memory management
         else:
-            logger.info("Using CPU for inference (slower)")
+            logger.info(f"Using CPU for inference (slower), precision: {precision}")
             self.device = torch.device("cpu")
             device_map = None  # CPU doesn't need device mapping
+            # Thread counts from the CPU tuning profile applied at startup
+            configure_torch_threads()
+        
+        # Precision only applies on CPU; accelerators keep half precision
+        self.precision = precision if self.device.type == "cpu" else "fp16"
+        self.device_map = device_map
+        self.draft_model = None
+        self.num_assistant_tokens = num_assistant_tokens
+        self.compiled_decode = False
+        self.compile_seconds = 0.0
             
-        # Load model and tokenizer with stderr capture
+        # Pre-staged local checkpoints are loaded directly and report per-shard progress;
+        # downloads report progress on stderr, which is captured and parsed
+        local_dir = find_local_checkpoint(model_name) if FAST_MODEL_LOADING else None
+        has_local_tokenizer = local_dir is not None and os.path.isfile(os.path.join(local_dir, "tokenizer_config.json"))
+        
+        # Load model and tokenizer
         try:
-            with StderrCapturer():
+            with StderrCapturer() if local_dir is None else nullcontext():
                 logger.info("Loading tokenizer...")
-                self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+                self.tokenizer = AutoTokenizer.from_pretrained(local_dir if has_local_tokenizer else model_name)
+                self.token_cache = MessageTokenCache(self.tokenizer)
                 
                 logger.info("Loading model...")
-                self.model = AutoModelForCausalLM.from_pretrained(
-                    model_name,
-                    torch_dtype=torch.float16 if self.device.type != "cpu" else torch.float32,
-                    device_map=device_map,
-                    low_cpu_mem_usage=True
-                )
+                self.model = self._load_model(model_name)
+                
+                if draft_model_name:
+                    logger.info(f"Loading draft model {draft_model_name} for assisted decoding...")
+                    self.draft_model = self._load_model(draft_model_name)
+                    # Propose a fixed number of tokens per step rather than HF's adaptive schedule
+                    self.draft_model.generation_config.num_assistant_tokens = num_assistant_tokens
+                    self.draft_model.generation_config.num_assistant_tokens_schedule = "constant"
+            
+            self.memory_bytes = model_memory_bytes(self.model)
+            # KV cache growth per token, used by the memory governor to size requests
+            self.kv_bytes_per_token = kv_bytes_per_token(self.model.config, torch.finfo(self.model.dtype).bits // 8)
+            if self.draft_model is not None:
+                self.memory_bytes += model_memory_bytes(self.draft_model)
+            
+            if compile_decode:
+                self.enable_compiled_decode(cache_buckets or DEFAULT_CACHE_BUCKETS)
             
             # Mark loading as complete
             progress_monitor.mark_loading_complete()
-            logger.info(f"Successfully loaded model on {self.device}")
+            logger.info(f"Successfully loaded model on {self.device} ({self.memory_bytes / 1024 ** 3:.2f} GB weights)")
         except Exception as e:
             logger.error(f"Error loading model: {str(e)}")
             raise RuntimeError(f"Failed to load model: {e}")
             
+    def _load_model(self, model_name: str):
+        """Load a causal LM in the handler's precision on the handler's device"""
+        if self.precision == "fp16":
+            torch_dtype = torch.float16
+        elif self.precision == "bf16":
+            torch_dtype = torch.bfloat16
+        else:
+            # int8 quantization starts from the float32 weights
+            torch_dtype = torch.float32
+        
+        model = None
+        local_dir = find_local_checkpoint(model_name) if FAST_MODEL_LOADING else None
+        if local_dir is not None:
+            try:
+                model = load_model_fast(local_dir, torch_dtype)
+                if self.device.type != "cpu":
+                    model = model.to(self.device)
+            except Exception as e:
+                logger.warning(f"Fast loading from {local_dir} failed, falling back to from_pretrained: {e}")
+                model = None
+        
+        if model is None:
+            model = AutoModelForCausalLM.from_pretrained(
+                model_name,
+                torch_dtype=torch_dtype,
+                device_map=self.device_map,
+                low_cpu_mem_usage=True
+            )
+        
+        if self.precision == "int8":
+            logger.info("Applying dynamic int8 quantization to Linear layers...")
+            model = torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        return model.eval()
+    
     def _format_messages(self, messages: List[Dict[str, str]]) -> str:
         """Format messages into a prompt the model can understand"""
-        prompt = ""
-        for msg in messages:
-            role = msg["role"]
-            content = msg["content"]
-            if role == "user":
-                prompt += f"<|im_start|>user\n{content}<|im_end|>\n"
-            elif role == "assistant":
-                prompt += f"<|im_start|>assistant\n{content}<|im_end|>\n"
-            else:
-                prompt += f"<|im_start|>{role}\n{content}<|im_end|>\n"
-        
-        # Add the final assistant prefix to prime the generation
-        prompt += "<|im_start|>assistant\n"
-        return prompt
+        return format_messages(messages)
         
     def generate(self, messages: List[Dict[str, str]], **kwargs) -> Dict[str, Any]:
         """
@@ -111,54 +290,394 @@ class TransformersModelHandler:
             **kwargs: Additional parameters for generation
                 temperature: Float temperature for generation
                 max_tokens: Maximum number of tokens to generate
+                use_draft: Use the draft model for assisted decoding if one is loaded (default True)
+                stop: Stop strings ending generation (default: </search> and </answer>, as with vLLM)
+                streamer: Optional transformers streamer receiving tokens as they are generated
+                kv_cache: KVCache from an earlier turn of the same conversation; the shared
+                    prompt prefix is not re-processed, and the cache is updated in place
+                return_cache: Include a KVCache for this generation in the result (key 'kv_cache');
+                    not available when the generation ran in compiled mode
                 
         Returns:
             Dictionary with generated text and metadata
         """
         try:
-            # Format messages into a prompt
-            prompt = self._format_messages(messages)
-            
             # Set generation parameters
             temperature = kwargs.get('temperature', 0.5)
             max_new_tokens = kwargs.get('max_tokens', 1000)
             
-            # Tokenize and generate
-            inputs = self.tokenizer(prompt, return_tensors="pt", padding=True)
+            # Assemble the prompt from cached per-message token ids; only new messages are tokenized
+            input_ids = torch.tensor([self.token_cache.encode_messages(messages)], dtype=torch.long, device=self.device)
+            inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+            
+            # Stop as soon as a reasoning step is complete instead of running to max_tokens
+            stop_strings = kwargs.get('stop', STOP_TAGS)
+            stop_criteria = None
+            generation_kwargs = {}
+            if kwargs.get('streamer') is not None:
+                generation_kwargs["streamer"] = kwargs['streamer']
+            if stop_strings:
+                stop_criteria = StopOnTags(self.tokenizer, stop_strings, inputs["input_ids"].shape[1])
+                generation_kwargs["stopping_criteria"] = StoppingCriteriaList([stop_criteria])
+            
+            # Compiled decoding runs on a pre-allocated static cache, so it replaces
+            # session cache reuse and assisted decoding for this generation
+            static_cache = None
+            if self.compiled_decode:
+                static_cache = self._acquire_static_cache(inputs["input_ids"].shape[1] + max_new_tokens)
+                if static_cache is not None:
+                    generation_kwargs["past_key_values"] = static_cache
+            
+            # Reuse the key/value cache of the previous turn for the shared prompt prefix
+            kv_cache = kwargs.get('kv_cache')
+            cached_tokens = 0
+            if kv_cache is not None and static_cache is None:
+                cached_tokens = self._reuse_cache(kv_cache, inputs["input_ids"][0])
+                if cached_tokens:
+                    generation_kwargs["past_key_values"] = kv_cache.past_key_values
             
-            # Explicitly create attention mask if not present
-            if 'attention_mask' not in inputs:
-                # Create attention mask (1 for all tokens)
-                inputs['attention_mask'] = torch.ones_like(inputs['input_ids'])
+            # Assisted decoding manages its own caches, so it is skipped when reusing one
+            use_draft = (self.draft_model is not None and kwargs.get('use_draft', True)
+                         and not cached_tokens and static_cache is None)
+            if use_draft:
+                generation_kwargs["assistant_model"] = self.draft_model
+                # Count forward passes to work out how many draft tokens were accepted
+                forward_calls = {"target": 0, "draft": 0}
                 
-            # Move inputs to the correct device
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
+                def count_target(*_):
+                    forward_calls["target"] += 1
+                
+                def count_draft(*_):
+                    forward_calls["draft"] += 1
+                
+                hooks = [
+                    self.model.register_forward_hook(count_target),
+                    self.draft_model.register_forward_hook(count_draft)
+                ]
             
             # Generate with appropriate parameters
+            try:
+                with torch.no_grad():
+                    outputs = self.model.generate(
+                        input_ids=inputs["input_ids"],
+                        attention_mask=inputs["attention_mask"],
+                        max_new_tokens=max_new_tokens,
+                        temperature=temperature,
+                        do_sample=temperature > 0,
+                        top_p=0.95,
+                        pad_token_id=self.tokenizer.eos_token_id,
+                        return_dict_in_generate=True,
+                        **generation_kwargs
+                    )
+            finally:
+                if use_draft:
+                    for hook in hooks:
+                        hook.remove()
+                if static_cache is not None:
+                    self._static_cache_lock.release()
+            sequences = outputs.sequences
+            
+            # Decode only the newly generated ids
+            prompt_tokens = inputs["input_ids"].shape[1]
+            response_text = self.tokenizer.decode(sequences[0][prompt_tokens:], skip_special_tokens=False).strip()
+            num_tokens = sequences.shape[1] - prompt_tokens
+            
+            result = {
+                "text": response_text,
+                "backend": "transformers",
+                "num_tokens": num_tokens,
+                "prompt_tokens": prompt_tokens,
+                "cached_tokens": cached_tokens,
+                "stopped_on": None,
+                "tokens_saved": 0,
+                "compiled": static_cache is not None and self.compiled_decode
+            }
+            
+            if kwargs.get('return_cache') and static_cache is None and getattr(outputs, "past_key_values", None) is not None:
+                result["kv_cache"] = KVCache(sequences[0], outputs.past_key_values)
+            
+            if stop_criteria is not None and stop_criteria.triggered:
+                # Without the stop criteria decoding would have continued up to max_new_tokens
+                result["stopped_on"] = stop_criteria.triggered
+                result["tokens_saved"] = max(0, max_new_tokens - num_tokens)
+                logger.info(f"Stopped on {stop_criteria.triggered} after {num_tokens} tokens, saved up to {result['tokens_saved']}")
+            
+            if use_draft:
+                # Each verification step (one target forward) emits the accepted draft tokens plus one
+                accepted = max(0, num_tokens - forward_calls["target"])
+                proposed = forward_calls["draft"]
+                result["draft_tokens_proposed"] = proposed
+                result["draft_tokens_accepted"] = accepted
+                result["draft_acceptance_rate"] = accepted / proposed if proposed else 0.0
+                logger.info(f"Assisted decoding: {accepted}/{proposed} draft tokens accepted ({result['draft_acceptance_rate']:.0%})")
+            
+            return result
+        except Exception as e:
+            logger.error(f"Error during generation: {str(e)}")
+            raise RuntimeError(f"Failed to generate response: {e}")
+        
+    def generate_batch(self, conversations: List[List[Dict[str, str]]], **kwargs) -> List[Dict[str, Any]]:
+        """
+        Generate responses for several conversations in one batched forward pass per step
+        
+        Prompts are left-padded to the same length; finished rows are padded until the
+        slowest row stops, so batches of similar prompts waste the least compute. Leading
+        tokens common to all prompts (such as the shared instructions of the system prompt)
+        are prefilled once and their key/value cache is reused by every row; padding then
+        goes between that shared prefix and each row's own tokens.
+        Session KV caches, assisted decoding and compiled decoding only apply to single
+        generations and are not used here.
+        
+        Args:
+            conversations: List of message lists, one per response
+            **kwargs: Additional parameters for generation
+                temperature: Float temperature for generation
+                max_tokens: Maximum number of tokens to generate per conversation
+                stop: Stop strings ending a row (default: </search> and </answer>)
+                
+        Returns:
+            One result dictionary per conversation, in order, with the same keys as generate()
+        """
+        if len(conversations) == 1:
+            return [self.generate(conversations[0], use_draft=False, **kwargs)]
+        try:
+            temperature = kwargs.get('temperature', 0.5)
+            max_new_tokens = kwargs.get('max_tokens', 1000)
+            stop_strings = kwargs.get('stop', STOP_TAGS)
+            pad_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+            
+            prompts = [self.token_cache.encode_messages(messages) for messages in conversations]
+            generation_kwargs = {}
+            
+            # Every row must keep at least one token of its own for the model to process
+            shared = min(common_prefix_length(prompts), min(len(ids) for ids in prompts) - 1)
+            if shared >= MIN_SHARED_PREFIX_TOKENS:
+                try:
+                    with torch.no_grad():
+                        prefill = self.model(
+                            input_ids=torch.tensor([prompts[0][:shared]], dtype=torch.long, device=self.device),
+                            past_key_values=DynamicCache(),
+                            use_cache=True
+                        )
+                    past_key_values = prefill.past_key_values
+                    past_key_values.batch_repeat_interleave(len(prompts))
+                    generation_kwargs["past_key_values"] = past_key_values
+                except Exception as e:
+                    logger.warning(f"Could not share the prompt prefix across the batch, prefilling every row: {e}")
+                    shared = 0
+            else:
+                shared = 0
+            
+            # Left-pad each row's own tokens so every row's next token is generated at the same position
+            prefix = prompts[0][:shared]
+            suffix_width = max(len(ids) - shared for ids in prompts)
+            width = shared + suffix_width
+            input_ids = torch.tensor(
+                [prefix + [pad_id] * (width - len(ids)) + ids[shared:] for ids in prompts],
+                dtype=torch.long, device=self.device
+            )
+            attention_mask = torch.tensor(
+                [[1] * shared + [0] * (width - len(ids)) + [1] * (len(ids) - shared) for ids in prompts],
+                dtype=torch.long, device=self.device
+            )
+            
+            if stop_strings:
+                # Marks each row done on its own stop tag; rows keep receiving padding afterwards
+                generation_kwargs["stopping_criteria"] = StoppingCriteriaList([StopOnTags(self.tokenizer, stop_strings, width)])
+            
             with torch.no_grad():
                 outputs = self.model.generate(
-                    input_ids=inputs["input_ids"],
-                    attention_mask=inputs["attention_mask"],
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
                     max_new_tokens=max_new_tokens,
                     temperature=temperature,
                     do_sample=temperature > 0,
                     top_p=0.95,
-                    pad_token_id=self.tokenizer.eos_token_id
+                    pad_token_id=pad_id,
+                    return_dict_in_generate=True,
+                    **generation_kwargs
                 )
             
-            # Decode the outputs
-            generated_text = self.tokenizer.decode(outputs[0], skip_special_tokens=False)
-            
-            # Extract the generated text after the prompt
-            response_text = generated_text[len(prompt):].strip()
-            
-            return {
-                "text": response_text,
-                "backend": "transformers"
-            }
+            results = []
+            for row, prompt_ids in zip(outputs.sequences, prompts):
+                generated = row[width:]
+                # Everything after a row's first padding token was filler for the slower rows
+                padding = (generated == pad_id).nonzero()
+                num_tokens = int(padding[0]) if len(padding) else generated.shape[0]
+                text = self.tokenizer.decode(generated[:num_tokens], skip_special_tokens=False).strip()
+                # A row stops as soon as a tag appears, so any tag in the text is the one it stopped on
+                stopped_on = next((s for s in stop_strings or [] if s in text), None)
+                results.append({
+                    "text": text,
+                    "backend": "transformers",
+                    "num_tokens": num_tokens,
+                    "prompt_tokens": len(prompt_ids),
+                    "cached_tokens": 0,
+                    "shared_prefix_tokens": shared,
+                    "stopped_on": stopped_on,
+                    "tokens_saved": max(0, max_new_tokens - num_tokens) if stopped_on else 0,
+                    "compiled": False
+                })
+            return results
         except Exception as e:
-            logger.error(f"Error during generation: {str(e)}")
-            raise RuntimeError(f"Failed to generate response: {e}")
+            logger.error(f"Error during batched generation: {str(e)}")
+            raise RuntimeError(f"Failed to generate batch: {e}")
+        
+    def enable_compiled_decode(self, cache_buckets: List[int]):
+        """
+        Switch to compiled decoding: a static, pre-allocated KV cache and a torch.compile'd
+        single-token decode step. Prefill stays eager. Each cache length in cache_buckets
+        gives one fixed set of shapes, so there are no recompiles after the warm-up here.
+        If compilation fails the handler keeps decoding eagerly.
+        """
+        self.cache_buckets = sorted(cache_buckets)
+        self._static_caches: Dict[int, Any] = {}
+        self._static_cache_lock = threading.Lock()
+        
+        eager_forward = self.model.forward
+        # CUDA graphs cut launch overhead on GPU; on CPU the gain comes from fusing the Python dispatch
+        mode = "reduce-overhead" if self.device.type == "cuda" else "default"
+        compiled_forward = torch.compile(eager_forward, mode=mode, fullgraph=True, dynamic=False)
+        
+        def forward(*args, **kwargs):
+            input_ids = kwargs.get("input_ids")
+            is_decode_step = (
+                self.compiled_decode
+                and input_ids is not None and input_ids.shape[1] == 1
+                and isinstance(kwargs.get("past_key_values"), StaticCache)
+            )
+            if is_decode_step:
+                try:
+                    return compiled_forward(*args, **kwargs)
+                except Exception as e:
+                    logger.warning(f"Compiled decode step failed, falling back to eager decoding: {e}")
+                    self.compiled_decode = False
+            return eager_forward(*args, **kwargs)
+        
+        self.model.forward = forward
+        self.compiled_decode = True
+        
+        # Compile every bucket now rather than on the first request that needs it
+        start = time.perf_counter()
+        warmup_ids = torch.tensor([self.token_cache.encode_messages([{"role": "user", "content": "Hello"}])],
+                                  dtype=torch.long, device=self.device)
+        for bucket in self.cache_buckets:
+            if not self.compiled_decode:
+                break
+            logger.info(f"Compiling decode step for a {bucket}-token static cache...")
+            with self._static_cache_lock, torch.no_grad():
+                self.model.generate(
+                    input_ids=warmup_ids,
+                    attention_mask=torch.ones_like(warmup_ids),
+                    past_key_values=self._static_cache(bucket),
+                    max_new_tokens=3,
+                    do_sample=False,
+                    pad_token_id=self.tokenizer.eos_token_id
+                )
+        self.compile_seconds = time.perf_counter() - start
+        
+        if self.compiled_decode:
+            logger.info(f"Compiled decoding ready for cache lengths {self.cache_buckets} in {self.compile_seconds:.1f}s")
+        else:
+            logger.warning("Compiled decoding disabled, using eager decoding")
+    
+    def _static_cache(self, bucket: int):
+        """Get the reset static cache for a cache length, allocating it on first use"""
+        cache = self._static_caches.get(bucket)
+        if cache is None:
+            cache_kwargs = {"config": self.model.config, "max_cache_len": bucket,
+                            "device": self.device, "dtype": self.model.dtype}
+            try:
+                cache = StaticCache(max_batch_size=1, **cache_kwargs)
+            except TypeError:
+                # Newer transformers size the batch dimension lazily
+                cache = StaticCache(**cache_kwargs)
+            self._static_caches[bucket] = cache
+        else:
+            cache.reset()
+        return cache
+    
+    def _acquire_static_cache(self, needed_tokens: int):
+        """
+        Reserve the smallest static cache that fits a generation.
+        Returns None (eager decoding) if no bucket is large enough or the caches are in use;
+        otherwise the caller must release _static_cache_lock when generation ends.
+        """
+        bucket = next((b for b in self.cache_buckets if b >= needed_tokens), None)
+        if bucket is None:
+            logger.info(f"{needed_tokens} tokens exceed the largest static cache, decoding eagerly")
+            return None
+        if not self._static_cache_lock.acquire(blocking=False):
+            return None
+        try:
+            return self._static_cache(bucket)
+        except Exception:
+            self._static_cache_lock.release()
+            raise
+    
+    def _reuse_cache(self, kv_cache: KVCache, input_ids: torch.Tensor) -> int:
+        """
+        Trim a cache to the prefix it shares with the new prompt.
+        Returns the number of reusable tokens (0 if the cache cannot be used).
+        """
+        # At least one prompt token must be left for the model to process
+        limit = min(kv_cache.length, kv_cache.token_ids.shape[0], input_ids.shape[0] - 1)
+        if limit <= 0:
+            return 0
+        matches = kv_cache.token_ids[:limit].to(input_ids.device) == input_ids[:limit]
+        mismatches = (~matches).nonzero()
+        shared = int(mismatches[0]) if len(mismatches) else limit
+        
+        if shared < kv_cache.length:
+            if shared == 0 or not hasattr(kv_cache.past_key_values, "crop"):
+                return 0
+            kv_cache.past_key_values.crop(shared)
+        return shared
+    
+    def count_tokens(self, text: str) -> int:
+        """Number of tokens the model's tokenizer produces for a piece of text"""
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+    
+    def encode_message(self, role: str, content: str) -> List[int]:
+        """Token ids of one formatted chat message, as they appear in a prompt"""
+        return self.token_cache.message_ids(role, content)
+    
+    def load_kv_cache(self, path: str) -> KVCache:
+        """Load a KVCache saved to disk back onto this handler's device"""
+        return KVCache.load(path, self.device)
+    
+    def stream_generate(self, messages: List[Dict[str, str]], **kwargs) -> Iterator[Dict[str, Any]]:
+        """
+        Generate a response, yielding text as it is decoded
+        
+        Args:
+            messages: List of message dictionaries with 'role' and 'content'
+            **kwargs: Same parameters as generate()
+                
+        Yields:
+            {'delta': text} for each decoded chunk, then the generate() result dictionary
+        """
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=False)
+        outcome = {}
+        
+        def run():
+            try:
+                outcome["result"] = self.generate(messages, streamer=streamer, **kwargs)
+            except Exception as e:
+                outcome["error"] = e
+                # Unblock the consumer if generation failed before the streamer was closed
+                streamer.end()
+        
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        for chunk in streamer:
+            if chunk:
+                yield {"delta": chunk}
+        thread.join()
+        
+        if "error" in outcome:
+            raise outcome["error"]
+        yield outcome["result"]
         
     def extract_sections(self, text: str) -> Dict[str, Optional[str]]:
         """
@@ -171,43 +690,4 @@ class TransformersModelHandler:
             Dictionary with extracted sections
         """
         logger.info(f"Extracting sections from text of length: {len(text)}")
-        
-        # More robust regex patterns that handle whitespace and newlines
-        thinking_pattern = r'<think>\s*(.*?)\s*</think>'
-        search_pattern = r'<search>\s*(.*?)\s*</search>'
-        answer_pattern = r'<answer>\s*(.*?)\s*</answer>'
-        
-        # Extract sections
-        thinking = re.search(thinking_pattern, text, re.DOTALL)
-        search = re.search(search_pattern, text, re.DOTALL)
-        answer = re.search(answer_pattern, text, re.DOTALL)
-        
-        # Log the extraction results
-        if thinking:
-            logger.info("Found <think> section")
-        if search:
-            logger.info("Found <search> section")
-        if answer:
-            logger.info("Found <answer> section")
-        
-        # If no sections are found, check if there might be malformed tags
-        if not thinking and not search and not answer:
-            logger.warning("No sections found in response, checking for malformed tags")
-            logger.debug(f"Response text: {text}")
-            
-            # Look for partial tags
-            has_think_start = "<think>" in text
-            has_think_end = "</think>" in text
-            has_search_start = "<search>" in text
-            has_search_end = "</search>" in text
-            has_answer_start = "<answer>" in text
-            has_answer_end = "</answer>" in text
-            
-            if has_think_start or has_think_end or has_search_start or has_search_end or has_answer_start or has_answer_end:
-                logger.warning(f"Detected partial tags: think[{has_think_start},{has_think_end}], search[{has_search_start},{has_search_end}], answer[{has_answer_start},{has_answer_end}]")
-        
-        return {
-            "thinking": thinking.group(1).strip() if thinking else None,
-            "search_query": search.group(1).strip() if search else None,
-            "answer": answer.group(1).strip() if answer else None
-        } 
+        return parse_sections(text)
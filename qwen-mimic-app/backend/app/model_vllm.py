@@ -1,7 +1,8 @@
-import re
 import logging
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Iterator, Optional
 from vllm import LLM, SamplingParams
+from app.section_parser import parse_sections
+from app.tokenization import format_message
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -32,6 +33,7 @@ class VLLMModelHandler:
                 gpu_memory_utilization=0.0,  # 0.0 to avoid using GPU
                 max_model_len=10000,
                 disable_log_stats=True,
+                enable_prefix_caching=True,  # Reuse KV blocks of shared prompt prefixes across turns
                 dtype="float16",
                 cpu_only=True     # Force CPU-only mode
             )
@@ -45,6 +47,7 @@ class VLLMModelHandler:
                 gpu_memory_utilization=0.96,
                 max_model_len=10000,
                 disable_log_stats=True,
+                enable_prefix_caching=True,  # Reuse KV blocks of shared prompt prefixes across turns
                 dtype="float16"
             )
             
@@ -59,6 +62,43 @@ class VLLMModelHandler:
             stop_token_ids=[151668, 151672]  # </search>, </answer>
         )
         
+    def _params(self, kwargs: Dict[str, Any]) -> SamplingParams:
+        """
+        Sampling parameters for a call, overriding temperature and max_tokens if provided.
+        Stop strings passed as 'stop' replace the reasoning tag stop tokens and, like on the
+        other backends, stay in the output.
+        """
+        if 'temperature' in kwargs or 'max_tokens' in kwargs or 'stop' in kwargs:
+            stop_kwargs = {"stop_token_ids": self.sampling_params.stop_token_ids}
+            if 'stop' in kwargs:
+                stop_kwargs = {"stop": kwargs['stop'] or [], "include_stop_str_in_output": True}
+            return SamplingParams(
+                temperature=kwargs.get('temperature', self.sampling_params.temperature),
+                max_tokens=kwargs.get('max_tokens', self.sampling_params.max_tokens),
+                n=self.sampling_params.n,
+                top_p=self.sampling_params.top_p,
+                skip_special_tokens=self.sampling_params.skip_special_tokens,
+                spaces_between_special_tokens=self.sampling_params.spaces_between_special_tokens,
+                **stop_kwargs
+            )
+        return self.sampling_params
+        
+    @staticmethod
+    def _result(output, params: SamplingParams) -> Dict[str, Any]:
+        """Turn one vLLM request output into the result dictionary"""
+        completion = output.outputs[0]
+        num_tokens = len(completion.token_ids)
+        # stop_reason is the matched stop token id or string, or None when the model emitted EOS
+        stopped_on = getattr(completion, "stop_reason", None)
+        
+        return {
+            "text": completion.text,
+            "backend": "vllm",
+            "num_tokens": num_tokens,
+            "stopped_on": stopped_on,
+            "tokens_saved": max(0, params.max_tokens - num_tokens) if stopped_on is not None else 0
+        }
+        
     def generate(self, messages: List[Dict[str, str]], **kwargs) -> Dict[str, Any]:
         """
         Generate a response from the model
@@ -72,30 +112,46 @@ class VLLMModelHandler:
         Returns:
             Dictionary with generated text and metadata
         """
-        # Override sampling parameters if provided
-        if 'temperature' in kwargs or 'max_tokens' in kwargs:
-            params = SamplingParams(
-                temperature=kwargs.get('temperature', self.sampling_params.temperature),
-                max_tokens=kwargs.get('max_tokens', self.sampling_params.max_tokens),
-                n=self.sampling_params.n,
-                top_p=self.sampling_params.top_p,
-                skip_special_tokens=self.sampling_params.skip_special_tokens,
-                spaces_between_special_tokens=self.sampling_params.spaces_between_special_tokens,
-                stop_token_ids=self.sampling_params.stop_token_ids
-            )
-        else:
-            params = self.sampling_params
-            
+        params = self._params(kwargs)
+        
         # Generate text with VLLM
         output = self.llm.chat(messages, sampling_params=params)
+        return self._result(output[0], params)
         
-        # Extract the text from VLLM output format
-        generated_text = output[0].outputs[0].text
+    def generate_batch(self, conversations: List[List[Dict[str, str]]], **kwargs) -> List[Dict[str, Any]]:
+        """
+        Generate responses for several conversations in one call; vLLM schedules
+        them with continuous batching.
         
-        return {
-            "text": generated_text,
-            "backend": "vllm"
-        }
+        Args:
+            conversations: List of message lists, one per response
+            **kwargs: Same parameters as generate()
+                
+        Returns:
+            One result dictionary per conversation, in order
+        """
+        params = self._params(kwargs)
+        outputs = self.llm.chat(conversations, sampling_params=params)
+        return [self._result(output, params) for output in outputs]
+        
+    def count_tokens(self, text: str) -> int:
+        """Number of tokens the model's tokenizer produces for a piece of text"""
+        return len(self.llm.get_tokenizer().encode(text, add_special_tokens=False))
+        
+    def encode_message(self, role: str, content: str) -> List[int]:
+        """Token ids of one formatted chat message, as they appear in a prompt"""
+        return self.llm.get_tokenizer().encode(format_message(role, content), add_special_tokens=False)
+        
+    def stream_generate(self, messages: List[Dict[str, str]], **kwargs) -> Iterator[Dict[str, Any]]:
+        """
+        Generate a response in streaming form
+        
+        The offline vLLM engine returns the whole completion at once, so this yields
+        a single delta followed by the generate() result dictionary.
+        """
+        result = self.generate(messages, **kwargs)
+        yield {"delta": result["text"]}
+        yield result
         
     def extract_sections(self, text: str) -> Dict[str, Optional[str]]:
         """
@@ -107,12 +163,4 @@ class VLLMModelHandler:
         Returns:
             Dictionary with extracted sections
         """
-        thinking = re.search(r'<think>(.*?)</think>', text, re.DOTALL)
-        search = re.search(r'<search>(.*?)</search>', text, re.DOTALL)
-        answer = re.search(r'<answer>(.*?)</answer>', text, re.DOTALL)
-        
-        return {
-            "thinking": thinking.group(1) if thinking else None,
-            "search_query": search.group(1) if search else None,
-            "answer": answer.group(1) if answer else None
-        } 
+        return parse_sections(text)
@@ -0,0 +1,188 @@
+import re
+import sqlite3
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from app.cohort import admission_context
+from app.config import PATIENT_CONTEXT_MAX_TOKENS
+from app.rules import MEASUREMENTS, RuleSet
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Pieces Qwen-style tokenizers split text into at least: single digits, words, punctuation
+TOKEN_PATTERN = re.compile(r"\d|[^\W\d_]+|[^\w\s]|_")
+
+# Readings kept per measurement while the context is over its token budget, tried in turn
+POINT_STEPS = (None, 24, 12, 6, 3, 1)
+
+MEASUREMENTS_HEADER = "Measurements (<hours since admission>h <value>, a..b = unchanged over that span, * = abnormal):"
+
+
+def estimate_tokens(text: str) -> int:
+    """Token count estimate for when no tokenizer is loaded; numbers cost one token per digit"""
+    return len(TOKEN_PATTERN.findall(text))
+
+
+def criteria_measurements(rule_set: Optional[RuleSet]) -> List[str]:
+    """Measurements the criteria's rules refer to, or every known measurement if it has no rules"""
+    if rule_set is None:
+        return list(MEASUREMENTS)
+    names = [measurement for rule in rule_set.rules for measurement, _, _ in rule.comparisons]
+    return list(dict.fromkeys(names))
+
+
+def load_measurement_events(conn: sqlite3.Connection, hadm_id: int,
+                            names: List[str]) -> Tuple[pd.DataFrame, Optional[pd.Timestamp]]:
+    """
+    Readings of some measurements for one admission, in the units the rules use.
+
+    Only the item ids of the requested measurements are read; missing tables are skipped.
+
+    Args:
+        conn: Connection to the MIMIC-IV SQLite database
+        hadm_id: Admission to load
+        names: Measurements to load (keys of MEASUREMENTS)
+
+    Returns:
+        (rows with name, charttime, value and flag; admission time or None if unknown)
+    """
+    frames = []
+    for table in sorted({MEASUREMENTS[name]["table"] for name in names}):
+        specs = {name: MEASUREMENTS[name] for name in names if MEASUREMENTS[name]["table"] == table}
+        ids = {name: ", ".join(str(i) for i in spec["itemids"]) for name, spec in specs.items()}
+        name_case = " ".join(f"WHEN itemid IN ({ids[name]}) THEN '{name}'" for name in specs)
+        value_case = " ".join(f"WHEN itemid IN ({ids[name]}) THEN {spec['value']}"
+                              for name, spec in specs.items() if "value" in spec)
+        value = f"CASE {value_case} ELSE valuenum END" if value_case else "valuenum"
+        flag = "flag" if table == "labevents" else "NULL"
+        query = (f"SELECT CASE {name_case} END AS name, charttime, {value} AS value, {flag} AS flag "
+                 f"FROM {table} WHERE hadm_id = ? AND itemid IN ({', '.join(ids.values())}) "
+                 f"AND valuenum IS NOT NULL")
+        try:
+            frames.append(pd.read_sql_query(query, conn, params=(hadm_id,)))
+        except (sqlite3.OperationalError, pd.errors.DatabaseError) as e:
+            logger.debug(f"Skipping {table} readings: {e}")
+    events = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=["name", "charttime", "value", "flag"])
+
+    try:
+        row = conn.execute("SELECT admittime FROM admissions WHERE hadm_id = ?", (hadm_id,)).fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    admittime = pd.to_datetime(row[0]) if row and row[0] else None
+    return events, admittime
+
+
+def _select_points(values: np.ndarray, max_points: int) -> List[int]:
+    """Positions of the readings to keep: highest, lowest, latest, first, then evenly spaced"""
+    n = len(values)
+    priority = [int(np.argmax(values)), int(np.argmin(values)), n - 1, 0]
+    priority += np.linspace(0, n - 1, max_points).round().astype(int).tolist()
+    return sorted(list(dict.fromkeys(priority))[:max_points])
+
+
+def _format_number(value: float) -> str:
+    return f"{round(float(value), 1):g}"
+
+
+def encode_measurements(events: pd.DataFrame, admittime: Optional[pd.Timestamp], names: List[str],
+                        max_points: Optional[int] = None) -> str:
+    """
+    Compact table of an admission's readings, one line per measurement.
+
+    The unit is given once per line, times are hours since admission, and consecutive
+    identical readings collapse into one time span. With max_points, at most that many
+    readings (or spans) are kept per measurement, always including the extremes and the
+    latest one.
+
+    Args:
+        events: Rows with name, charttime, value and flag (see load_measurement_events)
+        admittime: Admission time (default: the first reading)
+        names: Measurements to include, in output order
+        max_points: Readings kept per measurement (None = all)
+
+    Returns:
+        The table, or an empty string if there are no readings
+    """
+    if events.empty:
+        return ""
+    times = pd.to_datetime(events["charttime"])
+    anchor = admittime if admittime is not None else times.min()
+    frame = pd.DataFrame({
+        "name": events["name"].to_numpy(),
+        "hours": ((times - anchor).dt.total_seconds() / 3600).round(1).to_numpy(),
+        "value": events["value"].astype(float).round(1).to_numpy(),
+        "abnormal": events["flag"].notna().to_numpy(),
+    }).sort_values(["name", "hours"], kind="stable")
+
+    # Consecutive repeats of the same reading form one run per measurement
+    changed = (frame["name"].ne(frame["name"].shift()) | frame["value"].ne(frame["value"].shift())
+               | frame["abnormal"].ne(frame["abnormal"].shift()))
+    runs = frame.groupby(changed.cumsum().to_numpy(), sort=False).agg(
+        name=("name", "first"), start=("hours", "first"), end=("hours", "last"),
+        value=("value", "first"), abnormal=("abnormal", "first"))
+
+    lines = [MEASUREMENTS_HEADER]
+    by_name = dict(tuple(runs.groupby("name", sort=False)))
+    for name in names:
+        group = by_name.get(name)
+        if group is None:
+            continue
+        if max_points and len(group) > max_points:
+            group = group.iloc[_select_points(group["value"].to_numpy(), max_points)]
+        points = []
+        for start, end, value, abnormal in zip(group["start"], group["end"], group["value"], group["abnormal"]):
+            span = _format_number(start) if start == end else f"{_format_number(start)}..{_format_number(end)}"
+            points.append(f"{span}h {_format_number(value)}{'*' if abnormal else ''}")
+        lines.append(f"{name} ({MEASUREMENTS[name]['unit']}): {', '.join(points)}")
+    return "\n".join(lines) if len(lines) > 1 else ""
+
+
+def encode_patient_context(conn: sqlite3.Connection, hadm_id: int, rule_set: Optional[RuleSet] = None,
+                           count_tokens: Optional[Callable[[str], int]] = None,
+                           max_tokens: int = PATIENT_CONTEXT_MAX_TOKENS) -> Dict[str, Any]:
+    """
+    Patient information for a prompt: the admission summary plus the readings the criteria needs.
+
+    If the text is over the token budget, readings per measurement are thinned step by
+    step (see POINT_STEPS); if one reading each is still too long, summary sections are
+    dropped from the end.
+
+    Args:
+        conn: Connection to the MIMIC-IV SQLite database
+        hadm_id: Admission to describe
+        rule_set: Compiled rules of the criteria being assessed (None = every known measurement)
+        count_tokens: Tokenizer-backed counter (default: estimate_tokens)
+        max_tokens: Token budget (0 = no limit)
+
+    Returns:
+        {'text', 'tokens', 'max_points', 'measurements', 'readings'}
+    """
+    count = count_tokens or estimate_tokens
+    names = criteria_measurements(rule_set)
+    summary = admission_context(conn, hadm_id).split("\n")
+    events, admittime = load_measurement_events(conn, hadm_id, names)
+
+    for max_points in POINT_STEPS:
+        table = encode_measurements(events, admittime, names, max_points)
+        text = "\n".join(line for line in summary + [table] if line)
+        tokens = count(text)
+        if not max_tokens or tokens <= max_tokens or events.empty:
+            break
+    while max_tokens and tokens > max_tokens and summary:
+        summary = summary[:-1]
+        text = "\n".join(line for line in summary + [table] if line)
+        tokens = count(text)
+    if max_tokens and tokens > max_tokens:
+        logger.warning(f"Patient context of admission {hadm_id} is {tokens} tokens, over the budget of {max_tokens}")
+
+    return {
+        "text": text,
+        "tokens": tokens,
+        "max_points": max_points,
+        "measurements": names,
+        "readings": len(events)
+    }
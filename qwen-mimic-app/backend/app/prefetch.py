@@ -0,0 +1,292 @@
+import time
+import sqlite3
+import threading
+import logging
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.cohort import CONTEXT_MAX_ROWS, PATIENT_INFORMATION_HEADER
+from app.patient_context import MEASUREMENTS_HEADER, criteria_measurements, encode_patient_context
+from app.rules import RuleSet
+from app.config import (
+    MIMIC_DB_PATH,
+    PATIENT_CONTEXT_MAX_TOKENS,
+    PATIENT_PREFETCH,
+    PATIENT_PREFETCH_WORKERS,
+    PATIENT_CACHE_SIZE,
+    PATIENT_CACHE_TTL_SECONDS
+)
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# First line of a patient record in a prompt; marks conversations that already have it
+RECORD_HEADER = "Patient record from the MIMIC database:"
+
+# Text that shows a prompt already carries patient information: a prefetched record,
+# a cohort prompt's patient information, or an encoded measurement table
+CONTEXT_MARKERS = (RECORD_HEADER, PATIENT_INFORMATION_HEADER, MEASUREMENTS_HEADER)
+
+# Admissions a patient id refers to: the admission itself, or every admission of a subject
+ADMISSIONS_QUERY = "SELECT hadm_id FROM admissions WHERE hadm_id = ? OR subject_id = ? ORDER BY admittime"
+
+
+def has_patient_context(text: str) -> bool:
+    """Whether a message already carries patient information from the database"""
+    return any(marker in text for marker in CONTEXT_MARKERS)
+
+
+class PatientPrefetcher:
+    """
+    Singleton that loads patient records in the background, with an LRU+TTL cache.
+
+    prefetch() returns at once: the patient's admissions are looked up and each one is
+    encoded with encode_patient_context (admission summary plus the readings the criteria
+    needs, within PATIENT_CONTEXT_MAX_TOKENS) concurrently on a thread pool, each with its
+    own read-only connection. Records are cached per patient id and criteria measurements
+    for PATIENT_CACHE_TTL_SECONDS, so later turns about the same patient find them ready;
+    a load in flight is shared rather than started twice. get() never waits unless asked
+    to, so generation is not held up by the database.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = super(PatientPrefetcher, cls).__new__(cls)
+                cls._instance._initialize()
+            return cls._instance
+
+    def _initialize(self):
+        """Initialize the cache and the thread pool."""
+        self.db_path = MIMIC_DB_PATH
+        self.enabled = PATIENT_PREFETCH and bool(self.db_path)
+        self.max_entries = PATIENT_CACHE_SIZE
+        self.ttl_seconds = PATIENT_CACHE_TTL_SECONDS
+        self.max_tokens = PATIENT_CONTEXT_MAX_TOKENS
+        self.state_lock = threading.Lock()
+        # (patient id, measurements) -> (time the load started, future of the record)
+        self._entries: "OrderedDict[Tuple[str, Tuple[str, ...]], tuple]" = OrderedDict()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.errors = 0
+        self.served_ready = 0
+        self.served_pending = 0
+        self.load_seconds = 0.0
+
+    @staticmethod
+    def _key(patient_id: Any) -> Optional[str]:
+        """Cache key of a patient id, or None if it cannot be looked up (e.g. 'unknown')"""
+        try:
+            return str(int(patient_id))
+        except (TypeError, ValueError):
+            return None
+
+    def _fresh_entry(self, entry_key: Tuple[str, Tuple[str, ...]]) -> Optional[tuple]:
+        """Cached entry if it has not expired; must hold state_lock"""
+        entry = self._entries.get(entry_key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > self.ttl_seconds:
+            del self._entries[entry_key]
+            self.expired += 1
+            return None
+        self._entries.move_to_end(entry_key)
+        return entry
+
+    def prefetch(self, patient_id: Any, rule_set: Optional[RuleSet] = None) -> Optional[Future]:
+        """
+        Start loading a patient's record in the background unless it is cached or in flight.
+
+        Args:
+            patient_id: hadm_id or subject_id parsed from the prompt
+            rule_set: Compiled rules of the criteria being assessed (None = every known measurement)
+
+        Returns:
+            Future of the record, or None if prefetching is disabled or the id is not numeric
+        """
+        key = self._key(patient_id)
+        if not self.enabled or key is None:
+            return None
+        names = criteria_measurements(rule_set)
+        entry_key = (key, tuple(names))
+        with self.state_lock:
+            entry = self._fresh_entry(entry_key)
+            if entry is not None:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=PATIENT_PREFETCH_WORKERS,
+                                                    thread_name_prefix="patient-prefetch")
+            future: Future = Future()
+            self._entries[entry_key] = (time.monotonic(), future)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            executor = self._executor
+
+        start = time.perf_counter()
+        contexts: Dict[int, Dict[str, Any]] = {}
+        failures: List[str] = []
+        hadm_ids: List[int] = []
+        remaining = [0]
+        done_lock = threading.Lock()
+
+        def admission_done(hadm_id: int, encoded: Future):
+            try:
+                contexts[hadm_id] = encoded.result()
+            except Exception as e:
+                failures.append(f"admission {hadm_id}: {e}")
+            with done_lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            self._finish(entry_key, future, hadm_ids, contexts, failures, time.perf_counter() - start)
+
+        def admissions_found(found: Future):
+            try:
+                hadm_ids.extend(found.result())
+            except Exception as e:
+                failures.append(f"admissions: {e}")
+            if failures or not hadm_ids:
+                self._finish(entry_key, future, hadm_ids, contexts, failures, time.perf_counter() - start)
+                return
+            # A subject's admissions share the token budget of one prompt
+            budget = max(1, self.max_tokens // len(hadm_ids)) if self.max_tokens else 0
+            remaining[0] = len(hadm_ids)
+            for hadm_id in hadm_ids:
+                executor.submit(self._encode, hadm_id, rule_set, budget).add_done_callback(
+                    partial(admission_done, hadm_id))
+
+        executor.submit(self._admissions, int(key)).add_done_callback(admissions_found)
+        logger.info(f"Prefetching the record of patient {key}")
+        return future
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+
+    def _admissions(self, patient_id: int) -> List[int]:
+        """Admissions a patient id refers to, oldest first"""
+        conn = self._connect()
+        try:
+            return [row[0] for row in conn.execute(ADMISSIONS_QUERY, (patient_id, patient_id)).fetchmany(CONTEXT_MAX_ROWS)]
+        finally:
+            conn.close()
+
+    def _encode(self, hadm_id: int, rule_set: Optional[RuleSet], max_tokens: int) -> Dict[str, Any]:
+        """Compact patient information of one admission"""
+        conn = self._connect()
+        try:
+            return encode_patient_context(conn, hadm_id, rule_set, max_tokens=max_tokens)
+        finally:
+            conn.close()
+
+    def _finish(self, entry_key: Tuple[str, Tuple[str, ...]], future: Future, hadm_ids: List[int],
+                contexts: Dict[int, Dict[str, Any]], failures: List[str], seconds: float):
+        """Complete a load; a failed one is dropped from the cache so the next turn retries it"""
+        key, names = entry_key
+        with self.state_lock:
+            self.load_seconds += seconds
+            if failures:
+                self.errors += 1
+                if self._entries.get(entry_key, (None, None))[1] is future:
+                    del self._entries[entry_key]
+        if failures:
+            logger.warning(f"Prefetch of patient {key} failed: {'; '.join(failures)}")
+            future.set_exception(RuntimeError("; ".join(failures)))
+            return
+        admissions = [(hadm_id, contexts[hadm_id]) for hadm_id in hadm_ids]
+        if len(admissions) == 1:
+            parts = [admissions[0][1]["text"]]
+        else:
+            parts = [f"Admission {hadm_id}:\n{context['text']}" for hadm_id, context in admissions if context["text"]]
+        body = "\n".join(part for part in parts if part)
+        record = {
+            "patient_id": key,
+            "admissions": [hadm_id for hadm_id, _ in admissions],
+            "measurements": list(names),
+            "tokens": sum(context["tokens"] for _, context in admissions),
+            "readings": sum(context["readings"] for _, context in admissions),
+            "text": f"{RECORD_HEADER}\n{body}" if body else "",
+            "seconds": round(seconds, 4)
+        }
+        logger.info(f"Prefetched the record of patient {key} in {seconds:.3f}s")
+        future.set_result(record)
+
+    def get(self, patient_id: Any, rule_set: Optional[RuleSet] = None,
+            wait: float = 0.0) -> Optional[Dict[str, Any]]:
+        """
+        A patient's record if it is loaded, without starting a load.
+
+        Args:
+            patient_id: hadm_id or subject_id
+            rule_set: Compiled rules of the criteria being assessed (None = every known measurement)
+            wait: Seconds to wait for a load in flight (0 = do not wait)
+
+        Returns:
+            The record, or None if it is not cached, still loading, or failed
+        """
+        key = self._key(patient_id)
+        if key is None:
+            return None
+        with self.state_lock:
+            entry = self._fresh_entry((key, tuple(criteria_measurements(rule_set))))
+        if entry is None:
+            return None
+        future = entry[1]
+        try:
+            record = future.result(timeout=wait) if (wait or future.done()) else None
+        except TimeoutError:
+            record = None
+        except Exception:
+            return None
+        with self.state_lock:
+            if record is None:
+                self.served_pending += 1
+            else:
+                self.served_ready += 1
+        return record
+
+    def invalidate(self, patient_id: Any = None) -> int:
+        """Drop one patient's cached records (all if None)"""
+        with self.state_lock:
+            if patient_id is None:
+                removed = len(self._entries)
+                self._entries.clear()
+                return removed
+            key = self._key(patient_id)
+            stale = [entry_key for entry_key in self._entries if entry_key[0] == key]
+            for entry_key in stale:
+                del self._entries[entry_key]
+            return len(stale)
+
+    def get_state(self) -> Dict[str, Any]:
+        """Get prefetch and cache statistics for monitoring"""
+        with self.state_lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "errors": self.errors,
+                "served_ready": self.served_ready,
+                "served_pending": self.served_pending,
+                "load_seconds": round(self.load_seconds, 3)
+            }
+
+
+# Create singleton instance
+patient_prefetcher = PatientPrefetcher()
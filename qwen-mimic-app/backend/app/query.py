@@ -1,25 +1,58 @@
 import os
+import sys
 import sqlite3
 import re
 import logging
+import threading
 from typing import Dict, Any, List, Optional
 
 from app.config import MIMIC_DB_PATH
 from app.model_factory import ModelFactory
+from app.model_registry import model_registry
+from app.token_budget import token_budget
+from app.memory_governor import memory_governor, MemoryPressureError
+from app.coalescing import request_coalescer, coalescing_key, normalize_text
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Get database path with error handling
-try:
-    DB_PATH = os.path.abspath(MIMIC_DB_PATH.strip('"').strip("'"))
-    logger.info(f"Database path: {DB_PATH}")
-    if not os.path.exists(DB_PATH):
-        raise FileNotFoundError(f"Database file not found at {DB_PATH}")
-except Exception as e:
-    logger.error(f"Error with database path: {e}")
-    raise RuntimeError(f"Database configuration error: {e}")
+# Upper bound on tokens for a generated SQL statement; the adaptive budget may use less
+SQL_MAX_TOKENS = 200
+
+# Sampling temperature for SQL generation
+SQL_TEMPERATURE = 0.2
+
+# A statement is complete at its semicolon, or at a closing code fence if the model adds one;
+# the reasoning tag stops of the model handlers never occur in SQL
+SQL_STOP = [";", "\n```"]
+
+# Opening code fence the model sometimes puts around the statement despite the prompt
+SQL_FENCE_PATTERN = re.compile(r"^```[a-zA-Z]*\s*")
+
+# Rows fetched per batch when reading query results (shrunk under memory pressure)
+QUERY_FETCH_BATCH = 5000
+
+# Resolved lazily so that importing this module never touches the filesystem
+_db_path = None
+
+def get_db_path() -> str:
+    """Resolve and validate the MIMIC database path from configuration"""
+    global _db_path
+    
+    if _db_path is None:
+        try:
+            if not MIMIC_DB_PATH:
+                raise ValueError("MIMIC_DB_PATH is not set")
+            db_path = os.path.abspath(MIMIC_DB_PATH.strip('"').strip("'"))
+            logger.info(f"Database path: {db_path}")
+            if not os.path.exists(db_path):
+                raise FileNotFoundError(f"Database file not found at {db_path}")
+        except Exception as e:
+            logger.error(f"Error with database path: {e}")
+            raise RuntimeError(f"Database configuration error: {e}")
+        _db_path = db_path
+    return _db_path
 
 class SqlGenerationHandler:
     """Handler for SQL generation using the optimal backend for this hardware"""
@@ -31,7 +64,7 @@ class SqlGenerationHandler:
         
         # Use model factory to create the appropriate model handler
         self.model_handler = ModelFactory.create_model(model_name, model_type="sql")
-        logger.info(f"Using backend: {self.model_handler.__class__.__name__}")
+        logger.info(f"Using backend: {self.model_handler.backend}")
     
     def generate_code(self, query: str) -> str:
         """Generate SQL code for the given query"""
@@ -71,11 +104,26 @@ class SqlGenerationHandler:
         # Generate SQL code
         messages = [{"role": "user", "content": prompt}]
         
-        # Generate using the model handler
-        response_data = self.model_handler.generate(messages, max_tokens=200, temperature=0.2)
+        # The model stays loaded from the memory check until the generation
+        with model_registry.reserved(self.model_handler.key):
+            # Generate using the model handler, with a token budget learned from previous outputs
+            max_tokens = memory_governor.admit_generation(
+                self.model_handler.count_tokens(prompt),
+                token_budget.get_max_tokens("sql", default=SQL_MAX_TOKENS),
+                getattr(self.model_handler, "kv_bytes_per_token", None)
+            )
+        
+            # Identical questions asked at the same time share one generation
+            key = coalescing_key(normalize_text(cleaned_query), self.model_handler.key, max_tokens, SQL_TEMPERATURE)
+            response_data, shared = request_coalescer.run(
+                "sql_generation", key,
+                lambda: self.model_handler.generate(messages, max_tokens=max_tokens, temperature=SQL_TEMPERATURE, stop=SQL_STOP)
+            )
+        if not shared:
+            token_budget.record("sql", response_data.get("num_tokens", 0), response_data.get("tokens_saved", 0))
         
         # Extract and process the raw SQL
-        raw_sql = response_data["text"].strip()
+        raw_sql = SQL_FENCE_PATTERN.sub("", response_data["text"].strip()).replace("```", "")
         sql_statements = re.split(r";\s*", raw_sql)
         first_sql_statement = sql_statements[0].strip()
         
@@ -88,37 +136,77 @@ class SqlGenerationHandler:
 
 # Global instance for SQL generation
 _sql_generator = None
+_sql_generator_lock = threading.Lock()
 
-def get_qwen_generated_code(query: str) -> str:
-    """Get SQL code for the given query using the optimal backend"""
+def get_sql_generator() -> SqlGenerationHandler:
+    """Get the shared SQL generator, creating it on first use"""
     global _sql_generator
     
-    # Create the SQL generator if it doesn't exist yet
+    # Create the SQL generator if it doesn't exist yet; the warm-up thread and
+    # the first requests may get here at the same time
     if _sql_generator is None:
-        _sql_generator = SqlGenerationHandler()
-        
+        with _sql_generator_lock:
+            if _sql_generator is None:
+                _sql_generator = SqlGenerationHandler()
+    return _sql_generator
+
+def get_qwen_generated_code(query: str) -> str:
+    """Get SQL code for the given query using the optimal backend"""
     # Generate the SQL code
-    return _sql_generator.generate_code(query)
+    return get_sql_generator().generate_code(query)
+
+def estimate_rows_bytes(rows: List[tuple]) -> int:
+    """Approximate memory held by a list of result rows"""
+    return sum(sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row) for row in rows)
 
 def execute_sql_query(sql_query: str):
-    """Execute the generated SQL query on the MIMIC-IV database"""
+    """Execute the generated SQL query on the MIMIC-IV database, sharing the result with identical concurrent queries"""
+    # Whitespace inside string literals is significant in SQL, so only the ends are trimmed
+    result, shared = request_coalescer.run(
+        "sql_execution", coalescing_key(sql_query.strip()), lambda: _execute_sql_query(sql_query)
+    )
+    if shared:
+        logger.info(f"Shared result of a concurrent identical query: {sql_query}")
+    return result
+
+def _execute_sql_query(sql_query: str):
+    """Execute a SQL query on the MIMIC-IV database"""
     logger.info(f"Executing SQL Query: {sql_query}")
 
     try:
         # Verify database exists
-        if not os.path.exists(DB_PATH):
-            raise FileNotFoundError(f"Database file not found at {DB_PATH}")
+        db_path = get_db_path()
+        if not os.path.exists(db_path):
+            raise FileNotFoundError(f"Database file not found at {db_path}")
         
         # Connect to database and execute query
-        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-        cursor = conn.cursor()
-        cursor.execute(sql_query)
-        result = cursor.fetchall()
-        conn.close()
+        conn = sqlite3.connect(db_path, check_same_thread=False)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(sql_query)
+            
+            # Read in batches and stop as soon as the result outgrows the memory budget
+            result = []
+            result_bytes = 0
+            budget = memory_governor.result_budget_bytes()
+            batch_size = memory_governor.batch_size(QUERY_FETCH_BATCH)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                result.extend(rows)
+                result_bytes += estimate_rows_bytes(rows)
+                if result_bytes > budget:
+                    memory_governor.refuse_result(len(result), result_bytes)
+        finally:
+            conn.close()
         
         logger.info(f"Query result count: {len(result) if isinstance(result, list) else 'N/A'}")
         return result if result else "No results found"  
 
+    except MemoryPressureError:
+        raise
+
     except sqlite3.OperationalError as e:
         logger.error(f"SQLite Operational Error: {str(e)}")
         raise RuntimeError(f"SQLite Error: {str(e)}")
@@ -1,19 +1,48 @@
 import re
 import json
+import time
 import logging
-from typing import Dict, Any, List, Optional
+from contextlib import contextmanager
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+import pandas as pd
 
 from app.model_factory import ModelFactory
-from app.criteria import get_active_criteria
+from app.model_registry import model_registry
+from app.criteria import get_active_criteria_key, get_compiled_criteria
+from app.token_budget import token_budget
+from app.section_parser import SectionParser
+from app.sessions import ConversationSession, session_store
+from app.history import HistoryManager
+from app.memory_governor import memory_governor, MemoryPressureError
+from app.coalescing import request_coalescer, coalescing_key, normalize_text
+from app.response_cache import response_cache, prefix_hash
+from app.rules import load_patient_measurements, rule_precheck
+from app.query import get_db_path
+from app.prefetch import patient_prefetcher, has_patient_context
+from app.config import (
+    DETERMINISTIC_REASONING,
+    DIAGNOSE_BATCH_SIZE,
+    KV_BYTES_PER_TOKEN,
+    PATIENT_PREFETCH_WAIT_SECONDS,
+    RULE_PRECHECK
+)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Upper bound on tokens per reasoning step; the adaptive budget may use less
+REASONING_MAX_TOKENS = 1000
+
+# Sampling temperature for reasoning steps
+REASONING_TEMPERATURE = 0.2
+
 class LocalReasonerModel:
     """
     A model for medical reasoning using a step-by-step Q&A approach.
-    This model skips database queries and instead directly asks the user for information.
+    This model skips database queries and instead directly asks the user for information;
+    a patient record prefetched from the MIMIC database joins the prompt once it is ready.
     """
     
     def __init__(self):
@@ -23,7 +52,10 @@ class LocalReasonerModel:
         
         # Use model factory to create the appropriate model handler
         self.model_handler = ModelFactory.create_model(model_name, model_type="reasoning")
-        logger.info(f"Using backend: {self.model_handler.__class__.__name__}")
+        logger.info(f"Using backend: {self.model_handler.backend}")
+        
+        # Keeps prompts within the token budget as conversations grow
+        self.history_manager = HistoryManager(lambda text: self.model_handler.count_tokens(text))
     
     def extract_patient_id(self, user_prompt: str) -> str:
         """
@@ -46,17 +78,369 @@ class LocalReasonerModel:
         logger.info(f"Successfully extracted patient ID: {patient_id}")
         return patient_id
     
-    def process_reasoning(self, user_input: str, conversation_history: List[Dict[str, str]] = None) -> dict:
+    def process_reasoning(self, user_input: str, conversation_history: List[Dict[str, str]] = None,
+                          session: Optional[ConversationSession] = None, deterministic: Optional[bool] = None,
+                          criteria_key: Optional[str] = None) -> dict:
         """
         Process reasoning for both initial queries and follow-up information.
         
         Args:
             user_input: The user's query or response
             conversation_history: Optional conversation history for continuing an existing session
+            session: Optional server-side session; its history and KV cache are used instead of
+                conversation_history, and the result carries only the new messages
+            deterministic: Use greedy decoding and the persistent response cache
+                (default DETERMINISTIC_REASONING)
+            criteria_key: Criteria set to assess against instead of the globally active one;
+                a session keeps the criteria set of its first turn
             
         Returns:
             Dictionary with reasoning results
         """
+        # The model stays loaded from the memory check in _prepare_reasoning until the generation
+        with self._session_turn(session), model_registry.reserved(self.model_handler.key):
+            context = self._prepare_reasoning(user_input, conversation_history, session, deterministic,
+                                              criteria_key=criteria_key)
+            
+            response_data = context["cached_response"]
+            if response_data is None:
+                # Generate response based on messages, with a token budget learned from previous outputs;
+                # identical concurrent requests share one generation
+                response_data, shared = request_coalescer.run(
+                    "reasoning", self._coalescing_key(context),
+                    lambda: self.model_handler.generate(context["messages"], **context["generation_kwargs"])
+                )
+                if shared:
+                    response_data = self._shared_response(response_data)
+                else:
+                    self._cache_response(context, response_data)
+            
+            # Extract thinking, search query, and answer
+            extracted = self.model_handler.extract_sections(response_data["text"])
+            return self._build_result(context, response_data, extracted)
+    
+    def stream_reasoning(self, user_input: str, conversation_history: List[Dict[str, str]] = None,
+                         session: Optional[ConversationSession] = None,
+                         deterministic: Optional[bool] = None,
+                         criteria_key: Optional[str] = None) -> Iterator[Tuple[str, Any]]:
+        """
+        Same as process_reasoning, but parses sections while the response is generated.
+        
+        Yields:
+            ('section', SectionEvent) for each section open/delta/close event,
+            then ('result', dict) with the same result as process_reasoning
+        """
+        with self._session_turn(session), model_registry.reserved(self.model_handler.key):
+            context = self._prepare_reasoning(user_input, conversation_history, session, deterministic,
+                                              criteria_key=criteria_key)
+            
+            parser = SectionParser()
+            response_data = context["cached_response"]
+            if response_data is not None:
+                # A cached response is replayed in one piece
+                stream, shared = iter([{"delta": response_data["text"]}, response_data]), False
+            else:
+                # Streams are shared only with other streams: a blocking request joining one
+                # would get a delta instead of the response, and a stream joining a blocking
+                # generation would get no deltas
+                stream, shared = request_coalescer.stream(
+                    "reasoning_stream", self._coalescing_key(context),
+                    lambda: self.model_handler.stream_generate(context["messages"], **context["generation_kwargs"])
+                )
+            for item in stream:
+                if "delta" in item:
+                    for event in parser.feed(item["delta"]):
+                        yield "section", event
+                elif shared:
+                    response_data = self._shared_response(item)
+                else:
+                    response_data = item
+                    self._cache_response(context, response_data)
+            for event in parser.finish():
+                yield "section", event
+            
+            yield "result", self._build_result(context, response_data, parser.result())
+    
+    def process_batch(self, user_inputs: List[str], batch_size: int = DIAGNOSE_BATCH_SIZE,
+                      deterministic: Optional[bool] = None,
+                      criteria_key: Optional[str] = None) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """
+        Start reasoning for many independent prompts with batched generation.
+        
+        Prompts are generated together in micro-batches of batch_size (fewer under memory
+        pressure). A prompt that fails is reported on its own without stopping the others;
+        if a whole micro-batch fails, its prompts are retried one at a time.
+        
+        Args:
+            user_inputs: Initial prompts, one per patient
+            batch_size: Prompts generated together per micro-batch
+            deterministic: Use greedy decoding and the persistent response cache
+                (default DETERMINISTIC_REASONING)
+            criteria_key: Criteria set to assess against (default: the active criteria)
+            
+        Yields:
+            ('item', {'index': i, 'result': dict} or {'index': i, 'error': str}) for each prompt
+            once its micro-batch is done, then ('batch', stats) with the micro-batch throughput
+        """
+        position = 0
+        batch_number = 0
+        while position < len(user_inputs):
+            indices = list(range(position, min(len(user_inputs), position + memory_governor.batch_size(batch_size))))
+            position = indices[-1] + 1
+            batch_number += 1
+            start = time.perf_counter()
+            
+            contexts = {}
+            outcomes = {}
+            for index in indices:
+                try:
+                    contexts[index] = self._prepare_reasoning(user_inputs[index], None, deterministic=deterministic,
+                                                              admit=False, criteria_key=criteria_key)
+                except Exception as e:
+                    outcomes[index] = e
+            outcomes.update(self._respond_together(contexts))
+            
+            generated_tokens = 0
+            for index in indices:
+                outcome = outcomes[index]
+                if isinstance(outcome, Exception):
+                    logger.error(f"Batch item {index} failed: {outcome}")
+                    yield "item", {"index": index, "error": str(outcome)}
+                    continue
+                if not outcome["cached"]:
+                    generated_tokens += outcome["num_tokens"]
+                yield "item", {"index": index, "result": outcome}
+            
+            errors = [i for i in indices if isinstance(outcomes[i], Exception)]
+            cached = len([i for i in indices if i not in errors and outcomes[i]["cached"]])
+            seconds = time.perf_counter() - start
+            stats = {
+                "batch": batch_number,
+                "size": len(indices),
+                "generated": len(indices) - len(errors) - cached,
+                "cached": cached,
+                "errors": len(errors),
+                "seconds": round(seconds, 3),
+                "generated_tokens": generated_tokens,
+                "tokens_per_second": round(generated_tokens / seconds, 2) if seconds > 0 else 0.0,
+                "items_per_second": round(len(indices) / seconds, 3) if seconds > 0 else 0.0
+            }
+            logger.info(f"Batch {batch_number}: {len(indices)} prompts in {seconds:.2f}s "
+                        f"({stats['tokens_per_second']} tokens/s, {stats['errors']} errors)")
+            yield "batch", stats
+    
+    def process_multi_criteria(self, user_input: str, criteria_keys: List[str],
+                               deterministic: Optional[bool] = None) -> Dict[str, Any]:
+        """
+        Assess one patient against several criteria sets at once.
+        
+        The prompts for all criteria sets are generated together in one batch. They share
+        the criteria-independent part of the system prompt, which the transformers backend
+        prefills once for the whole batch.
+        
+        Args:
+            user_input: The patient prompt, e.g. 'Assess patient 12345: RR 24, SBP 95'
+            criteria_keys: Keys of the criteria sets to evaluate (e.g. qSOFA, SIRS, Sepsis-3)
+            deterministic: Use greedy decoding and the persistent response cache
+                (default DETERMINISTIC_REASONING)
+            
+        Returns:
+            Dictionary with one entry in 'results' per criteria set, in the requested order;
+            a criteria set that failed has an 'error' instead of the reasoning result
+        """
+        start = time.perf_counter()
+        keys = list(dict.fromkeys(criteria_keys))
+        # The rule pre-check scores every criteria set against one load of the patient's measurements
+        measurements = None
+        if RULE_PRECHECK:
+            try:
+                measurements = self._patient_measurements(self.extract_patient_id(user_input))
+            except ValueError:
+                # Each criteria set reports the missing patient id below
+                pass
+        contexts = {}
+        outcomes = {}
+        for key in keys:
+            try:
+                contexts[key] = self._prepare_reasoning(user_input, None, deterministic=deterministic,
+                                                        admit=False, criteria_key=key, measurements=measurements)
+            except Exception as e:
+                outcomes[key] = e
+        outcomes.update(self._respond_together(contexts))
+        
+        results = []
+        for key in keys:
+            outcome = outcomes[key]
+            if isinstance(outcome, Exception):
+                logger.error(f"Assessment against {key} failed: {outcome}")
+                results.append({"criteria_key": key, "error": str(outcome)})
+            else:
+                results.append(outcome)
+        seconds = time.perf_counter() - start
+        logger.info(f"Assessed {len(keys)} criteria sets in one batch in {seconds:.2f}s")
+        
+        return {
+            "patient_id": next((r["patient_id"] for r in results if "patient_id" in r), None),
+            "original_prompt": user_input,
+            "results": results,
+            "seconds": round(seconds, 3)
+        }
+    
+    def _respond_together(self, contexts: Dict[Any, Dict[str, Any]]) -> Dict[Any, Any]:
+        """
+        Answer prepared prompts together: cached responses are used as they are and the
+        rest are generated in one batch. Returns the result dict, or the exception that
+        prevented it, for each key of contexts.
+        """
+        outcomes = {}
+        responses = {k: c["cached_response"] for k, c in contexts.items() if c["cached_response"] is not None}
+        pending = [k for k in contexts if k not in responses]
+        for key, response in zip(pending, self._generate_batch([contexts[k] for k in pending])):
+            if isinstance(response, Exception):
+                outcomes[key] = response
+            else:
+                responses[key] = response
+                self._cache_response(contexts[key], response)
+        
+        for key, response in responses.items():
+            try:
+                extracted = self.model_handler.extract_sections(response["text"])
+                outcomes[key] = self._build_result(contexts[key], response, extracted)
+            except Exception as e:
+                outcomes[key] = e
+        return outcomes
+    
+    def _generate_batch(self, contexts: List[Dict[str, Any]]) -> List[Any]:
+        """Generate responses for prepared prompts together; each entry is a response or the exception it raised"""
+        if not contexts:
+            return []
+        with model_registry.reserved(self.model_handler.key):
+            return self._generate_reserved(contexts)
+    
+    def _generate_reserved(self, contexts: List[Dict[str, Any]]) -> List[Any]:
+        """_generate_batch with the model reserved, so memory relief cannot unload it between checks and generation"""
+        try:
+            # Left padding makes every row as long as the longest prompt
+            bytes_per_token = getattr(self.model_handler, "kv_bytes_per_token", None) or KV_BYTES_PER_TOKEN
+            max_tokens = memory_governor.admit_generation(
+                max(c["prompt_tokens"] for c in contexts),
+                contexts[0]["generation_kwargs"]["max_tokens"],
+                bytes_per_token * len(contexts)
+            )
+            responses = self.model_handler.generate_batch(
+                [c["messages"] for c in contexts],
+                max_tokens=max_tokens,
+                temperature=contexts[0]["generation_kwargs"]["temperature"]
+            )
+            for context in contexts:
+                context["max_tokens"] = max_tokens
+            return responses
+        except Exception as e:
+            if len(contexts) == 1 and not isinstance(e, MemoryPressureError):
+                return [e]
+            logger.warning(f"Batch of {len(contexts)} failed ({e}), generating one at a time")
+        
+        responses = []
+        for context in contexts:
+            try:
+                kwargs = dict(context["generation_kwargs"])
+                kwargs["max_tokens"] = memory_governor.admit_generation(
+                    context["prompt_tokens"],
+                    kwargs["max_tokens"],
+                    getattr(self.model_handler, "kv_bytes_per_token", None)
+                )
+                context["max_tokens"] = kwargs["max_tokens"]
+                responses.append(self.model_handler.generate(context["messages"], **kwargs))
+            except Exception as e:
+                responses.append(e)
+        return responses
+    
+    def _coalescing_key(self, context: Dict[str, Any]) -> str:
+        """Key identifying generations that would produce the same response"""
+        kwargs = context["generation_kwargs"]
+        return coalescing_key(
+            self.model_handler.key,
+            [(m["role"], normalize_text(m["content"])) for m in context["messages"]],
+            context["criteria"].content_hash,
+            kwargs["max_tokens"],
+            kwargs["temperature"]
+        )
+    
+    @staticmethod
+    def _shared_response(response_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Copy of a response generated for another request; its KV cache belongs to that request's session"""
+        shared = {k: v for k, v in response_data.items() if k != "kv_cache"}
+        shared["coalesced"] = True
+        return shared
+    
+    def _response_cache_key(self, user_input: str, record_text: str, valid_history: List[Dict[str, str]],
+                            criteria_content_hash: str) -> str:
+        """Key of a greedy response in the persistent response cache"""
+        return response_cache.make_key(
+            normalize_text(user_input) + record_text,
+            prefix_hash(valid_history),
+            criteria_content_hash,
+            list(self.model_handler.key),
+            {"temperature": 0.0, "max_tokens": REASONING_MAX_TOKENS}
+        )
+    
+    def _cache_response(self, context: Dict[str, Any], response_data: Dict[str, Any]):
+        """Store a greedy response if it finished on its own rather than at the token budget"""
+        if context["cache_key"] is None or response_data is None:
+            return
+        finished = (response_data.get("stopped_on") is not None
+                    or response_data.get("num_tokens", 0) < context["max_tokens"])
+        if not finished:
+            return
+        response_cache.put(
+            context["cache_key"],
+            context["criteria"].content_hash,
+            list(self.model_handler.key),
+            {k: response_data.get(k) for k in ("text", "backend", "num_tokens", "stopped_on", "tokens_saved")}
+        )
+    
+    @staticmethod
+    def _patient_measurements(patient_id: Any) -> pd.DataFrame:
+        """A patient's measurements for the rule pre-check, from the configured database"""
+        try:
+            db_path = get_db_path()
+        except RuntimeError as e:
+            logger.warning(f"Rule pre-check skipped: {e}")
+            db_path = None
+        return load_patient_measurements(db_path, patient_id)
+    
+    @staticmethod
+    def _rule_response(outcome: Dict[str, Any]) -> Dict[str, Any]:
+        """Response for a case the criteria's rules decided, in the format the model answers in"""
+        text = (f"<think>Rule-based pre-check on the recorded measurements of admission {outcome['hadm_id']}: "
+                f"{outcome['explanation']}.</think>\n<answer>{outcome['explanation']}</answer>")
+        return {"text": text, "backend": "rules", "num_tokens": 0, "stopped_on": None, "tokens_saved": 0,
+                "rule_based": True}
+    
+    @contextmanager
+    def _session_turn(self, session: Optional[ConversationSession]):
+        """Run one turn at a time per session"""
+        if session is None:
+            yield
+            return
+        with session.lock:
+            yield
+    
+    def _prepare_reasoning(self, user_input: str, conversation_history: Optional[List[Dict[str, str]]],
+                           session: Optional[ConversationSession] = None,
+                           deterministic: Optional[bool] = None, admit: bool = True,
+                           criteria_key: Optional[str] = None,
+                           measurements: Optional[pd.DataFrame] = None) -> Dict[str, Any]:
+        """
+        Validate the history and build the messages and generation parameters for a reasoning step.
+        With admit=False the memory check is left to the caller (batched generation checks the whole batch).
+        measurements are the patient's measurements for the rule pre-check if the caller already
+        loaded them (default: loaded here when the pre-check runs).
+        """
+        # Sessions keep the history on the server
+        if session is not None:
+            conversation_history = session.history
+        
         # Validate and clean conversation history
         if conversation_history is None:
             conversation_history = []
@@ -83,36 +467,44 @@ class LocalReasonerModel:
             patient_id = self._extract_patient_id_from_history(valid_history)
             logger.info(f"Retrieved patient ID from history: {patient_id}")
         
-        # Get the active criteria configuration
-        active_criteria = get_active_criteria()
-        
-        # Create system prompt for the reasoner with dynamic criteria
-        system_prompt = (
-            f"Answer the {active_criteria['name']} assessment question based on the criteria provided below.\n"
-            "You must conduct reasoning inside <think> and </think> first every time you get new information.\n" 
-            "After reasoning, if you find you lack some knowledge, you can call a search engine by <search> query </search>, and it will return the top searched results between <information> and </information>.\n"
-            "You can search as many times as you want. If you find no further external knowledge needed, you can directly provide the answer inside <answer> and </answer> without detailed illustrations. Example: <answer> Assessment complete, patient shows signs of respiratory distress </answer>\n\n"
-            f"{active_criteria['name']} criteria to consider:\n"
-        )
+        # Use the requested criteria set, else the one the session started with, else the active one
+        if criteria_key is None and session is not None:
+            criteria_key = session.criteria_key
+        if criteria_key is None:
+            criteria_key = get_active_criteria_key()
+        criteria = get_compiled_criteria(criteria_key)
+        if criteria is None:
+            raise ValueError(f"Criteria with key '{criteria_key}' not found")
+        active_criteria = criteria.definition
+        if session is not None:
+            # Follow-up turns keep assessing against the same criteria set
+            session.criteria_key = criteria_key
         
-        # Add each criterion from the configuration
-        for criterion in active_criteria['criteria']:
-            system_prompt += f"{criterion}\n"
+        # Deterministic mode decodes greedily, so a repeated assessment can be served from the cache
+        if deterministic is None:
+            deterministic = DETERMINISTIC_REASONING
         
-        # Add threshold if provided (not empty)
-        if 'threshold' in active_criteria and active_criteria['threshold'].strip():
-            system_prompt += f"\nThreshold rule: {active_criteria['threshold']}\n"
-            system_prompt += "Apply this threshold rule in your assessment.\n"
-        else:
-            # If no threshold provided, add guidance to use medical knowledge
-            system_prompt += "\nUse your medical knowledge to reason about these specific criteria and determine their clinical significance.\n"
+        # Load the patient's record in the background, encoded for this criteria set; it joins
+        # the prompt of the first turn that finds it ready, unless the conversation already
+        # carries patient information. Only deterministic steps wait for it, so that a
+        # repeated assessment sees the same prompt
+        record_text = ""
+        if not has_patient_context(user_input) and not any(
+                has_patient_context(str(msg["content"])) for msg in valid_history):
+            patient_prefetcher.prefetch(patient_id, criteria.rule_set)
+            patient_record = patient_prefetcher.get(
+                patient_id, criteria.rule_set, wait=PATIENT_PREFETCH_WAIT_SECONDS if deterministic else 0)
+            if patient_record and patient_record["text"]:
+                record_text = f"\n\n{patient_record['text']}"
+        history_input = user_input + record_text
         
-        # Create fresh messages list with system prompt
-        messages = [{"role": "system", "content": system_prompt}]
+        # Create fresh messages list with the criteria version's precompiled system prompt
+        messages = [{"role": "system", "content": criteria.system_prompt}]
+        prompt_tokens_saved = 0
         
         if is_new_conversation:
-            # For new conversations, just add the user's initial query
-            messages.append({"role": "user", "content": user_input})
+            # For new conversations, just add the user's initial query (with the patient record if ready)
+            messages.append({"role": "user", "content": history_input})
         else:
             # For continuations, add the conversation history (excluding system messages)
             for message in valid_history:
@@ -120,14 +512,91 @@ class LocalReasonerModel:
                     messages.append(message)
             
             # Add the new user response with context
-            messages.append({"role": "user", "content": f"I'm providing additional information: {user_input}. Please continue your assessment based on this new information."})
+            messages.append({"role": "user", "content": f"I'm providing additional information: {user_input}. Please continue your assessment based on this new information.{record_text}"})
+            
+            # Drop old reasoning and turns that no longer fit the prompt token budget
+            messages, compaction = self.history_manager.compact(messages)
+            prompt_tokens_saved = compaction["prompt_tokens_saved"]
+        
+        cache_key = None
+        cached_response = None
+        # A response available without generating: decided by the rule pre-check, or cached
+        if RULE_PRECHECK and is_new_conversation and criteria.rule_set is not None:
+            if measurements is None:
+                measurements = self._patient_measurements(patient_id)
+            outcome = rule_precheck(criteria.rule_set, measurements)
+            if outcome is not None:
+                cached_response = self._rule_response(outcome)
+                logger.info(f"Answered by the rule pre-check: {outcome['explanation']}")
+        if cached_response is None and deterministic and response_cache.enabled:
+            # The record is in the prompt only if it was ready in time, so it is part of the key
+            cache_key = self._response_cache_key(user_input, record_text, valid_history, criteria.content_hash)
+            cached_response = response_cache.get(cache_key)
+            if cached_response is not None:
+                cached_response["cached"] = True
+                logger.info("Serving reasoning response from the response cache")
+        
+        # The system message is tokenized once per criteria version and model
+        system_ids = criteria.token_ids(self.model_handler)
+        system_tokens = len(system_ids) if system_ids is not None else self.history_manager.message_tokens(messages[0])
+        prompt_tokens = system_tokens + self.history_manager.total_tokens(messages[1:])
         
-        # Generate response based on messages
-        response_data = self.model_handler.generate(messages, max_tokens=1000, temperature=0.2)
+        max_tokens = token_budget.get_max_tokens("reasoning", default=REASONING_MAX_TOKENS)
+        if cached_response is None and admit:
+            # Shorten the generation, or refuse it, if its KV cache would not fit in memory
+            max_tokens = memory_governor.admit_generation(
+                prompt_tokens,
+                max_tokens,
+                getattr(self.model_handler, "kv_bytes_per_token", None)
+            )
+        
+        generation_kwargs = {
+            "max_tokens": max_tokens,
+            "temperature": 0.0 if deterministic else REASONING_TEMPERATURE
+        }
+        if session is not None and cached_response is None:
+            # Reuse the previous turn's KV cache so only the new input is prefilled
+            generation_kwargs["kv_cache"] = session_store.load_cache(session, self.model_handler)
+            generation_kwargs["return_cache"] = True
+        
+        return {
+            "user_input": user_input,
+            "history_input": history_input,
+            "criteria_key": criteria_key,
+            "valid_history": valid_history,
+            "is_new_conversation": is_new_conversation,
+            "patient_id": patient_id,
+            "active_criteria": active_criteria,
+            "criteria": criteria,
+            "messages": messages,
+            "prompt_tokens": prompt_tokens,
+            "prompt_tokens_saved": prompt_tokens_saved,
+            "session": session,
+            "max_tokens": generation_kwargs["max_tokens"],
+            "generation_kwargs": generation_kwargs,
+            "deterministic": deterministic,
+            "cache_key": cache_key,
+            "cached_response": cached_response
+        }
+    
+    def _build_result(self, context: Dict[str, Any], response_data: Dict[str, Any], extracted: Dict[str, Optional[str]]) -> dict:
+        """Turn a generated response into the result returned to the API"""
+        user_input = context["user_input"]
+        # The user's message as the model saw it, including a patient record added this turn
+        history_input = context["history_input"]
+        valid_history = context["valid_history"]
+        is_new_conversation = context["is_new_conversation"]
+        active_criteria = context["active_criteria"]
         response_text = response_data["text"]
         
-        # Extract thinking, search query, and answer
-        extracted = self.model_handler.extract_sections(response_text)
+        # Tokens avoided compared to decoding up to the fixed limit without stop tags
+        num_tokens = response_data.get("num_tokens", 0)
+        tokens_saved = REASONING_MAX_TOKENS - num_tokens if response_data.get("stopped_on") is not None else 0
+        if not (response_data.get("coalesced") or response_data.get("cached") or response_data.get("rule_based")):
+            # Shared and cached responses were already recorded by the request that generated them,
+            # and rule-based ones were not generated
+            token_budget.record("reasoning", num_tokens, tokens_saved)
+        logger.info(f"Generated {num_tokens} tokens (budget {context['max_tokens']}), {tokens_saved} wasted tokens avoided")
         
         # Log what was extracted to help with debugging
         logger.info(f"Extracted thinking: {extracted['thinking'] is not None}")
@@ -137,12 +606,12 @@ class LocalReasonerModel:
         # Prepare conversation history for the result
         if is_new_conversation:
             updated_history = [
-                {"role": "user", "content": user_input},
+                {"role": "user", "content": history_input},
                 {"role": "assistant", "content": response_text}
             ]
         else:
             updated_history = valid_history.copy()
-            updated_history.append({"role": "user", "content": user_input})
+            updated_history.append({"role": "user", "content": history_input})
             updated_history.append({"role": "assistant", "content": response_text})
         
         # Prepare response
@@ -153,14 +622,37 @@ class LocalReasonerModel:
             "answer": extracted["answer"],
             "requires_information": bool(extracted["search_query"]),
             "conversation_history": updated_history,
-            "criteria_used": active_criteria["name"]
+            "criteria_used": active_criteria["name"],
+            "criteria_key": context["criteria_key"],
+            "num_tokens": num_tokens,
+            "tokens_saved": tokens_saved,
+            "prompt_tokens_saved": context["prompt_tokens_saved"],
+            "coalesced": response_data.get("coalesced", False),
+            "deterministic": context["deterministic"],
+            "cached": response_data.get("cached", False),
+            "rule_based": response_data.get("rule_based", False),
+            "patient_record": history_input != user_input
         }
         
         # Add extra fields for all responses to ensure consistency
-        result["patient_id"] = patient_id
+        result["patient_id"] = context["patient_id"]
         if is_new_conversation:
             result["original_prompt"] = user_input
         
+        session = context["session"]
+        if session is not None:
+            # Keep the history server-side and only return what this turn added
+            new_messages = updated_history[len(valid_history):]
+            session_store.update(session, new_messages, response_data.get("kv_cache"))
+            del result["conversation_history"]
+            result["conversation_delta"] = new_messages
+            result["session_id"] = session.session_id
+            result["prompt_tokens"] = response_data.get("prompt_tokens")
+            result["cached_tokens"] = response_data.get("cached_tokens")
+            logger.info(f"Session {session.session_id} turn {session.turns}: "
+                        f"{response_data.get('cached_tokens', 0)}/{response_data.get('prompt_tokens', 0)} prompt tokens from cache")
+            return result
+        
         # Log the conversation history for debugging
         logger.info(f"Returning result with conversation history of {len(updated_history)} messages")
         if len(updated_history) > 0:
@@ -0,0 +1,362 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import logging
+from typing import Any, Dict, Iterable, List, Optional
+
+import pandas as pd
+
+from app.rules import MEASUREMENTS, MEASUREMENT_COLUMNS, MEASUREMENT_INDEX, complete_admissions, window_sql
+from app.criteria import criteria_store
+from app.config import SCORE_STORE_PATH, RESCORE_INTERVAL_SECONDS
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# MIMIC tables whose new rows are picked up
+SOURCE_TABLES = ("chartevents", "labevents")
+
+# Largest number of source rows folded in per transaction
+SYNC_CHUNK_ROWS = 200000
+
+
+def measurement_rows_query(source: str) -> str:
+    """
+    Query turning raw event rows of a table into (hadm_id, time_window, name, value) rows of
+    known measurements, with values converted and windows numbered the same way load_measurements does.
+    """
+    names = " ".join(
+        f"WHEN itemid IN ({', '.join(str(i) for i in spec['itemids'])}) THEN '{name}'"
+        for name, spec in MEASUREMENTS.items()
+    )
+    values = " ".join(
+        f"WHEN itemid IN ({', '.join(str(i) for i in spec['itemids'])}) THEN {spec['value']}"
+        for spec in MEASUREMENTS.values() if "value" in spec
+    )
+    all_ids = ", ".join(str(i) for spec in MEASUREMENTS.values() for i in spec["itemids"])
+    value = f"CASE {values} ELSE valuenum END" if values else "valuenum"
+    return (f"SELECT hadm_id, {window_sql()} AS time_window, CASE {names} END AS name, {value} AS value FROM {source} "
+            f"WHERE itemid IN ({all_ids}) AND valuenum IS NOT NULL AND hadm_id IS NOT NULL")
+
+
+class RescoringPipeline:
+    """
+    Singleton pipeline keeping rule-based criteria scores up to date as measurements arrive.
+
+    New chartevents/labevents rows, read from the MIMIC database past a per-table rowid
+    watermark or posted directly, are folded into running min/max ranges per admission and
+    charttime window, and the admissions they touch are marked dirty. Re-scoring evaluates the rules of
+    every criteria set only for the dirty admissions, so the work follows the amount of
+    new data rather than the size of the cohort. A criteria set whose rules changed
+    (new version) is re-scored in full once. Scores are stored with the criteria version
+    that produced them, and every decision that flips is appended to a changes feed that
+    clients read with a sequence cursor.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = super(RescoringPipeline, cls).__new__(cls)
+                cls._instance._initialize()
+            return cls._instance
+
+    def _initialize(self):
+        """Initialize the pipeline state; the database is opened on first use."""
+        self.path = SCORE_STORE_PATH
+        self.state_lock = threading.RLock()
+        self._conn = None
+        self._worker = None
+        self.last_run: Optional[Dict[str, Any]] = None
+
+    def _connection(self) -> sqlite3.Connection:
+        # Caller holds self.state_lock
+        if self._conn is None:
+            if self.path:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            else:
+                self._conn = sqlite3.connect(":memory:", isolation_level=None, check_same_thread=False)
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS measurement_ranges (
+                    hadm_id INTEGER NOT NULL, time_window INTEGER NOT NULL, name TEXT NOT NULL,
+                    min_value REAL, max_value REAL, PRIMARY KEY (hadm_id, time_window, name));
+                CREATE TABLE IF NOT EXISTS dirty (hadm_id INTEGER PRIMARY KEY);
+                CREATE TABLE IF NOT EXISTS scores (
+                    criteria_key TEXT NOT NULL, hadm_id INTEGER NOT NULL, version INTEGER NOT NULL,
+                    decision TEXT NOT NULL, met INTEGER NOT NULL, unknown INTEGER NOT NULL, updated REAL NOT NULL,
+                    PRIMARY KEY (criteria_key, hadm_id));
+                CREATE TABLE IF NOT EXISTS changes (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT, criteria_key TEXT NOT NULL, hadm_id INTEGER NOT NULL,
+                    version INTEGER NOT NULL, previous TEXT NOT NULL, decision TEXT NOT NULL, changed REAL NOT NULL);
+                CREATE TABLE IF NOT EXISTS watermarks (source TEXT PRIMARY KEY, value INTEGER NOT NULL);
+            """)
+        return self._conn
+
+    def _watermark(self, source: str) -> int:
+        row = self._connection().execute("SELECT value FROM watermarks WHERE source = ?", (source,)).fetchone()
+        return row[0] if row else 0
+
+    def _fold(self, rows: pd.DataFrame) -> int:
+        """
+        Merge measurement rows into the per-window ranges and mark their admissions dirty
+        (caller holds an open write transaction). Returns the number of admissions touched.
+        """
+        if rows.empty:
+            return 0
+        ranges = rows.groupby(["hadm_id", "time_window", "name"])["value"].agg(["min", "max"]).reset_index()
+        conn = self._connection()
+        conn.executemany(
+            "INSERT INTO measurement_ranges VALUES (?, ?, ?, ?, ?) ON CONFLICT (hadm_id, time_window, name) DO UPDATE SET "
+            "min_value = MIN(min_value, excluded.min_value), max_value = MAX(max_value, excluded.max_value)",
+            ((int(h), int(w), name, low, high)
+             for h, w, name, low, high in ranges[["hadm_id", "time_window", "name", "min", "max"]].itertuples(index=False, name=None))
+        )
+        hadm_ids = ranges["hadm_id"].unique()
+        conn.executemany("INSERT OR IGNORE INTO dirty VALUES (?)", ((int(h),) for h in hadm_ids))
+        return len(hadm_ids)
+
+    def sync(self, db_path: str) -> Dict[str, Any]:
+        """
+        Fold in the chartevents/labevents rows added to the MIMIC database since the last
+        sync, then re-score the admissions they touched.
+
+        Args:
+            db_path: MIMIC SQLite database; rows are found by rowid past each table's watermark
+
+        Returns:
+            Rows read per table, admissions touched and the re-scoring stats
+        """
+        start = time.perf_counter()
+        source = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        read = {}
+        touched = 0
+        try:
+            with self.state_lock:
+                conn = self._connection()
+                for table in SOURCE_TABLES:
+                    try:
+                        latest = source.execute(f"SELECT MAX(rowid) FROM {table}").fetchone()[0] or 0
+                    except sqlite3.OperationalError as e:
+                        logger.debug(f"Skipping {table}: {e}")
+                        continue
+                    read[table] = 0
+                    query = measurement_rows_query(table) + " AND rowid > ? AND rowid <= ?"
+                    # The watermark moves in the same transaction as the ranges, so rows are folded in exactly once
+                    while True:
+                        conn.execute("BEGIN IMMEDIATE")
+                        try:
+                            watermark = self._watermark(table)
+                            if watermark >= latest:
+                                conn.execute("COMMIT")
+                                break
+                            upto = min(latest, watermark + SYNC_CHUNK_ROWS)
+                            rows = pd.read_sql_query(query, source, params=(watermark, upto))
+                            touched += self._fold(rows)
+                            conn.execute("INSERT OR REPLACE INTO watermarks VALUES (?, ?)", (table, upto))
+                            conn.execute("COMMIT")
+                        except Exception:
+                            conn.execute("ROLLBACK")
+                            raise
+                        read[table] += len(rows)
+        finally:
+            source.close()
+        stats = self.rescore()
+        stats.update({"rows_read": read, "admissions_touched": touched,
+                      "seconds": round(time.perf_counter() - start, 4)})
+        logger.info(f"Synced {sum(read.values())} new measurement rows, {touched} admissions touched, "
+                    f"{stats['rescored']} scores recomputed, {stats['flipped']} flipped")
+        return stats
+
+    def ingest(self, rows: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Fold in event rows posted directly, e.g. from a message feed, then re-score.
+
+        Args:
+            rows: chartevents/labevents rows with hadm_id, itemid, valuenum and charttime; rows
+                without a charttime can rule criteria out but never count as met together
+
+        Returns:
+            Rows accepted, admissions touched and the re-scoring stats
+        """
+        start = time.perf_counter()
+        records = [(r.get("hadm_id"), r.get("itemid"), r.get("valuenum"), r.get("charttime")) for r in rows]
+        with self.state_lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Converted by the same query as rows read from the database
+                conn.execute("CREATE TEMP TABLE IF NOT EXISTS incoming (hadm_id INTEGER, itemid INTEGER, valuenum REAL, charttime TEXT)")
+                conn.execute("DELETE FROM incoming")
+                conn.executemany("INSERT INTO incoming VALUES (?, ?, ?, ?)", records)
+                measurements = pd.read_sql_query(measurement_rows_query("incoming"), conn)
+                touched = self._fold(measurements)
+                conn.execute("DELETE FROM incoming")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        stats = self.rescore()
+        stats.update({"rows": len(records), "measurements": len(measurements), "admissions_touched": touched,
+                      "seconds": round(time.perf_counter() - start, 4)})
+        return stats
+
+    def _measurements(self, hadm_ids: List[int]) -> pd.DataFrame:
+        """Per-window measurement table of the given admissions from the stored ranges"""
+        ranges = pd.read_sql_query(
+            "SELECT hadm_id, time_window, name, min_value, max_value FROM measurement_ranges "
+            "WHERE hadm_id IN (SELECT value FROM json_each(?))",
+            self._connection(), params=(json.dumps(hadm_ids),)
+        )
+        measurements = ranges.pivot(index=MEASUREMENT_INDEX, columns="name", values=["min_value", "max_value"])
+        measurements.columns = [f"{name}_{'min' if bound == 'min_value' else 'max'}" for bound, name in measurements.columns]
+        return complete_admissions(measurements.reindex(columns=MEASUREMENT_COLUMNS).astype(float), hadm_ids)
+
+    def rescore(self) -> Dict[str, Any]:
+        """
+        Recompute the scores of dirty admissions for every criteria set with rules, and of all
+        admissions for a criteria set scored with an older version. Flipped decisions are
+        appended to the changes feed.
+        """
+        start = time.perf_counter()
+        rescored = 0
+        flipped = 0
+        full = []
+        with self.state_lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                dirty = [row[0] for row in conn.execute("SELECT hadm_id FROM dirty")]
+                tracked = None
+                now = time.time()
+                for compiled in criteria_store.list():
+                    if compiled.rule_set is None:
+                        continue
+                    outdated = conn.execute(
+                        "SELECT NOT EXISTS (SELECT 1 FROM scores WHERE criteria_key = ?) "
+                        "OR EXISTS (SELECT 1 FROM scores WHERE criteria_key = ? AND version != ?)",
+                        (compiled.key, compiled.key, compiled.version)
+                    ).fetchone()[0]
+                    if outdated:
+                        if tracked is None:
+                            tracked = [row[0] for row in conn.execute("SELECT DISTINCT hadm_id FROM measurement_ranges")]
+                        hadm_ids = tracked
+                        full.append(compiled.key)
+                    else:
+                        hadm_ids = dirty
+                    if not hadm_ids:
+                        continue
+
+                    scores = compiled.rule_set.score_admissions(self._measurements(hadm_ids))
+                    previous = dict(conn.execute(
+                        "SELECT hadm_id, decision FROM scores WHERE criteria_key = ? "
+                        "AND hadm_id IN (SELECT value FROM json_each(?))",
+                        (compiled.key, json.dumps(hadm_ids))
+                    ).fetchall())
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        ((compiled.key, int(h), compiled.version, d, int(m), int(u), now)
+                         for h, m, u, d in zip(scores.index, scores["met"], scores["unknown"], scores["decision"]))
+                    )
+                    changes = [(compiled.key, int(h), compiled.version, previous[h], d, now)
+                               for h, d in zip(scores.index, scores["decision"])
+                               if h in previous and previous[h] != d]
+                    conn.executemany(
+                        "INSERT INTO changes (criteria_key, hadm_id, version, previous, decision, changed) "
+                        "VALUES (?, ?, ?, ?, ?, ?)", changes
+                    )
+                    rescored += len(scores)
+                    flipped += len(changes)
+                conn.executemany("DELETE FROM dirty WHERE hadm_id = ?", ((h,) for h in dirty))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        self.last_run = {
+            "dirty_admissions": len(dirty),
+            "rescored": rescored,
+            "flipped": flipped,
+            "full_rescore": full,
+            "rescore_seconds": round(time.perf_counter() - start, 4)
+        }
+        return dict(self.last_run)
+
+    def changes(self, since: int = 0, criteria_key: Optional[str] = None, limit: int = 100) -> Dict[str, Any]:
+        """
+        Admissions whose decision flipped after sequence number since, oldest first.
+
+        Returns:
+            {'changes': [...], 'next': sequence number to pass as since on the next call}
+        """
+        query = "SELECT seq, criteria_key, hadm_id, version, previous, decision, changed FROM changes WHERE seq > ?"
+        params: list = [since]
+        if criteria_key:
+            query += " AND criteria_key = ?"
+            params.append(criteria_key)
+        query += " ORDER BY seq LIMIT ?"
+        params.append(limit)
+        with self.state_lock:
+            rows = self._connection().execute(query, params).fetchall()
+        changes = [
+            {"seq": seq, "criteria_key": key, "hadm_id": hadm_id, "version": version,
+             "previous": previous, "decision": decision, "changed": changed}
+            for seq, key, hadm_id, version, previous, decision, changed in rows
+        ]
+        return {"changes": changes, "next": changes[-1]["seq"] if changes else since}
+
+    def get_scores(self, hadm_id: int) -> Dict[str, Any]:
+        """Current scores and measurement ranges of one admission"""
+        with self.state_lock:
+            conn = self._connection()
+            scores = conn.execute(
+                "SELECT criteria_key, version, decision, met, unknown, updated FROM scores WHERE hadm_id = ?", (hadm_id,)
+            ).fetchall()
+            ranges = conn.execute(
+                "SELECT name, MIN(min_value), MAX(max_value) FROM measurement_ranges WHERE hadm_id = ? GROUP BY name", (hadm_id,)
+            ).fetchall()
+        return {
+            "hadm_id": hadm_id,
+            "scores": {key: {"version": version, "decision": decision, "met": met, "unknown": unknown, "updated": updated}
+                       for key, version, decision, met, unknown, updated in scores},
+            "measurements": {name: {"min": low, "max": high} for name, low, high in ranges}
+        }
+
+    def start(self, db_path: str, interval: float = RESCORE_INTERVAL_SECONDS):
+        """Sync from the MIMIC database in a background thread every interval seconds"""
+        if interval <= 0 or (self._worker is not None and self._worker.is_alive()):
+            return
+
+        def run():
+            while True:
+                try:
+                    self.sync(db_path)
+                except Exception as e:
+                    logger.error(f"Error re-scoring new measurements: {e}")
+                time.sleep(interval)
+
+        self._worker = threading.Thread(target=run, name="criteria-rescoring", daemon=True)
+        self._worker.start()
+        logger.info(f"Re-scoring new measurements every {interval:.0f}s")
+
+    def get_state(self) -> Dict[str, Any]:
+        """Get a summary of the pipeline for monitoring"""
+        with self.state_lock:
+            conn = self._connection()
+            return {
+                "path": self.path or None,
+                "watermarks": dict(conn.execute("SELECT source, value FROM watermarks").fetchall()),
+                "admissions": conn.execute("SELECT COUNT(DISTINCT hadm_id) FROM measurement_ranges").fetchone()[0],
+                "dirty": conn.execute("SELECT COUNT(*) FROM dirty").fetchone()[0],
+                "scores": dict(conn.execute("SELECT criteria_key, COUNT(*) FROM scores GROUP BY criteria_key").fetchall()),
+                "last_change": conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0],
+                "last_run": self.last_run,
+                "background_sync": self._worker is not None and self._worker.is_alive()
+            }
+
+
+# Create singleton instance
+rescoring_pipeline = RescoringPipeline()
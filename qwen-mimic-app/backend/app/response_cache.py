@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+import logging
+from typing import Any, Dict, List, Optional
+
+from app.config import RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_ENTRIES
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+def content_hash(value: Any) -> str:
+    """Stable hash of a JSON-serializable value"""
+    encoded = json.dumps(value, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def criteria_hash(criteria: Dict[str, Any]) -> str:
+    """Hash of the parts of a criteria definition that end up in the prompt"""
+    return content_hash([criteria.get("name"), criteria.get("criteria"), criteria.get("threshold", "")])
+
+
+def prefix_hash(messages: List[Dict[str, str]]) -> str:
+    """Hash of the conversation before the new input"""
+    return content_hash([(m.get("role"), m.get("content")) for m in messages])
+
+
+class ResponseCache:
+    """
+    Singleton persistent cache of deterministic (greedy) reasoning responses.
+
+    Entries are keyed on the prompt, the conversation prefix, the criteria content,
+    the model and the decoding parameters, and stored in SQLite so they survive restarts.
+    The least recently used entries are evicted once there are more than
+    RESPONSE_CACHE_MAX_ENTRIES, and entries for a criteria definition are dropped
+    when that definition changes.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = super(ResponseCache, cls).__new__(cls)
+                cls._instance._initialize()
+            return cls._instance
+
+    def _initialize(self):
+        """Initialize the cache state; the database is opened on first use."""
+        self.path = RESPONSE_CACHE_PATH
+        self.max_entries = RESPONSE_CACHE_MAX_ENTRIES
+        self.state_lock = threading.Lock()
+        self._conn = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path) and self.max_entries > 0
+
+    def _connection(self) -> sqlite3.Connection:
+        # Caller holds self.state_lock
+        if self._conn is None:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, criteria_hash TEXT NOT NULL, model TEXT NOT NULL, "
+                "response TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_criteria ON responses (criteria_hash)")
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def make_key(prompt: str, conversation_prefix_hash: str, criteria_content_hash: str,
+                 model: Any, decoding: Dict[str, Any]) -> str:
+        """Cache key for a response: everything that determines a greedy generation"""
+        return content_hash([prompt, conversation_prefix_hash, criteria_content_hash, model, decoding])
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Look up a cached response, marking it as recently used"""
+        if not self.enabled:
+            return None
+        with self.state_lock:
+            try:
+                conn = self._connection()
+                row = conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+                conn.commit()
+                self.hits += 1
+                return json.loads(row[0])
+            except (sqlite3.Error, ValueError) as e:
+                logger.error(f"Error reading response cache: {e}")
+                return None
+
+    def put(self, key: str, criteria_content_hash: str, model: Any, response: Dict[str, Any]):
+        """Store a response, evicting the least recently used entries over the size limit"""
+        if not self.enabled:
+            return
+        now = time.time()
+        with self.state_lock:
+            try:
+                conn = self._connection()
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, criteria_content_hash, json.dumps(model, default=str), json.dumps(response), now, now)
+                )
+                evicted = conn.execute(
+                    "DELETE FROM responses WHERE key IN ("
+                    "SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                ).rowcount
+                conn.commit()
+                self.evictions += max(0, evicted)
+            except (sqlite3.Error, TypeError) as e:
+                logger.error(f"Error writing response cache: {e}")
+
+    def invalidate_criteria(self, criteria_content_hash: str) -> int:
+        """Drop every response generated under a criteria definition"""
+        if not self.enabled:
+            return 0
+        with self.state_lock:
+            try:
+                conn = self._connection()
+                removed = conn.execute(
+                    "DELETE FROM responses WHERE criteria_hash = ?", (criteria_content_hash,)
+                ).rowcount
+                conn.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Error invalidating response cache: {e}")
+                return 0
+            self.invalidations += removed
+        if removed:
+            logger.info(f"Invalidated {removed} cached responses for changed criteria")
+        return removed
+
+    def clear(self) -> int:
+        """Remove all cached responses"""
+        if not self.enabled:
+            return 0
+        with self.state_lock:
+            conn = self._connection()
+            removed = conn.execute("DELETE FROM responses").rowcount
+            conn.commit()
+        return removed
+
+    def get_state(self) -> Dict[str, Any]:
+        """Get a summary of the cache for monitoring"""
+        entries = 0
+        if self.enabled:
+            with self.state_lock:
+                try:
+                    entries = self._connection().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+                except sqlite3.Error as e:
+                    logger.error(f"Error reading response cache: {e}")
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "path": self.path,
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
+
+
+# Create singleton instance
+response_cache = ResponseCache()
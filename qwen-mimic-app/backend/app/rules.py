@@ -0,0 +1,373 @@
+import re
+import json
+import sqlite3
+import logging
+import operator
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from app.config import RULE_WINDOW_HOURS
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Measurements rules can refer to: MIMIC-IV source table, item ids, and the SQL expression
+# converting a row's value to the unit the rules are written in
+MEASUREMENTS = {
+    "resp_rate": {"table": "chartevents", "itemids": (220210, 224690), "unit": "breaths/min"},
+    "sbp": {"table": "chartevents", "itemids": (220179, 220050), "unit": "mmHg"},
+    "heart_rate": {"table": "chartevents", "itemids": (220045,), "unit": "/min"},
+    "temperature": {"table": "chartevents", "itemids": (223762, 223761), "unit": "°C",
+                    "value": "CASE WHEN itemid = 223761 THEN (valuenum - 32) * 5.0 / 9 ELSE valuenum END"},
+    "gcs_verbal": {"table": "chartevents", "itemids": (223900,), "unit": "points (5 = oriented)"},
+    "paco2": {"table": "labevents", "itemids": (50818,), "unit": "mmHg"},
+    "wbc": {"table": "labevents", "itemids": (51301, 51300), "unit": "K/uL"},
+    "bands": {"table": "labevents", "itemids": (51144,), "unit": "%"},
+}
+
+# Columns of a measurement table: lowest and highest value of each measurement per admission
+MEASUREMENT_COLUMNS = [f"{name}_{bound}" for name in MEASUREMENTS for bound in ("min", "max")]
+
+# Index of a measurement table loaded from MIMIC: one row per admission and charttime window
+MEASUREMENT_INDEX = ["hadm_id", "time_window"]
+
+# Window of rows without a charttime: they can rule criteria out, but never count as met together
+UNDATED_WINDOW = -1
+
+OPERATORS = {
+    ">=": operator.ge, "≥": operator.ge,
+    "<=": operator.le, "≤": operator.le,
+    ">": operator.gt, "<": operator.lt,
+    "==": operator.eq, "!=": operator.ne,
+}
+
+COMPARISON_PATTERN = re.compile(r"^\s*([a-z_][a-z0-9_]*)\s*(>=|<=|==|!=|≥|≤|>|<)\s*(-?\d+(?:\.\d+)?)\s*$")
+THRESHOLD_PATTERN = re.compile(r"(≥|>=|>)\s*(\d+)")
+
+
+class RuleError(ValueError):
+    """A rule or threshold that cannot be compiled"""
+
+
+class Rule:
+    """
+    One criterion as a vectorized predicate, e.g. "temperature > 38 or temperature < 36".
+
+    A comparison on a missing measurement is unknown rather than false. A rule is met if
+    any of its comparisons is met, and unknown if none is met and some are unknown.
+    """
+
+    def __init__(self, text: str):
+        self.text = text.strip()
+        self.comparisons: List[Tuple[str, str, float]] = []
+        for part in re.split(r"\s+or\s+", self.text, flags=re.IGNORECASE):
+            match = COMPARISON_PATTERN.match(part)
+            if not match:
+                raise RuleError(f"Cannot parse rule '{text}': expected '<measurement> <op> <number>' "
+                                f"joined by 'or'")
+            measurement, op, value = match.groups()
+            if measurement not in MEASUREMENTS:
+                raise RuleError(f"Unknown measurement '{measurement}' in rule '{text}' "
+                                f"(known: {', '.join(MEASUREMENTS)})")
+            self.comparisons.append((measurement, op, float(value)))
+
+    @staticmethod
+    def _column(measurements: pd.DataFrame, measurement: str, op: str) -> Optional[str]:
+        """Column to compare: the worst value of the admission in the rule's direction, else a plain value"""
+        if op in (">", ">=", "≥") and f"{measurement}_max" in measurements:
+            return f"{measurement}_max"
+        if op in ("<", "<=", "≤") and f"{measurement}_min" in measurements:
+            return f"{measurement}_min"
+        if measurement in measurements:
+            return measurement
+        return None
+
+    def evaluate(self, measurements: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Evaluate the rule for every row at once.
+
+        Returns:
+            (met, known) boolean arrays with one entry per row
+        """
+        rows = len(measurements)
+        met = np.zeros(rows, dtype=bool)
+        all_known = np.ones(rows, dtype=bool)
+        for measurement, op, value in self.comparisons:
+            column = self._column(measurements, measurement, op)
+            if column is None:
+                all_known[:] = False
+                continue
+            values = pd.to_numeric(measurements[column], errors="coerce").to_numpy(dtype=float)
+            known = ~np.isnan(values)
+            met |= OPERATORS[op](values, value) & known
+            all_known &= known
+        return met, met | all_known
+
+
+class RuleSet:
+    """The compiled rules of a criteria definition and the number that must be met"""
+
+    def __init__(self, name: str, rules: List[Rule], min_met: int):
+        self.name = name
+        self.rules = rules
+        self.min_met = min_met
+
+    def score(self, measurements: pd.DataFrame) -> pd.DataFrame:
+        """
+        Score every row of a measurement table in one pass.
+
+        Args:
+            measurements: One row per patient or admission; columns are measurement names,
+                or <measurement>_min / <measurement>_max as returned by load_measurements
+
+        Returns:
+            DataFrame with the same index and columns 'met' (rules met), 'unknown' (rules that
+            could not be evaluated), 'decision' (positive / negative / indeterminate), and one
+            nullable boolean column per rule that is NA when unknown
+        """
+        met = np.zeros((len(measurements), len(self.rules)), dtype=bool)
+        known = np.zeros_like(met)
+        for j, rule in enumerate(self.rules):
+            met[:, j], known[:, j] = rule.evaluate(measurements)
+        met_count = met.sum(axis=1)
+        unknown_count = (~known).sum(axis=1)
+        decision = np.where(
+            met_count >= self.min_met, "positive",
+            np.where(met_count + unknown_count < self.min_met, "negative", "indeterminate")
+        )
+        scores = pd.DataFrame({"met": met_count, "unknown": unknown_count, "decision": decision},
+                              index=measurements.index)
+        for j, rule in enumerate(self.rules):
+            scores[rule.text] = pd.arrays.BooleanArray(met[:, j], ~known[:, j])
+        return scores
+
+    def score_admissions(self, measurements: pd.DataFrame) -> pd.DataFrame:
+        """
+        Score admissions from their per-window measurements, as returned by load_measurements.
+
+        Criteria met hours or days apart are not met together: an admission is positive only
+        if one charttime window meets the threshold, and indeterminate if only its worst values
+        over the whole stay do. Negative and the per-rule columns come from those worst values.
+
+        Returns:
+            score() frame with one row per admission, indexed by hadm_id
+        """
+        scores = self.score(admission_ranges(measurements))
+        dated = measurements[measurements.index.get_level_values("time_window") != UNDATED_WINDOW]
+        within_window = (self.score(dated)["decision"] == "positive").groupby(level="hadm_id").any()
+        apart = (scores["decision"] == "positive") & ~within_window.reindex(scores.index, fill_value=False)
+        scores.loc[apart, "decision"] = "indeterminate"
+        return scores
+
+    def describe(self, row: pd.Series) -> str:
+        """One-line explanation of a scored row"""
+        unknown = [rule.text for rule in self.rules if pd.isna(row[rule.text])]
+        met = [rule.text for rule in self.rules if rule.text not in unknown and row[rule.text]]
+        text = f"{self.name} {row['decision']}: {row['met']} of {len(self.rules)} criteria met (threshold {self.min_met})"
+        if row["decision"] == "indeterminate" and row["met"] >= self.min_met:
+            text += ", but not within one time window"
+        if met:
+            text += f"; met: {', '.join(met)}"
+        if unknown:
+            text += f"; not recorded: {', '.join(unknown)}"
+        return text
+
+
+def parse_min_met(threshold: str, rule_count: int) -> int:
+    """Number of rules that must be met, from a threshold like '≥2 => qSOFA' (default: all of them)"""
+    match = THRESHOLD_PATTERN.search(threshold or "")
+    if not match:
+        return rule_count
+    op, count = match.groups()
+    count = int(count) + (1 if op == ">" else 0)
+    if count > rule_count:
+        raise RuleError(f"Threshold '{threshold}' needs {count} criteria but only {rule_count} rules are defined")
+    return count
+
+
+def compile_rules(definition: Dict[str, Any]) -> Optional[RuleSet]:
+    """
+    Compile the 'rules' of a criteria definition into vectorized predicates.
+
+    Args:
+        definition: Criteria definition; its optional 'rules' list holds one rule per criterion,
+            e.g. ["resp_rate >= 22", "sbp <= 100", "gcs_verbal < 5"], and its threshold
+            gives the number that must be met
+
+    Returns:
+        The compiled RuleSet, or None if the definition has no rules
+    """
+    texts = definition.get("rules")
+    if not texts:
+        return None
+    rules = [Rule(text) for text in texts]
+    return RuleSet(definition["name"], rules, parse_min_met(definition.get("threshold", ""), len(rules)))
+
+
+def window_sql(window_hours: float = RULE_WINDOW_HOURS) -> str:
+    """SQL expression numbering the charttime window of an event row (UNDATED_WINDOW without a charttime)"""
+    if window_hours <= 0:
+        return "0"
+    seconds = max(1, int(window_hours * 3600))
+    return f"COALESCE(CAST(strftime('%s', charttime) AS INTEGER) / {seconds}, {UNDATED_WINDOW})"
+
+
+def admission_ranges(measurements: pd.DataFrame) -> pd.DataFrame:
+    """Lowest and highest value of every measurement over all windows of each admission"""
+    grouped = measurements.groupby(level="hadm_id", sort=False)
+    lows = grouped[[c for c in measurements.columns if c.endswith("_min")]].min()
+    highs = grouped[[c for c in measurements.columns if c.endswith("_max")]].max()
+    return pd.concat([lows, highs], axis=1).reindex(columns=measurements.columns)
+
+
+def complete_admissions(measurements: pd.DataFrame, hadm_ids: Sequence[int]) -> pd.DataFrame:
+    """
+    The windows of the given admissions in request order; an admission without any
+    measurement gets one empty undated row, so it is still scored (as unknown).
+    """
+    hadm_ids = [int(h) for h in hadm_ids]
+    present = set(measurements.index.get_level_values("hadm_id"))
+    missing = pd.MultiIndex.from_tuples([(h, UNDATED_WINDOW) for h in dict.fromkeys(hadm_ids) if h not in present],
+                                        names=MEASUREMENT_INDEX)
+    measurements = pd.concat([measurements, pd.DataFrame(index=missing, columns=measurements.columns, dtype=float)])
+    measurements = measurements[measurements.index.get_level_values("hadm_id").isin(hadm_ids)]
+    order = {h: i for i, h in reversed(list(enumerate(hadm_ids)))}
+    position = measurements.index.get_level_values("hadm_id").map(order)
+    return measurements.iloc[np.argsort(position.to_numpy(), kind="stable")]
+
+
+def empty_measurements() -> pd.DataFrame:
+    """Measurement table without rows"""
+    return pd.DataFrame(index=pd.MultiIndex.from_tuples([], names=MEASUREMENT_INDEX), columns=MEASUREMENT_COLUMNS, dtype=float)
+
+
+def load_measurements(conn: sqlite3.Connection, hadm_ids: Optional[Sequence[int]] = None,
+                      patient_id: Optional[int] = None, window_hours: float = RULE_WINDOW_HOURS) -> pd.DataFrame:
+    """
+    Lowest and highest value of every known measurement per admission and charttime window,
+    in one query per table.
+
+    Args:
+        conn: Connection to the MIMIC-IV SQLite database
+        hadm_ids: Admissions to load (default: all)
+        patient_id: Load the admissions with this hadm_id or subject_id instead
+        window_hours: Width of the charttime windows (0 = one window per admission)
+
+    Returns:
+        DataFrame indexed by (hadm_id, time_window) with <measurement>_min and <measurement>_max
+        columns; missing tables leave their columns empty. Score it with RuleSet.score_admissions,
+        or get per-admission values with admission_ranges
+    """
+    window = window_sql(window_hours)
+    frames = []
+    for table in sorted({spec["table"] for spec in MEASUREMENTS.values()}):
+        specs = {name: spec for name, spec in MEASUREMENTS.items() if spec["table"] == table}
+        columns = []
+        for name, spec in specs.items():
+            ids = ", ".join(str(i) for i in spec["itemids"])
+            value = spec.get("value", "valuenum")
+            columns.append(f"MIN(CASE WHEN itemid IN ({ids}) THEN {value} END) AS {name}_min")
+            columns.append(f"MAX(CASE WHEN itemid IN ({ids}) THEN {value} END) AS {name}_max")
+        all_ids = ", ".join(str(i) for spec in specs.values() for i in spec["itemids"])
+        query = (f"SELECT hadm_id, {window} AS time_window, {', '.join(columns)} FROM {table} "
+                 f"WHERE itemid IN ({all_ids}) AND valuenum IS NOT NULL AND hadm_id IS NOT NULL")
+        params: tuple = ()
+        if patient_id is not None:
+            query += " AND (hadm_id = ? OR subject_id = ?)"
+            params = (patient_id, patient_id)
+        elif hadm_ids is not None:
+            query += " AND hadm_id IN (SELECT value FROM json_each(?))"
+            params = (json.dumps([int(h) for h in hadm_ids]),)
+        query += " GROUP BY hadm_id, time_window"
+        try:
+            frames.append(pd.read_sql_query(query, conn, params=params, index_col=MEASUREMENT_INDEX))
+        except (sqlite3.OperationalError, pd.errors.DatabaseError) as e:
+            logger.debug(f"Skipping {table} measurements: {e}")
+
+    measurements = pd.concat(frames, axis=1).sort_index() if frames else empty_measurements()
+    measurements = measurements.reindex(columns=MEASUREMENT_COLUMNS).astype(float)
+    if hadm_ids is not None and patient_id is None:
+        measurements = complete_admissions(measurements, hadm_ids)
+    return measurements
+
+
+def score_records(rule_set: RuleSet, records: List[Dict[str, Any]]) -> pd.DataFrame:
+    """Score measurements given per patient, e.g. [{'hadm_id': 1, 'resp_rate': 24, 'sbp': 95}]"""
+    measurements = pd.DataFrame.from_records(records)
+    if "hadm_id" in measurements:
+        measurements = measurements.set_index("hadm_id")
+    return rule_set.score(measurements)
+
+
+def score_rows(rule_set: RuleSet, scores: pd.DataFrame) -> List[Dict[str, Any]]:
+    """Scored rows as JSON-ready dictionaries (index as 'hadm_id'), with unknown rules as None"""
+    rows = []
+    for index, met, unknown, decision, *rule_values in scores.itertuples(name=None):
+        rows.append({
+            "hadm_id": index.item() if isinstance(index, np.generic) else index,
+            "decision": decision,
+            "met": int(met),
+            "unknown": int(unknown),
+            "criteria": {rule.text: None if pd.isna(value) else bool(value)
+                         for rule, value in zip(rule_set.rules, rule_values)}
+        })
+    return rows
+
+
+def load_patient_measurements(db_path: Optional[str], patient_id: Any) -> pd.DataFrame:
+    """
+    Measurements of one patient for the rule pre-check, loaded once and scored against
+    every criteria set of a request.
+
+    Args:
+        db_path: MIMIC SQLite database
+        patient_id: hadm_id or subject_id from the prompt
+
+    Returns:
+        load_measurements() frame of the patient's admissions; empty if there is no
+        database, the id is not numeric, or the query fails
+    """
+    empty = empty_measurements()
+    if not db_path:
+        return empty
+    try:
+        patient_id = int(patient_id)
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            return load_measurements(conn, patient_id=patient_id)
+        finally:
+            conn.close()
+    except (ValueError, TypeError, sqlite3.Error) as e:
+        logger.warning(f"Rule pre-check skipped for patient {patient_id}: {e}")
+        return empty
+
+
+def rule_precheck(rule_set: Optional[RuleSet], measurements: pd.DataFrame) -> Optional[Dict[str, Any]]:
+    """
+    Score one patient's measurements before asking the model.
+
+    Args:
+        rule_set: Compiled rules of the criteria being assessed
+        measurements: The patient's measurements (see load_patient_measurements)
+
+    Returns:
+        {'decision', 'met', 'unknown', 'hadm_id', 'explanation'} if the rules decide the case,
+        or None if there are no rules, no data, several admissions, or the outcome depends on
+        measurements that are not recorded or on criteria met in different time windows
+    """
+    if rule_set is None or measurements.index.get_level_values("hadm_id").nunique() != 1:
+        # No measurements, or a subject with several admissions: leave it to the model
+        return None
+    scores = rule_set.score_admissions(measurements)
+    row = scores.iloc[0]
+    if row["decision"] == "indeterminate":
+        return None
+    return {
+        "decision": row["decision"],
+        "met": int(row["met"]),
+        "unknown": int(row["unknown"]),
+        "hadm_id": int(scores.index[0]),
+        "explanation": rule_set.describe(row)
+    }
@@ -0,0 +1,62 @@
+import logging
+from typing import Any, Dict, List, Optional
+
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+
+from app.config import MIMIC_DB_PATH
+from app.rescoring import rescoring_pipeline
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+
+class IngestRequest(BaseModel):
+    # New chartevents/labevents rows, e.g.
+    # [{"hadm_id": 20001, "itemid": 220210, "valuenum": 26, "charttime": "2150-01-01 08:00:00"}]
+    rows: List[Dict[str, Any]]
+
+
+@router.post("/scores/ingest")
+def ingest_measurements(request: IngestRequest):
+    """Fold new measurement rows in and re-score only the admissions they touch"""
+    try:
+        return rescoring_pipeline.ingest(request.rows)
+    except Exception as e:
+        logger.error(f"Error ingesting measurements: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/scores/sync")
+def sync_measurements():
+    """Pick up rows added to the MIMIC database since the last sync and re-score the admissions they touch"""
+    if not MIMIC_DB_PATH:
+        raise HTTPException(status_code=400, detail="MIMIC_DB_PATH is not set")
+    try:
+        return rescoring_pipeline.sync(MIMIC_DB_PATH)
+    except Exception as e:
+        logger.error(f"Error syncing measurements: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/scores/changes")
+def score_changes(since: int = 0, criteria: Optional[str] = None, limit: int = 100):
+    """Admissions whose decision flipped; pass the returned 'next' as 'since' to continue"""
+    return rescoring_pipeline.changes(since, criteria, min(max(limit, 1), 1000))
+
+
+@router.get("/scores")
+def get_scores_state():
+    """Get the watermarks, dirty admissions and last re-scoring run"""
+    return rescoring_pipeline.get_state()
+
+
+@router.get("/scores/{hadm_id}")
+def get_admission_scores(hadm_id: int):
+    """Get the current rule-based scores and measurement ranges of one admission"""
+    scores = rescoring_pipeline.get_scores(hadm_id)
+    if not scores["scores"] and not scores["measurements"]:
+        raise HTTPException(status_code=404, detail=f"Admission {hadm_id} has no scores")
+    return scores
@@ -0,0 +1,151 @@
+import logging
+from typing import Dict, List, NamedTuple, Optional
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Tag name -> key used in extracted section dictionaries
+SECTION_KEYS = {
+    "think": "thinking",
+    "search": "search_query",
+    "answer": "answer",
+}
+
+OPEN_TAGS = {f"<{name}>": name for name in SECTION_KEYS}
+CLOSE_TAGS = {f"</{name}>": name for name in SECTION_KEYS}
+ALL_TAGS = {**OPEN_TAGS, **CLOSE_TAGS}
+
+
+class SectionEvent(NamedTuple):
+    """A parser event: 'open', 'delta' or 'close' for one of the sections"""
+    type: str
+    section: str
+    text: str = ""
+
+
+class SectionParser:
+    """
+    Incremental parser for <think>, <search> and <answer> sections.
+
+    Feed it chunks of generated text as they arrive; each call returns the open,
+    delta and close events produced by that chunk. Every character is examined a
+    bounded number of times, so parsing a whole output is O(n) no matter how it is
+    split into chunks.
+
+    Malformed output is handled leniently:
+    - an opening tag while another section is open closes the open section first
+    - a closing tag that does not match the open section is kept as section text
+    - closing tags outside any section are ignored
+    - a section still open when the stream ends is closed by finish()
+    """
+
+    def __init__(self):
+        self.current = None
+        self.pending = ""
+        self.buffers: Dict[str, List[str]] = {}
+        self.sections: Dict[str, str] = {}
+        self.unclosed: List[str] = []
+        self.finished = False
+
+    def feed(self, chunk: str) -> List[SectionEvent]:
+        """Parse the next chunk of text and return the events it produced"""
+        events: List[SectionEvent] = []
+        text = self.pending + chunk
+        self.pending = ""
+        position = 0
+        length = len(text)
+
+        while position < length:
+            tag_start = text.find("<", position)
+            if tag_start == -1:
+                self._emit_text(text[position:], events)
+                break
+
+            self._emit_text(text[position:tag_start], events)
+            tag_end = text.find(">", tag_start, tag_start + self._max_tag_length)
+            if tag_end == -1:
+                remainder = text[tag_start:]
+                if len(remainder) < self._max_tag_length and self._is_tag_prefix(remainder):
+                    # Possibly a tag split across chunks - wait for more text
+                    self.pending = remainder
+                    break
+                self._emit_text("<", events)
+                position = tag_start + 1
+                continue
+
+            tag = text[tag_start:tag_end + 1]
+            if self._handle_tag(tag, events):
+                position = tag_end + 1
+            else:
+                self._emit_text("<", events)
+                position = tag_start + 1
+
+        return events
+
+    def finish(self) -> List[SectionEvent]:
+        """Flush buffered text and close any section left open"""
+        events: List[SectionEvent] = []
+        if self.finished:
+            return events
+        if self.pending:
+            self._emit_text(self.pending, events)
+            self.pending = ""
+        if self.current is not None:
+            self.unclosed.append(self.current)
+            self._close(events)
+        self.finished = True
+        if self.unclosed:
+            logger.warning(f"Closed unterminated sections: {self.unclosed}")
+        return events
+
+    def result(self) -> Dict[str, Optional[str]]:
+        """Extracted sections keyed like extract_sections() results (first occurrence of each)"""
+        return {key: self.sections.get(name) for name, key in SECTION_KEYS.items()}
+
+    _max_tag_length = max(len(tag) for tag in ALL_TAGS)
+
+    @staticmethod
+    def _is_tag_prefix(text: str) -> bool:
+        return any(tag.startswith(text) for tag in ALL_TAGS)
+
+    def _handle_tag(self, tag: str, events: List[SectionEvent]) -> bool:
+        """Apply a complete tag; returns False if it should be treated as plain text"""
+        if tag in OPEN_TAGS:
+            if self.current is not None:
+                # Missing closing tag - close the open section before starting the next
+                self.unclosed.append(self.current)
+                self._close(events)
+            self.current = OPEN_TAGS[tag]
+            self.buffers[self.current] = []
+            events.append(SectionEvent("open", self.current))
+            return True
+
+        if tag in CLOSE_TAGS:
+            if self.current == CLOSE_TAGS[tag]:
+                self._close(events)
+                return True
+            if self.current is None:
+                # Stray closing tag outside any section
+                return True
+        return False
+
+    def _emit_text(self, text: str, events: List[SectionEvent]):
+        if not text or self.current is None:
+            return
+        self.buffers[self.current].append(text)
+        events.append(SectionEvent("delta", self.current, text))
+
+    def _close(self, events: List[SectionEvent]):
+        name = self.current
+        content = "".join(self.buffers.pop(name, [])).strip()
+        self.sections.setdefault(name, content)
+        events.append(SectionEvent("close", name, content))
+        self.current = None
+
+
+def parse_sections(text: str) -> Dict[str, Optional[str]]:
+    """Extract the <think>, <search> and <answer> sections from a complete output"""
+    parser = SectionParser()
+    parser.feed(text)
+    parser.finish()
+    return parser.result()
@@ -0,0 +1,235 @@
+import os
+import time
+import uuid
+import tempfile
+import threading
+import logging
+from typing import Any, Dict, List, Optional
+
+from app.config import (
+    SESSION_TTL_SECONDS,
+    SESSION_OFFLOAD_SECONDS,
+    SESSION_CACHE_BUDGET_GB,
+    SESSION_CACHE_DIR
+)
+from app.memory_governor import memory_governor
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class ConversationSession:
+    """Server-side state for one diagnosis conversation"""
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.history: List[Dict[str, str]] = []
+        self.created = time.time()
+        self.last_used = self.created
+        self.turns = 0
+        # Criteria set the conversation assesses against (fixed by its first turn)
+        self.criteria_key: Optional[str] = None
+        # Key/value cache of the last generation, either in memory or offloaded to disk
+        self.kv_cache = None
+        self.cache_path: Optional[str] = None
+        self.cache_bytes = 0
+        # Serializes turns of the same conversation
+        self.lock = threading.Lock()
+
+
+class SessionStore:
+    """
+    Singleton store of conversation sessions.
+    Each session keeps its message history and the model's key/value cache so a
+    follow-up turn only has to process the new input. Caches of idle sessions are
+    offloaded to disk, least-recently-used caches are offloaded when the memory
+    budget is exceeded, and sessions expire after the TTL.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = super(SessionStore, cls).__new__(cls)
+                cls._instance._initialize()
+            return cls._instance
+
+    def _initialize(self):
+        """Initialize the store state."""
+        self.sessions: Dict[str, ConversationSession] = {}
+        self.state_lock = threading.RLock()
+        self.budget_bytes = int(SESSION_CACHE_BUDGET_GB * 1024 ** 3)
+        self.cache_dir = SESSION_CACHE_DIR or os.path.join(tempfile.gettempdir(), "medinsight_kv_cache")
+        self.offloads = 0
+        self.restores = 0
+        self._reaper = None
+
+    def create(self) -> ConversationSession:
+        """Create a new empty session"""
+        session = ConversationSession(uuid.uuid4().hex)
+        with self.state_lock:
+            self.sessions[session.session_id] = session
+        self._ensure_reaper()
+        logger.info(f"Created session {session.session_id}")
+        return session
+
+    def get(self, session_id: str) -> Optional[ConversationSession]:
+        """Look up a session, returning None if it does not exist or has expired"""
+        with self.state_lock:
+            session = self.sessions.get(session_id)
+            if session is not None:
+                session.last_used = time.time()
+            return session
+
+    def delete(self, session_id: str) -> bool:
+        """Remove a session and its cache"""
+        with self.state_lock:
+            session = self.sessions.pop(session_id, None)
+        if session is None:
+            return False
+        self._drop_cache(session)
+        logger.info(f"Deleted session {session_id}")
+        return True
+
+    def load_cache(self, session: ConversationSession, handler: Any) -> Any:
+        """
+        Get the session's key/value cache, restoring it from disk if it was offloaded.
+        Returns None if there is no cache or it cannot be restored with this handler.
+        """
+        if session.kv_cache is not None:
+            return session.kv_cache
+        if session.cache_path is None:
+            return None
+        try:
+            session.kv_cache = handler.load_kv_cache(session.cache_path)
+            self.restores += 1
+            logger.info(f"Restored KV cache for session {session.session_id} from disk")
+        except Exception as e:
+            logger.warning(f"Could not restore KV cache for session {session.session_id}: {e}")
+        finally:
+            self._remove_file(session.cache_path)
+            session.cache_path = None
+        return session.kv_cache
+
+    def update(self, session: ConversationSession, new_messages: List[Dict[str, str]], kv_cache: Any = None):
+        """Append a finished turn to the session and keep its new cache"""
+        with self.state_lock:
+            session.history.extend(new_messages)
+            session.turns += 1
+            session.last_used = time.time()
+            if kv_cache is not None:
+                session.kv_cache = kv_cache
+                session.cache_bytes = kv_cache.nbytes
+        self._enforce_budget(exclude=session.session_id)
+
+    def cache_bytes_in_memory(self) -> int:
+        with self.state_lock:
+            return sum(s.cache_bytes for s in self.sessions.values() if s.kv_cache is not None)
+
+    def _enforce_budget(self, exclude: Optional[str] = None):
+        """Offload least-recently-used caches to disk until the in-memory budget is respected"""
+        if self.budget_bytes <= 0:
+            return
+        with self.state_lock:
+            candidates = sorted(
+                (s for s in self.sessions.values() if s.kv_cache is not None and s.session_id != exclude),
+                key=lambda s: s.last_used
+            )
+            for session in candidates:
+                if self.cache_bytes_in_memory() <= self.budget_bytes:
+                    break
+                self._offload(session, reason="cache memory budget exceeded")
+
+    def _offload(self, session: ConversationSession, reason: str):
+        """Move a session's cache to disk, or drop it if it cannot be written"""
+        if not session.lock.acquire(blocking=False):
+            # A turn is running for this session; leave its cache alone
+            return
+        try:
+            if session.kv_cache is None:
+                return
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = os.path.join(self.cache_dir, f"{session.session_id}.pt")
+            try:
+                session.kv_cache.save(path)
+                session.cache_path = path
+                self.offloads += 1
+                logger.info(f"Offloaded KV cache for session {session.session_id} to disk: {reason}")
+            except Exception as e:
+                logger.warning(f"Could not offload KV cache for session {session.session_id}, dropping it: {e}")
+            session.kv_cache = None
+        finally:
+            session.lock.release()
+
+    def release_memory(self) -> int:
+        """Offload every cache that is not in use to disk; returns the bytes moved out of memory"""
+        with self.state_lock:
+            sessions = [s for s in self.sessions.values() if s.kv_cache is not None]
+        released = 0
+        for session in sessions:
+            size = session.cache_bytes
+            self._offload(session, reason="memory pressure")
+            if session.kv_cache is None:
+                released += size
+        return released
+
+    def _drop_cache(self, session: ConversationSession):
+        session.kv_cache = None
+        if session.cache_path:
+            self._remove_file(session.cache_path)
+            session.cache_path = None
+
+    @staticmethod
+    def _remove_file(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def sweep(self):
+        """Offload caches of idle sessions and remove expired sessions"""
+        now = time.time()
+        with self.state_lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            idle = now - session.last_used
+            if SESSION_TTL_SECONDS > 0 and idle > SESSION_TTL_SECONDS:
+                self.delete(session.session_id)
+            elif SESSION_OFFLOAD_SECONDS > 0 and idle > SESSION_OFFLOAD_SECONDS and session.kv_cache is not None:
+                self._offload(session, reason=f"idle for {idle:.0f}s")
+
+    def _ensure_reaper(self):
+        """Start the background thread that offloads and expires sessions"""
+        if self._reaper is not None and self._reaper.is_alive():
+            return
+
+        def reap():
+            while True:
+                time.sleep(30)
+                try:
+                    self.sweep()
+                except Exception as e:
+                    logger.error(f"Error sweeping sessions: {e}")
+
+        self._reaper = threading.Thread(target=reap, name="session-reaper", daemon=True)
+        self._reaper.start()
+
+    def get_state(self) -> Dict[str, Any]:
+        """Get a summary of the store for monitoring"""
+        with self.state_lock:
+            return {
+                "sessions": len(self.sessions),
+                "caches_in_memory": sum(1 for s in self.sessions.values() if s.kv_cache is not None),
+                "caches_on_disk": sum(1 for s in self.sessions.values() if s.cache_path is not None),
+                "cache_memory_gb": round(self.cache_bytes_in_memory() / 1024 ** 3, 3),
+                "budget_gb": round(self.budget_bytes / 1024 ** 3, 3) if self.budget_bytes else None,
+                "offloads": self.offloads,
+                "restores": self.restores
+            }
+
+
+# Create singleton instance
+session_store = SessionStore()
+# KV caches can be restored from disk, so they are released first under memory pressure
+memory_governor.register_evictor("session_kv_caches", session_store.release_memory, priority=0)
@@ -0,0 +1,225 @@
+import json
+import time
+import sqlite3
+import threading
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from app.config import MIMIC_DB_PATH, TIMELINE_PARQUET_PATH, TIMELINE_CACHE_SIZE
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Format of the timestamps used as timeline keys
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Event rows per kind of timeline from the MIMIC-IV tables, labelled with the item dictionaries
+EVENT_QUERIES = {
+    "lab": "SELECT e.hadm_id, e.charttime, d.label, e.value, e.valueuom AS unit, e.flag "
+           "FROM labevents e JOIN d_labitems d ON d.itemid = e.itemid "
+           "WHERE e.hadm_id IN (SELECT value FROM json_each(?))",
+    "chart": "SELECT e.hadm_id, e.charttime, d.label, e.value, e.valueuom AS unit, NULL AS flag "
+             "FROM chartevents e JOIN d_items d ON d.itemid = e.itemid "
+             "WHERE e.hadm_id IN (SELECT value FROM json_each(?))",
+}
+
+# Value of the 'type' column for each kind in a Parquet event table (the notebook's sample format)
+PARQUET_TYPES = {"lab": "lab", "chart": "icu_chart"}
+
+Timeline = Dict[str, Dict[str, Any]]
+
+
+def build_timelines(events: pd.DataFrame) -> Dict[int, Timeline]:
+    """
+    Build {charttime: {label: value}} timelines for many admissions at once.
+
+    Produces the same result as the notebook's group_hadm_item_js: timestamps in
+    chronological order, a value with a flag becomes "<value> - <flag>", and a later row
+    for the same admission, time and label replaces an earlier one. If a unit is given
+    it is appended to the value ("<value> <unit>"). Sorting, timestamp formatting and
+    value formatting are vectorized; the dictionaries are then filled one timestamp at a
+    time from column slices instead of row by row. Rows without a charttime are dropped.
+
+    Args:
+        events: Rows with hadm_id, charttime, label, value and optionally unit and flag
+
+    Returns:
+        Timeline per hadm_id
+    """
+    # pd.factorize gives a missing charttime the code -1, which would index the last timestamp
+    events = events[events["charttime"].notna()]
+    if events.empty:
+        return {}
+    # Only values with a unit or a flag are turned into strings
+    values = events["value"].astype(object)
+    for column, separator in (("unit", " "), ("flag", " - ")):
+        if column in events:
+            mask = (events[column].notna() & (events[column] != "")).to_numpy()
+            if mask.any():
+                values = values.copy()
+                values[mask] = values[mask].astype(str) + separator + events[column][mask].astype(str)
+
+    # Each distinct charttime is parsed once
+    raw_codes, raw_times = pd.factorize(events["charttime"])
+    frame = pd.DataFrame({
+        "hadm_id": events["hadm_id"].to_numpy(),
+        "time": pd.DatetimeIndex(pd.to_datetime(raw_times)).to_numpy()[raw_codes],
+        "label": events["label"].to_numpy(),
+        "value": values.to_numpy(),
+    }).sort_values(["hadm_id", "time"], kind="stable")
+
+    # Each distinct timestamp is formatted once
+    time_codes, unique_times = pd.factorize(frame["time"])
+    time_strings = pd.DatetimeIndex(unique_times).strftime(TIME_FORMAT).to_numpy()
+
+    # Row ranges of each (admission, timestamp) group in the sorted frame
+    hadm_ids = frame["hadm_id"].to_numpy()
+    boundaries = np.flatnonzero((hadm_ids[1:] != hadm_ids[:-1]) | (time_codes[1:] != time_codes[:-1])) + 1
+    starts = np.concatenate(([0], boundaries)).tolist()
+    ends = np.concatenate((boundaries, [len(frame)])).tolist()
+
+    hadm_list = hadm_ids.tolist()
+    time_list = time_strings[time_codes].tolist()
+    labels = frame["label"].tolist()
+    values = frame["value"].tolist()
+    timelines: Dict[int, Timeline] = {}
+    for start, end in zip(starts, ends):
+        timeline = timelines.get(hadm_list[start])
+        if timeline is None:
+            timeline = timelines[hadm_list[start]] = {}
+        timeline[time_list[start]] = dict(zip(labels[start:end], values[start:end]))
+    return timelines
+
+
+def load_events(kind: str, hadm_ids: Sequence[int], db_path: Optional[str] = None,
+                parquet_path: Optional[str] = None) -> pd.DataFrame:
+    """
+    Load the lab or chart event rows of some admissions.
+
+    Args:
+        kind: 'lab' or 'chart'
+        hadm_ids: Admissions to load
+        db_path: MIMIC SQLite database (labevents/chartevents with d_labitems/d_items)
+        parquet_path: Event table with hadm_id, charttime, label, value, flag, type and
+            optionally valueuom columns, used instead of the database
+
+    Returns:
+        Event rows in the format build_timelines expects
+    """
+    ids = [int(h) for h in hadm_ids]
+    if parquet_path:
+        events = pd.read_parquet(parquet_path, filters=[("hadm_id", "in", ids), ("type", "==", PARQUET_TYPES[kind])])
+        return events.rename(columns={"valueuom": "unit"})
+    if not db_path:
+        raise ValueError("No timeline source: set MIMIC_DB_PATH or TIMELINE_PARQUET_PATH")
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        return pd.read_sql_query(EVENT_QUERIES[kind], conn, params=(json.dumps(ids),))
+    finally:
+        conn.close()
+
+
+class TimelineCache:
+    """
+    Singleton LRU cache of per-admission timelines.
+
+    Admissions that are not cached are loaded together in one query and built in one
+    pass; an admission without events is cached as an empty timeline. At most
+    TIMELINE_CACHE_SIZE timelines are kept per kind.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = super(TimelineCache, cls).__new__(cls)
+                cls._instance._initialize()
+            return cls._instance
+
+    def _initialize(self):
+        """Initialize the cache state."""
+        self.max_entries = TIMELINE_CACHE_SIZE
+        self.state_lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, int], Timeline]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.load_seconds = 0.0
+
+    def get(self, hadm_ids: Sequence[int], kind: str = "lab") -> Dict[int, Timeline]:
+        """
+        Timelines of several admissions, loading the ones that are not cached.
+
+        Args:
+            hadm_ids: Admissions to get
+            kind: 'lab' or 'chart'
+
+        Returns:
+            Timeline per hadm_id, in the order requested
+        """
+        if kind not in EVENT_QUERIES:
+            raise ValueError(f"Unknown timeline kind '{kind}' (expected one of {', '.join(EVENT_QUERIES)})")
+        ids = list(dict.fromkeys(int(h) for h in hadm_ids))
+        found: Dict[int, Timeline] = {}
+        with self.state_lock:
+            for hadm_id in ids:
+                timeline = self._entries.get((kind, hadm_id))
+                if timeline is not None:
+                    self._entries.move_to_end((kind, hadm_id))
+                    found[hadm_id] = timeline
+            self.hits += len(found)
+            missing = [h for h in ids if h not in found]
+            self.misses += len(missing)
+
+        if missing:
+            start = time.perf_counter()
+            built = build_timelines(load_events(kind, missing, MIMIC_DB_PATH, TIMELINE_PARQUET_PATH))
+            seconds = time.perf_counter() - start
+            with self.state_lock:
+                self.loads += 1
+                self.load_seconds += seconds
+                for hadm_id in missing:
+                    found[hadm_id] = built.get(hadm_id, {})
+                    self._entries[(kind, hadm_id)] = found[hadm_id]
+                    self._entries.move_to_end((kind, hadm_id))
+                while len(self._entries) > self.max_entries * len(EVENT_QUERIES):
+                    self._entries.popitem(last=False)
+            logger.info(f"Built {kind} timelines for {len(missing)} admissions in {seconds:.3f}s")
+        return {h: found[h] for h in ids}
+
+    def invalidate(self, hadm_ids: Optional[Sequence[int]] = None) -> int:
+        """Drop cached timelines of some admissions (all if None), e.g. after new events were loaded"""
+        with self.state_lock:
+            if hadm_ids is None:
+                removed = len(self._entries)
+                self._entries.clear()
+                return removed
+            targets = {int(h) for h in hadm_ids}
+            keys = [k for k in self._entries if k[1] in targets]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def get_state(self) -> Dict[str, Any]:
+        """Get cache statistics for monitoring"""
+        with self.state_lock:
+            lookups = self.hits + self.misses
+            return {
+                "source": TIMELINE_PARQUET_PATH or MIMIC_DB_PATH,
+                "entries": len(self._entries),
+                "max_entries_per_kind": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "loads": self.loads,
+                "load_seconds": round(self.load_seconds, 3)
+            }
+
+
+# Create singleton instance
+timeline_cache = TimelineCache()
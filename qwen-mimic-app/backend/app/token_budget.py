@@ -0,0 +1,79 @@
+import math
+import threading
+import logging
+from collections import deque
+from typing import Dict, Any
+
+from app.config import (
+    ADAPTIVE_TOKEN_BUDGET,
+    TOKEN_BUDGET_PERCENTILE,
+    TOKEN_BUDGET_HEADROOM,
+    TOKEN_BUDGET_MIN_SAMPLES
+)
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Lower bound so a run of short outputs can never starve a task
+MIN_TOKEN_BUDGET = 32
+
+
+def percentile(values, pct: float) -> float:
+    """Nearest-rank percentile of a sequence of numbers"""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return float(ordered[rank - 1])
+
+
+class AdaptiveTokenBudget:
+    """
+    Sets max_tokens per task from the observed output lengths instead of a fixed limit.
+    Once enough outputs have been recorded, the budget is the configured percentile of
+    recent lengths plus headroom, capped at the task's default. Outputs that hit the
+    budget push the percentile up, so the budget grows back if it was set too low.
+    """
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self.lock = threading.Lock()
+        self.lengths: Dict[str, deque] = {}
+        self.tokens_saved: Dict[str, int] = {}
+
+    def get_max_tokens(self, task: str, default: int) -> int:
+        """Get the token budget for a task, falling back to the default until enough data is seen"""
+        if not ADAPTIVE_TOKEN_BUDGET:
+            return default
+        with self.lock:
+            lengths = self.lengths.get(task)
+            if not lengths or len(lengths) < TOKEN_BUDGET_MIN_SAMPLES:
+                return default
+            budget = int(percentile(lengths, TOKEN_BUDGET_PERCENTILE) * TOKEN_BUDGET_HEADROOM)
+        return max(MIN_TOKEN_BUDGET, min(default, budget))
+
+    def record(self, task: str, num_tokens: int, tokens_saved: int = 0):
+        """Record the length of a finished output and the tokens saved by stopping early"""
+        with self.lock:
+            if task not in self.lengths:
+                self.lengths[task] = deque(maxlen=self.window)
+                self.tokens_saved[task] = 0
+            self.lengths[task].append(num_tokens)
+            self.tokens_saved[task] += tokens_saved
+
+    def get_state(self) -> Dict[str, Any]:
+        """Get a summary of the observed lengths and current budget per task"""
+        with self.lock:
+            return {
+                task: {
+                    "samples": len(lengths),
+                    "p50": percentile(lengths, 50),
+                    "p95": percentile(lengths, 95),
+                    "tokens_saved_total": self.tokens_saved[task]
+                }
+                for task, lengths in self.lengths.items()
+            }
+
+
+# Create singleton instance
+token_budget = AdaptiveTokenBudget()
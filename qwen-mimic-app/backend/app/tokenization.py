@@ -0,0 +1,98 @@
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Prefix that primes the model to answer as the assistant
+GENERATION_PREFIX = "<|im_start|>assistant\n"
+
+
+def format_message(role: str, content: str) -> str:
+    """ChatML text of a single message"""
+    return f"<|im_start|>{role}\n{content}<|im_end|>\n"
+
+
+def format_messages(messages: List[Dict[str, str]]) -> str:
+    """Format messages into a ChatML prompt ending with the assistant prefix"""
+    return "".join(format_message(m["role"], m["content"]) for m in messages) + GENERATION_PREFIX
+
+
+class MessageTokenCache:
+    """
+    Caches the token ids of individual chat messages.
+
+    Every ChatML message starts with <|im_start|> and ends with <|im_end|>, which the
+    tokenizer treats as special tokens, so no BPE merge crosses a message boundary and
+    the ids of a prompt are the concatenation of the ids of its messages. Only messages
+    that have not been seen before are tokenized, which makes building the prompt for a
+    new turn proportional to the new input rather than to the whole conversation.
+    """
+
+    def __init__(self, tokenizer: Any, cache_size: int = 4096):
+        self.tokenizer = tokenizer
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self._ids: "OrderedDict[Tuple[str, str], List[int]]" = OrderedDict()
+        self._prefix_ids = self._encode(GENERATION_PREFIX)
+        self.hits = 0
+        self.misses = 0
+
+    def _encode(self, text: str) -> List[int]:
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+    def message_ids(self, role: str, content: str) -> List[int]:
+        """Token ids of one formatted message, tokenizing it only on first use"""
+        key = (role, hashlib.sha1(content.encode("utf-8")).hexdigest())
+        with self.lock:
+            ids = self._ids.get(key)
+            if ids is not None:
+                self._ids.move_to_end(key)
+                self.hits += 1
+                return ids
+
+        ids = self._encode(format_message(role, content))
+        with self.lock:
+            self.misses += 1
+            self._ids[key] = ids
+            if len(self._ids) > self.cache_size:
+                self._ids.popitem(last=False)
+        return ids
+
+    def encode_message(self, role: str, content: str) -> List[int]:
+        """Token ids of one formatted message, as model handlers name it"""
+        return self.message_ids(role, content)
+
+    def encode_messages(self, messages: List[Dict[str, str]]) -> List[int]:
+        """
+        Token ids of a full prompt, identical to tokenizing format_messages(messages)
+
+        Args:
+            messages: List of message dictionaries with 'role' and 'content'
+
+        Returns:
+            Prompt token ids ending with the assistant generation prefix
+        """
+        ids: List[int] = []
+        if getattr(self.tokenizer, "add_bos_token", False) and self.tokenizer.bos_token_id is not None:
+            ids.append(self.tokenizer.bos_token_id)
+        for message in messages:
+            ids.extend(self.message_ids(message["role"], message["content"]))
+        ids.extend(self._prefix_ids)
+        return ids
+
+    def count_tokens(self, text: str) -> int:
+        """Number of tokens in a piece of plain text (not cached)"""
+        return len(self._encode(text))
+
+    def get_state(self) -> Dict[str, Any]:
+        """Get cache statistics for monitoring"""
+        with self.lock:
+            return {
+                "messages_cached": len(self._ids),
+                "hits": self.hits,
+                "misses": self.misses
+            }
@@ -0,0 +1,160 @@
+import time
+import threading
+import logging
+from typing import Any, Dict, List, Optional
+
+from app.config import WARMUP_MODELS
+from app.model_detector import HardwareDetector
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class StartupMonitor:
+    """
+    Tracks the background warm-up that runs after the API starts serving.
+    The server is 'ready' once hardware has been probed and the configured
+    models have loaded and produced a short dummy generation.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = None
+        self.finished_at = None
+        self.is_ready = False
+        self.error = None
+        self.current_phase = None
+        self.timings: Dict[str, float] = {}
+
+    def start_phase(self, name: str):
+        with self.lock:
+            self.current_phase = name
+        logger.info(f"Warm-up: {name}...")
+        return time.perf_counter()
+
+    def end_phase(self, name: str, start: float):
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.timings[name] = round(elapsed, 3)
+            self.current_phase = None
+        logger.info(f"Warm-up: {name} took {elapsed:.2f}s")
+
+    def get_state(self) -> str:
+        """'warming_up', 'ready' or 'failed'"""
+        if self.is_ready:
+            return "ready"
+        if self.error is not None:
+            return "failed"
+        return "warming_up"
+
+    def get_status(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "ready": self.is_ready,
+                "state": self.get_state(),
+                "phase": self.current_phase,
+                "error": self.error,
+                "timings": dict(self.timings),
+                "warmup_seconds": round(self.finished_at - self.started_at, 3)
+                if self.started_at and self.finished_at else None
+            }
+
+
+# Create singleton instance
+startup_monitor = StartupMonitor()
+
+
+def log_system_info(system_info: Dict[str, Any]):
+    """Log detailed system information"""
+    logger.info("=" * 50)
+    logger.info("SYSTEM INFORMATION")
+    logger.info("=" * 50)
+    logger.info(f"OS: {system_info['os']}")
+    logger.info(f"Architecture: {system_info['architecture']}")
+    logger.info(f"Python version: {system_info['python_version']}")
+
+    if system_info.get('torch_available', False):
+        logger.info(f"PyTorch version: {system_info.get('torch_version', 'Unknown')}")
+        if system_info.get('cuda_available', False):
+            logger.info(f"CUDA available: Yes (version {system_info.get('cuda_version', 'Unknown')})")
+            logger.info(f"GPU: {system_info.get('gpu_name', 'Unknown')}")
+        elif system_info.get('mps_available', False):
+            logger.info("Apple MPS available: Yes (M1/M2 Mac acceleration)")
+        else:
+            logger.info("GPU acceleration: Not available, using CPU")
+    else:
+        logger.info("PyTorch: Not available")
+
+    logger.info(f"Recommended backend: {system_info.get('recommended_backend', 'unknown')}")
+    logger.info("=" * 50)
+
+    # Test if VLLM is available
+    can_use_vllm, vllm_reason = HardwareDetector.can_use_vllm()
+    logger.info(f"VLLM available: {'Yes' if can_use_vllm else 'No'}")
+    if not can_use_vllm:
+        logger.info(f"VLLM status: {vllm_reason}")
+
+    # Test if transformers is available
+    can_use_transformers, transformers_reason = HardwareDetector.can_use_transformers()
+    logger.info(f"Transformers available: {'Yes' if can_use_transformers else 'No'}")
+    if not can_use_transformers:
+        logger.info(f"Transformers status: {transformers_reason}")
+
+    # Test if llama.cpp is available
+    can_use_llama_cpp, llama_cpp_reason = HardwareDetector.can_use_llama_cpp()
+    logger.info(f"llama.cpp available: {'Yes' if can_use_llama_cpp else 'No'}")
+    if not can_use_llama_cpp:
+        logger.info(f"llama.cpp status: {llama_cpp_reason}")
+
+    logger.info("=" * 50)
+
+
+def _get_model_handle(model_type: str):
+    """Get the shared model handle for a model type without loading it"""
+    if model_type == "reasoning":
+        from app.diagnose import get_local_reasoner
+        return get_local_reasoner().model_handler
+    if model_type == "sql":
+        from app.query import get_sql_generator
+        return get_sql_generator().model_handler
+    raise ValueError(f"Unknown model type for warm-up: {model_type}")
+
+
+def run_warmup(model_types: Optional[List[str]] = None):
+    """
+    Probe hardware, import the ML stack, then load each model and run a
+    one-token dummy generation so the first real request does not pay for it.
+    Blocking - meant to run in a background thread.
+    """
+    if model_types is None:
+        model_types = WARMUP_MODELS
+
+    with startup_monitor.lock:
+        startup_monitor.started_at = time.time()
+        startup_monitor.finished_at = None
+        startup_monitor.is_ready = False
+        startup_monitor.error = None
+    try:
+        start = startup_monitor.start_phase("hardware_probe")
+        system_info = HardwareDetector.detect_system()
+        log_system_info(system_info)
+        startup_monitor.end_phase("hardware_probe", start)
+
+        for model_type in model_types:
+            phase = f"{model_type}_model"
+            start = startup_monitor.start_phase(phase)
+            handle = _get_model_handle(model_type)
+            handle.generate([{"role": "user", "content": "Hello"}], max_tokens=1, temperature=0)
+            startup_monitor.end_phase(phase, start)
+
+        with startup_monitor.lock:
+            startup_monitor.is_ready = True
+        logger.info("Server is ready")
+    except Exception as e:
+        logger.error(f"Warm-up failed: {str(e)}")
+        with startup_monitor.lock:
+            startup_monitor.error = str(e)
+            startup_monitor.current_phase = None
+    finally:
+        startup_monitor.finished_at = time.time()
+        logger.info(f"Warm-up timings: {startup_monitor.get_status()['timings']}")
@@ -0,0 +1,191 @@
+"""
+Assess a cohort of MIMIC admissions offline with the local reasoning model.
+
+Selects admissions from the MIMIC SQLite database with a cohort filter and runs the
+criteria assessment for each one in a pool of worker processes. Each worker loads its
+own model and is pinned to its own core slice (see app/cpu_tuning.py). Each prompt
+carries the admission summary and the readings the criteria needs, compactly encoded
+within --context-tokens (see app/patient_context.py). Every result is appended to a
+JSONL checkpoint as soon as it is done. Re-running the same command skips admissions
+that are already in the checkpoint, so a killed run resumes where it stopped. With an output path ending in .parquet, results are checkpointed to a .jsonl
+file next to it and exported to Parquet periodically and at the end.
+
+Each worker holds a full copy of the model, so plan for workers x model size of RAM.
+
+Usage:
+    python assess_cohort.py --where "admission_type LIKE '%EMER%'" --limit 500 \\
+        --criteria qSOFA --workers 2 --output results/qsofa.jsonl
+    python assess_cohort.py --sql "SELECT hadm_id, subject_id FROM diagnoses_icd WHERE icd_code LIKE 'A41%'" \\
+        --output results/sepsis.parquet --deterministic
+"""
+import os
+os.environ["TRANSFORMERS_VERBOSITY"] = "error"
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+if __name__ == "__mp_main__":
+    # A pool worker re-imports this module: claim a free core slice among the pool's workers
+    # (CPU_WORKERS is set by the parent) before pandas and numpy size their thread pools
+    from app.cpu_tuning import apply_cpu_profile
+    apply_cpu_profile()
+
+import sys
+import time
+import sqlite3
+import argparse
+import multiprocessing as mp
+from datetime import datetime, timezone
+
+from app.cohort import select_cohort, build_prompt, CohortCheckpoint
+from app.config import PATIENT_CONTEXT_MAX_TOKENS
+from app.patient_context import encode_patient_context
+
+# Set in each worker process by init_worker
+_worker = {}
+
+
+def init_worker(criteria_key: str, db_path: str, deterministic: bool, context_tokens: int):
+    """Load this worker's own model and database connection"""
+    from app.criteria import get_criteria, get_compiled_criteria
+    from app.reasoner import LocalReasonerModel
+
+    # Assessed per request, so the server's active criteria (shared through the criteria store) is left alone
+    _worker["criteria_key"] = criteria_key
+    _worker["criteria"] = get_criteria(criteria_key)["name"]
+    _worker["rule_set"] = get_compiled_criteria(criteria_key).rule_set
+    _worker["reasoner"] = LocalReasonerModel()
+    _worker["context_tokens"] = context_tokens
+    _worker["conn"] = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    _worker["deterministic"] = deterministic
+
+
+def assess_admission(admission: tuple) -> dict:
+    """Assess one admission; failures are returned as records with an error instead of raised"""
+    hadm_id, subject_id = admission
+    start = time.perf_counter()
+    record = {"hadm_id": hadm_id, "subject_id": subject_id, "criteria": _worker["criteria"], "worker": os.getpid()}
+    try:
+        context = encode_patient_context(_worker["conn"], hadm_id, _worker["rule_set"],
+                                         _worker["reasoner"].model_handler.count_tokens, _worker["context_tokens"])
+        prompt = build_prompt(_worker["criteria"], hadm_id, context["text"])
+        result = _worker["reasoner"].process_reasoning(prompt, deterministic=_worker["deterministic"],
+                                                       criteria_key=_worker["criteria_key"])
+        record.update({
+            "answer": result["answer"],
+            "thinking": result["thinking"],
+            "search_query": result["search_query"],
+            "requires_information": result["requires_information"],
+            "full_response": result["full_response"],
+            "num_tokens": result["num_tokens"],
+            "error": None
+        })
+    except Exception as e:
+        record["error"] = str(e)
+    record["seconds"] = round(time.perf_counter() - start, 3)
+    record["completed_at"] = datetime.now(timezone.utc).isoformat()
+    return record
+
+
+def format_duration(seconds: float) -> str:
+    hours, remainder = divmod(int(seconds), 3600)
+    return f"{hours}h{remainder // 60:02d}m"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    cohort = parser.add_mutually_exclusive_group()
+    cohort.add_argument("--where", help="SQL condition on the admissions table")
+    cohort.add_argument("--sql", help="full cohort query returning hadm_id and subject_id")
+    parser.add_argument("--limit", type=int, help="maximum number of admissions")
+    parser.add_argument("--criteria", default="qSOFA", help="criteria key to assess (default qSOFA)")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes, each with its own model")
+    parser.add_argument("--output", default="cohort_results.jsonl", help=".jsonl or .parquet output")
+    parser.add_argument("--parquet-every", type=int, default=100, help="results between Parquet exports")
+    parser.add_argument("--deterministic", action="store_true", help="greedy decoding and the response cache")
+    parser.add_argument("--retry-errors", action="store_true", help="assess failed admissions again")
+    parser.add_argument("--context-tokens", type=int, default=PATIENT_CONTEXT_MAX_TOKENS,
+                        help="token budget of the patient information in each prompt (0 = no limit)")
+    parser.add_argument("--db", default=os.getenv("MIMIC_DB_PATH"), help="MIMIC SQLite database (default MIMIC_DB_PATH)")
+    parser.add_argument("--dry-run", action="store_true", help="print the first prompts without loading a model")
+    args = parser.parse_args()
+
+    from app.criteria import get_criteria, get_compiled_criteria
+    if not args.db or not os.path.exists(args.db):
+        print(f"❌ MIMIC database not found: {args.db} (set MIMIC_DB_PATH or pass --db)")
+        sys.exit(1)
+    criteria = get_criteria(args.criteria)
+    if criteria is None:
+        print(f"❌ Unknown criteria '{args.criteria}'")
+        sys.exit(1)
+    criteria_name = criteria["name"]
+
+    admissions = select_cohort(args.db, where=args.where, sql=args.sql, limit=args.limit)
+    checkpoint = CohortCheckpoint(args.output)
+    done = checkpoint.completed(criteria_name, retry_errors=args.retry_errors)
+    pending = [a for a in admissions if a[0] not in done]
+
+    print("=" * 80)
+    print("COHORT ASSESSMENT")
+    print("=" * 80)
+    print(f"Cohort: {len(admissions)} admissions, {len(admissions) - len(pending)} already in {checkpoint.path}, "
+          f"{len(pending)} to assess")
+    print(f"Criteria: {criteria_name}, {args.workers} worker(s){', deterministic' if args.deterministic else ''}")
+
+    if args.dry_run:
+        conn = sqlite3.connect(f"file:{args.db}?mode=ro", uri=True)
+        rule_set = get_compiled_criteria(args.criteria).rule_set
+        for hadm_id, _ in pending[:3]:
+            context = encode_patient_context(conn, hadm_id, rule_set, max_tokens=args.context_tokens)
+            print("-" * 80)
+            print(build_prompt(criteria_name, hadm_id, context["text"]))
+            print(f"({context['tokens']} tokens of patient information, estimated)")
+        conn.close()
+        return
+    if not pending:
+        print("Nothing to do")
+        checkpoint.export_parquet()
+        return
+
+    # Workers claim distinct core slices of this many (see app/cpu_tuning.py)
+    os.environ["CPU_WORKERS"] = str(args.workers)
+    ctx = mp.get_context("spawn")
+    pool = ctx.Pool(args.workers, initializer=init_worker, initargs=(args.criteria, args.db, args.deterministic, args.context_tokens))
+
+    start = time.perf_counter()
+    completed = 0
+    failed = 0
+    try:
+        for record in pool.imap_unordered(assess_admission, pending):
+            checkpoint.append(record)
+            completed += 1
+            if record["error"]:
+                failed += 1
+            elapsed = time.perf_counter() - start
+            rate = completed / elapsed * 3600
+            eta = (len(pending) - completed) / rate * 3600 if rate else 0
+            status = f"❌ {record['error']}" if record["error"] else f"{record['num_tokens']} tokens"
+            print(f"[{completed}/{len(pending)}] admission {record['hadm_id']}: {status} ({record['seconds']:.1f}s) | "
+                  f"{rate:.1f} patients/hour | ETA {format_duration(eta)}")
+            if checkpoint.parquet and completed % args.parquet_every == 0:
+                checkpoint.export_parquet()
+        pool.close()
+    except KeyboardInterrupt:
+        print(f"\nInterrupted after {completed} admissions; run the same command again to resume")
+        pool.terminate()
+        sys.exit(130)
+    finally:
+        pool.join()
+        checkpoint.close()
+
+    elapsed = time.perf_counter() - start
+    exported = checkpoint.export_parquet()
+    print("\n" + "=" * 80)
+    print(f"Assessed {completed} admissions in {format_duration(elapsed)} "
+          f"({completed / elapsed * 3600:.1f} patients/hour), {failed} failed")
+    print(f"Results: {exported or checkpoint.path}")
+    if failed:
+        print("Re-run with --retry-errors to assess the failed admissions again")
+    print("=" * 80)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Autotune CPU threads and worker layout for TransformersModelHandler on this host.
+
+For every worker count, starts that many worker processes, each pinned to its own
+slice of cores, and measures TransformersModelHandler.generate throughput at several
+thread counts with all workers generating at the same time. The best thread count for
+each worker count is written to a tuning profile, which the backend applies at startup
+(see app/cpu_tuning.py): set CPU_WORKERS (or uvicorn's WEB_CONCURRENCY) to the number
+of workers you deploy.
+
+Each worker loads its own copy of the model, so the largest layout needs
+workers x model size of RAM; use --precision bf16/int8 or a smaller --workers list.
+
+Usage:
+    CUDA_VISIBLE_DEVICES= python autotune_cpu.py [--model MODEL] [--workers 1,2,4]
+        [--precision fp32] [--tokens 32] [--output cpu_profile.json]
+"""
+import os
+os.environ["TRANSFORMERS_VERBOSITY"] = "error"
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+import sys
+import json
+import time
+import socket
+import argparse
+import multiprocessing as mp
+from datetime import datetime, timezone
+
+from app.cpu_tuning import available_cores, worker_cores
+
+DEFAULT_MODEL = "tossowski/MedAgentReasoner-3B-Chat"
+PROMPT = "Evaluate qSOFA for patient 12345. Respiratory rate is 24, systolic blood pressure is 95 mmHg."
+
+
+def thread_candidates(cores_per_worker: int) -> list:
+    """Powers of two up to the cores available to one worker, plus that core count"""
+    candidates = {cores_per_worker}
+    threads = 1
+    while threads < cores_per_worker:
+        candidates.add(threads)
+        threads *= 2
+    # Very low thread counts are never competitive on a free slice; keep the top few
+    return sorted(candidates)[-4:]
+
+
+def run_worker(index, cores, thread_counts, args, barrier, results):
+    """One benchmark worker: pin, load the model, then generate once per thread count in lockstep"""
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+    import torch
+    torch.set_interop_threads(1)
+    from app.model_transformers import TransformersModelHandler
+
+    handler = TransformersModelHandler(args.model, precision=args.precision)
+    messages = [{"role": "user", "content": PROMPT}]
+    handler.generate(messages, max_tokens=4, temperature=0, stop=[], use_draft=False)
+
+    for threads in thread_counts:
+        torch.set_num_threads(threads)
+        # All workers generate at the same time, as they would under load
+        barrier.wait(timeout=args.timeout)
+        start = time.perf_counter()
+        result = handler.generate(messages, max_tokens=args.tokens, temperature=0, stop=[], use_draft=False)
+        elapsed = time.perf_counter() - start
+        results.put((index, threads, result["num_tokens"] / elapsed))
+
+
+def benchmark_layout(workers: int, cores: list, args) -> dict:
+    """Aggregate tokens/sec per thread count for one worker count"""
+    cores_per_worker = max(1, len(cores) // workers)
+    thread_counts = thread_candidates(cores_per_worker)
+
+    ctx = mp.get_context("spawn")
+    barrier = ctx.Barrier(workers)
+    results = ctx.Queue()
+    processes = []
+    for index in range(workers):
+        slice_cores = worker_cores(cores, cores_per_worker, index) if workers > 1 else cores
+        process = ctx.Process(target=run_worker, args=(index, slice_cores, thread_counts, args, barrier, results))
+        process.start()
+        processes.append(process)
+
+    throughput = {threads: [] for threads in thread_counts}
+    expected = workers * len(thread_counts)
+    received = 0
+    while received < expected:
+        try:
+            index, threads, tokens_per_second = results.get(timeout=args.timeout)
+        except Exception:
+            print(f"  ❌ Timed out waiting for workers ({received}/{expected} results)")
+            break
+        throughput[threads].append(tokens_per_second)
+        received += 1
+
+    for process in processes:
+        process.join(timeout=30)
+        if process.is_alive():
+            process.terminate()
+
+    return {
+        threads: {
+            "tokens_per_second": sum(values),
+            "per_worker_tokens_per_second": sum(values) / len(values)
+        }
+        for threads, values in throughput.items() if len(values) == workers
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--precision", default="fp32")
+    parser.add_argument("--workers", default="1,2,4", help="worker counts to try")
+    parser.add_argument("--tokens", type=int, default=32)
+    parser.add_argument("--timeout", type=float, default=1800, help="seconds to wait for a worker step")
+    parser.add_argument("--output", default="cpu_profile.json")
+    args = parser.parse_args()
+
+    cores = available_cores()
+    print("=" * 80)
+    print("CPU AUTOTUNING")
+    print("=" * 80)
+    print(f"Host: {socket.gethostname()}, {len(cores)} cores")
+    print(f"Model: {args.model} ({args.precision}), {args.tokens} tokens per run")
+
+    layouts = {}
+    for workers in [int(w) for w in args.workers.split(",")]:
+        if workers > len(cores):
+            print(f"\nSkipping {workers} workers: only {len(cores)} cores")
+            continue
+        print(f"\n{workers} worker(s), {len(cores) // workers} cores each")
+        measurements = benchmark_layout(workers, cores, args)
+        if not measurements:
+            continue
+        for threads, m in measurements.items():
+            print(f"  {threads:>3} threads: {m['tokens_per_second']:>8.2f} tok/s total, "
+                  f"{m['per_worker_tokens_per_second']:>7.2f} per worker")
+        best_threads = max(measurements, key=lambda t: measurements[t]["tokens_per_second"])
+        layouts[str(workers)] = {
+            "workers": workers,
+            "threads_per_worker": best_threads,
+            "interop_threads": 1,
+            "pin": workers > 1,
+            **measurements[best_threads],
+            "measurements": {str(t): m for t, m in measurements.items()}
+        }
+
+    if not layouts:
+        print("❌ No layout could be measured")
+        sys.exit(1)
+
+    recommended = max(layouts.values(), key=lambda l: l["tokens_per_second"])["workers"]
+    profile = {
+        "host": socket.gethostname(),
+        "cpu_count": len(cores),
+        "model": args.model,
+        "precision": args.precision,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "recommended_workers": recommended,
+        "layouts": layouts
+    }
+    with open(args.output, "w") as f:
+        json.dump(profile, f, indent=2)
+
+    print("\n" + "=" * 80)
+    for key, layout in layouts.items():
+        print(f"{key} worker(s): {layout['threads_per_worker']} threads each, {layout['tokens_per_second']:.2f} tok/s total")
+    print(f"Best total throughput with {recommended} worker(s)")
+    print(f"Profile written to {args.output}")
+    print("=" * 80)
+
+
+if __name__ == "__main__":
+    main()
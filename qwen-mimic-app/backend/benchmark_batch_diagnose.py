@@ -0,0 +1,84 @@
+"""
+Benchmark batched diagnosis against one request per patient.
+
+Runs the same set of patient prompts through LocalReasonerModel twice: one
+process_reasoning call per prompt (what N calls to /diagnose cost), then
+process_batch in micro-batches (what one call to /diagnose/batch costs), and
+compares prompts/sec and generated tokens/sec. Both runs decode greedily with
+the response cache disabled so they do the same work.
+
+Usage:
+    RESPONSE_CACHE_PATH= python benchmark_batch_diagnose.py [--patients 16] [--batch-size 8]
+"""
+import os
+os.environ["TRANSFORMERS_VERBOSITY"] = "error"
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+os.environ["RESPONSE_CACHE_PATH"] = ""
+
+import sys
+import time
+import argparse
+
+from app.reasoner import LocalReasonerModel
+
+PROMPT = "Evaluate qSOFA for patient {patient_id}. Respiratory rate is {rr}, systolic blood pressure is {sbp} mmHg."
+
+
+def make_prompts(count: int) -> list:
+    """Distinct prompts of similar length, like a ward's worth of patients"""
+    return [PROMPT.format(patient_id=10000 + i, rr=16 + i % 12, sbp=90 + (7 * i) % 40) for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=8)
+    args = parser.parse_args()
+
+    prompts = make_prompts(args.patients)
+    print("=" * 80)
+    print("BATCHED DIAGNOSIS BENCHMARK")
+    print("=" * 80)
+
+    reasoner = LocalReasonerModel()
+    # Load the model and warm up before timing
+    reasoner.process_reasoning(prompts[0], deterministic=True)
+    print(f"Backend: {reasoner.model_handler.backend}, {len(prompts)} patients, micro-batches of {args.batch_size}")
+
+    start = time.perf_counter()
+    sequential_tokens = 0
+    sequential_errors = 0
+    for prompt in prompts:
+        try:
+            sequential_tokens += reasoner.process_reasoning(prompt, deterministic=True)["num_tokens"]
+        except Exception as e:
+            sequential_errors += 1
+            print(f"  ❌ {e}")
+    sequential_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched_tokens = 0
+    batched_errors = 0
+    for kind, payload in reasoner.process_batch(prompts, args.batch_size, deterministic=True):
+        if kind == "batch":
+            batched_tokens += payload["generated_tokens"]
+            print(f"  batch {payload['batch']}: {payload['size']} prompts in {payload['seconds']:.2f}s, "
+                  f"{payload['tokens_per_second']:.1f} tok/s")
+        elif "error" in payload:
+            batched_errors += 1
+            print(f"  ❌ prompt {payload['index']}: {payload['error']}")
+    batched_seconds = time.perf_counter() - start
+
+    print("\n" + "=" * 80)
+    print(f"One request per patient: {len(prompts) / sequential_seconds:.3f} patients/s, "
+          f"{sequential_tokens / sequential_seconds:.1f} tok/s ({sequential_seconds:.1f}s)")
+    print(f"Batched:                 {len(prompts) / batched_seconds:.3f} patients/s, "
+          f"{batched_tokens / batched_seconds:.1f} tok/s ({batched_seconds:.1f}s)")
+    print(f"Speedup: {sequential_seconds / batched_seconds:.2f}x")
+    print("=" * 80)
+
+    sys.exit(1 if sequential_errors or batched_errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Benchmark: prompt tokens of patient information before and after compact encoding.
+
+For a sample cohort, compares the notebook's patient information (admission summary
+plus the full lab and chart timelines as JSON) with encode_patient_context (admission
+summary plus only the readings the criteria needs, as a compact table within the token
+budget). Without a MIMIC database, a synthetic cohort is generated.
+
+Token counts use the given Hugging Face tokenizer, or estimate_tokens (one token per
+digit, word or punctuation mark) when none is given.
+
+Usage:
+    python benchmark_context_encoding.py [--db mimic.db] [--limit 50] [--criteria qSOFA,SIRS,Sepsis-3]
+        [--tokenizer Qwen/Qwen2.5-3B-Instruct] [--max-tokens 1024]
+"""
+import os
+os.environ.setdefault("CRITERIA_STORE_PATH", "")
+
+import json
+import sqlite3
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from app.cohort import admission_context, select_cohort
+from app.config import PATIENT_CONTEXT_MAX_TOKENS
+from app.criteria import get_compiled_criteria
+from app.patient_context import encode_patient_context, estimate_tokens
+from app.rules import MEASUREMENTS
+from app.timelines import build_timelines, load_events
+
+LAB_ITEMS = {
+    50813: "Lactate", 51301: "White Blood Cells", 51144: "Bands", 50818: "pCO2", 51222: "Hemoglobin",
+    51221: "Hematocrit", 51265: "Platelet Count", 50983: "Sodium", 50971: "Potassium", 50902: "Chloride",
+    50882: "Bicarbonate", 51006: "Urea Nitrogen", 50912: "Creatinine", 50931: "Glucose", 50820: "pH",
+    50821: "pO2", 50885: "Bilirubin, Total", 50862: "Albumin", 51237: "INR(PT)", 51275: "PTT",
+}
+CHART_ITEMS = {
+    220045: ("Heart Rate", "bpm", 85, 15), 220179: ("Non Invasive Blood Pressure systolic", "mmHg", 115, 18),
+    220180: ("Non Invasive Blood Pressure diastolic", "mmHg", 65, 10), 220210: ("Respiratory Rate", "insp/min", 19, 4),
+    220277: ("O2 saturation pulseoxymetry", "%", 96, 2), 223762: ("Temperature Celsius", "°C", 37.2, 0.7),
+    223900: ("GCS - Verbal Response", "", 4.5, 0.7), 223901: ("GCS - Motor Response", "", 5.6, 0.6),
+    220739: ("GCS - Eye Opening", "", 3.6, 0.6), 224690: ("Respiratory Rate (Total)", "insp/min", 19, 4),
+}
+
+
+def make_sample_db(path: str, admissions: int, seed: int = 0):
+    """Synthetic MIMIC-style cohort: 5 days per admission, hourly vitals and labs every 6 hours"""
+    rng = np.random.default_rng(seed)
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE admissions (subject_id INTEGER, hadm_id INTEGER, admittime TEXT, dischtime TEXT,
+            admission_type TEXT, admission_location TEXT, discharge_location TEXT, hospital_expire_flag INTEGER);
+        CREATE TABLE patients (subject_id INTEGER, gender TEXT, anchor_age INTEGER);
+        CREATE TABLE diagnoses_icd (subject_id INTEGER, hadm_id INTEGER, seq_num INTEGER, icd_code TEXT);
+        CREATE TABLE prescriptions (subject_id INTEGER, hadm_id INTEGER, starttime TEXT, drug TEXT);
+        CREATE TABLE d_labitems (itemid INTEGER, label TEXT);
+        CREATE TABLE labevents (subject_id INTEGER, hadm_id INTEGER, itemid INTEGER, charttime TEXT,
+            value TEXT, valuenum REAL, valueuom TEXT, flag TEXT);
+        CREATE TABLE d_items (itemid INTEGER, label TEXT);
+        CREATE TABLE chartevents (subject_id INTEGER, hadm_id INTEGER, itemid INTEGER, charttime TEXT,
+            value TEXT, valuenum REAL, valueuom TEXT);
+    """)
+    conn.executemany("INSERT INTO d_labitems VALUES (?, ?)", LAB_ITEMS.items())
+    conn.executemany("INSERT INTO d_items VALUES (?, ?)", [(i, spec[0]) for i, spec in CHART_ITEMS.items()])
+    for n in range(admissions):
+        hadm_id, subject_id = 20000000 + n, 10000000 + n
+        admit = pd.Timestamp("2150-01-01") + pd.Timedelta(days=int(rng.integers(0, 3650)), hours=int(rng.integers(0, 24)))
+        conn.execute("INSERT INTO admissions VALUES (?, ?, ?, ?, 'EW EMER.', 'EMERGENCY ROOM', 'HOME', 0)",
+                     (subject_id, hadm_id, str(admit), str(admit + pd.Timedelta(days=5))))
+        conn.execute("INSERT INTO patients VALUES (?, ?, ?)", (subject_id, "F" if n % 2 else "M", int(rng.integers(20, 90))))
+        codes = rng.choice(["A419", "J189", "N179", "I10", "E119", "R6520"], 4, replace=False)
+        conn.executemany("INSERT INTO diagnoses_icd VALUES (?, ?, ?, ?)",
+                         [(subject_id, hadm_id, i + 1, str(code)) for i, code in enumerate(codes)])
+        conn.executemany("INSERT INTO prescriptions VALUES (?, ?, ?, ?)",
+                         [(subject_id, hadm_id, str(admit), drug) for drug in ("Vancomycin", "Piperacillin-Tazobactam", "Heparin", "Acetaminophen")])
+        labs = []
+        for draw in range(20):
+            time = str(admit + pd.Timedelta(hours=6 * draw + 2))
+            for itemid in LAB_ITEMS:
+                value = round(float(rng.normal(10, 3)), 1)
+                flag = "abnormal" if rng.random() < 0.25 else None
+                labs.append((subject_id, hadm_id, itemid, time, str(value), value, "mg/dL", flag))
+        conn.executemany("INSERT INTO labevents VALUES (?, ?, ?, ?, ?, ?, ?, ?)", labs)
+        vitals = []
+        for hour in range(120):
+            time = str(admit + pd.Timedelta(hours=hour))
+            for itemid, (_, unit, mean, sd) in CHART_ITEMS.items():
+                value = round(float(rng.normal(mean, sd)), 1) if unit else int(np.clip(round(rng.normal(mean, sd)), 1, 5))
+                vitals.append((subject_id, hadm_id, itemid, time, str(value), value, unit))
+        conn.executemany("INSERT INTO chartevents VALUES (?, ?, ?, ?, ?, ?, ?)", vitals)
+    conn.commit()
+    conn.close()
+
+
+def notebook_context(summary: str, labs: dict, charts: dict) -> str:
+    """Patient information the way the notebook builds it: notes plus JSON timelines"""
+    return f"{summary}\nLab results: {json.dumps(labs)}\nChart events: {json.dumps(charts)}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=os.getenv("MIMIC_DB_PATH"), help="MIMIC SQLite database (default: synthetic)")
+    parser.add_argument("--limit", type=int, default=50, help="admissions in the sample cohort")
+    parser.add_argument("--criteria", default="qSOFA,SIRS,Sepsis-3")
+    parser.add_argument("--tokenizer", help="Hugging Face tokenizer to count tokens with")
+    parser.add_argument("--max-tokens", type=int, default=PATIENT_CONTEXT_MAX_TOKENS)
+    args = parser.parse_args()
+
+    if args.tokenizer:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+        count = lambda text: len(tokenizer.encode(text))
+        counter = args.tokenizer
+    else:
+        count, counter = estimate_tokens, "estimate_tokens"
+
+    db_path = args.db
+    if not db_path or not os.path.exists(db_path):
+        db_path = os.path.join(tempfile.mkdtemp(prefix="context_benchmark_"), "sample.db")
+        make_sample_db(db_path, args.limit)
+    hadm_ids = [hadm_id for hadm_id, _ in select_cohort(db_path, limit=args.limit)]
+
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    labs = build_timelines(load_events("lab", hadm_ids, db_path))
+    charts = build_timelines(load_events("chart", hadm_ids, db_path))
+    before = [count(notebook_context(admission_context(conn, h), labs.get(h, {}), charts.get(h, {}))) for h in hadm_ids]
+
+    print("=" * 80)
+    print("PATIENT CONTEXT ENCODING")
+    print("=" * 80)
+    print(f"Cohort: {len(hadm_ids)} admissions from {db_path if db_path == args.db else 'a synthetic sample'}")
+    print(f"Tokens counted with {counter}; budget {args.max_tokens or 'none'}")
+    print(f"{'encoding':>24}{'measurements':>14}{'mean tokens':>13}{'p95 tokens':>12}{'reduction':>11}{'thinned':>9}")
+    print(f"{'notebook (JSON)':>24}{'all':>14}{np.mean(before):>13,.0f}{np.percentile(before, 95):>12,.0f}{'-':>11}{'-':>9}")
+    for key in args.criteria.split(","):
+        compiled = get_compiled_criteria(key)
+        if compiled is None:
+            print(f"❌ Unknown criteria '{key}'")
+            continue
+        contexts = [encode_patient_context(conn, h, compiled.rule_set, count, args.max_tokens) for h in hadm_ids]
+        after = [c["tokens"] for c in contexts]
+        thinned = sum(1 for c in contexts if c["max_points"] is not None)
+        measurements = len(contexts[0]["measurements"]) if contexts else 0
+        print(f"{'compact ' + key:>24}{f'{measurements}/{len(MEASUREMENTS)}':>14}{np.mean(after):>13,.0f}"
+              f"{np.percentile(after, 95):>12,.0f}{np.mean(before) / np.mean(after):>10.1f}x{thinned:>9}")
+    conn.close()
+    print("=" * 80)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Benchmark memory-mapped parallel shard loading against from_pretrained.
+
+Generates a small random Qwen2 checkpoint split into many safetensors shards,
+then loads it repeatedly with the previous path (from_pretrained under the
+stderr progress capture) and with app.fast_loader.load_model_fast. Checks both
+models produce identical logits and reports load times and per-shard times.
+
+The checkpoint stays in the page cache between runs, so this measures the
+loading overhead rather than disk throughput; use --hidden/--layers to scale it up.
+
+Usage:
+    python benchmark_fast_loading.py [--layers 8] [--hidden 512] [--shard-size 8MB] [--repeat 3]
+"""
+import os
+os.environ["TRANSFORMERS_VERBOSITY"] = "error"
+
+import time
+import argparse
+import tempfile
+import statistics
+
+import torch
+from transformers import AutoModelForCausalLM, Qwen2Config, Qwen2ForCausalLM
+
+from app.fast_loader import list_shards, load_model_fast
+from app.model_progress import progress_monitor
+from app.model_transformers import StderrCapturer
+
+
+def make_checkpoint(path: str, layers: int, hidden: int, shard_size: str):
+    """Save a randomly initialized tiny Qwen2 model as a multi-shard safetensors checkpoint"""
+    config = Qwen2Config(
+        vocab_size=32000,
+        hidden_size=hidden,
+        intermediate_size=hidden * 4,
+        num_hidden_layers=layers,
+        num_attention_heads=8,
+        num_key_value_heads=2,
+        tie_word_embeddings=False
+    )
+    torch.manual_seed(0)
+    Qwen2ForCausalLM(config).save_pretrained(path, max_shard_size=shard_size, safe_serialization=True)
+
+
+def load_baseline(path: str):
+    with StderrCapturer():
+        return AutoModelForCausalLM.from_pretrained(path, torch_dtype=torch.float32, low_cpu_mem_usage=True).eval()
+
+
+def load_fast(path: str):
+    return load_model_fast(path, torch.float32).eval()
+
+
+def time_loads(fn, path: str, repeat: int) -> list:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        model = fn(path)
+        times.append(time.perf_counter() - start)
+        del model
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--layers", type=int, default=8)
+    parser.add_argument("--hidden", type=int, default=512)
+    parser.add_argument("--shard-size", default="8MB")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="tiny_checkpoint_") as path:
+        make_checkpoint(path, args.layers, args.hidden, args.shard_size)
+        shards = list_shards(path)
+        size_mb = sum(os.path.getsize(s) for s in shards) / 1024 ** 2
+
+        print("=" * 80)
+        print("FAST LOADING BENCHMARK")
+        print("=" * 80)
+        print(f"Checkpoint: {len(shards)} shards, {size_mb:.1f} MB")
+
+        # Both paths must produce the same model
+        input_ids = torch.randint(0, 32000, (1, 16))
+        with torch.no_grad():
+            reference = load_baseline(path)(input_ids).logits
+            fast = load_fast(path)(input_ids).logits
+        assert torch.equal(reference, fast), "fast-loaded model produces different logits"
+        print("✅ Identical logits")
+
+        baseline_times = time_loads(load_baseline, path, args.repeat)
+        progress_monitor.reset()
+        fast_times = time_loads(load_fast, path, args.repeat)
+        shard_times = [info.get("load_seconds", 0.0) for info in progress_monitor.get_progress_summary()["files"].values()]
+
+        print("-" * 80)
+        print(f"{'path':<16}{'best s':>10}{'median s':>10}")
+        print(f"{'from_pretrained':<16}{min(baseline_times):>10.3f}{statistics.median(baseline_times):>10.3f}")
+        print(f"{'fast (mmap)':<16}{min(fast_times):>10.3f}{statistics.median(fast_times):>10.3f}")
+        print(f"Speedup: {min(baseline_times) / min(fast_times):.2f}x")
+        if shard_times:
+            print(f"Per-shard load time (last run): mean {statistics.mean(shard_times) * 1000:.1f} ms, "
+                  f"max {max(shard_times) * 1000:.1f} ms")
+        print("=" * 80)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Benchmark the llama.cpp (GGUF) backend against the transformers backend on CPU.
+
+Each backend is loaded in a fresh subprocess so resident memory is measured
+cleanly, then runs the same prompts as benchmark_precision.py with greedy
+decoding. Records load time, resident memory, time to first token and tokens/sec.
+
+Usage:
+    CUDA_VISIBLE_DEVICES= python benchmark_llama_cpp.py --gguf PATH_OR_REPO:FILE [--model MODEL]
+        [--precision fp32] [--threads N] [--max-tokens N]
+"""
+import os
+os.environ["TRANSFORMERS_VERBOSITY"] = "error"
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+from benchmark_precision import DEFAULT_MODEL, PROMPTS, current_rss_bytes
+
+BACKENDS = ["transformers", "llama_cpp"]
+
+
+def load_handler(backend: str, args):
+    if backend == "llama_cpp":
+        from app.model_llama_cpp import LlamaCppModelHandler
+        return LlamaCppModelHandler(args.gguf, n_threads=args.threads)
+    from app.model_transformers import TransformersModelHandler
+    return TransformersModelHandler(args.model, precision=args.precision)
+
+
+def run_single(backend: str, args) -> dict:
+    """Load one backend and stream a greedy generation for every prompt (runs in a subprocess)"""
+    rss_before = current_rss_bytes()
+    start = time.perf_counter()
+    handler = load_handler(backend, args)
+    load_seconds = time.perf_counter() - start
+    rss_loaded = current_rss_bytes()
+
+    # Warm up once so the first timed prompt is not penalised
+    handler.generate([{"role": "user", "content": "Hello"}], max_tokens=4, temperature=0)
+
+    outputs = []
+    first_token_seconds = []
+    total_tokens = 0
+    total_seconds = 0.0
+    for prompt in PROMPTS:
+        messages = [{"role": "user", "content": prompt}]
+        start = time.perf_counter()
+        first_token = None
+        for item in handler.stream_generate(messages, max_tokens=args.max_tokens, temperature=0, stop=[]):
+            if "delta" in item:
+                if first_token is None and item["delta"]:
+                    first_token = time.perf_counter() - start
+            else:
+                result = item
+        total_seconds += time.perf_counter() - start
+        total_tokens += result["num_tokens"]
+        first_token_seconds.append(first_token or 0.0)
+        outputs.append(result["text"])
+
+    return {
+        "backend": backend,
+        "load_seconds": load_seconds,
+        "rss_gb": (rss_loaded - rss_before) / 1024 ** 3,
+        "peak_rss_gb": current_rss_bytes() / 1024 ** 3,
+        "first_token_ms": 1000 * sum(first_token_seconds) / len(first_token_seconds),
+        "tokens": total_tokens,
+        "tokens_per_second": total_tokens / total_seconds if total_seconds else 0.0,
+        "outputs": outputs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=DEFAULT_MODEL, help="Hugging Face model for the transformers backend")
+    parser.add_argument("--gguf", required=True, help="GGUF export of the same model for llama.cpp")
+    parser.add_argument("--precision", default="fp32", help="transformers CPU precision (fp32, bf16, int8)")
+    parser.add_argument("--threads", type=int, default=0, help="llama.cpp threads (0 = default)")
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--single", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Child mode: benchmark one backend and print JSON on the last line
+    if args.single:
+        print(json.dumps(run_single(args.single, args)))
+        return
+
+    print("=" * 80)
+    print("LLAMA.CPP vs TRANSFORMERS BENCHMARK")
+    print("=" * 80)
+    print(f"Transformers: {args.model} ({args.precision})")
+    print(f"llama.cpp:    {args.gguf}")
+    print(f"Prompts: {len(PROMPTS)}, max tokens: {args.max_tokens}")
+
+    results = {}
+    for backend in args.backends.split(","):
+        print(f"\nRunning {backend}...")
+        proc = subprocess.run(
+            [sys.executable, __file__, "--model", args.model, "--gguf", args.gguf,
+             "--precision", args.precision, "--threads", str(args.threads),
+             "--max-tokens", str(args.max_tokens), "--single", backend],
+            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        if proc.returncode != 0:
+            print(f"❌ {backend} failed:\n{proc.stderr[-2000:]}")
+            continue
+        results[backend] = json.loads(proc.stdout.strip().splitlines()[-1])
+
+    if not results:
+        sys.exit(1)
+
+    print("\n" + "=" * 80)
+    print(f"{'backend':<14}{'load s':>9}{'RSS GB':>9}{'TTFT ms':>10}{'tok/s':>9}")
+    for backend, r in results.items():
+        print(f"{backend:<14}{r['load_seconds']:>9.1f}{r['rss_gb']:>9.2f}{r['first_token_ms']:>10.0f}{r['tokens_per_second']:>9.2f}")
+
+    if len(results) == 2:
+        base, fast = results["transformers"], results["llama_cpp"]
+        if base["tokens_per_second"]:
+            print(f"\nllama.cpp speedup: {fast['tokens_per_second'] / base['tokens_per_second']:.2f}x tokens/sec")
+        same = sum(a == b for a, b in zip(base["outputs"], fast["outputs"]))
+        print(f"Identical greedy outputs: {same}/{len(PROMPTS)} (quantization changes some tokens)")
+    print("=" * 80)
+
+
+if __name__ == "__main__":
+    main()
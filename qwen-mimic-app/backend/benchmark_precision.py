@@ -0,0 +1,149 @@
+"""
+Benchmark CPU precision modes (fp32, bf16, int8) of TransformersModelHandler.
+
+For each precision the model is loaded in a fresh subprocess so resident memory
+is measured cleanly. Records load time, resident memory, tokens/sec and how
+closely greedy outputs agree with fp32 on a fixed prompt set.
+
+Usage:
+    CUDA_VISIBLE_DEVICES= python benchmark_precision.py [--model MODEL] [--max-tokens N]
+"""
+import os
+os.environ["TRANSFORMERS_VERBOSITY"] = "error"
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+DEFAULT_MODEL = "tossowski/MedAgentReasoner-3B-Chat"
+PRECISIONS = ["fp32", "bf16", "int8"]
+
+# Fixed prompt set, covering both reasoning and SQL style requests
+PROMPTS = [
+    "Evaluate qSOFA for patient 12345. Respiratory rate is 24, systolic blood pressure is 95 mmHg.",
+    "What are the SIRS criteria and how many must be met?",
+    "The patient's GCS verbal response is 'Confused'. Does this count as altered mentation?",
+    "Write a SQLite query counting admissions per admission_type in the admissions table.",
+]
+
+
+def current_rss_bytes() -> int:
+    """Resident set size of this process in bytes"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        # ru_maxrss is in KB on Linux and bytes on macOS; peak is the best we can do here
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+
+
+def run_single(model_name: str, precision: str, max_tokens: int) -> dict:
+    """Load the model in one precision and generate for every prompt (runs in a subprocess)"""
+    from app.model_transformers import TransformersModelHandler
+
+    rss_before = current_rss_bytes()
+    start = time.perf_counter()
+    handler = TransformersModelHandler(model_name, precision=precision)
+    load_seconds = time.perf_counter() - start
+    rss_loaded = current_rss_bytes()
+
+    outputs = []
+    total_tokens = 0
+    total_seconds = 0.0
+    for prompt in PROMPTS:
+        messages = [{"role": "user", "content": prompt}]
+        start = time.perf_counter()
+        result = handler.generate(messages, max_tokens=max_tokens, temperature=0)
+        total_seconds += time.perf_counter() - start
+        total_tokens += result["num_tokens"]
+        outputs.append(result["text"])
+
+    return {
+        "precision": handler.precision,
+        "load_seconds": load_seconds,
+        "rss_gb": (rss_loaded - rss_before) / 1024 ** 3,
+        "peak_rss_gb": current_rss_bytes() / 1024 ** 3,
+        "weights_gb": handler.memory_bytes / 1024 ** 3,
+        "tokens": total_tokens,
+        "tokens_per_second": total_tokens / total_seconds if total_seconds else 0.0,
+        "outputs": outputs,
+    }
+
+
+def agreement(tokenizer, reference: list, outputs: list) -> dict:
+    """Exact-match rate and mean shared-prefix fraction (in tokens) against the reference outputs"""
+    exact = 0
+    prefix_fractions = []
+    for ref, out in zip(reference, outputs):
+        ref_ids = tokenizer(ref)["input_ids"]
+        out_ids = tokenizer(out)["input_ids"]
+        shared = 0
+        for a, b in zip(ref_ids, out_ids):
+            if a != b:
+                break
+            shared += 1
+        exact += int(ref_ids == out_ids)
+        prefix_fractions.append(shared / max(len(ref_ids), len(out_ids), 1))
+    return {
+        "exact_match": exact / len(reference),
+        "prefix_agreement": sum(prefix_fractions) / len(prefix_fractions),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--precisions", default=",".join(PRECISIONS))
+    parser.add_argument("--single", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Child mode: benchmark one precision and print JSON on the last line
+    if args.single:
+        print(json.dumps(run_single(args.model, args.single, args.max_tokens)))
+        return
+
+    print("=" * 80)
+    print("CPU PRECISION BENCHMARK")
+    print("=" * 80)
+    print(f"Model: {args.model}")
+    print(f"Prompts: {len(PROMPTS)}, max tokens: {args.max_tokens}")
+
+    results = {}
+    for precision in args.precisions.split(","):
+        print(f"\nRunning {precision}...")
+        proc = subprocess.run(
+            [sys.executable, __file__, "--model", args.model, "--max-tokens", str(args.max_tokens), "--single", precision],
+            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        if proc.returncode != 0:
+            print(f"❌ {precision} failed:\n{proc.stderr[-2000:]}")
+            continue
+        results[precision] = json.loads(proc.stdout.strip().splitlines()[-1])
+
+    if not results:
+        sys.exit(1)
+
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    reference = results.get("fp32", {}).get("outputs")
+
+    print("\n" + "=" * 80)
+    print(f"{'precision':<10}{'load s':>9}{'RSS GB':>9}{'weights GB':>12}{'tok/s':>9}{'exact':>8}{'prefix':>8}")
+    for precision, r in results.items():
+        agree = agreement(tokenizer, reference, r["outputs"]) if reference else {}
+        print(
+            f"{precision:<10}{r['load_seconds']:>9.1f}{r['rss_gb']:>9.2f}{r['weights_gb']:>12.2f}"
+            f"{r['tokens_per_second']:>9.2f}{agree.get('exact_match', float('nan')):>8.2f}"
+            f"{agree.get('prefix_agreement', float('nan')):>8.2f}"
+        )
+    print("=" * 80)
+
+
+if __name__ == "__main__":
+    main()
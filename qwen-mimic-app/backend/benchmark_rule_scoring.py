@@ -0,0 +1,101 @@
+"""
+Benchmark: vectorized criteria rule scoring vs evaluating patients one at a time.
+
+Generates a synthetic cohort with some missing measurements, scores it against the
+qSOFA and SIRS rules once with RuleSet.score (one NumPy pass per rule) and once with
+a per-patient Python loop over the same compiled comparisons, and checks that both
+agree.
+
+Usage:
+    python benchmark_rule_scoring.py [--patients 10000,100000,1000000]
+"""
+import os
+os.environ.setdefault("CRITERIA_STORE_PATH", "")
+
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from app.rules import OPERATORS
+from app.criteria import get_compiled_criteria
+
+
+def make_cohort(patients: int, seed: int = 0) -> pd.DataFrame:
+    """Worst values per admission, about 10% of each measurement missing"""
+    rng = np.random.default_rng(seed)
+    columns = {
+        "resp_rate_min": rng.normal(16, 3, patients), "resp_rate_max": rng.normal(21, 4, patients),
+        "sbp_min": rng.normal(105, 15, patients), "sbp_max": rng.normal(135, 15, patients),
+        "gcs_verbal_min": rng.integers(1, 6, patients).astype(float),
+        "temperature_min": rng.normal(36.4, 0.5, patients), "temperature_max": rng.normal(37.6, 0.8, patients),
+        "heart_rate_min": rng.normal(70, 10, patients), "heart_rate_max": rng.normal(95, 15, patients),
+        "paco2_min": rng.normal(38, 5, patients),
+        "wbc_min": rng.normal(7, 2, patients), "wbc_max": rng.normal(10, 3, patients),
+        "bands_max": rng.normal(3, 3, patients),
+    }
+    for values in columns.values():
+        values[rng.random(patients) < 0.1] = np.nan
+    return pd.DataFrame(columns, index=pd.RangeIndex(patients, name="hadm_id"))
+
+
+def score_loop(rule_set, cohort: pd.DataFrame) -> list:
+    """The same decision computed patient by patient"""
+    decisions = []
+    for record in cohort.to_dict("records"):
+        met = unknown = 0
+        for rule in rule_set.rules:
+            rule_met, all_known = False, True
+            for measurement, op, value in rule.comparisons:
+                column = rule._column(cohort, measurement, op)
+                observed = record.get(column) if column else None
+                if observed is None or observed != observed:
+                    all_known = False
+                elif OPERATORS[op](observed, value):
+                    rule_met = True
+            met += rule_met
+            unknown += not rule_met and not all_known
+        if met >= rule_set.min_met:
+            decisions.append("positive")
+        elif met + unknown < rule_set.min_met:
+            decisions.append("negative")
+        else:
+            decisions.append("indeterminate")
+    return decisions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", default="10000,100000,1000000")
+    parser.add_argument("--max-loop", type=int, default=200000, help="skip the per-patient loop above this size")
+    args = parser.parse_args()
+
+    print("=" * 80)
+    print("RULE SCORING BENCHMARK")
+    print("=" * 80)
+    print(f"{'criteria':>10}{'patients':>10}{'loop ms':>12}{'vectorized ms':>15}{'speedup':>10}{'patients/s':>14}")
+
+    for patients in [int(p) for p in args.patients.split(",")]:
+        cohort = make_cohort(patients)
+        for key in ("qSOFA", "SIRS"):
+            rule_set = get_compiled_criteria(key).rule_set
+            start = time.perf_counter()
+            scores = rule_set.score(cohort)
+            vectorized = time.perf_counter() - start
+
+            if patients <= args.max_loop:
+                start = time.perf_counter()
+                decisions = score_loop(rule_set, cohort)
+                loop = time.perf_counter() - start
+                assert decisions == list(scores["decision"]), "loop and vectorized decisions differ"
+                loop_ms, speedup = f"{loop * 1000:>12.1f}", f"{loop / vectorized:>9.1f}x"
+            else:
+                loop_ms, speedup = f"{'skipped':>12}", f"{'-':>10}"
+            print(f"{key:>10}{patients:>10}{loop_ms}{vectorized * 1000:>15.1f}{speedup}{patients / vectorized:>14,.0f}")
+
+    print("=" * 80)
+
+
+if __name__ == "__main__":
+    main()
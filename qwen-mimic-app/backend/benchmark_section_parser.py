@@ -0,0 +1,100 @@
+"""
+Microbenchmark: incremental SectionParser vs the previous regex extract_sections.
+
+Measures both on long synthetic outputs, once on the complete text and once
+in streaming form (token-sized chunks), where the regex path has to re-scan
+the accumulated text after every chunk to find sections as they complete.
+
+Usage:
+    python benchmark_section_parser.py [--sizes 10000,100000,1000000] [--chunk 4]
+"""
+import re
+import time
+import argparse
+
+from app.section_parser import SectionParser, parse_sections
+
+
+def regex_extract_sections(text: str) -> dict:
+    """The regex-based extraction previously used by TransformersModelHandler"""
+    thinking = re.search(r'<think>\s*(.*?)\s*</think>', text, re.DOTALL)
+    search = re.search(r'<search>\s*(.*?)\s*</search>', text, re.DOTALL)
+    answer = re.search(r'<answer>\s*(.*?)\s*</answer>', text, re.DOTALL)
+
+    if not thinking and not search and not answer:
+        # Partial tag scan performed on every miss
+        any(tag in text for tag in ["<think>", "</think>", "<search>", "</search>", "<answer>", "</answer>"])
+
+    return {
+        "thinking": thinking.group(1).strip() if thinking else None,
+        "search_query": search.group(1).strip() if search else None,
+        "answer": answer.group(1).strip() if answer else None
+    }
+
+
+def make_output(size: int) -> str:
+    """Synthetic model output with a long <think> block followed by an answer"""
+    sentence = "The respiratory rate is 24 breaths/min, which is >= 22, so this criterion is met. "
+    thinking = (sentence * (size // len(sentence) + 1))[:size]
+    return f"<think>\n{thinking}\n</think>\n<answer> qSOFA score is 2, criteria met </answer>"
+
+
+def time_it(fn, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def stream_regex(text: str, chunk: int):
+    accumulated = ""
+    for i in range(0, len(text), chunk):
+        accumulated += text[i:i + chunk]
+        regex_extract_sections(accumulated)
+
+
+def stream_parser(text: str, chunk: int):
+    parser = SectionParser()
+    for i in range(0, len(text), chunk):
+        parser.feed(text[i:i + chunk])
+    parser.finish()
+    return parser.result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--chunk", type=int, default=4, help="characters per streamed chunk (about one token)")
+    parser.add_argument("--max-stream-regex", type=int, default=20000,
+                        help="skip the quadratic streaming regex run above this size")
+    args = parser.parse_args()
+
+    print("=" * 80)
+    print("SECTION PARSER BENCHMARK")
+    print("=" * 80)
+    print(f"{'chars':>10}{'regex full ms':>15}{'parser full ms':>16}{'regex stream ms':>17}{'parser stream ms':>18}")
+
+    for size in [int(s) for s in args.sizes.split(",")]:
+        text = make_output(size)
+
+        # Both paths must agree on the extracted sections
+        assert parse_sections(text) == regex_extract_sections(text)
+        assert stream_parser(text, args.chunk) == regex_extract_sections(text)
+
+        regex_full = time_it(lambda: regex_extract_sections(text))
+        parser_full = time_it(lambda: parse_sections(text))
+        parser_stream = time_it(lambda: stream_parser(text, args.chunk), repeat=1)
+        if size <= args.max_stream_regex:
+            regex_stream = f"{time_it(lambda: stream_regex(text, args.chunk), repeat=1) * 1000:>17.1f}"
+        else:
+            regex_stream = f"{'skipped':>17}"
+
+        print(f"{size:>10}{regex_full * 1000:>15.2f}{parser_full * 1000:>16.2f}{regex_stream}{parser_stream * 1000:>18.1f}")
+
+    print("=" * 80)
+
+
+if __name__ == "__main__":
+    main()
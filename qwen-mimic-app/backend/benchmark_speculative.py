@@ -0,0 +1,103 @@
+"""
+Benchmark assisted (speculative) decoding in TransformersModelHandler.
+
+Loads the main model together with a small draft model that shares its tokenizer,
+then runs the same prompts with plain greedy decoding and with assisted decoding.
+Reports tokens/sec for both, the speedup, the draft acceptance rate, and checks
+that the greedy outputs are identical.
+
+Usage:
+    python benchmark_speculative.py [--model MODEL] [--draft DRAFT] [--lookahead N]
+"""
+import os
+os.environ["TRANSFORMERS_VERBOSITY"] = "error"
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+import sys
+import time
+import argparse
+
+from app.model_transformers import TransformersModelHandler
+
+DEFAULT_MODEL = "tossowski/MedAgentReasoner-3B-Chat"
+DEFAULT_DRAFT = "Qwen/Qwen2.5-0.5B-Instruct"
+
+PROMPTS = [
+    "Evaluate qSOFA for patient 12345. Respiratory rate is 24, systolic blood pressure is 95 mmHg.",
+    "What are the SIRS criteria and how many must be met?",
+    "The patient's GCS verbal response is 'Confused'. Does this count as altered mentation?",
+    "Summarize the Sepsis-3 definition in two sentences.",
+]
+
+
+def run_prompts(handler: TransformersModelHandler, use_draft: bool, max_tokens: int) -> dict:
+    """Generate greedily for every prompt and collect throughput statistics"""
+    outputs = []
+    total_tokens = 0
+    total_seconds = 0.0
+    acceptance = []
+    for prompt in PROMPTS:
+        messages = [{"role": "user", "content": prompt}]
+        start = time.perf_counter()
+        result = handler.generate(messages, max_tokens=max_tokens, temperature=0, use_draft=use_draft)
+        total_seconds += time.perf_counter() - start
+        total_tokens += result["num_tokens"]
+        outputs.append(result["text"])
+        if "draft_acceptance_rate" in result:
+            acceptance.append(result["draft_acceptance_rate"])
+    return {
+        "outputs": outputs,
+        "tokens_per_second": total_tokens / total_seconds if total_seconds else 0.0,
+        "acceptance_rate": sum(acceptance) / len(acceptance) if acceptance else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--draft", default=DEFAULT_DRAFT)
+    parser.add_argument("--lookahead", type=int, default=5)
+    parser.add_argument("--precision", default="fp32")
+    parser.add_argument("--max-tokens", type=int, default=128)
+    args = parser.parse_args()
+
+    print("=" * 80)
+    print("ASSISTED DECODING BENCHMARK")
+    print("=" * 80)
+    print(f"Model: {args.model}")
+    print(f"Draft: {args.draft} (lookahead {args.lookahead})")
+
+    handler = TransformersModelHandler(
+        args.model,
+        precision=args.precision,
+        draft_model_name=args.draft,
+        num_assistant_tokens=args.lookahead
+    )
+
+    # Warm up both paths once so the first timed prompt is not penalised
+    warmup = [{"role": "user", "content": "Hello"}]
+    handler.generate(warmup, max_tokens=4, temperature=0, use_draft=False)
+    handler.generate(warmup, max_tokens=4, temperature=0, use_draft=True)
+
+    plain = run_prompts(handler, use_draft=False, max_tokens=args.max_tokens)
+    assisted = run_prompts(handler, use_draft=True, max_tokens=args.max_tokens)
+
+    mismatches = [i for i, (a, b) in enumerate(zip(plain["outputs"], assisted["outputs"])) if a != b]
+    speedup = assisted["tokens_per_second"] / plain["tokens_per_second"] if plain["tokens_per_second"] else 0.0
+
+    print("\n" + "=" * 80)
+    print(f"Plain decoding:    {plain['tokens_per_second']:.2f} tokens/sec")
+    print(f"Assisted decoding: {assisted['tokens_per_second']:.2f} tokens/sec")
+    print(f"Speedup:           {speedup:.2f}x")
+    print(f"Draft acceptance:  {assisted['acceptance_rate']:.0%}")
+    if mismatches:
+        print(f"❌ Greedy outputs differ for prompts {mismatches}")
+    else:
+        print("✅ Greedy outputs are identical")
+    print("=" * 80)
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Benchmark: vectorized timeline building vs the notebook's iterrows implementation.
+
+Generates a synthetic lab event table (hadm_id, charttime, label, value, flag) in
+random row order, builds the nested {charttime: {label: value}} timelines once with
+group_hadm_item_js from the Week 3 notebook and once with build_timelines, and checks
+that both produce the same timelines.
+
+Usage:
+    python benchmark_timelines.py [--rows 1000000] [--admissions 2000]
+"""
+import os
+os.environ.setdefault("CRITERIA_STORE_PATH", "")
+
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from app.timelines import build_timelines
+
+LABELS = [
+    "Hemoglobin", "Hematocrit", "White Blood Cells", "Platelet Count", "Sodium", "Potassium",
+    "Chloride", "Bicarbonate", "Urea Nitrogen", "Creatinine", "Glucose", "Lactate", "pH",
+    "pCO2", "pO2", "Bilirubin, Total", "Albumin", "INR(PT)", "PTT", "Magnesium",
+]
+
+
+def group_hadm_item_js(df):
+    """Reference implementation, as in reasoning-diagnosis/Sepsis_Diagnosis_Week3.ipynb"""
+    df['charttime'] = pd.to_datetime(df['charttime'])
+
+    def aggregate_lab_results(group):
+        grouped_data = {}
+        for _, row in group.iterrows():
+            time_str = row['charttime'].strftime('%Y-%m-%d %H:%M:%S')
+            if time_str not in grouped_data:
+                grouped_data[time_str] = {}
+            grouped_data[time_str][row['label']] = f"{row['value']} - {row['flag']}" if pd.notna(row['flag']) else row['value']
+        return grouped_data
+
+    grouped_df = df.sort_values(by=['charttime']).groupby('hadm_id').apply(aggregate_lab_results).reset_index()
+    grouped_df.columns = ['hadm_id', 'item_result']
+    return grouped_df
+
+
+def make_events(rows: int, admissions: int, seed: int = 0) -> pd.DataFrame:
+    """Lab rows spread over admissions, one value per (admission, draw time, label), shuffled"""
+    rng = np.random.default_rng(seed)
+    per_draw = len(LABELS)
+    draw = np.arange(rows) // per_draw
+    hadm_id = 20000000 + draw % admissions
+    draw_in_admission = draw // admissions
+    start = pd.Timestamp("2150-01-01") + pd.to_timedelta(rng.integers(0, 3650, admissions), unit="D")
+    charttime = start[hadm_id - 20000000] + pd.to_timedelta(draw_in_admission * 6, unit="h")
+    flag = np.where(rng.random(rows) < 0.2, "abnormal", None)
+    events = pd.DataFrame({
+        "hadm_id": hadm_id,
+        "charttime": charttime.strftime("%Y-%m-%d %H:%M:%S"),
+        "label": np.array(LABELS, dtype=object)[np.arange(rows) % per_draw],
+        "value": np.round(rng.normal(50, 20, rows), 1),
+        "flag": flag,
+    })
+    return events.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--admissions", type=int, default=2000)
+    parser.add_argument("--skip-reference", action="store_true", help="only time build_timelines")
+    args = parser.parse_args()
+
+    events = make_events(args.rows, args.admissions)
+
+    print("=" * 80)
+    print("TIMELINE BUILD BENCHMARK")
+    print("=" * 80)
+    print(f"rows: {len(events):,}  admissions: {events['hadm_id'].nunique():,}  "
+          f"timestamps: {len(events.drop_duplicates(['hadm_id', 'charttime'])):,}")
+
+    start = time.perf_counter()
+    timelines = build_timelines(events)
+    vectorized = time.perf_counter() - start
+
+    print(f"{'implementation':>20}{'seconds':>12}{'rows/s':>16}{'speedup':>10}")
+    if not args.skip_reference:
+        start = time.perf_counter()
+        reference = group_hadm_item_js(events.copy())
+        iterrows = time.perf_counter() - start
+        assert dict(zip(reference["hadm_id"].tolist(), reference["item_result"])) == timelines, \
+            "iterrows and vectorized timelines differ"
+        print(f"{'iterrows':>20}{iterrows:>12.2f}{len(events) / iterrows:>16,.0f}{'1.0x':>10}")
+        print(f"{'build_timelines':>20}{vectorized:>12.2f}{len(events) / vectorized:>16,.0f}{iterrows / vectorized:>9.1f}x")
+        print("Timelines identical: yes")
+    else:
+        print(f"{'build_timelines':>20}{vectorized:>12.2f}{len(events) / vectorized:>16,.0f}{'-':>10}")
+    print("=" * 80)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Microbenchmark: incremental per-message tokenization vs re-tokenizing the whole prompt.
+
+Simulates a long reasoning conversation and, at every turn, builds the prompt ids
+and decodes a generated reply in two ways:
+- full: format the whole ChatML prompt, tokenize it, decode prompt + reply and slice
+  by the prompt length (the previous TransformersModelHandler behavior)
+- incremental: MessageTokenCache ids (only the new messages are tokenized) and a
+  decode of the newly generated ids only
+
+Only the tokenizer is loaded, so this runs without the model weights.
+
+Usage:
+    python benchmark_tokenization.py [--tokenizer NAME] [--turns 60] [--report-every 10]
+"""
+import os
+os.environ["TRANSFORMERS_VERBOSITY"] = "error"
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+import time
+import argparse
+
+from transformers import AutoTokenizer
+
+from app.tokenization import MessageTokenCache, format_messages
+
+DEFAULT_TOKENIZER = "tossowski/MedAgentReasoner-3B-Chat"
+
+SYSTEM_PROMPT = "You are a clinical reasoning assistant. Think step by step inside <think> tags. " * 8
+THINKING = "The respiratory rate is 24 breaths/min, which is >= 22, so this criterion is met. " * 12
+
+
+def assistant_turn(i: int) -> str:
+    return f"<think>\n{THINKING}\n</think>\n<search> systolic blood pressure for step {i} </search>"
+
+
+def user_turn(i: int) -> str:
+    return f"Search result {i}: systolic blood pressure was {90 + i % 30} mmHg at 08:{i % 60:02d}."
+
+
+def time_full(tokenizer, messages, reply_ids):
+    start = time.perf_counter()
+    prompt = format_messages(messages)
+    prompt_ids = tokenizer(prompt, return_tensors=None)["input_ids"]
+    tokenize_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    text = tokenizer.decode(prompt_ids + reply_ids, skip_special_tokens=False)
+    reply = text[len(prompt):].strip()
+    decode_seconds = time.perf_counter() - start
+    return prompt_ids, reply, tokenize_seconds, decode_seconds
+
+
+def time_incremental(cache, tokenizer, messages, reply_ids):
+    start = time.perf_counter()
+    prompt_ids = cache.encode_messages(messages)
+    tokenize_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reply = tokenizer.decode(reply_ids, skip_special_tokens=False).strip()
+    decode_seconds = time.perf_counter() - start
+    return prompt_ids, reply, tokenize_seconds, decode_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokenizer", default=DEFAULT_TOKENIZER)
+    parser.add_argument("--turns", type=int, default=60)
+    parser.add_argument("--report-every", type=int, default=10)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    cache = MessageTokenCache(tokenizer)
+
+    print("=" * 80)
+    print(f"TOKENIZATION BENCHMARK ({args.tokenizer})")
+    print("=" * 80)
+    print(f"{'turn':>6}{'prompt tokens':>15}{'full tok ms':>13}{'incr tok ms':>13}{'full dec ms':>13}{'incr dec ms':>13}")
+
+    messages = [{"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": "Evaluate qSOFA for patient 12345."}]
+    totals = {"full": 0.0, "incremental": 0.0}
+    for turn in range(1, args.turns + 1):
+        reply = assistant_turn(turn)
+        reply_ids = tokenizer.encode(reply, add_special_tokens=False)
+
+        full_ids, full_reply, full_tok, full_dec = time_full(tokenizer, messages, reply_ids)
+        incr_ids, incr_reply, incr_tok, incr_dec = time_incremental(cache, tokenizer, messages, reply_ids)
+
+        # Both paths must produce the same prompt and the same reply
+        assert full_ids == incr_ids, f"prompt ids differ at turn {turn}"
+        assert full_reply == incr_reply, f"decoded reply differs at turn {turn}"
+
+        totals["full"] += full_tok + full_dec
+        totals["incremental"] += incr_tok + incr_dec
+        if turn % args.report_every == 0 or turn == 1:
+            print(f"{turn:>6}{len(full_ids):>15}{full_tok * 1000:>13.2f}{incr_tok * 1000:>13.2f}"
+                  f"{full_dec * 1000:>13.2f}{incr_dec * 1000:>13.2f}")
+
+        messages.append({"role": "assistant", "content": reply})
+        messages.append({"role": "user", "content": user_turn(turn)})
+
+    print("-" * 80)
+    print(f"Total tokenize+decode: full {totals['full'] * 1000:.1f} ms, "
+          f"incremental {totals['incremental'] * 1000:.1f} ms "
+          f"({totals['full'] / max(totals['incremental'], 1e-9):.1f}x)")
+    print(f"Message cache: {cache.get_state()}")
+    print("=" * 80)
+
+
+if __name__ == "__main__":
+    main()
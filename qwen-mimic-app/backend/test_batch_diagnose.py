@@ -0,0 +1,100 @@
+"""
+Check batched diagnosis (LocalReasonerModel.process_batch) with a stand-in model,
+without downloading or loading anything.
+
+Checks micro-batching, per-item errors that do not abort the batch, the one-at-a-time
+retry of a failed micro-batch, and per-batch throughput stats.
+
+Usage:
+    python test_batch_diagnose.py
+"""
+import sys
+
+from testing_utils import check, finish, prepare_environment, run_script
+
+prepare_environment("batch_diagnose_test_", MEMORY_CHECK_SECONDS="0")
+
+from app.reasoner import LocalReasonerModel
+from app.history import HistoryManager
+from app.section_parser import parse_sections
+
+
+class FakeModel:
+    """Answers each prompt with its patient id; fails on prompts containing 'crash'"""
+    key = ("fake/model", "transformers", "fp32")
+    backend = "transformers"
+    kv_bytes_per_token = 1
+
+    def __init__(self):
+        self.batches = []
+        self.single_calls = 0
+
+    def _result(self, messages):
+        prompt = messages[-1]["content"]
+        if "crash" in prompt:
+            raise RuntimeError(f"model failed on '{prompt}'")
+        text = f"<think>{prompt}</think><answer>assessed {prompt.split()[-1]}</answer>"
+        return {"text": text, "backend": self.backend, "num_tokens": 10, "stopped_on": "</answer>", "tokens_saved": 0}
+
+    def generate_batch(self, conversations, **kwargs):
+        self.batches.append(len(conversations))
+        return [self._result(messages) for messages in conversations]
+
+    def generate(self, messages, **kwargs):
+        self.single_calls += 1
+        return self._result(messages)
+
+    def extract_sections(self, text):
+        return parse_sections(text)
+
+    def count_tokens(self, text):
+        return len(text.split())
+
+
+def main() -> int:
+    reasoner = LocalReasonerModel.__new__(LocalReasonerModel)
+    model = reasoner.model_handler = FakeModel()
+    reasoner.history_manager = HistoryManager(model.count_tokens)
+
+    print("Testing batched diagnosis...")
+
+    # 1. Prompts are generated in fixed-size micro-batches, results keep their index
+    prompts = [f"Evaluate qSOFA for patient {1000 + i}" for i in range(10)]
+    events = list(reasoner.process_batch(prompts, batch_size=4))
+    items = [payload for kind, payload in events if kind == "item"]
+    batches = [payload for kind, payload in events if kind == "batch"]
+    check("micro-batches of the requested size", model.batches == [4, 4, 2], f"(got {model.batches})")
+    check("one result per prompt", sorted(item["index"] for item in items) == list(range(10)))
+    check("results match their prompts",
+          all(item["result"]["answer"] == f"assessed {1000 + item['index']}" for item in items))
+    check("per-batch throughput reported",
+          len(batches) == 3 and all(b["tokens_per_second"] > 0 and b["generated_tokens"] == 10 * b["size"] for b in batches))
+
+    # 2. A bad prompt is reported on its own line and the rest of the batch completes
+    model.batches.clear()
+    prompts = ["Evaluate qSOFA for patient 1", "Evaluate qSOFA for nobody", "Evaluate qSOFA for patient 3"]
+    items = [payload for kind, payload in reasoner.process_batch(prompts, batch_size=8) if kind == "item"]
+    errors = {item["index"]: item["error"] for item in items if "error" in item}
+    check("prompt without a patient id reported as an item error", list(errors) == [1], f"(got {errors})")
+    check("other prompts still generated in one batch", model.batches == [2] and len(items) == 3)
+
+    # 3. A generation failure falls back to one-at-a-time generation for that micro-batch only
+    model.batches.clear()
+    prompts = ["Evaluate qSOFA for patient 1", "Evaluate qSOFA crash patient 2", "Evaluate qSOFA for patient 3",
+               "Evaluate qSOFA for patient 4"]
+    events = list(reasoner.process_batch(prompts, batch_size=2))
+    items = {payload["index"]: payload for kind, payload in events if kind == "item"}
+    check("failing item reported with its error", "error" in items[1] and "model failed" in items[1]["error"])
+    check("rest of the failed micro-batch retried individually", "result" in items[0] and model.single_calls == 2)
+    check("later micro-batches unaffected", "result" in items[2] and "result" in items[3] and model.batches[-1] == 2)
+    check("batch stats count the error", [b["errors"] for k, b in events if k == "batch"] == [1, 0])
+
+    return finish("batched diagnosis")
+
+
+def test_batch_diagnose():
+    run_script(__file__)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,223 @@
+"""
+Check single-flight coalescing of identical concurrent requests, without loading any model.
+
+Fires identical requests from several threads at a slow stand-in for a model call and
+checks that it runs once, that every caller gets the result (or the error), that
+streams are replayed in full to late joiners, that identical concurrent SQL
+queries against a temporary SQLite database share one execution, and that identical
+SQL questions share one generation that stops at the end of the statement.
+
+Usage:
+    python test_coalescing.py
+"""
+import os
+import sys
+import time
+import sqlite3
+import threading
+
+from testing_utils import check, finish, prepare_environment, run_script
+
+# A small SQLite database standing in for MIMIC, created before the app reads its config
+prepare_environment("coalescing_test_", files={"MIMIC_DB_PATH": "test.db"}, REQUEST_COALESCING="true")
+
+from app.coalescing import request_coalescer, coalescing_key, normalize_text
+from app.query import execute_sql_query, SqlGenerationHandler, SQL_STOP
+from app.token_budget import token_budget
+from app.reasoner import LocalReasonerModel
+from app.history import HistoryManager
+from app.section_parser import parse_sections
+
+CALLERS = 8
+
+
+def run_concurrently(target, count: int = CALLERS) -> list:
+    """Call target(index) from count threads released at the same moment"""
+    results = [None] * count
+    barrier = threading.Barrier(count)
+
+    def worker(index):
+        barrier.wait()
+        try:
+            results[index] = target(index)
+        except Exception as e:
+            results[index] = e
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class FakeReasoningModel:
+    """Slow stand-in for the reasoning model, blocking or streamed"""
+    key = ("fake/model", "transformers", "fp32")
+    backend = "transformers"
+    text = "<think>Vitals are normal</think><answer>qSOFA negative</answer>"
+
+    def _response(self):
+        return {"text": self.text, "backend": self.backend, "num_tokens": 8, "stopped_on": "</answer>", "tokens_saved": 0}
+
+    def generate(self, messages, **kwargs):
+        time.sleep(0.3)
+        return self._response()
+
+    def stream_generate(self, messages, **kwargs):
+        for i in range(0, len(self.text), 10):
+            time.sleep(0.03)
+            yield {"delta": self.text[i:i + 10]}
+        yield self._response()
+
+    def extract_sections(self, text):
+        return parse_sections(text)
+
+    def count_tokens(self, text):
+        return len(text.split())
+
+
+class FakeSqlModel:
+    """Slow stand-in for the SQL model that records the generation arguments"""
+    key = ("fake/sql", "transformers", "fp32")
+    backend = "transformers"
+
+    def __init__(self):
+        self.calls = []
+
+    def generate(self, messages, **kwargs):
+        self.calls.append(kwargs)
+        time.sleep(0.3)
+        # The stop string stays in the output, as with the real backends
+        return {"text": "```sql\nSELECT COUNT(*) FROM admissions;", "backend": self.backend,
+                "num_tokens": 12, "stopped_on": ";", "tokens_saved": 188}
+
+    def count_tokens(self, text):
+        return len(text.split())
+
+
+def main() -> int:
+    print("Testing request coalescing...")
+
+    # 1. Keys ignore whitespace differences but not parameters
+    key = coalescing_key(normalize_text("How many  patients\nwere admitted?"), ("model", "transformers", "fp32"), 200, 0.2)
+    check("whitespace does not change the key",
+          key == coalescing_key(normalize_text("How many patients were admitted?"), ("model", "transformers", "fp32"), 200, 0.2))
+    check("sampling params change the key",
+          key != coalescing_key(normalize_text("How many patients were admitted?"), ("model", "transformers", "fp32"), 200, 0.7))
+
+    # 2. Identical concurrent calls run once and all get the result
+    calls = []
+
+
+    def slow_generate():
+        calls.append(1)
+        time.sleep(0.5)
+        return {"text": "SELECT COUNT(*) FROM admissions;", "num_tokens": 9}
+
+
+    results = run_concurrently(lambda i: request_coalescer.run("test", key, slow_generate))
+    check("one model call for identical concurrent requests", len(calls) == 1, f"(got {len(calls)})")
+    check("every caller got the result", all(r[0]["num_tokens"] == 9 for r in results))
+    check("all but one result marked as shared", sum(shared for _, shared in results) == CALLERS - 1)
+
+    # 3. Different keys are not coalesced
+    calls.clear()
+    run_concurrently(lambda i: request_coalescer.run("test", f"{key}-{i % 2}", slow_generate))
+    check("different requests run separately", len(calls) == 2, f"(got {len(calls)})")
+
+    # 4. Errors reach every caller, and the next request runs again
+    def failing_generate():
+        time.sleep(0.3)
+        raise RuntimeError("model failed")
+
+
+    results = run_concurrently(lambda i: request_coalescer.run("test", "failing", failing_generate))
+    check("error raised for every caller", all(isinstance(r, RuntimeError) for r in results))
+    calls.clear()
+    request_coalescer.run("test", key, slow_generate)
+    check("finished requests are not cached", len(calls) == 1)
+
+    # 5. Streams run once and late joiners receive every item
+    stream_calls = []
+
+
+    def slow_stream():
+        stream_calls.append(1)
+        for i in range(5):
+            time.sleep(0.1)
+            yield {"delta": str(i)}
+        yield {"text": "01234", "num_tokens": 5}
+
+
+    def consume(index):
+        # Join at different points of the stream
+        time.sleep(0.05 * index)
+        stream, shared = request_coalescer.stream("test_stream", key, slow_stream)
+        return list(stream), shared
+
+
+    results = run_concurrently(consume, count=4)
+    expected = [{"delta": str(i)} for i in range(5)] + [{"text": "01234", "num_tokens": 5}]
+    check("one stream for identical concurrent requests", len(stream_calls) == 1, f"(got {len(stream_calls)})")
+    check("every stream consumer got all items", all(items == expected for items, _ in results))
+
+    # 6. Identical concurrent SQL queries share one execution
+    conn = sqlite3.connect(os.environ["MIMIC_DB_PATH"])
+    conn.execute("CREATE TABLE admissions (subject_id INTEGER, hadm_id INTEGER)")
+    conn.executemany("INSERT INTO admissions VALUES (?, ?)", ((i % 500, i) for i in range(200000)))
+    conn.commit()
+    conn.close()
+
+    before = request_coalescer.get_state()["requests"].get("sql_execution", {}).get("executed", 0)
+    sql = "SELECT subject_id, COUNT(*) FROM admissions a JOIN admissions b USING (subject_id) WHERE a.hadm_id < 3000 GROUP BY subject_id;"
+    results = run_concurrently(lambda i: execute_sql_query(sql if i % 2 else f"  {sql}\n"))
+    executed = request_coalescer.get_state()["requests"]["sql_execution"]["executed"] - before
+    check("every SQL caller got the rows", all(isinstance(r, list) and len(r) == 500 for r in results))
+    check("identical concurrent queries executed fewer times than requested", executed < CALLERS, f"(executed {executed})")
+
+    # 7. Whitespace inside SQL string literals keeps queries apart
+    literal_sql = sql.replace("SELECT subject_id,", "SELECT '{}' AS label,")
+    results = run_concurrently(lambda i: execute_sql_query(literal_sql.format("a  b" if i % 2 else "a b")))
+    check("queries differing inside a literal are not coalesced",
+          all(row[0] == ("a  b" if i % 2 else "a b") for i, result in enumerate(results) for row in result), str([r[0] for r in results]))
+
+    # 8. Blocking and streaming reasoning for the same prompt each get a whole response
+    reasoner = LocalReasonerModel.__new__(LocalReasonerModel)
+    reasoner.model_handler = FakeReasoningModel()
+    reasoner.history_manager = HistoryManager(reasoner.model_handler.count_tokens)
+    prompt = "Evaluate qSOFA for patient 12345"
+
+    def reason(index):
+        time.sleep(0.05 * index)
+        if index % 2:
+            return reasoner.process_reasoning(prompt)
+        events = list(reasoner.stream_reasoning(prompt))
+        return events[-1][1]
+
+    results = run_concurrently(reason, count=4)
+    check("blocking and streaming requests for one prompt all answered",
+          all(isinstance(r, dict) and r.get("answer") == "qSOFA negative" for r in results), str(results))
+
+    # 9. Identical SQL questions share one generation, which stops at the end of the statement
+    generator = SqlGenerationHandler.__new__(SqlGenerationHandler)
+    model = generator.model_handler = FakeSqlModel()
+    results = run_concurrently(lambda i: generator.generate_code("How many admissions are there?" + " " * i), count=4)
+    check("identical SQL questions generated once", len(model.calls) == 1, str(model.calls))
+    check("SQL generation stops at the semicolon or a closing fence",
+          model.calls[0]["stop"] == SQL_STOP == [";", "\n```"], str(model.calls[0]))
+    check("code fence removed from the statement", all(r == "SELECT COUNT(*) FROM admissions;" for r in results), str(results))
+    check("SQL lengths recorded in their own budget", token_budget.get_state()["sql"]["samples"] == 1
+          and token_budget.get_state()["sql"]["tokens_saved_total"] == 188, str(token_budget.get_state()))
+
+    print(f"\nCoalescing state: {request_coalescer.get_state()}")
+
+    return finish("coalescing")
+
+
+def test_coalescing():
+    run_script(__file__)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
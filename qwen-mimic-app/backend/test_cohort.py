@@ -0,0 +1,91 @@
+"""
+Check cohort selection, admission summaries and checkpoint/resume of assess_cohort.py
+against a small temporary SQLite database, without loading a model.
+
+Usage:
+    python test_cohort.py
+"""
+import os
+import sys
+import json
+import sqlite3
+import subprocess
+
+from testing_utils import check, finish, prepare_environment, run_script
+
+# Criteria are only looked up; the store is kept in memory
+work_dir = prepare_environment("cohort_test_")
+
+from app.cohort import select_cohort, admission_context, build_prompt, CohortCheckpoint
+
+
+def main() -> int:
+    db_path = os.path.join(work_dir, "mimic.db")
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""
+        CREATE TABLE admissions (subject_id INTEGER, hadm_id INTEGER, admittime TEXT, dischtime TEXT,
+            admission_type TEXT, admission_location TEXT, discharge_location TEXT, hospital_expire_flag INTEGER);
+        CREATE TABLE patients (subject_id INTEGER, gender TEXT, anchor_age INTEGER);
+        CREATE TABLE diagnoses_icd (subject_id INTEGER, hadm_id INTEGER, seq_num INTEGER, icd_code TEXT);
+    """)
+    for i in range(10):
+        conn.execute("INSERT INTO admissions VALUES (?, ?, '2150-01-01', '2150-01-05', ?, 'EMERGENCY ROOM', 'HOME', 0)",
+                     (100 + i % 5, 2000 + i, "URGENT" if i % 2 else "EW EMER."))
+        conn.execute("INSERT INTO diagnoses_icd VALUES (?, ?, 1, ?)", (100 + i % 5, 2000 + i, "A419" if i < 3 else "I10"))
+    for s in range(5):
+        conn.execute("INSERT INTO patients VALUES (?, 'F', ?)", (100 + s, 60 + s))
+    conn.commit()
+
+    print("Testing cohort assessment helpers...")
+
+    # 1. Cohort selection
+    check("all admissions selected", len(select_cohort(db_path)) == 10)
+    check("where filter applied", [h for h, _ in select_cohort(db_path, where="admission_type = 'URGENT'")] == [2001, 2003, 2005, 2007, 2009])
+    check("full cohort query supported",
+          select_cohort(db_path, sql="SELECT hadm_id, subject_id FROM diagnoses_icd WHERE icd_code LIKE 'A41%';") == [(2000, 100), (2001, 101), (2002, 102)])
+    check("limit applied", len(select_cohort(db_path, limit=4)) == 4)
+
+    # 2. Admission summary and prompt; missing tables are skipped
+    context = admission_context(conn, 2000)
+    prompt = build_prompt("qSOFA", 2000, context)
+    check("summary includes admission, patient and diagnoses",
+          "EW EMER." in context and "age 60" in context and "A419" in context, f"({context!r})")
+    check("prompt carries the admission id for the reasoner", prompt.startswith("Evaluate qSOFA for admission=2000."))
+
+    # 3. Checkpoint: results persist, a cut-off line is ignored, resume skips finished admissions
+    checkpoint = CohortCheckpoint(os.path.join(work_dir, "out", "results.jsonl"))
+    checkpoint.append({"hadm_id": 2000, "criteria": "qSOFA", "answer": "negative", "error": None})
+    checkpoint.append({"hadm_id": 2001, "criteria": "qSOFA", "answer": None, "error": "model failed"})
+    checkpoint.close()
+    with open(checkpoint.path, "a") as f:
+        f.write('{"hadm_id": 2002, "criteria": "qSO')  # killed mid-write
+    check("finished and failed admissions count as done", CohortCheckpoint(checkpoint.path).completed("qSOFA") == {2000, 2001})
+    check("failed admissions retried on request", CohortCheckpoint(checkpoint.path).completed("qSOFA", retry_errors=True) == {2000})
+    check("other criteria are not done", CohortCheckpoint(checkpoint.path).completed("SIRS") == set())
+    resumed = CohortCheckpoint(checkpoint.path)
+    resumed.append({"hadm_id": 2002, "criteria": "qSOFA", "answer": "positive", "error": None})
+    resumed.close()
+    check("appending after a cut-off line keeps the file readable", len(CohortCheckpoint(checkpoint.path).load()) == 3)
+
+    parquet = CohortCheckpoint(os.path.join(work_dir, "results.parquet"))
+    check("parquet output checkpoints to a jsonl file", parquet.path.endswith("results.jsonl"))
+
+    # 4. The CLI resumes from the checkpoint (dry run, no model)
+    output = subprocess.run(
+        [sys.executable, "assess_cohort.py", "--db", db_path, "--output", checkpoint.path, "--dry-run"],
+        capture_output=True, text=True
+    ).stdout
+    check("CLI skips admissions in the checkpoint", "3 already in" in output and "7 to assess" in output, output)
+    check("CLI builds prompts for pending admissions", "Evaluate qSOFA for admission=2003." in output)
+
+    conn.close()
+
+    return finish("cohort")
+
+
+def test_cohort():
+    run_script(__file__)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+"""
+Check the versioned criteria store: versions, persistence, propagation between
+processes and the precompiled prompts, against a temporary SQLite file.
+
+Usage:
+    python test_criteria_store.py
+"""
+import os
+import sys
+import threading
+import subprocess
+
+from testing_utils import check, finish, prepare_environment, run_script
+
+prepare_environment("criteria_store_test_", files={"CRITERIA_STORE_PATH": "criteria.sqlite"}, CRITERIA_SYNC_SECONDS="0")
+
+from app.criteria import (
+    criteria_store,
+    add_custom_criteria,
+    delete_custom_criteria,
+    set_active_criteria,
+    get_active_criteria_key,
+    get_compiled_criteria,
+    get_criteria_versions,
+    build_system_prompt
+)
+
+
+def other_process(code: str) -> str:
+    """Run code against the same store in a separate process (a second worker)"""
+    return subprocess.run(
+        [sys.executable, "-c", "from app.criteria import *\n" + code],
+        capture_output=True, text=True, env=os.environ
+    ).stdout.strip()
+
+
+class FakeHandler:
+    key = ("fake/model", "transformers", "fp32")
+
+    def __init__(self):
+        self.calls = 0
+
+    def encode_message(self, role, content):
+        self.calls += 1
+        return list(range(len(content.split())))
+
+
+def main() -> int:
+    print("Testing the criteria store...")
+
+    # 1. Versions and precompiled prompts
+    check("built-in criteria are version 0", get_compiled_criteria("qSOFA").version == 0)
+    check("built-in criteria cannot be overridden", not add_custom_criteria("SIRS", "SIRS", "x", ["- x"], ""))
+    add_custom_criteria("ward", "Ward score", "Ward alert", ["- Heart rate >90/min"], "≥1 => alert")
+    first = get_compiled_criteria("ward")
+    check("new definition is version 1", first.version == 1)
+    check("system prompt compiled once per version",
+          get_compiled_criteria("ward") is first and first.system_prompt == build_system_prompt(first.definition))
+    handler = FakeHandler()
+    ids = first.token_ids(handler)
+    check("token ids cached per version and model", first.token_ids(handler) is ids and handler.calls == 1)
+    add_custom_criteria("ward", "Ward score", "Ward alert", ["- Heart rate >100/min"], "≥1 => alert")
+    second = get_compiled_criteria("ward")
+    check("redefinition adds a version", second.version == 2 and "100/min" in second.system_prompt)
+    check("new version gets its own prompt", second.system_prompt != first.system_prompt)
+
+    # 2. Persistence and propagation to other workers
+    check("definitions survive a restart", other_process("print(get_compiled_criteria('ward').version)") == "2")
+    other_process("add_custom_criteria('icu', 'ICU score', 'From another worker', ['- Lactate >2'], '')\n"
+                  "set_active_criteria('icu')")
+    check("definitions added by another worker are picked up", get_compiled_criteria("icu") is not None)
+    check("active criteria set by another worker is picked up", get_active_criteria_key() == "icu")
+    check("unchanged versions keep their compiled prompt", get_compiled_criteria("ward") is second)
+
+    # 3. Deletion keeps the history and resets the active criteria
+    check("deleting the active criteria", delete_custom_criteria("icu") and get_active_criteria_key() == "qSOFA")
+    check("deleted criteria are gone", get_compiled_criteria("icu") is None and not delete_custom_criteria("icu"))
+    add_custom_criteria("icu", "ICU score", "Re-added", ["- Lactate >4"], "")
+    versions = [v["version"] for v in get_criteria_versions("icu")]
+    check("version numbers are never reused", versions == [1, 2, 3] and get_compiled_criteria("icu").version == 3,
+          f"(got {versions})")
+    check("other workers see the deletion", other_process("print(get_criteria('icu')['description'])") == "Re-added")
+
+    # 4. Concurrent writers get distinct versions
+    threads = [threading.Thread(target=add_custom_criteria, args=("busy", "Busy", str(i), ["- x"], ""))
+               for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    check("concurrent writes each get a version", [v["version"] for v in get_criteria_versions("busy")] == list(range(1, 9)))
+    set_active_criteria("qSOFA")
+    check("store state reported", criteria_store.get_state()["custom"] == 3)
+
+    return finish("criteria store")
+
+
+def test_criteria_store():
+    run_script(__file__)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""
+Check history compaction and the per-message token count cache, with a word-count
+tokenizer standing in for the model's.
+
+Usage:
+    python test_history.py
+"""
+import sys
+import threading
+
+from testing_utils import check, finish, run_script
+
+from app.history import HistoryManager, MESSAGE_OVERHEAD_TOKENS, REASONING_OMITTED
+
+
+calls = []
+
+
+def count_words(text: str) -> int:
+    calls.append(text)
+    return len(text.split())
+
+
+def conversation(turns: int, thinking_words: int = 50):
+    """System prompt, the patient question, then turns of reasoning and user answers, ending with a new answer"""
+    messages = [{"role": "system", "content": "You assess qSOFA."},
+                {"role": "user", "content": "Evaluate qSOFA for patient 2001"}]
+    for turn in range(turns):
+        messages.append({"role": "assistant",
+                         "content": f"<think>{' step' * thinking_words}</think><search>value {turn}</search>"})
+        messages.append({"role": "user", "content": f"answer {turn}"})
+    return messages
+
+
+def main() -> int:
+    print("Testing history compaction...")
+
+    # 1. Under the budget nothing changes
+    manager = HistoryManager(count_words, token_budget=10000, keep_recent_turns=2)
+    messages = conversation(3)
+    compacted, stats = manager.compact(messages)
+    check("history under the budget kept as is", compacted == messages and stats["prompt_tokens_saved"] == 0)
+
+    # 2. Over the budget: old reasoning goes first, the head and recent turns stay verbatim
+    manager = HistoryManager(count_words, token_budget=300, keep_recent_turns=2)
+    messages = conversation(6)
+    compacted, stats = manager.compact(messages)
+    check("compacted history fits the budget", stats["prompt_tokens_after"] <= 300 < stats["prompt_tokens_before"], str(stats))
+    check("system prompt and patient question kept", compacted[:2] == messages[:2])
+    check("recent turns kept verbatim", compacted[-5:] == messages[-5:])
+    check("older reasoning stripped", all("<think>" not in m["content"] for m in compacted[2:-5])
+          and any("<search>value 0</search>" == m["content"] for m in compacted), str(compacted[2:-5]))
+
+    # 3. A tight budget drops the oldest turns and leaves a note
+    manager = HistoryManager(count_words, token_budget=160, keep_recent_turns=1)
+    compacted, stats = manager.compact(conversation(8))
+    check("oldest turns dropped with a note", any(m["role"] == "system" and "earlier messages omitted" in m["content"]
+                                                  for m in compacted), str(compacted))
+    check("newest message never dropped", compacted[-1] == {"role": "user", "content": "answer 7"})
+
+    # 4. A reasoning-only assistant message keeps a placeholder, so roles still alternate
+    messages = conversation(5)
+    messages[2] = {"role": "assistant", "content": f"<think>{' step' * 50}</think>"}
+    for budget in (150, 120):
+        compacted, stats = HistoryManager(count_words, token_budget=budget, keep_recent_turns=1).compact(messages)
+        roles = [m["role"] for m in compacted if m["role"] != "system"]
+        check(f"user and assistant still alternate (budget {budget})", stats["prompt_tokens_after"] <= budget
+              and all(a != b for a, b in zip(roles, roles[1:])), str(compacted))
+        check(f"no empty assistant message (budget {budget})", all(m["content"] for m in compacted))
+        if budget == 150:
+            check("reasoning-only message replaced by a placeholder", compacted[2] == {"role": "assistant", "content": REASONING_OMITTED},
+                  str(compacted[2]))
+
+    # 5. Token counts are cached per message content, least recently used first out
+    manager = HistoryManager(count_words, token_budget=0, cache_size=2)
+    calls.clear()
+    one, two, three = ({"role": "user", "content": text} for text in ("one", "two words", "three more words"))
+    check("count includes the chat template overhead", manager.message_tokens(two) == 2 + MESSAGE_OVERHEAD_TOKENS)
+    manager.message_tokens(one)
+    manager.message_tokens(two)
+    check("repeated message counted from the cache", calls == ["two words", "one"], str(calls))
+    manager.message_tokens(three)
+    manager.message_tokens(two)
+    manager.message_tokens(one)
+    check("least recently used count evicted", calls == ["two words", "one", "three more words", "one"], str(calls))
+
+    # 6. The cache stays consistent when shared by concurrent requests
+    manager = HistoryManager(count_words, token_budget=0, cache_size=64)
+    errors = []
+
+
+    def worker(offset: int):
+        try:
+            for i in range(2000):
+                text = " ".join(["word"] * ((i + offset) % 100 + 1))
+                if manager.message_tokens({"role": "user", "content": text}) != (i + offset) % 100 + 1 + MESSAGE_OVERHEAD_TOKENS:
+                    errors.append(text)
+        except Exception as e:
+            errors.append(repr(e))
+
+
+    threads = [threading.Thread(target=worker, args=(n * 7,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    check("concurrent counts correct and cache bounded", not errors and len(manager._token_counts) <= 64,
+          f"{errors[:3]} {len(manager._token_counts)}")
+
+    return finish("history")
+
+
+def test_history():
+    run_script(__file__)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
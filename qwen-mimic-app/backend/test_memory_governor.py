@@ -0,0 +1,140 @@
+"""
+Exercise the memory governor with artificially low limits, without loading any model.
+
+Sets the limit just above the current RSS of this process and checks that the
+governor caps max_tokens, shrinks batches, releases registered caches, keeps idle
+models loaded under soft pressure, refuses generations that cannot fit, and refuses
+query results over the result budget.
+
+Usage:
+    python test_memory_governor.py
+"""
+import os
+import sys
+import sqlite3
+
+from testing_utils import check, finish, prepare_environment, run_script
+
+# A small SQLite database standing in for MIMIC, created before the app reads its config
+prepare_environment("memory_governor_test_", files={"MIMIC_DB_PATH": "test.db"}, MEMORY_CHECK_SECONDS="0")
+
+from app.memory_governor import memory_governor, MemoryPressureError, MIN_GENERATION_TOKENS, EXPENSIVE_EVICTOR_PRIORITY
+from app.query import execute_sql_query
+
+MB = 1024 ** 2
+KV_BYTES = 64 * 1024  # per token
+
+
+def set_headroom(headroom_bytes: int, soft_headroom_bytes: int = None):
+    """Set limits so the hard limit is headroom_bytes above the current RSS"""
+    rss = memory_governor.rss_reader()
+    memory_governor.hard_fraction = 1.0
+    memory_governor.limit_bytes = rss + headroom_bytes
+    soft = rss + (soft_headroom_bytes if soft_headroom_bytes is not None else headroom_bytes)
+    memory_governor.soft_fraction = soft / memory_governor.limit_bytes
+
+
+def main() -> int:
+    print("Testing memory governor with artificially low limits...")
+
+    # 1. Plenty of room: the request is unchanged
+    set_headroom(1024 * MB)
+    check("no cap with enough memory", memory_governor.admit_generation(500, 1000, KV_BYTES) == 1000)
+    check("batch size unchanged", memory_governor.batch_size(16) == 16)
+
+    # 2. Room for ~300 tokens: max_tokens is capped to what fits
+    set_headroom(800 * KV_BYTES)
+    allowed = memory_governor.admit_generation(500, 1000, KV_BYTES)
+    check("max_tokens capped to the available KV cache", MIN_GENERATION_TOKENS <= allowed <= 300, f"(got {allowed})")
+
+    # 3. Above the soft limit: budgets and batches are halved
+    set_headroom(1024 * MB, soft_headroom_bytes=-1)
+    check("max_tokens halved above the soft limit", memory_governor.admit_generation(100, 1000, KV_BYTES) == 500)
+    check("batch size halved above the soft limit", memory_governor.batch_size(16) == 8)
+
+    # 4. No room at all: caches are released first, then the request is refused
+    ballast = {"data": bytearray(64 * MB)}
+
+
+    def release_ballast() -> int:
+        if ballast["data"] is None:
+            return 0
+        ballast["data"] = None
+        return 64 * MB
+
+
+    memory_governor.register_evictor("test_ballast", release_ballast)
+    set_headroom(0)
+    runs_before = memory_governor.stats["relief_runs"]
+    try:
+        memory_governor.admit_generation(4000, 1000, KV_BYTES)
+        refused = False
+    except MemoryPressureError as e:
+        refused = True
+        print(f"   refused: {e}")
+    check("registered cache released under pressure", ballast["data"] is None and memory_governor.stats["relief_runs"] > runs_before)
+    check("oversized generation refused", refused)
+    # Releasing the ballast lowered RSS, so squeeze the limit again
+    set_headroom(-1)
+    check("batch size is 1 above the hard limit", memory_governor.batch_size(16) == 1)
+
+    # 5. Soft pressure only releases cheap caches, once until RSS falls below the resume threshold
+    calls = {"sessions": 0, "models": 0}
+
+
+    def count_call(name: str):
+        def evictor() -> int:
+            calls[name] += 1
+            return 0
+        return evictor
+
+
+    memory_governor.register_evictor("test_sessions", count_call("sessions"))
+    memory_governor.register_evictor("test_models", count_call("models"), priority=EXPENSIVE_EVICTOR_PRIORITY)
+    set_headroom(1024 * MB, soft_headroom_bytes=-1)
+    memory_governor.check_pressure()
+    memory_governor.check_pressure()
+    check("idle model survives soft pressure", calls["models"] == 0, str(calls))
+    check("cheap caches released once under soft pressure", calls["sessions"] == 1, str(calls))
+    check("generation that fits keeps idle models", memory_governor.admit_generation(10, 100, KV_BYTES) > 0 and calls["models"] == 0)
+    set_headroom(1024 * MB, soft_headroom_bytes=int(memory_governor.resume_margin * (memory_governor.rss_reader() + 1024 * MB)) // 2)
+    memory_governor.check_pressure()
+    check("no release between the resume threshold and the soft limit", calls["sessions"] == 2, str(calls))
+    set_headroom(1024 * MB)
+    memory_governor.check_pressure()
+    set_headroom(1024 * MB, soft_headroom_bytes=-1)
+    memory_governor.check_pressure()
+    check("cheap caches released again after RSS recovered", calls["sessions"] == 3, str(calls))
+    set_headroom(-1)
+    memory_governor.check_pressure()
+    check("idle models unloaded above the hard limit", calls["models"] == 1, str(calls))
+
+    # 6. Query results over the result budget are refused instead of materialized
+    conn = sqlite3.connect(os.environ["MIMIC_DB_PATH"])
+    conn.execute("CREATE TABLE notes (id INTEGER, text TEXT)")
+    conn.executemany("INSERT INTO notes VALUES (?, ?)", ((i, "x" * 200) for i in range(20000)))
+    conn.commit()
+    conn.close()
+
+    set_headroom(1024 * MB)
+    memory_governor.max_result_bytes = 1 * MB
+    try:
+        execute_sql_query("SELECT * FROM notes;")
+        refused = False
+    except MemoryPressureError as e:
+        refused = True
+        print(f"   refused: {e}")
+    check("oversized query result refused", refused)
+    check("small query result allowed", len(execute_sql_query("SELECT * FROM notes LIMIT 100;")) == 100)
+
+    print(f"\nGovernor state: {memory_governor.get_state()}")
+
+    return finish("memory governor")
+
+
+def test_memory_governor():
+    run_script(__file__)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
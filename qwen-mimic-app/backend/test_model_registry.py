@@ -0,0 +1,169 @@
+"""
+Exercise the model registry with stand-in loaders, without loading any model.
+
+Checks that handlers are shared per key (including the draft model), that the memory
+budget is enforced least-recently-used first and before a first load using the size
+estimate, that idle models are unloaded after the TTL, that a failed load raises
+instead of retrying forever, that a model reserved by a request is not unloaded, and
+that sizing a request and counting tokens never load a model.
+
+Usage:
+    python test_model_registry.py
+"""
+import sys
+import time
+
+from testing_utils import check, finish, run_script
+
+from app.model_registry import model_registry, estimate_model_bytes
+
+GB = 1024 ** 3
+
+
+class FakeHandler:
+    def __init__(self, name: str, size_gb: float):
+        self.name = name
+        self.memory_bytes = int(size_gb * GB)
+        self.kv_bytes_per_token = 1024
+
+    def count_tokens(self, text: str) -> int:
+        return len(text.split())
+
+    def encode_message(self, role: str, content: str):
+        return [role] + content.split()
+
+
+class FakeTokenizer(FakeHandler):
+    def __init__(self):
+        super().__init__("tokenizer", 0)
+
+
+loads = []
+
+
+def loader(name: str, size_gb: float):
+    def load():
+        loads.append(name)
+        return FakeHandler(name, size_gb)
+    return load
+
+
+def use(handle):
+    """Acquire and release a model the way a request does"""
+    handler = model_registry.acquire(handle.key)
+    model_registry.release(handle.key)
+    return handler
+
+
+def loaded():
+    return [m["model"] for m in model_registry.get_state()["models"] if m["loaded"]]
+
+
+def main() -> int:
+    print("Testing model registry with stand-in loaders...")
+    model_registry.idle_ttl = 0
+    model_registry.budget_bytes = 5 * GB
+
+    # 1. One handler per key; the draft model is part of the key
+    a = model_registry.register(("fake/a", "transformers", "fp32", ""), loader("a", 2))
+    check("same key returns the same entry", model_registry.register(("fake/a", "transformers", "fp32", ""), loader("a2", 2)).key == a.key
+          and len([k for k in model_registry.entries if k[0] == "fake/a"]) == 1)
+    a_draft = model_registry.register(("fake/a", "transformers", "fp32", "fake/draft"), loader("a+draft", 2))
+    check("draft model gets its own entry", use(a).name == "a" and use(a_draft).name == "a+draft", str(loads))
+    check("handler loaded once and shared", use(a) is use(a) and loads.count("a") == 1, str(loads))
+
+    # 2. Budget: least recently used idle models are unloaded first
+    b = model_registry.register(("fake/b", "transformers", "fp32", ""), loader("b", 2))
+    use(a)
+    use(b)
+    check("least recently used model unloaded over the budget", loaded() == ["fake/a", "fake/b"]
+          and model_registry.loaded_bytes() <= model_registry.budget_bytes, str(loaded()))
+    model_registry.acquire(b.key)
+    c = model_registry.register(("fake/c", "transformers", "fp32", ""), loader("c", 2))
+    use(c)
+    check("model in use is not unloaded", "fake/b" in loaded() and "fake/a" not in loaded(), str(loaded()))
+    model_registry.release(b.key)
+
+    # 3. A first load makes room using the size estimated from the model name
+    check("size estimated from the parameter count", estimate_model_bytes(("org/Model-3B-Chat", "transformers", "bf16", "")) == 6 * 10 ** 9
+          and estimate_model_bytes(("org/Model-3B", "transformers", "fp32", "org/Draft-0.5B")) == 14 * 10 ** 9)
+    big = model_registry.register(("fake/Big-0.5B", "transformers", "fp32", ""), loader("big", 0))
+    before = loaded()
+    sizes_seen = []
+    big_entry = model_registry.entries[big.key]
+    big_entry.loader = lambda: sizes_seen.append(model_registry.loaded_bytes()) or FakeHandler("big", 0)
+    use(big)
+    check("room made before the first load", before == ["fake/b", "fake/c"] and sizes_seen == [2 * GB]
+          and "fake/c" not in loaded(), f"{before} {sizes_seen}")
+
+    # 4. Idle models are unloaded after the TTL
+    model_registry.budget_bytes = 0
+    use(a)
+    model_registry.idle_ttl = 0.2
+    time.sleep(0.3)
+    use(c)
+    evicted = model_registry.evict_idle()
+    check("idle models unloaded after the TTL", ("fake/a", "transformers", "fp32", "") in evicted and "fake/c" in loaded(), str(evicted))
+    model_registry.idle_ttl = 0
+
+    # 5. A failed load raises instead of retrying forever
+    broken = model_registry.register(("fake/broken", "transformers", "fp32", ""), lambda: None)
+    try:
+        model_registry.acquire(broken.key)
+        raised = False
+    except RuntimeError:
+        raised = True
+    check("load returning no handler raises", raised and model_registry.entries[broken.key].in_use == 0)
+    failing = model_registry.register(("fake/failing", "transformers", "fp32", ""), lambda: 1 / 0)
+    try:
+        model_registry.acquire(failing.key)
+        raised = False
+    except ZeroDivisionError:
+        raised = True
+    check("loader error propagates", raised)
+
+    # 6. A reserved model survives memory relief and the budget until the request is done
+    model_registry.budget_bytes = 5 * GB
+    use(a)
+    use(c)
+    with model_registry.reserved(a.key):
+        freed = [model_registry.release_memory() for _ in range(3)]
+        check("reserved model not unloaded under memory pressure", "fake/a" in loaded() and "fake/c" not in loaded(), f"{loaded()} {freed}")
+        check("reserving does not load a model", c.key not in [k for k, e in model_registry.entries.items() if e.is_loaded]
+              and model_registry.entries[c.key].reserved == 0)
+        with model_registry.reserved(c.key):
+            check("reserving an unloaded model leaves it unloaded", "fake/c" not in loaded())
+        check("evict skips a reserved model", not model_registry.evict(a.key))
+    check("reservation released", model_registry.entries[a.key].reserved == 0 and model_registry.evict(a.key))
+    with model_registry.reserved(("fake/unregistered", "transformers", "fp32", "")):
+        check("unregistered keys are ignored", True)
+
+    # 7. Probes, token counts and request sizing do not load the model
+    tokenizers = []
+    t = model_registry.register(("fake/t", "transformers", "fp32", ""), loader("t", 1),
+                                tokenizer_loader=lambda: tokenizers.append(1) or FakeTokenizer())
+    check("probes do not load the model", getattr(t, "token_cache", None) is None and t.kv_bytes_per_token is None
+          and "fake/t" not in loaded() and "t" not in loads, str(loads))
+    check("tokens counted with the tokenizer alone", t.count_tokens("a b c") == 3 and t.encode_message("system", "x y") == ["system", "x", "y"]
+          and tokenizers == [1] and "t" not in loads, f"{tokenizers} {loads}")
+    use(t)
+    check("attributes forwarded once loaded", t.name == "t" and t.kv_bytes_per_token == 1024)
+    model_registry.evict(t.key)
+    check("bytes per token remembered after an unload", t.kv_bytes_per_token == 1024 and "fake/t" not in loaded())
+    t.count_tokens("a")
+    check("tokenizer loaded once and kept across unloads", tokenizers == [1] and loads.count("t") == 1, str(tokenizers))
+    c_loads = loads.count("c")
+    check("without a tokenizer loader, counting tokens loads the model", "fake/c" not in loaded() and c.count_tokens("a b") == 2
+          and loads.count("c") == c_loads + 1, str(loads))
+
+    print(f"\nRegistry state: {model_registry.get_state()}")
+
+    return finish("model registry")
+
+
+def test_model_registry():
+    run_script(__file__)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""
+Check per-request criteria selection and multi-criteria fan-out with a stand-in model,
+without downloading or loading anything.
+
+Usage:
+    python test_multi_criteria.py
+"""
+import sys
+
+from testing_utils import check, finish, prepare_environment, run_script
+
+prepare_environment("multi_criteria_test_")
+
+from app.reasoner import LocalReasonerModel
+from app.history import HistoryManager
+from app.sessions import session_store
+from app.section_parser import parse_sections
+from app.criteria import get_active_criteria_key, build_system_prompt, DEFAULT_CRITERIA, REASONING_INSTRUCTIONS
+
+
+class FakeModel:
+    """Answers with the criteria name found in the system prompt"""
+    key = ("fake/model", "transformers", "fp32")
+    backend = "transformers"
+
+    def __init__(self):
+        self.batches = []
+        self.system_prompts = []
+
+    def _result(self, messages):
+        system = messages[0]["content"]
+        self.system_prompts.append(system)
+        name = system.split("Answer the ")[1].split(" assessment")[0]
+        text = f"<think>Checking {name}</think><answer>{name} negative</answer>"
+        return {"text": text, "backend": self.backend, "num_tokens": 8, "stopped_on": "</answer>", "tokens_saved": 0}
+
+    def generate_batch(self, conversations, **kwargs):
+        self.batches.append(len(conversations))
+        return [self._result(messages) for messages in conversations]
+
+    def generate(self, messages, **kwargs):
+        return self._result(messages)
+
+    def extract_sections(self, text):
+        return parse_sections(text)
+
+    def count_tokens(self, text):
+        return len(text.split())
+
+
+def main() -> int:
+    reasoner = LocalReasonerModel.__new__(LocalReasonerModel)
+    model = reasoner.model_handler = FakeModel()
+    reasoner.history_manager = HistoryManager(model.count_tokens)
+    prompt = "Assess patient 12345: respiratory rate 24, systolic blood pressure 95 mmHg, temperature 38.6"
+
+    print("Testing per-request criteria and multi-criteria fan-out...")
+
+    # 1. Per-request criteria leave the global selection alone
+    active = get_active_criteria_key()
+    result = reasoner.process_reasoning(prompt, criteria_key="SIRS")
+    check("request assessed against its own criteria", result["criteria_used"] == "SIRS" and result["answer"] == "SIRS negative")
+    check("global active criteria unchanged", get_active_criteria_key() == active)
+    try:
+        reasoner.process_reasoning(prompt, criteria_key="no-such-criteria")
+        check("unknown criteria rejected", False)
+    except ValueError:
+        check("unknown criteria rejected", True)
+
+    # 2. Sessions keep the criteria set of their first turn
+    session = session_store.create()
+    reasoner.process_reasoning(prompt, session=session, criteria_key="Sepsis-3")
+    follow_up = reasoner.process_reasoning("Lactate is 3.1", session=session)
+    check("session follow-up keeps its criteria", follow_up["criteria_used"] == "Sepsis-3")
+    session_store.delete(session.session_id)
+
+    # 3. Fan-out: one batched generation, one result per criteria set, in order
+    model.batches.clear()
+    model.system_prompts.clear()
+    fan_out = reasoner.process_multi_criteria(prompt, ["qSOFA", "SIRS", "Sepsis-3", "SIRS"])
+    results = fan_out["results"]
+    check("all criteria generated in one batch", model.batches == [3], f"(got {model.batches})")
+    check("one result per criteria set in order", [r["criteria_key"] for r in results] == ["qSOFA", "SIRS", "Sepsis-3"])
+    check("each result answers its own criteria", all(r["answer"] == f"{r['criteria_used']} negative" for r in results))
+    check("patient id reported once", fan_out["patient_id"] == "12345")
+    check("each criteria prompt has the shared instructions",
+          all(REASONING_INSTRUCTIONS in p for p in model.system_prompts) and len(model.system_prompts) == 3)
+
+    # 4. A failing criteria set is reported without dropping the others
+    fan_out = reasoner.process_multi_criteria(prompt, ["qSOFA", "no-such-criteria"])
+    check("unknown criteria reported per result",
+          "error" in fan_out["results"][1] and fan_out["results"][0]["answer"] == "qSOFA negative")
+
+    # 5. The system prompt keeps the wording and order of the original reasoner prompt
+    expected = (
+        "Answer the qSOFA assessment question based on the criteria provided below.\n"
+        "You must conduct reasoning inside <think> and </think> first every time you get new information.\n"
+        "After reasoning, if you find you lack some knowledge, you can call a search engine by <search> query </search>, and it will return the top searched results between <information> and </information>.\n"
+        "You can search as many times as you want. If you find no further external knowledge needed, you can directly provide the answer inside <answer> and </answer> without detailed illustrations. Example: <answer> Assessment complete, patient shows signs of respiratory distress </answer>\n\n"
+        "qSOFA criteria to consider:\n"
+        "- Respiratory Rate (RR) ≥ 22 breaths/min\n"
+        "- Systolic Blood Pressure (SBP) ≤ 100 mmHg\n"
+        "- Altered mentation (GCS verbal response is not \"Oriented\")\n"
+        "\nThreshold rule: ≥2 => qSOFA\n"
+        "Apply this threshold rule in your assessment.\n"
+    )
+    check("system prompt identical to the original", build_system_prompt(DEFAULT_CRITERIA["qSOFA"]) == expected)
+
+    return finish("multi-criteria")
+
+
+def test_multi_criteria():
+    run_script(__file__)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+"""
+Check the compact patient-context encoder: criteria item filtering, relative times,
+units, collapsed repeats and the token budget, against a temporary SQLite database.
+
+Usage:
+    python test_patient_context.py
+"""
+import os
+import sys
+import sqlite3
+
+from testing_utils import check, finish, prepare_environment, run_script
+
+work_dir = prepare_environment("patient_context_test_")
+
+from app.criteria import get_compiled_criteria
+from app.patient_context import criteria_measurements, encode_patient_context, estimate_tokens
+
+
+def main() -> int:
+    db_path = os.path.join(work_dir, "mimic.db")
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""
+        CREATE TABLE admissions (subject_id INTEGER, hadm_id INTEGER, admittime TEXT, dischtime TEXT,
+            admission_type TEXT, admission_location TEXT, discharge_location TEXT, hospital_expire_flag INTEGER);
+        CREATE TABLE diagnoses_icd (subject_id INTEGER, hadm_id INTEGER, seq_num INTEGER, icd_code TEXT);
+        CREATE TABLE chartevents (subject_id INTEGER, hadm_id INTEGER, itemid INTEGER, charttime TEXT, valuenum REAL);
+        CREATE TABLE labevents (subject_id INTEGER, hadm_id INTEGER, itemid INTEGER, charttime TEXT, valuenum REAL, flag TEXT);
+        INSERT INTO admissions VALUES (1, 100, '2150-01-01 10:00:00', '2150-01-04 10:00:00', 'EW EMER.', 'EMERGENCY ROOM', 'HOME', 0);
+        INSERT INTO diagnoses_icd VALUES (1, 100, 1, 'A419');
+        INSERT INTO chartevents VALUES
+            (1, 100, 220210, '2150-01-01 12:00:00', 18), (1, 100, 220210, '2150-01-01 13:00:00', 18),
+            (1, 100, 220210, '2150-01-01 14:00:00', 18), (1, 100, 220210, '2150-01-01 16:30:00', 24),
+            (1, 100, 220179, '2150-01-01 12:00:00', 95),
+            (1, 100, 223761, '2150-01-01 12:00:00', 102.2),
+            (1, 100, 220277, '2150-01-01 12:00:00', 91);
+        INSERT INTO labevents VALUES (1, 100, 51301, '2150-01-01 09:00:00', 14.2, 'abnormal');
+    """)
+    conn.commit()
+
+    print("Testing patient context encoding...")
+
+    # 1. Token estimate and the measurements each criteria needs
+    check("digits count one token each", estimate_tokens("HR 112, RR 24") == 8, str(estimate_tokens("HR 112, RR 24")))
+    qsofa, sirs = get_compiled_criteria("qSOFA").rule_set, get_compiled_criteria("SIRS").rule_set
+    check("qSOFA needs only its rule measurements", criteria_measurements(qsofa) == ["resp_rate", "sbp", "gcs_verbal"])
+    check("criteria without rules keep every measurement", "wbc" in criteria_measurements(None))
+
+    # 2. Compact table: only the criteria's items, times relative to admission, unit once, repeats collapsed
+    context = encode_patient_context(conn, 100, qsofa, max_tokens=0)
+    text = context["text"]
+    check("admission summary included", "A419" in text and "EW EMER." in text, text)
+    check("repeated readings collapse into one span", "resp_rate (breaths/min): 2..4h 18, 6.5h 24" in text, text)
+    check("items the criteria does not use are left out", "temperature" not in text and "wbc" not in text and "91" not in text, text)
+    sirs_text = encode_patient_context(conn, 100, sirs, max_tokens=0)["text"]
+    check("values converted to the rule units", "temperature (°C): 2h 39" in sirs_text, sirs_text)
+    check("readings before admission and lab flags kept", "wbc (K/uL): -1h 14.2*" in sirs_text, sirs_text)
+
+    # 3. Token budget: long histories are thinned, keeping the extremes and the latest reading
+    conn.executemany("INSERT INTO chartevents VALUES (1, 100, 220045, ?, ?)",
+                     [(f"2150-01-{1 + h // 24:02d} {h % 24:02d}:00:00", 80 + (h * 7) % 30) for h in range(10, 70)])
+    conn.execute("INSERT INTO chartevents VALUES (1, 100, 220045, '2150-01-03 22:00:00', 150)")
+    conn.commit()
+    full = encode_patient_context(conn, 100, sirs, max_tokens=0)
+    budget = full["tokens"] // 2
+    thinned = encode_patient_context(conn, 100, sirs, max_tokens=budget)
+    check("context fits the budget", thinned["tokens"] <= budget < full["tokens"], f"{thinned['tokens']} > {budget}")
+    check("readings were thinned", thinned["max_points"] is not None and full["max_points"] is None)
+    heart_rate = next(line for line in thinned["text"].split("\n") if line.startswith("heart_rate"))
+    check("extremes and latest reading kept", "60h 150" in heart_rate and "20h 80" in heart_rate, heart_rate)
+    tiny = encode_patient_context(conn, 100, sirs, max_tokens=60)
+    check("summary sections dropped before readings", "A419" not in tiny["text"] and "heart_rate" in tiny["text"], tiny["text"])
+
+    conn.close()
+
+    return finish("patient context")
+
+
+def test_patient_context():
+    run_script(__file__)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
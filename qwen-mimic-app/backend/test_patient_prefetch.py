@@ -0,0 +1,189 @@
+"""
+Check the patient record prefetcher: concurrent non-blocking loads encoded with the
+compact patient-context encoder, the LRU+TTL cache, and the record joining the
+reasoner's prompt once it is ready, with a stand-in model and a temporary SQLite database.
+
+Usage:
+    python test_patient_prefetch.py
+"""
+import os
+import sys
+import time
+import sqlite3
+
+from testing_utils import check, finish, prepare_environment, run_script
+
+work_dir = prepare_environment("prefetch_test_", files={"MIMIC_DB_PATH": "mimic.db", "RESPONSE_CACHE_PATH": "responses.sqlite"},
+                               PATIENT_PREFETCH="true", PATIENT_CONTEXT_MAX_TOKENS="1024")
+db_path = os.environ["MIMIC_DB_PATH"]
+
+from app.prefetch import patient_prefetcher, RECORD_HEADER
+from app.patient_context import encode_patient_context
+from app.criteria import get_compiled_criteria
+from app.reasoner import LocalReasonerModel
+from app.history import HistoryManager
+from app.section_parser import parse_sections
+
+
+def main() -> int:
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""
+        CREATE TABLE admissions (subject_id INTEGER, hadm_id INTEGER, admittime TEXT, dischtime TEXT,
+            admission_type TEXT, admission_location TEXT, discharge_location TEXT, hospital_expire_flag INTEGER);
+        CREATE TABLE diagnoses_icd (subject_id INTEGER, hadm_id INTEGER, seq_num INTEGER, icd_code TEXT);
+        CREATE TABLE prescriptions (subject_id INTEGER, hadm_id INTEGER, starttime TEXT, drug TEXT);
+        CREATE TABLE chartevents (subject_id INTEGER, hadm_id INTEGER, itemid INTEGER, charttime TEXT, valuenum REAL);
+        INSERT INTO admissions VALUES
+            (10, 2001, '2150-01-01 08:00:00', '2150-01-05 12:00:00', 'EW EMER.', 'EMERGENCY ROOM', 'HOME', 0),
+            (10, 2002, '2151-03-01 08:00:00', '2151-03-02 12:00:00', 'URGENT', 'TRANSFER', 'DIED', 1),
+            (11, 2003, '2150-06-01 08:00:00', '2150-06-03 12:00:00', 'URGENT', 'CLINIC', 'HOME', 0);
+        INSERT INTO diagnoses_icd VALUES (10, 2001, 1, 'A419'), (10, 2001, 2, 'N179'), (11, 2003, 1, 'I10');
+        INSERT INTO prescriptions VALUES (10, 2001, '2150-01-01 09:00:00', 'Vancomycin'), (10, 2001, '2150-01-01 10:00:00', 'Vancomycin');
+        INSERT INTO chartevents VALUES
+            (10, 2001, 220210, '2150-01-01 10:00:00', 24), (10, 2001, 220179, '2150-01-01 10:00:00', 95),
+            (10, 2001, 220045, '2150-01-01 10:00:00', 112), (10, 2002, 220210, '2151-03-01 09:00:00', 30);
+    """)
+    conn.commit()
+
+    qsofa, sirs = get_compiled_criteria("qSOFA").rule_set, get_compiled_criteria("SIRS").rule_set
+
+    # Each admission takes 0.3 s to encode, so a subject's admissions one after another take 0.6 s
+    _encode = patient_prefetcher._encode
+
+
+    def slow_encode(hadm_id, rule_set, max_tokens):
+        time.sleep(0.3)
+        return _encode(hadm_id, rule_set, max_tokens)
+
+
+    patient_prefetcher._encode = slow_encode
+
+    print("Testing patient record prefetch...")
+
+    # 1. Loads run in the background and reuse the compact patient-context encoder
+    start = time.perf_counter()
+    future = patient_prefetcher.prefetch(2001, qsofa)
+    check("prefetch returns without waiting", time.perf_counter() - start < 0.1)
+    check("record not served while loading", patient_prefetcher.get(2001, qsofa) is None)
+    check("load in flight is shared", patient_prefetcher.prefetch("2001", qsofa) is future)
+    record = future.result(timeout=5)
+    expected = encode_patient_context(conn, 2001, qsofa, max_tokens=patient_prefetcher.max_tokens)
+    check("record is the encoded patient context", record["text"] == f"{RECORD_HEADER}\n{expected['text']}", record["text"])
+    check("admission summary and criteria readings included", "A419; N179" in record["text"]
+          and "resp_rate (breaths/min): 2h 24" in record["text"], record["text"])
+    check("readings the criteria does not use left out", "heart_rate" not in record["text"] and "112" not in record["text"])
+    check("record within the token budget", record["admissions"] == [2001] and 0 < record["tokens"] <= patient_prefetcher.max_tokens)
+    check("ready record served from the cache", patient_prefetcher.get(2001, qsofa) is record)
+    check("other criteria get their own record", patient_prefetcher.get(2001, sirs) is None
+          and "heart_rate" in patient_prefetcher.prefetch(2001, sirs).result(timeout=5)["text"])
+
+    start = time.perf_counter()
+    subject = patient_prefetcher.prefetch(10, qsofa).result(timeout=5)
+    check("subject id loads every admission", subject["admissions"] == [2001, 2002]
+          and "Admission 2002:" in subject["text"] and "died in hospital" in subject["text"], subject["text"])
+    check("admissions encoded concurrently", time.perf_counter() - start < 0.55, f"{time.perf_counter() - start:.2f}s")
+    check("unknown patient cached as empty", patient_prefetcher.prefetch(999, qsofa).result(timeout=5)["text"] == "")
+    check("non-numeric id not prefetched", patient_prefetcher.prefetch("unknown", qsofa) is None)
+
+    # 2. LRU and TTL
+    patient_prefetcher.invalidate()
+    patient_prefetcher.max_entries = 2
+    for patient_id in (2001, 2003, 2002):
+        patient_prefetcher.prefetch(patient_id, qsofa).result(timeout=5)
+    check("least recently used patient evicted", patient_prefetcher.get(2001, qsofa) is None
+          and patient_prefetcher.get(2002, qsofa) is not None)
+    patient_prefetcher.ttl_seconds = 0.2
+    time.sleep(0.3)
+    check("expired record not served", patient_prefetcher.get(2002, qsofa) is None and patient_prefetcher.get_state()["expired"] >= 1)
+    patient_prefetcher.max_entries, patient_prefetcher.ttl_seconds = 256, 600
+
+    # 3. A failed load is not cached
+    patient_prefetcher.invalidate()
+    patient_prefetcher.db_path = os.path.join(work_dir, "missing.db")
+    try:
+        patient_prefetcher.prefetch(2003, qsofa).result(timeout=5)
+        check("failed load raises", False)
+    except RuntimeError:
+        check("failed load raises", True)
+    patient_prefetcher.db_path = db_path
+    check("failed load retried on the next turn", patient_prefetcher.prefetch(2003, qsofa).result(timeout=5)["admissions"] == [2003])
+    conn.close()
+
+
+    # 4. The reasoner never waits for the record, and later turns get it from the cache
+    class FakeModel:
+        key = ("fake/model", "transformers", "fp32")
+        backend = "transformers"
+
+        def __init__(self):
+            self.prompts = []
+
+        def generate(self, messages, **kwargs):
+            self.prompts.append(messages[-1]["content"])
+            return {"text": "<think>Need vitals</think><search>respiratory rate</search>", "backend": self.backend,
+                    "num_tokens": 6, "stopped_on": None, "tokens_saved": 0}
+
+        def extract_sections(self, text):
+            return parse_sections(text)
+
+        def count_tokens(self, text):
+            return len(text.split())
+
+
+    reasoner = LocalReasonerModel.__new__(LocalReasonerModel)
+    model = reasoner.model_handler = FakeModel()
+    reasoner.history_manager = HistoryManager(model.count_tokens)
+    patient_prefetcher.invalidate()
+    state = patient_prefetcher.get_state()
+
+    start = time.perf_counter()
+    first = reasoner.process_reasoning("Evaluate qSOFA for patient 2001", criteria_key="qSOFA")
+    check("first turn generates without waiting for the database", time.perf_counter() - start < 0.25,
+          f"{time.perf_counter() - start:.2f}s")
+    check("record not in the first prompt", RECORD_HEADER not in model.prompts[-1] and first["patient_record"] is False)
+    patient_prefetcher.prefetch(2001, qsofa).result(timeout=5)
+
+    second = reasoner.process_reasoning("RR 24", first["conversation_history"], criteria_key="qSOFA")
+    check("second turn gets the record from the cache", RECORD_HEADER in model.prompts[-1] and second["patient_record"] is True,
+          model.prompts[-1])
+    check("record kept in the conversation history", RECORD_HEADER in second["conversation_history"][-2]["content"])
+    third = reasoner.process_reasoning("SBP 95", second["conversation_history"], criteria_key="qSOFA")
+    check("record added only once", RECORD_HEADER not in model.prompts[-1] and third["patient_record"] is False)
+    after = patient_prefetcher.get_state()
+    check("later turns hit the cache", after["misses"] - state["misses"] == 1 and after["hits"] - state["hits"] >= 2, str(after))
+
+    # 5. Prompts that already carry patient information get no record
+    patient_prefetcher.invalidate()
+    misses = patient_prefetcher.get_state()["misses"]
+    cohort = reasoner.process_reasoning("Evaluate qSOFA for admission=2001.\nPatient information:\nAdmission: EW EMER.",
+                                        criteria_key="qSOFA")
+    check("no record for a prompt with patient information", cohort["patient_record"] is False
+          and patient_prefetcher.get_state()["misses"] == misses)
+
+    # 6. Deterministic steps wait for the record, and whether it was ready is part of the response cache key
+    start = time.perf_counter()
+    greedy = reasoner.process_reasoning("Evaluate qSOFA for patient 2003", criteria_key="qSOFA", deterministic=True)
+    check("deterministic turn waits for the record", RECORD_HEADER in model.prompts[-1] and greedy["patient_record"] is True
+          and time.perf_counter() - start >= 0.3, model.prompts[-1])
+    generations = len(model.prompts)
+    repeat = reasoner.process_reasoning("Evaluate qSOFA for patient 2003", criteria_key="qSOFA", deterministic=True)
+    check("repeated deterministic turn served from the response cache", len(model.prompts) == generations
+          and repeat.get("cached") is True, str(repeat.keys()))
+    import app.reasoner
+    wait = app.reasoner.PATIENT_PREFETCH_WAIT_SECONDS
+    app.reasoner.PATIENT_PREFETCH_WAIT_SECONDS = 0
+    patient_prefetcher.invalidate()
+    late = reasoner.process_reasoning("Evaluate qSOFA for patient 2003", criteria_key="qSOFA", deterministic=True)
+    app.reasoner.PATIENT_PREFETCH_WAIT_SECONDS = wait
+    check("turn without the record not served the response made with it", len(model.prompts) == generations + 1
+          and RECORD_HEADER not in model.prompts[-1] and not late.get("cached"), str(late.keys()))
+
+    return finish("patient prefetch")
+
+
+def test_patient_prefetch():
+    run_script(__file__)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+"""
+Check incremental re-scoring: watermarks, dirty admissions, the changes feed and
+full re-scoring after a rule change, against temporary SQLite databases.
+
+Usage:
+    python test_rescoring.py
+"""
+import os
+import sys
+import sqlite3
+import subprocess
+
+from testing_utils import check, finish, prepare_environment, run_script
+
+work_dir = prepare_environment("rescoring_test_", files={"SCORE_STORE_PATH": "scores.sqlite",
+                                                          "CRITERIA_STORE_PATH": "criteria.sqlite"})
+db_path = os.path.join(work_dir, "mimic.db")
+
+from app.rescoring import rescoring_pipeline
+from app.criteria import add_custom_criteria
+
+
+def main() -> int:
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""
+        CREATE TABLE chartevents (subject_id INTEGER, hadm_id INTEGER, itemid INTEGER, valuenum REAL, charttime TEXT);
+        CREATE TABLE labevents (subject_id INTEGER, hadm_id INTEGER, itemid INTEGER, valuenum REAL, charttime TEXT);
+    """)
+    day1, day3 = "2150-01-01 08:00:00", "2150-01-03 08:00:00"
+    # 50 admissions with normal vitals; admission 3000 already has a low blood pressure
+    for h in range(3000, 3050):
+        conn.executemany("INSERT INTO chartevents VALUES (?, ?, ?, ?, ?)", [
+            (h, h, 220210, 16, day1), (h, h, 220179, 95 if h == 3000 else 120, day1), (h, h, 223900, 5, day1),
+            (h, h, 220045, 80, day1), (h, h, 223762, 37.0, day1), (h, h, 220277, 98, day1),  # SpO2 is not a rule measurement
+        ])
+        conn.execute("INSERT INTO labevents VALUES (?, ?, 51301, 8.0, ?)", (h, h, day1))
+    conn.commit()
+
+    print("Testing incremental re-scoring...")
+
+    # 1. First sync scores the whole cohort
+    stats = rescoring_pipeline.sync(db_path)
+    check("first sync reads every measurement row", stats["rows_read"] == {"chartevents": 250, "labevents": 50}, str(stats["rows_read"]))
+    check("first sync scores every admission per criteria set", stats["rescored"] == 100 and stats["flipped"] == 0, str(stats))
+    check("watermarks recorded", rescoring_pipeline.get_state()["watermarks"] == {"chartevents": 300, "labevents": 50})
+
+    # 2. Nothing new: nothing to do
+    stats = rescoring_pipeline.sync(db_path)
+    check("sync without new rows re-scores nothing", stats["rescored"] == 0 and stats["admissions_touched"] == 0)
+
+    # 3. New rows for two admissions: only those are re-scored
+    conn.executemany("INSERT INTO chartevents VALUES (?, ?, ?, ?, ?)", [
+        (3000, 3000, 220210, 26, day1),   # RR 26 with SBP 95 on the same day: qSOFA flips to positive
+        (3001, 3001, 220045, 85, day1),   # still normal
+    ])
+    conn.commit()
+    stats = rescoring_pipeline.sync(db_path)
+    check("only new rows are read", stats["rows_read"] == {"chartevents": 2, "labevents": 0}, str(stats["rows_read"]))
+    check("only touched admissions are re-scored", stats["admissions_touched"] == 2 and stats["rescored"] == 4, str(stats))
+    feed = rescoring_pipeline.changes()
+    check("flip appears in the changes feed",
+          [(c["criteria_key"], c["hadm_id"], c["previous"], c["decision"]) for c in feed["changes"]]
+          == [("qSOFA", 3000, "negative", "positive")], str(feed))
+    check("ranges keep the worst values", rescoring_pipeline.get_scores(3000)["measurements"]["resp_rate"] == {"min": 16, "max": 26})
+
+    # 4. Rows posted directly, with unit conversion (102.2 °F = 39 °C)
+    stats = rescoring_pipeline.ingest([
+        {"hadm_id": 3002, "itemid": 223761, "valuenum": 102.2, "charttime": day1},
+        {"hadm_id": 3002, "itemid": 220045, "valuenum": 112, "charttime": day1},
+        {"hadm_id": 3002, "itemid": 220277, "valuenum": 91, "charttime": day1},
+        # A high respiratory rate two days in, and a low blood pressure without a time: not met together
+        {"hadm_id": 3005, "itemid": 220210, "valuenum": 26, "charttime": day3},
+        {"hadm_id": 3005, "itemid": 220179, "valuenum": 95},
+    ])
+    check("posted rows re-score their admissions", stats["admissions_touched"] == 2 and stats["rescored"] == 4, str(stats))
+    feed = rescoring_pipeline.changes(since=feed["next"])
+    check("feed continues from the cursor",
+          sorted((c["criteria_key"], c["hadm_id"], c["decision"]) for c in feed["changes"])
+          == [("SIRS", 3002, "positive"), ("qSOFA", 3005, "indeterminate")], str(feed))
+    qsofa = rescoring_pipeline.get_scores(3005)["scores"]["qSOFA"]
+    check("criteria met in different time windows are not positive", qsofa["decision"] == "indeterminate" and qsofa["met"] == 2, str(qsofa))
+    check("feed filtered by criteria", rescoring_pipeline.changes(criteria_key="SIRS")["changes"][0]["hadm_id"] == 3002)
+
+    # 5. A new criteria set, and a new version of it, are scored in full once
+    add_custom_criteria("tachy", "Tachycardia", "Heart rate", ["- HR > 100"], "", rules=["heart_rate > 100"])
+    stats = rescoring_pipeline.rescore()
+    check("new criteria set scored for every admission", stats["full_rescore"] == ["tachy"] and stats["rescored"] == 50, str(stats))
+    add_custom_criteria("tachy", "Tachycardia", "Heart rate", ["- HR > 84"], "", rules=["heart_rate > 84"])
+    stats = rescoring_pipeline.rescore()
+    check("changed rules trigger a full re-score", stats["full_rescore"] == ["tachy"] and stats["flipped"] == 1, str(stats))
+    check("next run is incremental again", rescoring_pipeline.rescore()["rescored"] == 0)
+
+    # 6. The state survives a restart: a new process resumes from the watermarks
+    conn.execute("INSERT INTO labevents VALUES (3003, 3003, 51301, 15.0, '2150-01-01 09:00:00')")
+    conn.commit()
+    output = subprocess.run(
+        [sys.executable, "-c", f"from app.rescoring import rescoring_pipeline\nprint(rescoring_pipeline.sync({db_path!r}))"],
+        capture_output=True, text=True, env=os.environ
+    ).stdout
+    check("restarted pipeline reads only the new row", "'rows_read': {'chartevents': 0, 'labevents': 1}" in output, output)
+
+    conn.close()
+
+    return finish("re-scoring")
+
+
+def test_rescoring():
+    run_script(__file__)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""
+Check deterministic mode and the persistent response cache of LocalReasonerModel,
+using a stand-in model so nothing is downloaded or loaded.
+
+Usage:
+    python test_response_cache.py
+"""
+import sys
+
+from testing_utils import check, finish, prepare_environment, run_script
+
+# Keep the cache of this test away from the real one, before the app reads its config
+prepare_environment("response_cache_test_", files={"RESPONSE_CACHE_PATH": "responses.sqlite"},
+                    RESPONSE_CACHE_MAX_ENTRIES="3")
+
+from app.reasoner import LocalReasonerModel
+from app.history import HistoryManager
+from app.response_cache import response_cache
+from app.section_parser import parse_sections
+from app.criteria import add_custom_criteria, set_active_criteria, delete_custom_criteria
+
+
+class FakeModel:
+    """Answers every prompt the same way and records the decoding parameters it was called with"""
+    key = ("fake/model", "transformers", "fp32")
+    backend = "transformers"
+
+    def __init__(self):
+        self.calls = []
+
+    def _result(self, messages):
+        text = f"<think>Assessing {messages[-1]['content']}</think><answer>qSOFA 2</answer>"
+        return {"text": text, "backend": self.backend, "num_tokens": 12, "stopped_on": "</answer>", "tokens_saved": 0}
+
+    def generate(self, messages, **kwargs):
+        self.calls.append(kwargs)
+        return self._result(messages)
+
+    def stream_generate(self, messages, **kwargs):
+        self.calls.append(kwargs)
+        result = self._result(messages)
+        yield {"delta": result["text"]}
+        yield result
+
+    def extract_sections(self, text):
+        return parse_sections(text)
+
+    def count_tokens(self, text):
+        return len(text.split())
+
+
+def main() -> int:
+    reasoner = LocalReasonerModel.__new__(LocalReasonerModel)
+    reasoner.model_handler = FakeModel()
+    reasoner.history_manager = HistoryManager(reasoner.model_handler.count_tokens)
+    calls = reasoner.model_handler.calls
+    prompt = "Evaluate qSOFA for patient 12345"
+
+    print("Testing deterministic mode and the response cache...")
+
+    # 1. Sampling mode never uses the cache
+    reasoner.process_reasoning(prompt, deterministic=False)
+    reasoner.process_reasoning(prompt, deterministic=False)
+    check("sampling mode generates every time", len(calls) == 2 and calls[0]["temperature"] > 0)
+
+    # 2. Deterministic mode decodes greedily and serves repeats from the cache
+    calls.clear()
+    first = reasoner.process_reasoning(prompt, deterministic=True)
+    second = reasoner.process_reasoning(" Evaluate  qSOFA for patient 12345 ", deterministic=True)
+    check("deterministic mode decodes greedily", calls and calls[0]["temperature"] == 0.0)
+    check("repeat assessment served from the cache", len(calls) == 1 and second["cached"] and not first["cached"])
+    check("cached response is identical", first["full_response"] == second["full_response"] and first["answer"] == second["answer"])
+
+    # 3. Streaming uses the same cache
+    events = list(reasoner.stream_reasoning(prompt, deterministic=True))
+    streamed = events[-1][1]
+    check("streamed repeat served from the cache", len(calls) == 1 and streamed["cached"])
+    check("cached stream still yields sections", any(kind == "section" for kind, _ in events))
+
+    # 4. A different conversation prefix is a different entry
+    history = [{"role": "user", "content": prompt}, {"role": "assistant", "content": first["full_response"]}]
+    reasoner.process_reasoning("Respiratory rate is 24", history, deterministic=True)
+    check("continuation with a new prefix generates", len(calls) == 2)
+
+    # 5. Changing a criteria definition invalidates its entries
+    add_custom_criteria("ward", "Ward score", "Test criteria", ["- Heart rate >90/min"], "≥1 => alert")
+    set_active_criteria("ward")
+    reasoner.process_reasoning(prompt, deterministic=True)
+    reasoner.process_reasoning(prompt, deterministic=True)
+    check("entries are per criteria", len(calls) == 3)
+    invalidations = response_cache.invalidations
+    add_custom_criteria("ward", "Ward score", "Test criteria", ["- Heart rate >100/min"], "≥1 => alert")
+    check("redefined criteria drop their cached responses", response_cache.invalidations == invalidations + 1)
+    reasoner.process_reasoning(prompt, deterministic=True)
+    check("redefined criteria generate again", len(calls) == 4)
+    delete_custom_criteria("ward")
+
+    # 6. The cache is bounded and evicts the least recently used entries
+    for i in range(5):
+        reasoner.process_reasoning(f"Evaluate qSOFA for patient {i}", deterministic=True)
+    state = response_cache.get_state()
+    check("cache stays within its size limit", state["entries"] == 3, f"(entries {state['entries']})")
+    check("least recently used entries evicted", state["evictions"] > 0)
+
+    # 7. Entries survive a restart
+    response_cache._conn.close()
+    response_cache._conn = None
+    calls.clear()
+    reasoner.process_reasoning("Evaluate qSOFA for patient 4", deterministic=True)
+    check("cache persists across restarts", len(calls) == 0)
+
+    print(f"\nResponse cache state: {response_cache.get_state()}")
+
+    return finish("response cache")
+
+
+def test_response_cache():
+    run_script(__file__)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+"""
+Check the criteria rule compiler, vectorized cohort scoring per charttime window and the
+rule pre-check before the model, against a small temporary SQLite database and a
+stand-in model.
+
+Usage:
+    python test_rule_scoring.py
+"""
+import os
+import sys
+import sqlite3
+
+from testing_utils import check, finish, prepare_environment, run_script
+
+prepare_environment("rules_test_", files={"MIMIC_DB_PATH": "mimic.db"}, RULE_PRECHECK="true")
+
+import pandas as pd
+
+from app.rules import Rule, RuleError, compile_rules, load_measurements, admission_ranges, score_rows
+from app.criteria import add_custom_criteria, get_compiled_criteria
+from app.reasoner import LocalReasonerModel
+from app.history import HistoryManager
+from app.section_parser import parse_sections
+
+
+def main() -> int:
+    print("Testing rule scoring...")
+
+    # 1. Compiling rules
+    qsofa = get_compiled_criteria("qSOFA").rule_set
+    check("default criteria compile to rules", qsofa is not None and qsofa.min_met == 2 and len(qsofa.rules) == 3)
+    check("criteria without rules have no rule set", get_compiled_criteria("Sepsis-3").rule_set is None)
+    check("alternatives parsed", len(Rule("wbc > 12 or wbc < 4 or bands > 10").comparisons) == 3)
+    for bad in ("resp_rate >> 22", "lactate > 2", "sbp <= high"):
+        try:
+            Rule(bad)
+            check(f"invalid rule '{bad}' rejected", False)
+        except RuleError:
+            check(f"invalid rule '{bad}' rejected", True)
+    check("threshold 'All criteria met' needs every rule",
+          compile_rules({"name": "x", "threshold": "All criteria met", "rules": ["sbp < 90", "heart_rate > 100"]}).min_met == 2)
+    try:
+        add_custom_criteria("shock", "Shock", "x", ["- SBP < 90"], "≥2 => shock", rules=["sbp < 90"])
+        check("threshold above the rule count rejected", False)
+    except RuleError:
+        check("threshold above the rule count rejected", True)
+
+    # 2. Vectorized scoring with missing measurements
+    patients = pd.DataFrame({
+        "resp_rate": [24, 18, 25, None, 16],
+        "sbp": [95, 120, 130, 90, None],
+        "gcs_verbal": [5, 5, None, 3, None],
+    }, index=pd.Index([1, 2, 3, 4, 5], name="hadm_id"))
+    scores = qsofa.score(patients)
+    check("decisions account for unknown measurements",
+          list(scores["decision"]) == ["positive", "negative", "indeterminate", "positive", "indeterminate"],
+          f"(got {list(scores['decision'])})")
+    check("unknown rules counted", list(scores["unknown"]) == [0, 0, 1, 1, 2])
+    rows = score_rows(qsofa, scores)
+    check("rows are JSON-ready", rows[2]["criteria"] == {"resp_rate >= 22": True, "sbp <= 100": False, "gcs_verbal < 5": None}
+          and type(rows[0]["hadm_id"]) is int)
+
+    # 3. Measurements from the MIMIC tables: worst value per admission and day, Fahrenheit converted
+    conn = sqlite3.connect(os.environ["MIMIC_DB_PATH"])
+    conn.executescript("""
+        CREATE TABLE chartevents (subject_id INTEGER, hadm_id INTEGER, itemid INTEGER, valuenum REAL, charttime TEXT);
+        CREATE TABLE labevents (subject_id INTEGER, hadm_id INTEGER, itemid INTEGER, valuenum REAL, charttime TEXT);
+    """)
+    day1, day3 = "2150-01-01 08:00:00", "2150-01-03 20:00:00"
+    conn.executemany("INSERT INTO chartevents VALUES (?, ?, ?, ?, ?)", [
+        (100, 2000, 220210, 18, day1), (100, 2000, 220210, 26, day1), (100, 2000, 220179, 96, day1), (100, 2000, 223900, 5, day1),
+        (101, 2001, 220210, 16, day1), (101, 2001, 220179, 125, day1), (101, 2001, 223900, 5, day1), (101, 2001, 223761, 102.2, day1),
+        (102, 2002, 220210, 23, day1),
+        # High respiratory rate and low blood pressure two days apart
+        (104, 2004, 220210, 26, day1), (104, 2004, 220179, 96, day3), (104, 2004, 223900, 5, day1),
+        (104, 2004, 220179, 120, day1), (104, 2004, 220210, 16, day3),
+    ])
+    conn.executemany("INSERT INTO labevents VALUES (?, ?, ?, ?, ?)", [(101, 2001, 51301, 13.5, day1)])
+    conn.commit()
+    measurements = load_measurements(conn, [2000, 2001, 2002, 2003, 2004])
+    ranges = admission_ranges(measurements)
+    check("one row per admission and day", len(measurements.loc[2004]) == 2 and len(measurements.loc[2000]) == 1)
+    check("worst values loaded per admission", ranges.loc[2000, "resp_rate_max"] == 26 and ranges.loc[2000, "resp_rate_min"] == 18)
+    check("Fahrenheit converted to Celsius", abs(ranges.loc[2001, "temperature_max"] - 39.0) < 1e-9)
+    check("admissions without data are kept", 2003 in ranges.index and ranges.loc[2003].isna().all())
+    cohort = qsofa.score_admissions(measurements)
+    check("cohort scored in one pass", list(cohort.index) == [2000, 2001, 2002, 2003, 2004]
+          and list(cohort["decision"]) == ["positive", "negative", "indeterminate", "indeterminate", "indeterminate"],
+          f"(got {list(cohort['decision'])})")
+    check("criteria met days apart are not met together", cohort.loc[2004, "met"] == 2
+          and "not within one time window" in qsofa.describe(cohort.loc[2004]), qsofa.describe(cohort.loc[2004]))
+    whole_stay = qsofa.score_admissions(load_measurements(conn, [2004], window_hours=0))
+    check("window of 0 scores the whole admission", whole_stay.loc[2004, "decision"] == "positive")
+    sirs = get_compiled_criteria("SIRS").rule_set.score_admissions(measurements)
+    check("labs and vitals combine", sirs.loc[2001, "decision"] == "positive")
+    conn.close()
+
+
+    # 4. Pre-check before the model
+    class FakeModel:
+        key = ("fake/model", "transformers", "fp32")
+        backend = "transformers"
+        calls = 0
+
+        def generate(self, messages, **kwargs):
+            FakeModel.calls += 1
+            return {"text": "<think>Reasoning</think><answer>model answer</answer>", "backend": self.backend,
+                    "num_tokens": 8, "stopped_on": "</answer>", "tokens_saved": 0}
+
+        def extract_sections(self, text):
+            return parse_sections(text)
+
+        def count_tokens(self, text):
+            return len(text.split())
+
+
+    reasoner = LocalReasonerModel.__new__(LocalReasonerModel)
+    reasoner.model_handler = FakeModel()
+    reasoner.history_manager = HistoryManager(reasoner.model_handler.count_tokens)
+    result = reasoner.process_reasoning("Evaluate qSOFA for admission=2000.", criteria_key="qSOFA")
+    check("decided case answered without the model",
+          FakeModel.calls == 0 and result["rule_based"] and result["answer"].startswith("qSOFA positive"), result["answer"])
+    result = reasoner.process_reasoning("Evaluate qSOFA for admission=2001.", criteria_key="qSOFA")
+    check("ruled-out case answered without the model",
+          FakeModel.calls == 0 and result["rule_based"] and result["answer"].startswith("qSOFA negative"), result["answer"])
+    result = reasoner.process_reasoning("Evaluate qSOFA for admission=2002.", criteria_key="qSOFA")
+    check("undecided case goes to the model", FakeModel.calls == 1 and not result["rule_based"])
+    result = reasoner.process_reasoning("Evaluate qSOFA for admission=2004.", criteria_key="qSOFA")
+    check("criteria met days apart go to the model", FakeModel.calls == 2 and not result["rule_based"])
+    reasoner.process_reasoning("Evaluate Sepsis-3 for admission=2000.", criteria_key="Sepsis-3")
+    check("criteria without rules go to the model", FakeModel.calls == 3)
+
+    # 5. Several criteria sets for one patient are scored from one load of the measurements
+    import app.reasoner
+    loads = []
+    _load = app.reasoner.load_patient_measurements
+    app.reasoner.load_patient_measurements = lambda db_path, patient_id: loads.append(patient_id) or _load(db_path, patient_id)
+    multi = reasoner.process_multi_criteria("Evaluate admission=2001.", ["qSOFA", "SIRS"])
+    app.reasoner.load_patient_measurements = _load
+    check("measurements loaded once for every criteria set", loads == ["2001"] and FakeModel.calls == 3
+          and [r.get("rule_based") for r in multi["results"]] == [True, True], f"{loads} {multi['results']}")
+
+    return finish("rule scoring")
+
+
+def test_rule_scoring():
+    run_script(__file__)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+"""
+Check the vectorized timeline builder and the per-admission timeline cache against a
+temporary MIMIC-style SQLite database.
+
+Usage:
+    python test_timelines.py
+"""
+import os
+import sys
+import sqlite3
+
+from testing_utils import check, finish, prepare_environment, run_script
+
+prepare_environment("timelines_test_", files={"MIMIC_DB_PATH": "mimic.db"}, TIMELINE_PARQUET_PATH="")
+db_path = os.environ["MIMIC_DB_PATH"]
+
+import pandas as pd
+
+from app.timelines import build_timelines, timeline_cache
+
+
+def main() -> int:
+    print("Testing timeline building...")
+
+    # 1. Same shape as the notebook's group_hadm_item_js, from rows in any order
+    events = pd.DataFrame([
+        (2, "2150-01-02 08:00:00", "Lactate", 1.1, None),
+        (1, "2150-01-01 12:00:00", "Lactate", 4.2, "abnormal"),
+        (1, "2150-01-01 06:00:00", "Lactate", 2.0, None),
+        (1, "2150-01-01 06:00:00", "White Blood Cells", 13.5, "abnormal"),
+        (1, "2150-01-01 06:00:00", "Lactate", 2.2, None),  # later row for the same time and label wins
+    ], columns=["hadm_id", "charttime", "label", "value", "flag"])
+    timelines = build_timelines(events)
+    check("one timeline per admission", sorted(timelines) == [1, 2])
+    check("flags appended like the notebook", timelines[1] == {
+        "2150-01-01 06:00:00": {"Lactate": 2.2, "White Blood Cells": "13.5 - abnormal"},
+        "2150-01-01 12:00:00": {"Lactate": "4.2 - abnormal"},
+    }, str(timelines[1]))
+    check("timestamps in chronological order", list(timelines[1]) == ["2150-01-01 06:00:00", "2150-01-01 12:00:00"])
+    check("empty input gives no timelines", build_timelines(events.iloc[:0]) == {})
+    undated = pd.concat([events, pd.DataFrame([(1, None, "Lactate", 9.9, None), (3, None, "Lactate", 1.0, None)],
+                                              columns=events.columns)], ignore_index=True)
+    timelines = build_timelines(undated)
+    check("rows without a charttime dropped", sorted(timelines) == [1, 2]
+          and timelines[1]["2150-01-01 12:00:00"] == {"Lactate": "4.2 - abnormal"}, str(timelines))
+    check("only undated rows give no timelines", build_timelines(undated.iloc[-1:]) == {})
+
+    # 2. Units are appended when present
+    with_units = events.assign(unit=["mmol/L", "mmol/L", None, "K/uL", ""])
+    timelines = build_timelines(with_units)
+    check("units appended before flags", timelines[1]["2150-01-01 12:00:00"]["Lactate"] == "4.2 mmol/L - abnormal"
+          and timelines[1]["2150-01-01 06:00:00"]["White Blood Cells"] == "13.5 K/uL - abnormal", str(timelines[1]))
+    check("missing or empty unit leaves the value as is", timelines[1]["2150-01-01 06:00:00"]["Lactate"] == 2.2)
+
+    # 3. Loaded from SQLite and cached per admission
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""
+        CREATE TABLE d_labitems (itemid INTEGER, label TEXT);
+        CREATE TABLE labevents (hadm_id INTEGER, itemid INTEGER, charttime TEXT, value TEXT, valueuom TEXT, flag TEXT);
+        CREATE TABLE d_items (itemid INTEGER, label TEXT);
+        CREATE TABLE chartevents (hadm_id INTEGER, itemid INTEGER, charttime TEXT, value TEXT, valueuom TEXT);
+        INSERT INTO d_labitems VALUES (50813, 'Lactate'), (51301, 'White Blood Cells');
+        INSERT INTO d_items VALUES (220045, 'Heart Rate');
+        INSERT INTO labevents VALUES
+            (100, 50813, '2150-01-01 06:00:00', '2.0', 'mmol/L', NULL),
+            (100, 51301, '2150-01-01 06:00:00', '13.5', 'K/uL', 'abnormal'),
+            (101, 50813, '2150-02-01 10:30:00', '1.0', 'mmol/L', NULL);
+        INSERT INTO chartevents VALUES (100, 220045, '2150-01-01 07:00:00', '112', 'bpm');
+    """)
+    conn.commit()
+
+    labs = timeline_cache.get([100, 101, 102], "lab")
+    check("admissions loaded in one query", timeline_cache.get_state()["loads"] == 1)
+    check("lab timeline from SQLite", labs[100] == {"2150-01-01 06:00:00": {"Lactate": "2.0 mmol/L", "White Blood Cells": "13.5 K/uL - abnormal"}}, str(labs[100]))
+    check("admission without events gets an empty timeline", labs[102] == {})
+    charts = timeline_cache.get([100], "chart")
+    check("chart timeline from SQLite", charts[100] == {"2150-01-01 07:00:00": {"Heart Rate": "112 bpm"}}, str(charts[100]))
+
+    state = timeline_cache.get_state()
+    timeline_cache.get([101, 100], "lab")
+    check("cached admissions are not reloaded", timeline_cache.get_state()["loads"] == state["loads"]
+          and timeline_cache.get_state()["hits"] == state["hits"] + 2)
+
+    conn.execute("INSERT INTO labevents VALUES (101, 50813, '2150-02-01 16:00:00', '3.1', 'mmol/L', 'abnormal')")
+    conn.commit()
+    check("stale until invalidated", len(timeline_cache.get([101])[101]) == 1)
+    check("invalidate drops every kind of an admission", timeline_cache.invalidate([101]) == 1)
+    check("reloaded after invalidation", timeline_cache.get([101])[101]["2150-02-01 16:00:00"] == {"Lactate": "3.1 mmol/L - abnormal"})
+
+    try:
+        timeline_cache.get([100], "notes")
+        check("unknown kind rejected", False)
+    except ValueError:
+        check("unknown kind rejected", True)
+
+    conn.close()
+
+    return finish("timeline")
+
+
+def test_timelines():
+    run_script(__file__)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
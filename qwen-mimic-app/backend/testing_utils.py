@@ -0,0 +1,77 @@
+"""
+Helpers shared by the test scripts in this directory.
+
+The app reads its configuration from environment variables once, when app.config is
+first imported, so each script sets them with prepare_environment() before importing
+anything from app and runs in a process of its own. Run a script directly:
+
+    python test_history.py
+
+or let pytest collect them all; each script's test function runs it in a subprocess:
+
+    python -m pytest -q
+"""
+import os
+import sys
+import tempfile
+import subprocess
+from typing import Dict, Optional
+
+# The environment before any script changed it, passed on to the scripts pytest runs
+_base_environment = dict(os.environ)
+
+# Stores a test run must not share with the server: kept in memory unless a script sets a path
+DEFAULT_ENVIRONMENT = {
+    "RESPONSE_CACHE_PATH": "",
+    "CRITERIA_STORE_PATH": "",
+    "SCORE_STORE_PATH": "",
+}
+
+failures = 0
+
+
+def check(name: str, condition: bool, detail: str = ""):
+    """Print the outcome of one check and count it if it failed"""
+    global failures
+    if condition:
+        print(f"✅ {name}")
+    else:
+        failures += 1
+        print(f"❌ {name} {detail}")
+
+
+def prepare_environment(prefix: str, files: Optional[Dict[str, str]] = None, **settings: str) -> str:
+    """
+    Configure the app for a test run. Call before importing anything from app.
+
+    Args:
+        prefix: Prefix of the temporary work directory
+        files: Settings naming a file in the work directory, e.g. {"MIMIC_DB_PATH": "mimic.db"}
+        **settings: Other settings, overriding DEFAULT_ENVIRONMENT
+
+    Returns:
+        The temporary work directory
+    """
+    work_dir = tempfile.mkdtemp(prefix=prefix)
+    os.environ.update(DEFAULT_ENVIRONMENT)
+    os.environ.update({name: os.path.join(work_dir, file_name) for name, file_name in (files or {}).items()})
+    os.environ.update(settings)
+    return work_dir
+
+
+def finish(name: str) -> int:
+    """Print the summary of a script's checks and return its exit status"""
+    if failures:
+        print(f"❌ {failures} check(s) failed")
+        return 1
+    print(f"All {name} checks passed!")
+    return 0
+
+
+def run_script(path: str):
+    """Run a test script in a process of its own and fail with its output if a check failed"""
+    result = subprocess.run(
+        [sys.executable, os.path.basename(path)], cwd=os.path.dirname(os.path.abspath(path)),
+        capture_output=True, text=True, env=_base_environment
+    )
+    assert result.returncode == 0, f"{result.stdout}\n{result.stderr[-4000:]}"
@@ -5,6 +5,9 @@ const QUERY_URL = `${BASE_URL}/query`;
 const DIAGNOSE_URL = `${BASE_URL}/diagnose`;
 const PROVIDE_INFO_URL = `${BASE_URL}/provide_info`;
 
+// Server-side session of the current diagnosis; follow-up turns only send the new input
+let currentSessionId = null;
+
 // Configure axios with longer timeout and retry capability
 const apiClient = axios.create({
     baseURL: BASE_URL,
@@ -94,6 +97,12 @@ export const startDiagnosis = async (query) => {
                         if (progressCallback) {
                             progressCallback(data.content);
                         }
+                    } else if (data.type === 'session') {
+                        currentSessionId = data.content;
+                        result.session_id = data.content;
+                    } else if (data.type === 'conversation_delta') {
+                        // Session-based turns only carry the messages they added
+                        result.conversation_history = [...result.conversation_history, ...data.content];
                     } else if (data.type === 'conversation') {
                         // This handles conversation history updates from the server
                         result.conversation_history = data.content;
@@ -198,9 +207,22 @@ export const provideInfo = async (userResponse, conversationHistory) => {
             // Send the POST request containing both the user response and conversation history
             console.log(`Sending POST request to ${PROVIDE_INFO_URL} with ${history.length} messages`);
             
-            apiClient.post(PROVIDE_INFO_URL, {
-                user_response: userResponse,
-                conversation_history: history
+            const payload = currentSessionId
+                ? { user_response: userResponse, session_id: currentSessionId }
+                : { user_response: userResponse, conversation_history: history };
+            
+            apiClient.post(PROVIDE_INFO_URL, payload)
+            .catch(error => {
+                // Session expired on the server - fall back to sending the full history
+                if (currentSessionId && error.response && error.response.status === 404) {
+                    console.log("Session expired, resending full conversation history");
+                    currentSessionId = null;
+                    return apiClient.post(PROVIDE_INFO_URL, {
+                        user_response: userResponse,
+                        conversation_history: history
+                    });
+                }
+                throw error;
             })
             .then(response => {
                 console.log("Successfully received provide_info response");
@@ -216,7 +238,9 @@ export const provideInfo = async (userResponse, conversationHistory) => {
                     answer: responseData.answer || "",
                     full_response: responseData.full_response || "",
                     conversation_history: Array.isArray(responseData.conversation_history) ? 
-                        responseData.conversation_history : history,
+                        responseData.conversation_history :
+                        Array.isArray(responseData.conversation_delta) ?
+                            [...history, ...responseData.conversation_delta] : history,
                     model_progress: []
                 };
                 